@@ -0,0 +1,79 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion, Throughput};
+use mumei_rust::*;
+use mumei_rust::array::{self, NumArray};
+use mumei_rust::value::Value;
+
+const N: usize = 100_000;
+
+/// 数値配列の集計と要素ごとの演算
+const ARRAY_SCRIPT: &str = r#"
+let xs = array(range(0, 100000))
+let ys = xs * 2 + 1
+sum(ys) + dot(xs, ys) + max(ys)
+"#;
+
+/// 同じ計算をリストとループで書いた形（比較用）
+const LIST_SCRIPT: &str = r#"
+fun run(xs) {
+    let total = 0
+    let product = 0
+    let largest = 0
+    for (x in xs) {
+        let y = x * 2 + 1
+        total = total + y
+        product = product + x * y
+        largest = max(largest, y)
+    }
+    return total + product + largest
+}
+run(list(range(0, 100000)))
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_kernels(c: &mut Criterion) {
+    // 連続した f64 とタグ付きの Value の並びを同じ処理で比べる
+    let numbers: Vec<f64> = (0..N).map(|i| i as f64).collect();
+    let values: Vec<Value> = numbers.iter().map(|&n| Value::Number(n)).collect();
+    let a = NumArray::new(numbers.clone());
+
+    let mut group = c.benchmark_group("array_kernels");
+    group.throughput(Throughput::Elements(N as u64));
+    group.bench_function("sum_array", |b| b.iter(|| black_box(array::sum(black_box(a.as_slice())))));
+    group.bench_function("sum_value_list", |b| {
+        b.iter(|| {
+            black_box(values.iter().fold(0.0, |acc, v| match v {
+                Value::Number(n) => acc + n,
+                _ => acc,
+            }))
+        })
+    });
+    group.bench_function("dot_array", |b| b.iter(|| black_box(array::dot(a.as_slice(), a.as_slice()))));
+    group.bench_function("max_array", |b| b.iter(|| black_box(array::max(a.as_slice()))));
+    group.bench_function("scale_array", |b| b.iter(|| black_box(array::map(&a, |x| x * 2.0 + 1.0))));
+    group.bench_function("scale_value_list", |b| {
+        b.iter(|| {
+            black_box(values.iter().map(|v| v.multiply(&Value::Number(2.0))?.add(&Value::Number(1.0))).collect::<Result<Vec<_>, _>>())
+        })
+    });
+    group.finish();
+}
+
+fn bench_scripts(c: &mut Criterion) {
+    for (name, source) in [("array_script", ARRAY_SCRIPT), ("list_script", LIST_SCRIPT)] {
+        let bytecode = compiler::Compiler::new().compile(parse(source)).unwrap();
+        c.bench_function(&format!("vm_{}", name), |b| {
+            b.iter(|| {
+                let mut vm = vm::VM::new();
+                builtins::setup_vm_builtins(&mut vm);
+                black_box(vm.execute(bytecode.clone()).unwrap());
+            })
+        });
+    }
+}
+
+criterion_group!(benches, bench_kernels, bench_scripts);
+criterion_main!(benches);
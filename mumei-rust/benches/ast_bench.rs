@@ -0,0 +1,122 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::*;
+use std::alloc::{GlobalAlloc, Layout, System};
+use std::sync::atomic::{AtomicUsize, Ordering};
+
+/// 確保中のバイト数を数えるアロケータ（構文木が保持するメモリの計測用）
+struct CountingAllocator;
+
+static ALLOCATED: AtomicUsize = AtomicUsize::new(0);
+
+unsafe impl GlobalAlloc for CountingAllocator {
+    unsafe fn alloc(&self, layout: Layout) -> *mut u8 {
+        ALLOCATED.fetch_add(layout.size(), Ordering::Relaxed);
+        System.alloc(layout)
+    }
+
+    unsafe fn dealloc(&self, ptr: *mut u8, layout: Layout) {
+        ALLOCATED.fetch_sub(layout.size(), Ordering::Relaxed);
+        System.dealloc(ptr, layout)
+    }
+
+    unsafe fn realloc(&self, ptr: *mut u8, layout: Layout, new_size: usize) -> *mut u8 {
+        ALLOCATED.fetch_add(new_size, Ordering::Relaxed);
+        ALLOCATED.fetch_sub(layout.size(), Ordering::Relaxed);
+        System.realloc(ptr, layout, new_size)
+    }
+}
+
+#[global_allocator]
+static GLOBAL: CountingAllocator = CountingAllocator;
+
+fn parse(source: &str) -> Option<ast::Ast> {
+    let tokens = lexer::Lexer::new(source).tokenize().ok()?;
+    parser::Parser::new(tokens).parse().ok()
+}
+
+/// examples/ のスクリプトのうち、現在のパーサーで読めるもの
+fn load_corpus() -> Vec<(String, String)> {
+    let dir = std::path::Path::new(env!("CARGO_MANIFEST_DIR")).join("../examples");
+    let mut corpus = Vec::new();
+    if let Ok(entries) = std::fs::read_dir(&dir) {
+        for entry in entries.flatten() {
+            let path = entry.path();
+            if path.extension().map_or(false, |ext| ext == "mu") {
+                if let Ok(source) = std::fs::read_to_string(&path) {
+                    if parse(&source).is_some() {
+                        let name = path.file_name().unwrap().to_string_lossy().into_owned();
+                        corpus.push((name, source));
+                    }
+                }
+            }
+        }
+    }
+    corpus.sort();
+    corpus
+}
+
+fn bench_ast(c: &mut Criterion) {
+    let corpus = load_corpus();
+
+    // 構文木が保持するメモリ（トークン列を捨てたあとに残るバイト数）
+    let mut retained_total = 0;
+    let mut nodes_total = 0;
+    for (name, source) in &corpus {
+        let before = ALLOCATED.load(Ordering::Relaxed);
+        let ast = parse(source).unwrap();
+        let retained = ALLOCATED.load(Ordering::Relaxed) - before;
+        println!("{:<40} {:>6} nodes {:>9} bytes", name, ast.len(), retained);
+        retained_total += retained;
+        nodes_total += ast.len();
+        drop(ast);
+    }
+    println!(
+        "examples/ corpus: {} files, {} nodes, {} bytes retained by ASTs",
+        corpus.len(), nodes_total, retained_total
+    );
+
+    c.bench_function("parse_examples_corpus", |b| {
+        b.iter(|| {
+            for (_, source) in &corpus {
+                black_box(parse(source));
+            }
+        })
+    });
+
+    // 呼び出しのたびにネストした関数を宣言する（本体のASTはコピーされない）
+    let calls = parse(r#"
+fun make_handler(x) {
+    fun handler(y) {
+        let a = y + 1
+        let b = a * 2
+        let c = b - 3
+        if c > 10 {
+            c = c - 10
+        } elif c > 5 {
+            c = c - 5
+        } else {
+            c = c + 1
+        }
+        c
+    }
+    handler(x)
+}
+let i = 0
+let total = 0
+while i < 2000 {
+    total = total + make_handler(i)
+    i = i + 1
+}
+total
+"#).unwrap();
+
+    c.bench_function("interpreter_declare_and_call", |b| {
+        b.iter(|| {
+            let mut interpreter = interpreter::Interpreter::new();
+            black_box(interpreter.evaluate(calls.clone()).unwrap());
+        })
+    });
+}
+
+criterion_group!(benches, bench_ast);
+criterion_main!(benches);
@@ -0,0 +1,105 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion, Throughput};
+use mumei_rust::*;
+use mumei_rust::value::Value;
+use std::time::Duration;
+use tokio::io::{AsyncBufReadExt, AsyncReadExt, AsyncWriteExt, BufReader};
+use tokio::net::{TcpListener, TcpStream};
+
+/// 同時に送るリクエストの数
+const REQUESTS: usize = 1000;
+
+/// スタブサーバーが応答するまでの時間（リモートのサービスの応答待ちを模す）
+const LATENCY: Duration = Duration::from_millis(2);
+
+/// 1件ずつ await する（応答を待つ間は何もしない）
+const SEQUENTIAL: &str = r#"
+let total = 0
+for (i in range(0, REQUESTS)) {
+    total = total + len(await request(PORT))
+}
+total
+"#;
+
+/// async 関数をまとめて呼び出して gather で待つ（応答待ちの間にほかのリクエストを送る）
+const CONCURRENT: &str = r#"
+async fun fetch(port) {
+    let body = await request(port)
+    return len(body)
+}
+let total = 0
+for (n in await gather([fetch(PORT) for i in range(0, REQUESTS)])) {
+    total = total + n
+}
+total
+"#;
+
+/// 1行のリクエストを読んで LATENCY 後に "ok" を返すサーバーを別スレッドで起動し、そのポートを返す
+fn start_stub_server() -> u16 {
+    let (sender, receiver) = std::sync::mpsc::channel();
+    std::thread::spawn(move || {
+        let runtime = tokio::runtime::Builder::new_multi_thread().enable_all().build().unwrap();
+        runtime.block_on(async move {
+            let listener = TcpListener::bind("127.0.0.1:0").await.unwrap();
+            sender.send(listener.local_addr().unwrap().port()).unwrap();
+            loop {
+                let (stream, _) = listener.accept().await.unwrap();
+                tokio::spawn(async move {
+                    let mut reader = BufReader::new(stream);
+                    let mut line = String::new();
+                    if reader.read_line(&mut line).await.is_ok() {
+                        tokio::time::sleep(LATENCY).await;
+                        let _ = reader.get_mut().write_all(b"ok\n").await;
+                    }
+                });
+            }
+        });
+    });
+    receiver.recv().unwrap()
+}
+
+/// request(port) - スタブサーバーに1行のリクエストを送り、応答の本文を結果にするタスク
+fn request(args: Vec<Value>) -> Result<Value, String> {
+    let port = match &args[0] {
+        Value::Number(n) => *n as u16,
+        other => return Err(format!("request() requires a port number, got {}", other.type_name())),
+    };
+    Ok(Value::Task(task::spawn_native("request", async move {
+        let mut stream = TcpStream::connect(("127.0.0.1", port)).await.map_err(|e| e.to_string())?;
+        stream.write_all(b"GET /\n").await.map_err(|e| e.to_string())?;
+        let mut body = String::new();
+        stream.read_to_string(&mut body).await.map_err(|e| e.to_string())?;
+        Ok(Value::String(body.into()))
+    })))
+}
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_async(c: &mut Criterion) {
+    let port = start_stub_server();
+    let programs = [("sequential", SEQUENTIAL), ("concurrent", CONCURRENT)];
+
+    let mut group = c.benchmark_group("requests");
+    group.throughput(Throughput::Elements(REQUESTS as u64));
+    group.sample_size(10);
+    for (name, source) in programs {
+        let source = source.replace("REQUESTS", &REQUESTS.to_string()).replace("PORT", &port.to_string());
+        let bytecode = compiler::Compiler::new().compile(parse(&source)).unwrap();
+        group.bench_function(format!("vm_{}", name), |b| {
+            b.iter(|| {
+                let mut vm = vm::VM::new();
+                builtins::setup_vm_builtins(&mut vm);
+                vm.define_global("request", Value::native("request", 1, request));
+                let total = vm.execute(bytecode.clone()).unwrap();
+                assert_eq!(total, Value::Number(3.0 * REQUESTS as f64));
+                black_box(total);
+            })
+        });
+    }
+    group.finish();
+}
+
+criterion_group!(benches, bench_async);
+criterion_main!(benches);
@@ -0,0 +1,45 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::*;
+
+/// キャッシュから取り出して実行するたびにバイトコード全体を複製していたケース
+const PROGRAM: &str = r#"
+fun fib(n) {
+    if (n <= 1) {
+        return n;
+    }
+    return fib(n - 1) + fib(n - 2);
+}
+let greeting = "hello"
+let items = [1, 2, 3, 4, 5]
+fib(5)
+"#;
+
+fn bench_cache(c: &mut Criterion) {
+    let id = bytecode_cache::compile_and_cache(PROGRAM).unwrap();
+
+    c.bench_function("cache_lookup_by_source", |b| {
+        b.iter(|| black_box(cache::get_cached_bytecode(black_box(PROGRAM)).unwrap()))
+    });
+
+    c.bench_function("cache_execute_cached", |b| {
+        b.iter(|| black_box(bytecode_cache::execute_cached(id).unwrap()))
+    });
+
+    // 複数スレッドから同じキャッシュを同時に引く
+    c.bench_function("cache_lookup_4_threads", |b| {
+        b.iter(|| {
+            std::thread::scope(|scope| {
+                for _ in 0..4 {
+                    scope.spawn(|| {
+                        for _ in 0..1000 {
+                            black_box(cache::get_cached_bytecode(PROGRAM).unwrap());
+                        }
+                    });
+                }
+            })
+        })
+    });
+}
+
+criterion_group!(benches, bench_cache);
+criterion_main!(benches);
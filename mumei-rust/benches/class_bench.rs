@@ -0,0 +1,108 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::*;
+
+/// 1つのクラスのインスタンスのフィールド読み書きとメソッド呼び出し（単相のキャッシュ）
+const MONOMORPHIC: &str = r#"
+class Vec2 {
+    fun __init__(self, x, y) {
+        self.x = x
+        self.y = y
+    }
+    fun add(self, other) {
+        self.x = self.x + other.x
+        self.y = self.y + other.y
+        return self
+    }
+}
+let acc = new Vec2(0, 0)
+let step = new Vec2(1, 2)
+let i = 0
+while i < 20000 {
+    acc.add(step)
+    i = i + 1
+}
+acc.x + acc.y
+"#;
+
+/// 同じ箇所に3つのクラスのインスタンスが来る（多相のキャッシュ、メソッドは親クラスから継承）
+const POLYMORPHIC: &str = r#"
+class Shape {
+    fun __init__(self, size) {
+        self.size = size
+    }
+    fun scale(self) {
+        return 1
+    }
+    fun area(self) {
+        return self.size * self.size * self.scale()
+    }
+}
+class Square extends Shape {}
+class Circle extends Shape {
+    fun scale(self) {
+        return 3.14
+    }
+}
+let shapes = [new Shape(1), new Square(2), new Circle(3)]
+let total = 0
+let i = 0
+while i < 5000 {
+    for (shape in shapes) {
+        total = total + shape.area()
+    }
+    i = i + 1
+}
+total
+"#;
+
+/// インスタンスの作成（__init__ のフィールド追加は形の遷移をたどるだけ）
+const CONSTRUCT: &str = r#"
+class Node {
+    fun __init__(self, value, next) {
+        self.value = value
+        self.next = next
+        self.visited = false
+    }
+}
+let head = null
+let i = 0
+while i < 20000 {
+    head = new Node(i, head)
+    i = i + 1
+}
+head.value
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_classes(c: &mut Criterion) {
+    let programs = [("monomorphic", MONOMORPHIC), ("polymorphic", POLYMORPHIC), ("construct", CONSTRUCT)];
+
+    for (name, source) in programs {
+        let bytecode = compiler::Compiler::new().compile(parse(source)).unwrap();
+        c.bench_function(&format!("vm_{}", name), |b| {
+            b.iter(|| {
+                let mut vm = vm::VM::new();
+                builtins::setup_vm_builtins(&mut vm);
+                black_box(vm.execute(bytecode.clone()).unwrap());
+            })
+        });
+    }
+
+    for (name, source) in programs {
+        let ast = parse(source);
+        c.bench_function(&format!("ast_{}", name), |b| {
+            b.iter(|| {
+                let mut interpreter = interpreter::Interpreter::new();
+                builtins::setup_builtins(&*interpreter.global_env());
+                black_box(interpreter.evaluate(ast.clone()).unwrap());
+            })
+        });
+    }
+}
+
+criterion_group!(benches, bench_classes);
+criterion_main!(benches);
@@ -0,0 +1,95 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::*;
+
+/// 大きなリストリテラル（MakeList は要素をスタックからまとめて移す、ELEMENTS は 0..256 に置き換える）
+const LIST_LITERAL: &str = r#"
+let total = 0
+let i = 0
+while i < 500 {
+    let xs = [ELEMENTS]
+    total = total + len(xs)
+    i = i + 1
+}
+total
+"#;
+
+/// 辞書リテラルと添字の読み書き（MakeDict・IndexGet・IndexSet）
+const INDEXING: &str = r#"
+let grid = [0, 0, 0, 0, 0, 0, 0, 0]
+let weights = {"a": 1, "b": 2, "c": 3}
+let i = 0
+while i < 20000 {
+    let k = i % 8
+    grid[k] = grid[k] + weights["b"]
+    i = i + 1
+}
+grid[3]
+"#;
+
+/// 内包表記（結果は反復対象の要素数で確保する）
+const COMPREHENSION: &str = r#"
+let total = 0
+for (round in range(0, 50)) {
+    let squares = [x * x for x in range(0, 400)]
+    let index = {x: x + 1 for x in range(0, 100)}
+    total = total + len(squares) + index[99]
+}
+total
+"#;
+
+/// 要素ごとのループと組み込みの一括操作（extend・sort・map。map は遅延イテレータなので list で受け取る）
+const BULK_LOOP: &str = r#"
+let xs = []
+for (round in range(0, 20)) {
+    for (x in range(0, 500)) {
+        push(xs, 500 - x)
+    }
+}
+let ys = []
+for (x in xs) {
+    push(ys, abs(x))
+}
+len(ys)
+"#;
+
+const BULK_NATIVE: &str = r#"
+let xs = []
+for (round in range(0, 20)) {
+    extend(xs, range(0, 500))
+}
+reverse(xs)
+let ys = list(map(abs, xs))
+sort(ys)
+len(ys)
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_collections(c: &mut Criterion) {
+    let elements: Vec<String> = (0..256).map(|i| i.to_string()).collect();
+    let list_literal = LIST_LITERAL.replace("ELEMENTS", &elements.join(", "));
+    let programs = [
+        ("list_literal", list_literal.as_str()),
+        ("indexing", INDEXING),
+        ("comprehension", COMPREHENSION),
+        ("bulk_loop", BULK_LOOP),
+        ("bulk_native", BULK_NATIVE),
+    ];
+
+    for (name, source) in programs {
+        let bytecode = compiler::Compiler::new().compile(parse(source)).unwrap();
+        c.bench_function(&format!("vm_{}", name), |b| {
+            b.iter(|| {
+                let mut vm = vm::VM::new();
+                builtins::setup_vm_builtins(&mut vm);
+                black_box(vm.execute(bytecode.clone()).unwrap());
+            })
+        });
+    }
+}
+
+criterion_group!(benches, bench_collections);
+criterion_main!(benches);
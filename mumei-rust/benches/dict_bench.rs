@@ -0,0 +1,99 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::dict::{Dict, Key};
+use mumei_rust::value::Value;
+use mumei_rust::*;
+use std::collections::HashMap;
+
+/// 単語の出現回数を数える（文字列キーの読み出しと更新）
+const WORD_COUNT: &str = r#"
+let text = "the quick brown fox jumps over the lazy dog and the cat sat on the mat a stitch in time saves nine but the early bird catches the worm"
+let words = []
+let i = 0
+while i < 200 {
+    for (word in split(text, " ")) {
+        push(words, word)
+    }
+    i = i + 1
+}
+let counts = {w: 0 for w in words}
+for (w in words) {
+    counts[w] = counts[w] + 1
+}
+counts["the"]
+"#;
+
+/// 数値キーの度数分布（キーを文字列に変換しない）
+const NUMBER_KEYS: &str = r#"
+let histogram = {b: 0 for b in range(0, 100)}
+for (i in range(0, 20000)) {
+    let b = i % 100
+    histogram[b] = histogram[b] + 1
+}
+histogram[42]
+"#;
+
+/// 辞書リテラルと内包表記の構築（大きさが分かっているので表を作り直さない）
+const BUILD: &str = r#"
+let total = 0
+for (i in range(0, 2000)) {
+    let small = {"x": i, "y": i + 1, "z": i + 2}
+    let squares = {k: k * k for k in range(0, 16)}
+    total = total + small["y"] + squares[15]
+}
+total
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_dict_programs(c: &mut Criterion) {
+    let programs = [("word_count", WORD_COUNT), ("number_keys", NUMBER_KEYS), ("build", BUILD)];
+
+    for (name, source) in programs {
+        let ast = parse(source);
+        c.bench_function(&format!("ast_{}", name), |b| {
+            b.iter(|| {
+                let mut interpreter = interpreter::Interpreter::new();
+                builtins::setup_builtins(&*interpreter.global_env());
+                black_box(interpreter.evaluate(ast.clone()).unwrap());
+            })
+        });
+    }
+}
+
+/// 辞書そのものの比較: Dict（FxHash・型付きキー）と HashMap<String, Value>（SipHash・文字列化したキー）
+fn bench_dict_native(c: &mut Criterion) {
+    let words: Vec<Value> = (0..20000).map(|i| Value::String(format!("word{}", i % 500).into())).collect();
+    let numbers: Vec<Value> = (0..20000).map(|i| Value::Number((i % 500) as f64)).collect();
+
+    for (name, keys) in [("strings", &words), ("numbers", &numbers)] {
+        c.bench_function(&format!("dict_count_{}", name), |b| {
+            b.iter(|| {
+                let mut counts = Dict::new();
+                for key in keys {
+                    let key = Key::from_value(key).unwrap();
+                    let count = counts.get(&key).map_or(0.0, |v| v.as_number().unwrap());
+                    counts.insert(key, Value::Number(count + 1.0));
+                }
+                black_box(counts.len())
+            })
+        });
+
+        c.bench_function(&format!("hashmap_count_{}", name), |b| {
+            b.iter(|| {
+                let mut counts: HashMap<String, Value> = HashMap::new();
+                for key in keys {
+                    let key = key.to_string();
+                    let count = counts.get(&key).map_or(0.0, |v| v.as_number().unwrap());
+                    counts.insert(key, Value::Number(count + 1.0));
+                }
+                black_box(counts.len())
+            })
+        });
+    }
+}
+
+criterion_group!(benches, bench_dict_programs, bench_dict_native);
+criterion_main!(benches);
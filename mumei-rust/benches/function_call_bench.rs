@@ -0,0 +1,136 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::*;
+
+/// benchmark_optimizations.py の再帰フィボナッチ
+const FIB: &str = r#"
+fun fib(n) {
+    if (n <= 1) {
+        return n;
+    }
+    return fib(n - 1) + fib(n - 2);
+}
+fib(20)
+"#;
+
+/// 同じ計算をif式の値で返す形（return を使わない場合との比較用）
+const FIB_IF_VALUE: &str = r#"
+fun fib(n) {
+    if (n <= 1) {
+        n
+    } else {
+        fib(n - 1) + fib(n - 2)
+    }
+}
+fib(20)
+"#;
+
+/// クロージャが捕捉した変数を更新し続ける
+const CLOSURE_COUNTER: &str = r#"
+fun make_counter() {
+    let count = 0
+    fun increment() {
+        count = count + 1
+        count
+    }
+    increment
+}
+let counter = make_counter()
+let i = 0
+while i < 10000 {
+    counter()
+    i = i + 1
+}
+counter()
+"#;
+
+/// ループの途中から return する（制御の流れの伝播コスト）
+const EARLY_RETURN: &str = r#"
+fun first_over(limit) {
+    let i = 0
+    while true {
+        if i > limit {
+            return i
+        }
+        i = i + 1
+    }
+}
+let n = 0
+let total = 0
+while n < 200 {
+    total = total + first_over(n)
+    n = n + 1
+}
+total
+"#;
+
+/// 本体が小さい関数を大量に呼ぶ（呼び出し1回あたりのオーバーヘッド）
+const SMALL_CALLS: &str = r#"
+fun add(a, b) {
+    return a + b
+}
+let i = 0
+let total = 0
+while i < 10000 {
+    total = add(total, i)
+    i = i + 1
+}
+total
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_function_calls(c: &mut Criterion) {
+    let fib = parse(FIB);
+    c.bench_function("ast_fib_20", |b| {
+        b.iter(|| {
+            let mut interpreter = interpreter::Interpreter::new();
+            black_box(interpreter.evaluate(fib.clone()).unwrap());
+        })
+    });
+
+    let fib_if_value = parse(FIB_IF_VALUE);
+    c.bench_function("ast_fib_20_if_value", |b| {
+        b.iter(|| {
+            let mut interpreter = interpreter::Interpreter::new();
+            black_box(interpreter.evaluate(fib_if_value.clone()).unwrap());
+        })
+    });
+
+    let early_return = parse(EARLY_RETURN);
+    c.bench_function("ast_early_return_in_loop", |b| {
+        b.iter(|| {
+            let mut interpreter = interpreter::Interpreter::new();
+            black_box(interpreter.evaluate(early_return.clone()).unwrap());
+        })
+    });
+
+    let small_calls = parse(SMALL_CALLS);
+    c.bench_function("ast_small_calls", |b| {
+        b.iter(|| {
+            let mut interpreter = interpreter::Interpreter::new();
+            black_box(interpreter.evaluate(small_calls.clone()).unwrap());
+        })
+    });
+
+    let fib_bytecode = compiler::Compiler::new().compile(parse(FIB)).unwrap();
+    c.bench_function("vm_fib_20", |b| {
+        b.iter(|| {
+            let mut vm = vm::VM::new();
+            black_box(vm.execute(fib_bytecode.clone()).unwrap());
+        })
+    });
+
+    let counter_bytecode = compiler::Compiler::new().compile(parse(CLOSURE_COUNTER)).unwrap();
+    c.bench_function("vm_closure_counter", |b| {
+        b.iter(|| {
+            let mut vm = vm::VM::new();
+            black_box(vm.execute(counter_bytecode.clone()).unwrap());
+        })
+    });
+}
+
+criterion_group!(benches, bench_function_calls);
+criterion_main!(benches);
@@ -0,0 +1,109 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion, Throughput};
+use flate2::{Compress, Compression, FlushCompress};
+use futures_util::{SinkExt, StreamExt};
+use mumei_rust::*;
+use mumei_rust::value::Value;
+use serde_json::json;
+use tokio::net::TcpListener;
+use tokio_tungstenite::accept_async;
+use tokio_tungstenite::tungstenite::Message;
+
+/// 1回の接続で送るイベントの数
+const EVENTS: usize = 2000;
+
+/// MESSAGE_CREATE ごとにハンドラーを呼び出し、"done" を受け取ったら閉じる
+const PROGRAM: &str = r#"
+let total = [0]
+fun on_message(message) {
+    total[0] = total[0] + len(message["content"])
+    if (message["content"] == "done") {
+        gateway_close()
+    }
+}
+gateway_on("message", on_message)
+await gateway_connect("bench", 513, {"url": "URL"})
+total[0]
+"#;
+
+/// 接続ごとに Hello・READY と EVENTS 件の MESSAGE_CREATE（Discord のメッセージに近い大きさ）を
+/// zlib-stream で送る Gateway を別スレッドで起動する
+fn start_fake_gateway() -> u16 {
+    let (sender, receiver) = std::sync::mpsc::channel();
+    std::thread::spawn(move || {
+        let runtime = tokio::runtime::Builder::new_multi_thread().enable_all().build().unwrap();
+        runtime.block_on(async move {
+            let listener = TcpListener::bind("127.0.0.1:0").await.unwrap();
+            sender.send(listener.local_addr().unwrap().port()).unwrap();
+            loop {
+                let (stream, _) = listener.accept().await.unwrap();
+                stream.set_nodelay(true).unwrap();
+                tokio::spawn(async move {
+                    let mut socket = accept_async(stream).await.unwrap();
+                    let mut compress = Compress::new(Compression::default(), true);
+                    send(&mut socket, &mut compress, json!({"op": 10, "d": {"heartbeat_interval": 41250}})).await;
+                    let _identify = socket.next().await;
+                    send(&mut socket, &mut compress, json!({"op": 0, "t": "READY", "s": 1, "d": {"session_id": "bench"}})).await;
+                    for i in 0..EVENTS {
+                        let content = if i + 1 == EVENTS { "done".to_string() } else { format!("message {}", i) };
+                        let payload = json!({
+                            "op": 0, "t": "MESSAGE_CREATE", "s": i + 2,
+                            "d": {
+                                "id": "1200000000000000000", "channel_id": "1100000000000000000", "guild_id": "1000000000000000000",
+                                "content": content, "tts": false, "mention_everyone": false, "pinned": false, "type": 0,
+                                "timestamp": "2024-01-01T00:00:00.000000+00:00", "mentions": [], "attachments": [], "embeds": [],
+                                "author": {"id": "1300000000000000000", "username": "bench", "discriminator": "0", "avatar": null, "bot": false}
+                            }
+                        });
+                        send(&mut socket, &mut compress, payload).await;
+                    }
+                    while let Some(Ok(message)) = socket.next().await {
+                        if matches!(message, Message::Close(_)) {
+                            break;
+                        }
+                    }
+                });
+            }
+        });
+    });
+    receiver.recv().unwrap()
+}
+
+/// zlib-stream で圧縮して送る
+async fn send<S: futures_util::Sink<Message> + Unpin>(socket: &mut S, compress: &mut Compress, payload: serde_json::Value)
+where
+    S::Error: std::fmt::Debug,
+{
+    let text = payload.to_string();
+    let mut output = Vec::with_capacity(text.len() + 64);
+    compress.compress_vec(text.as_bytes(), &mut output, FlushCompress::Sync).unwrap();
+    socket.send(Message::Binary(output)).await.unwrap();
+}
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_gateway(c: &mut Criterion) {
+    let url = format!("ws://127.0.0.1:{}", start_fake_gateway());
+    let expected: usize = (0..EVENTS - 1).map(|i| format!("message {}", i).len()).sum::<usize>() + "done".len();
+
+    let mut group = c.benchmark_group("gateway");
+    group.throughput(Throughput::Elements(EVENTS as u64));
+    group.sample_size(10);
+    let source = PROGRAM.replace("URL", &url);
+    let bytecode = compiler::Compiler::new().compile(parse(&source)).unwrap();
+    group.bench_function("vm_dispatch", |b| {
+        b.iter(|| {
+            let mut vm = vm::VM::new();
+            builtins::setup_vm_builtins(&mut vm);
+            let total = vm.execute(bytecode.clone()).unwrap();
+            assert_eq!(total, Value::Number(expected as f64));
+            black_box(total);
+        })
+    });
+    group.finish();
+}
+
+criterion_group!(benches, bench_gateway);
+criterion_main!(benches);
@@ -0,0 +1,81 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::*;
+
+/// 中間リストを作る ETL 風の処理（各段がすべての要素を持つリストを作る）
+const EAGER: &str = r#"
+fun parse(x) {
+    return x * 3 + 1
+}
+let rows = [parse(x) for x in range(0, 20000)]
+let kept = [x for x in rows if x % 2 == 0]
+let scaled = [x / 2 for x in kept]
+let total = 0
+for (x in scaled) {
+    total = total + x
+}
+total
+"#;
+
+/// 同じ処理をジェネレータでつなぐ（要素は1つずつ流れ、中間リストを作らない）
+const STREAMING: &str = r#"
+fun parse(x) {
+    return x * 3 + 1
+}
+fun rows(n) {
+    for (x in range(0, n)) {
+        yield parse(x)
+    }
+}
+let kept = (x for x in rows(20000) if x % 2 == 0)
+let scaled = (x / 2 for x in kept)
+let total = 0
+for (x in scaled) {
+    total = total + x
+}
+total
+"#;
+
+/// 組み込みのアダプタでつなぐ（map・filter・take・zip はユーザー関数をVMに呼ばせる）
+const ADAPTERS: &str = r#"
+fun naturals() {
+    let i = 0
+    while true {
+        yield i
+        i = i + 1
+    }
+}
+fun even(x) {
+    return x % 2 == 0
+}
+fun half(x) {
+    return x / 2
+}
+let total = 0
+for (pair in zip(map(half, filter(even, naturals())), take(naturals(), 10000))) {
+    total = total + pair[0] + pair[1]
+}
+total
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_generators(c: &mut Criterion) {
+    let programs = [("eager", EAGER), ("streaming", STREAMING), ("adapters", ADAPTERS)];
+
+    for (name, source) in programs {
+        let bytecode = compiler::Compiler::new().compile(parse(source)).unwrap();
+        c.bench_function(&format!("vm_{}", name), |b| {
+            b.iter(|| {
+                let mut vm = vm::VM::new();
+                builtins::setup_vm_builtins(&mut vm);
+                black_box(vm.execute(bytecode.clone()).unwrap());
+            })
+        });
+    }
+}
+
+criterion_group!(benches, bench_generators);
+criterion_main!(benches);
@@ -0,0 +1,157 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion, Throughput};
+use mumei_rust::*;
+use mumei_rust::value::Value;
+use std::time::{Duration, Instant};
+use tokio::io::{AsyncBufReadExt, AsyncReadExt, AsyncWriteExt, BufReader};
+use tokio::net::TcpListener;
+
+/// 1回に送るリクエストの数
+const REQUESTS: usize = 500;
+
+/// モックサーバーが応答するまでの時間（リモートのAPIの処理時間を模す）
+const LATENCY: Duration = Duration::from_millis(1);
+
+/// 1件ずつ await する
+const SEQUENTIAL: &str = r#"
+let total = 0
+for (i in range(0, REQUESTS)) {
+    total = total + len(await http_get("BASE/items/" + str(i)))
+}
+total
+"#;
+
+/// http_get のタスクを gather でまとめて待つ
+const GATHER: &str = r#"
+let total = 0
+for (body in await gather([http_get("BASE/items/" + str(i)) for i in range(0, REQUESTS)])) {
+    total = total + len(body)
+}
+total
+"#;
+
+/// http_get_many でまとめて送る
+const GET_MANY: &str = r#"
+let total = 0
+for (body in await http_get_many(["BASE/items/" + str(i) for i in range(0, REQUESTS)])) {
+    total = total + len(body)
+}
+total
+"#;
+
+/// keep-alive で LATENCY 後に "ok" を返すHTTPサーバーを別スレッドで起動し、そのポートを返す
+fn start_mock_server() -> u16 {
+    let (sender, receiver) = std::sync::mpsc::channel();
+    std::thread::spawn(move || {
+        let runtime = tokio::runtime::Builder::new_multi_thread().enable_all().build().unwrap();
+        runtime.block_on(async move {
+            let listener = TcpListener::bind("127.0.0.1:0").await.unwrap();
+            sender.send(listener.local_addr().unwrap().port()).unwrap();
+            loop {
+                let (stream, _) = listener.accept().await.unwrap();
+                tokio::spawn(async move {
+                    let mut stream = BufReader::new(stream);
+                    loop {
+                        let mut line = String::new();
+                        if stream.read_line(&mut line).await.unwrap_or(0) == 0 {
+                            return;
+                        }
+                        let mut length = 0;
+                        loop {
+                            line.clear();
+                            stream.read_line(&mut line).await.unwrap();
+                            if line.trim().is_empty() {
+                                break;
+                            }
+                            if let Some((name, value)) = line.split_once(':') {
+                                if name.eq_ignore_ascii_case("content-length") {
+                                    length = value.trim().parse().unwrap();
+                                }
+                            }
+                        }
+                        let mut body = vec![0; length];
+                        stream.read_exact(&mut body).await.unwrap();
+                        tokio::time::sleep(LATENCY).await;
+                        let response = "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok";
+                        if stream.get_mut().write_all(response.as_bytes()).await.is_err() {
+                            return;
+                        }
+                    }
+                });
+            }
+        });
+    });
+    receiver.recv().unwrap()
+}
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_http(c: &mut Criterion) {
+    let base = format!("http://127.0.0.1:{}", start_mock_server());
+    let programs = [("sequential", SEQUENTIAL), ("gather", GATHER), ("get_many", GET_MANY)];
+
+    // スレッドのクライアントはベンチマークの間ずっと同じもの（keep-alive の接続を使い回す）
+    let mut group = c.benchmark_group("http");
+    group.throughput(Throughput::Elements(REQUESTS as u64));
+    group.sample_size(10);
+    for (name, source) in programs {
+        let source = source.replace("REQUESTS", &REQUESTS.to_string()).replace("BASE", &base);
+        let bytecode = compiler::Compiler::new().compile(parse(&source)).unwrap();
+        group.bench_function(format!("vm_{}", name), |b| {
+            b.iter(|| {
+                let mut vm = vm::VM::new();
+                builtins::setup_vm_builtins(&mut vm);
+                let total = vm.execute(bytecode.clone()).unwrap();
+                assert_eq!(total, Value::Number(2.0 * REQUESTS as f64));
+                black_box(total);
+            })
+        });
+    }
+    group.finish();
+
+    report_latency(&base);
+}
+
+/// REQUESTS 件を同時に送ったときの1件ごとの応答時間（ホストごとの同時接続数の上限で待つ時間を含む）
+/// プールした接続はスケジューラのランタイムのものなので、同じイベントループで送る
+fn report_latency(base: &str) {
+    let client = http::client().unwrap();
+    let started = Instant::now();
+    let requests = (0..REQUESTS)
+        .map(|i| {
+            let client = client.clone();
+            let url = format!("{}/items/{}", base, i).parse().unwrap();
+            task::spawn_native("latency", async move {
+                let sent = Instant::now();
+                let response = client.send(reqwest::Method::GET, url, None, Default::default()).await?;
+                assert_eq!(response.body, "ok");
+                Ok(Value::Number(sent.elapsed().as_secs_f64()))
+            })
+        })
+        .collect();
+    let all = task::gather(requests);
+    while !all.is_done() {
+        task::wait_for_io(&all).unwrap();
+    }
+    let elapsed = started.elapsed();
+
+    let Some(Ok(Value::List(latencies))) = all.result() else {
+        panic!("latency requests failed: {:?}", all.result());
+    };
+    let mut latencies: Vec<f64> = latencies.borrow().iter().map(|latency| latency.as_number().unwrap()).collect();
+    latencies.sort_by(f64::total_cmp);
+    let percentile = |p: f64| Duration::from_secs_f64(latencies[((latencies.len() as f64 * p).ceil() as usize).saturating_sub(1)]);
+    println!(
+        "http/latency: {} requests in {:?} ({:.0} req/s), p50 {:?}, p99 {:?}",
+        REQUESTS,
+        elapsed,
+        REQUESTS as f64 / elapsed.as_secs_f64(),
+        percentile(0.50),
+        percentile(0.99)
+    );
+}
+
+criterion_group!(benches, bench_http);
+criterion_main!(benches);
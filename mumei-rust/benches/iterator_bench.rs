@@ -0,0 +1,84 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::*;
+
+/// range を for 文で回す（要素のリストを作らない）
+const FOR_RANGE: &str = r#"
+fun run(n) {
+    let total = 0
+    for (i in range(0, n)) {
+        total = total + i
+    }
+    total
+}
+run(200000)
+"#;
+
+/// 同じ計算を while 文とカウンタで書いた形（比較用）
+const WHILE_COUNTER: &str = r#"
+fun run(n) {
+    let total = 0
+    let i = 0
+    while i < n {
+        total = total + i
+        i = i + 1
+    }
+    total
+}
+run(200000)
+"#;
+
+/// リストと文字列の反復
+const FOR_LIST_AND_STRING: &str = r#"
+fun run(items, text) {
+    let total = 0
+    for (x in items) {
+        total = total + x
+    }
+    for (c in text) {
+        total = total + 1
+    }
+    total
+}
+let items = list(range(0, 20000))
+let text = ""
+let i = 0
+while i < 2000 {
+    text = "abcdefghij" + text
+    i = i + 1
+}
+run(items, text)
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_iterators(c: &mut Criterion) {
+    for (name, source) in [
+        ("for_range", FOR_RANGE),
+        ("while_counter", WHILE_COUNTER),
+        ("for_list_and_string", FOR_LIST_AND_STRING),
+    ] {
+        let ast = parse(source);
+        c.bench_function(&format!("ast_{}", name), |b| {
+            b.iter(|| {
+                let mut interpreter = interpreter::Interpreter::new();
+                builtins::setup_builtins(&*interpreter.global_env());
+                black_box(interpreter.evaluate(ast.clone()).unwrap());
+            })
+        });
+
+        let bytecode = compiler::Compiler::new().compile(ast).unwrap();
+        c.bench_function(&format!("vm_{}", name), |b| {
+            b.iter(|| {
+                let mut vm = vm::VM::new();
+                builtins::setup_vm_builtins(&mut vm);
+                black_box(vm.execute(bytecode.clone()).unwrap());
+            })
+        });
+    }
+}
+
+criterion_group!(benches, bench_iterators);
+criterion_main!(benches);
@@ -1,4 +1,4 @@
-use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use criterion::{black_box, criterion_group, criterion_main, Criterion, Throughput};
 use mumei_rust::*;  // ベンチマークに必要な関数をインポート
 
 fn bench_tokenize(c: &mut Criterion) {
@@ -10,17 +10,38 @@ fun fibonacci(n) {
     return fibonacci(n - 1) + fibonacci(n - 2)
 }
 
+# 日本語のコメントと文字列（非ASCII）
 let result = fibonacci(10)
-print(result)
+let message = "結果: " + str(result)
+print(message)
 "#.repeat(100);
 
-    c.bench_function("tokenize_large", |b| {
+    let mut group = c.benchmark_group("lexer");
+    group.throughput(Throughput::Bytes(source.len() as u64));
+
+    group.bench_function("tokenize_large", |b| {
+        b.iter(|| {
+            let tokens = lexer::Lexer::new(black_box(&source)).tokenize().unwrap();
+            black_box(tokens.len())
+        })
+    });
+
+    group.bench_function("tokenize_interned_large", |b| {
         b.iter(|| {
-            // Rust実装のレキサーベンチマーク
-            // 注: 実際のベンチマークはビルド後に実行
-            black_box(&source);
+            let (tokens, interner) = lexer::Lexer::new(black_box(&source)).tokenize_interned().unwrap();
+            black_box((tokens.len(), interner.len()))
         })
     });
+
+    // 字句解析＋構文解析（トークンの受け渡しも含めたフロントエンド全体）
+    group.bench_function("tokenize_and_parse_large", |b| {
+        b.iter(|| {
+            let tokens = lexer::Lexer::new(black_box(&source)).tokenize().unwrap();
+            black_box(parser::Parser::new(tokens).parse().unwrap())
+        })
+    });
+
+    group.finish();
 }
 
 criterion_group!(benches, bench_tokenize);
@@ -0,0 +1,83 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::optimizer::OptLevel;
+use mumei_rust::*;
+
+/// 関数内のカウンタループ（比較＋分岐・x = x + k が複合命令になる）
+const LOCAL_LOOP: &str = r#"
+fun run(n) {
+    let sum = 0
+    let i = 0
+    while i < n {
+        if i % 3 == 0 {
+            sum = sum + i
+        } else {
+            sum = sum + 2
+        }
+        i = i + 1
+    }
+    sum
+}
+run(20000)
+"#;
+
+/// トップレベル（グローバル変数）のループと定数式
+const GLOBAL_LOOP: &str = r#"
+let scale = 60 * 60 * 24
+let total = 0
+let i = 0
+while i < 20000 {
+    total = total + scale / 3600
+    i = i + 1
+}
+total
+"#;
+
+/// 再帰フィボナッチ（比較＋分岐と呼び出し）
+const FIB: &str = r#"
+fun fib(n) {
+    if (n <= 1) {
+        return n;
+    }
+    return fib(n - 1) + fib(n - 2);
+}
+fib(20)
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_optimizer(c: &mut Criterion) {
+    let levels = [("O0", OptLevel::None), ("O1", OptLevel::Basic), ("O2", OptLevel::Full)];
+
+    for (name, source) in [("local_loop", LOCAL_LOOP), ("global_loop", GLOBAL_LOOP), ("fib_20", FIB)] {
+        let ast = parse(source);
+        let mut group = c.benchmark_group(format!("vm_{}", name));
+        for (label, level) in levels {
+            let bytecode = compiler::Compiler::with_opt_level(level).compile(ast.clone()).unwrap();
+            println!("{} {}: {} instructions", name, label, bytecode.instructions.len()
+                + bytecode.functions.iter().map(|f| f.chunk.instructions.len()).sum::<usize>());
+            group.bench_function(label, |b| {
+                b.iter(|| {
+                    let mut vm = vm::VM::new();
+                    black_box(vm.execute(bytecode.clone()).unwrap());
+                })
+            });
+        }
+        group.finish();
+    }
+
+    // 最適化にかかる時間（コンパイル全体に対する上乗せ）
+    let ast = parse(&LOCAL_LOOP.repeat(20));
+    let mut group = c.benchmark_group("compile");
+    for (label, level) in levels {
+        group.bench_function(label, |b| {
+            b.iter(|| black_box(compiler::Compiler::with_opt_level(level).compile(ast.clone()).unwrap()))
+        });
+    }
+    group.finish();
+}
+
+criterion_group!(benches, bench_optimizer);
+criterion_main!(benches);
@@ -0,0 +1,103 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::optimizer::OptLevel;
+use mumei_rust::*;
+
+/// 数値の演算と比較が中心のループ（AddNum / MultiplyNum / LessNumJump）
+const ARITHMETIC: &str = r#"
+fun run(n) {
+    let total = 0
+    let i = 0
+    while i < n {
+        total = total + i * 2 - i / 4
+        i = i + 1
+    }
+    total
+}
+run(20000)
+"#;
+
+/// 比較結果を値として使う（LessNum などが Boolean を直接積む）
+const COMPARE_VALUES: &str = r#"
+fun run(n) {
+    let hits = 0
+    let i = 0
+    while i < n {
+        let small = i < 100
+        let large = i >= 19000
+        if small or large {
+            hits = hits + 1
+        }
+        i = i + 1
+    }
+    hits
+}
+run(20000)
+"#;
+
+/// グローバル変数を読み続ける（LoadGlobalCached）
+const GLOBALS: &str = r#"
+let step = 3
+let limit = 20000
+let total = 0
+let i = 0
+while i < limit {
+    total = total + step
+    i = i + 1
+}
+total
+"#;
+
+/// 文字列の連結（ConcatStr）
+const CONCAT: &str = r#"
+fun run(n) {
+    let s = ""
+    let i = 0
+    while i < n {
+        s = "ab" + s
+        i = i + 1
+    }
+    s
+}
+run(2000)
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_quickening(c: &mut Criterion) {
+    let programs = [
+        ("arithmetic", ARITHMETIC),
+        ("compare_values", COMPARE_VALUES),
+        ("globals", GLOBALS),
+        ("concat", CONCAT),
+    ];
+
+    for (name, source) in programs {
+        // 最適化なし（汎用命令が多い）と最適化あり（複合命令が多い）の両方で比べる
+        for (label, level) in [("O0", OptLevel::None), ("O2", OptLevel::Full)] {
+            let bytecode = compiler::Compiler::with_opt_level(level).compile(parse(source)).unwrap();
+            let mut group = c.benchmark_group(format!("vm_{}_{}", name, label));
+            for (mode, quickening) in [("generic", false), ("quickened", true)] {
+                group.bench_function(mode, |b| {
+                    b.iter(|| {
+                        let mut vm = vm::VM::new();
+                        vm.set_quickening(quickening);
+                        black_box(vm.execute(bytecode.clone()).unwrap());
+                    })
+                });
+            }
+            group.finish();
+
+            // 特殊化のヒット率
+            let mut vm = vm::VM::new();
+            vm.set_quicken_stats(true);
+            vm.execute(bytecode.clone()).unwrap();
+            println!("{} {}:\n{}", name, label, vm.quicken_stats().report());
+        }
+    }
+}
+
+criterion_group!(benches, bench_quickening);
+criterion_main!(benches);
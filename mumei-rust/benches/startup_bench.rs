@@ -0,0 +1,48 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::*;
+
+/// ボットスクリプトと同程度（約450行）の、バイトコードにコンパイルできるスクリプト
+fn bot_sized_script() -> String {
+    let mut source = String::new();
+    for i in 0..50 {
+        source.push_str(&format!(
+            r#"
+# ハンドラ {i}
+fun handler_{i}(count, limit) {{
+    let total = 0
+    let step = {i} + 1
+    while count < limit {{
+        total = total + count * step
+        count = count + 1
+    }}
+    total
+}}
+"#
+        ));
+    }
+    source.push_str("handler_0(0, 10)\n");
+    source
+}
+
+fn bench_startup(c: &mut Criterion) {
+    let source = bot_sized_script();
+    let dir = std::env::temp_dir().join(format!("mumei-startup-bench-{}", std::process::id()));
+    let cache_path = dir.join("bot.muc");
+    let bytecode = bytecode_cache::compile_source(&source).unwrap();
+    diskcache::store(&cache_path, &source, &bytecode).unwrap();
+
+    // 毎回ソースから字句解析・構文解析・コンパイル
+    c.bench_function("startup_cold_compile", |b| {
+        b.iter(|| black_box(bytecode_cache::compile_source(black_box(&source)).unwrap()))
+    });
+
+    // .muc を読んで確認・デコード
+    c.bench_function("startup_cached_muc", |b| {
+        b.iter(|| black_box(diskcache::load(&cache_path, black_box(&source)).unwrap()))
+    });
+
+    let _ = std::fs::remove_dir_all(&dir);
+}
+
+criterion_group!(benches, bench_startup);
+criterion_main!(benches);
@@ -0,0 +1,100 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::*;
+
+/// ループでの文字列の連結（共有されていなければその場で追記される）
+const APPEND: &str = r#"
+fun build(n) {
+    let out = ""
+    let i = 0
+    while i < n {
+        out += "line " + str(i)
+        out = out + "\n"
+        i = i + 1
+    }
+    return out
+}
+len(build(20000))
+"#;
+
+/// リストに集めて join で1つにする
+const JOIN: &str = r#"
+let parts = []
+let i = 0
+while i < 20000 {
+    push(parts, "line " + str(i))
+    i = i + 1
+}
+len(join(parts, "\n"))
+"#;
+
+/// 文字の添字アクセス（ASCII・非ASCII）
+const INDEX: &str = r#"
+fun scan(text) {
+    let count = 0
+    let i = 0
+    let n = len(text)
+    while i < n {
+        if text[i] == "a" {
+            count = count + 1
+        }
+        i = i + 1
+    }
+    count
+}
+let ascii = ""
+let wide = ""
+let k = 0
+while k < 500 {
+    ascii = ascii + "abcdefgh"
+    wide = wide + "あいうえおabc"
+    k = k + 1
+}
+scan(ascii) + scan(wide)
+"#;
+
+/// 変数の読み出し・リストへの格納で長い文字列を複製する
+const SHARE: &str = r#"
+let text = "a fairly long string that does not fit in the inline buffer"
+let items = []
+let i = 0
+while i < 20000 {
+    push(items, text)
+    i = i + 1
+}
+len(items)
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_strings(c: &mut Criterion) {
+    println!("size_of::<Value>() = {} bytes", std::mem::size_of::<value::Value>());
+
+    for (name, source) in [("append", APPEND), ("join", JOIN), ("share", SHARE)] {
+        let bytecode = compiler::Compiler::new().compile(parse(source)).unwrap();
+        c.bench_function(&format!("vm_{}", name), |b| {
+            b.iter(|| {
+                let mut vm = vm::VM::new();
+                builtins::setup_vm_builtins(&mut vm);
+                black_box(vm.execute(bytecode.clone()).unwrap());
+            })
+        });
+    }
+
+    // 添字アクセスはバイトコード未対応なのでツリーウォーキングインタプリタで測る
+    for (name, source) in [("append", APPEND), ("index", INDEX)] {
+        let ast = parse(source);
+        c.bench_function(&format!("ast_{}", name), |b| {
+            b.iter(|| {
+                let mut interpreter = interpreter::Interpreter::new();
+                builtins::setup_builtins(&*interpreter.global_env());
+                black_box(interpreter.evaluate(ast.clone()).unwrap());
+            })
+        });
+    }
+}
+
+criterion_group!(benches, bench_strings);
+criterion_main!(benches);
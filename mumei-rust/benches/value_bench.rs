@@ -0,0 +1,79 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion, Throughput};
+use mumei_rust::*;
+use mumei_rust::value::Value;
+use std::cell::RefCell;
+use std::rc::Rc;
+
+/// リストを組み立てて走査する（要素のコピー・移動が支配的）
+const LIST_HEAVY: &str = r#"
+let items = []
+let i = 0
+while i < 5000 {
+    push(items, i)
+    i = i + 1
+}
+let total = 0
+for (x in items) {
+    total = total + x
+}
+total
+"#;
+
+/// 数値のみのループ（VMスタックのpush/popが支配的）
+const NUMERIC: &str = r#"
+fun run(n) {
+    let acc = 0
+    let i = 0
+    while i < n {
+        acc = acc + i * 2 - 1
+        i = i + 1
+    }
+    acc
+}
+run(20000)
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_values(c: &mut Criterion) {
+    // Valueのサイズがそのままスタック・リスト要素のメモリ使用量になる
+    let value_size = std::mem::size_of::<Value>();
+    println!("size_of::<Value>() = {} bytes", value_size);
+
+    let mut group = c.benchmark_group("value_memory");
+    let values: Vec<Value> = (0..10_000)
+        .map(|i| match i % 3 {
+            0 => Value::Number(i as f64),
+            1 => Value::List(Rc::new(RefCell::new(vec![Value::Number(i as f64)]))),
+            _ => Value::native("f", 0, |_| Ok(Value::Null)),
+        })
+        .collect();
+    group.throughput(Throughput::Bytes((values.len() * value_size) as u64));
+    group.bench_function("clone_10k_values", |b| {
+        b.iter(|| black_box(values.clone()))
+    });
+    group.finish();
+
+    let list_heavy = parse(LIST_HEAVY);
+    c.bench_function("ast_list_heavy", |b| {
+        b.iter(|| {
+            let mut interpreter = interpreter::Interpreter::new();
+            builtins::setup_builtins(&*interpreter.global_env());
+            black_box(interpreter.evaluate(list_heavy.clone()).unwrap());
+        })
+    });
+
+    let numeric = compiler::Compiler::new().compile(parse(NUMERIC)).unwrap();
+    c.bench_function("vm_numeric", |b| {
+        b.iter(|| {
+            let mut vm = vm::VM::new();
+            black_box(vm.execute(numeric.clone()).unwrap());
+        })
+    });
+}
+
+criterion_group!(benches, bench_values);
+criterion_main!(benches);
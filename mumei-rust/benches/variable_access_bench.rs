@@ -0,0 +1,70 @@
+use criterion::{black_box, criterion_group, criterion_main, Criterion};
+use mumei_rust::*;
+
+/// benchmark_rust.py の「ループ処理」「変数代入」ケースを while ループに展開したもの
+const LOOP_GLOBAL: &str = r#"
+let sum = 0
+let i = 0
+while i < 10000 {
+    sum = sum + i
+    i = i + 1
+}
+sum
+"#;
+
+/// 同じループを関数内（ローカル変数スロット）で実行
+const LOOP_LOCAL: &str = r#"
+fun run(n) {
+    let sum = 0
+    let i = 0
+    while i < n {
+        sum = sum + i
+        i = i + 1
+    }
+    sum
+}
+run(10000)
+"#;
+
+fn parse(source: &str) -> ast::Ast {
+    let tokens = lexer::Lexer::new(source).tokenize().unwrap();
+    parser::Parser::new(tokens).parse().unwrap()
+}
+
+fn bench_variable_access(c: &mut Criterion) {
+    let global_loop = parse(LOOP_GLOBAL);
+    let local_loop = parse(LOOP_LOCAL);
+
+    c.bench_function("ast_loop_global", |b| {
+        b.iter(|| {
+            let mut interpreter = interpreter::Interpreter::new();
+            black_box(interpreter.evaluate(global_loop.clone()).unwrap());
+        })
+    });
+
+    c.bench_function("ast_loop_local", |b| {
+        b.iter(|| {
+            let mut interpreter = interpreter::Interpreter::new();
+            black_box(interpreter.evaluate(local_loop.clone()).unwrap());
+        })
+    });
+
+    let bytecode = compiler::Compiler::new().compile(global_loop.clone()).unwrap();
+    c.bench_function("vm_loop_global", |b| {
+        b.iter(|| {
+            let mut vm = vm::VM::new();
+            black_box(vm.execute(bytecode.clone()).unwrap());
+        })
+    });
+
+    let local_bytecode = compiler::Compiler::new().compile(local_loop.clone()).unwrap();
+    c.bench_function("vm_loop_local", |b| {
+        b.iter(|| {
+            let mut vm = vm::VM::new();
+            black_box(vm.execute(local_bytecode.clone()).unwrap());
+        })
+    });
+}
+
+criterion_group!(benches, bench_variable_access);
+criterion_main!(benches);
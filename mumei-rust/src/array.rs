@@ -0,0 +1,200 @@
+/// 数値配列
+/// 要素を Value ではなく連続した f64 として持つ（リストの要素は1つずつタグ付きの Value）。
+/// 四則演算・集計はスライスに対するループで行い、コンパイラの自動ベクトル化に任せる。
+/// スライスはバッファを共有するビュー（要素をコピーしない）。
+
+use crate::value::Value;
+use std::rc::Rc;
+
+/// 集計で並べる部分和の数（浮動小数の加算は結合則が成り立たないため、
+/// 1本の累積ではベクトル化されない。部分和を分けておくとSIMDレジスタに載る）
+const LANES: usize = 8;
+
+/// 数値配列（共有バッファの start から len 要素を見るビュー）
+#[derive(Debug, Clone)]
+pub struct NumArray {
+    data: Rc<[f64]>,
+    start: usize,
+    len: usize,
+}
+
+impl NumArray {
+    /// 要素から配列を作成
+    pub fn new(values: Vec<f64>) -> NumArray {
+        let len = values.len();
+        NumArray { data: values.into(), start: 0, len }
+    }
+
+    /// 要素を順に並べた配列を作成（長さが分かるイテレータなら1回の確保で済む）
+    pub fn from_values(values: impl Iterator<Item = f64>) -> NumArray {
+        let data: Rc<[f64]> = values.collect();
+        let len = data.len();
+        NumArray { data, start: 0, len }
+    }
+
+    /// 要素のスライス
+    #[inline]
+    pub fn as_slice(&self) -> &[f64] {
+        &self.data[self.start..self.start + self.len]
+    }
+
+    /// 要素数
+    #[inline]
+    pub fn len(&self) -> usize {
+        self.len
+    }
+
+    /// 要素がないか
+    #[inline]
+    pub fn is_empty(&self) -> bool {
+        self.len == 0
+    }
+
+    /// index 番目の要素
+    #[inline]
+    pub fn get(&self, index: usize) -> Option<f64> {
+        self.as_slice().get(index).copied()
+    }
+
+    /// start..end のビュー（範囲は要素数に切り詰める。要素はコピーしない）
+    pub fn slice(&self, start: usize, end: usize) -> NumArray {
+        let end = end.min(self.len);
+        let start = start.min(end);
+        NumArray { data: self.data.clone(), start: self.start + start, len: end - start }
+    }
+
+    /// 同じバッファを共有しているか
+    pub fn shares_buffer(&self, other: &NumArray) -> bool {
+        Rc::ptr_eq(&self.data, &other.data)
+    }
+}
+
+impl PartialEq for NumArray {
+    fn eq(&self, other: &Self) -> bool {
+        self.as_slice() == other.as_slice()
+    }
+}
+
+// ============================================
+// 要素ごとの演算
+// ============================================
+
+/// 配列と配列の要素ごとの演算（長さが違えばエラー）
+#[inline]
+pub fn zip(left: &NumArray, right: &NumArray, f: impl Fn(f64, f64) -> f64) -> Result<Value, String> {
+    if left.len() != right.len() {
+        return Err(format!("Array length mismatch: {} and {}", left.len(), right.len()));
+    }
+    let values = left.as_slice().iter().zip(right.as_slice()).map(|(&a, &b)| f(a, b));
+    Ok(Value::Array(Rc::new(NumArray::from_values(values))))
+}
+
+/// 配列の各要素への演算（配列とスカラーの演算）
+#[inline]
+pub fn map(array: &NumArray, f: impl Fn(f64) -> f64) -> Value {
+    Value::Array(Rc::new(NumArray::from_values(array.as_slice().iter().map(|&a| f(a)))))
+}
+
+/// 0 の要素を含むか（除算の前に確認する）
+pub fn contains_zero(array: &NumArray) -> bool {
+    array.as_slice().iter().fold(false, |found, &a| found | (a == 0.0))
+}
+
+// ============================================
+// 集計
+// ============================================
+
+/// 合計
+pub fn sum(values: &[f64]) -> f64 {
+    let mut lanes = [0.0; LANES];
+    let chunks = values.chunks_exact(LANES);
+    let rest = chunks.remainder();
+    for chunk in chunks {
+        for i in 0..LANES {
+            lanes[i] += chunk[i];
+        }
+    }
+    lanes.iter().sum::<f64>() + rest.iter().sum::<f64>()
+}
+
+/// 内積（長さは呼び出し側で揃える）
+pub fn dot(left: &[f64], right: &[f64]) -> f64 {
+    debug_assert_eq!(left.len(), right.len());
+    let mut lanes = [0.0; LANES];
+    let left_chunks = left.chunks_exact(LANES);
+    let right_chunks = right.chunks_exact(LANES);
+    let rest: f64 = left_chunks.remainder().iter().zip(right_chunks.remainder()).map(|(a, b)| a * b).sum();
+    for (a, b) in left_chunks.zip(right_chunks) {
+        for i in 0..LANES {
+            lanes[i] += a[i] * b[i];
+        }
+    }
+    lanes.iter().sum::<f64>() + rest
+}
+
+/// 最小値（空なら None）
+pub fn min(values: &[f64]) -> Option<f64> {
+    reduce(values, f64::INFINITY, f64::min)
+}
+
+/// 最大値（空なら None）
+pub fn max(values: &[f64]) -> Option<f64> {
+    reduce(values, f64::NEG_INFINITY, f64::max)
+}
+
+/// 部分ごとに畳み込んでから1つにまとめる
+#[inline]
+fn reduce(values: &[f64], init: f64, f: impl Fn(f64, f64) -> f64) -> Option<f64> {
+    if values.is_empty() {
+        return None;
+    }
+    let mut lanes = [init; LANES];
+    let chunks = values.chunks_exact(LANES);
+    let rest = chunks.remainder();
+    for chunk in chunks {
+        for i in 0..LANES {
+            lanes[i] = f(lanes[i], chunk[i]);
+        }
+    }
+    let result = lanes.iter().copied().fold(init, &f);
+    Some(rest.iter().copied().fold(result, &f))
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_reductions() {
+        let values: Vec<f64> = (1..=20).map(|n| n as f64).collect();
+        assert_eq!(sum(&values), 210.0);
+        assert_eq!(dot(&values, &values), 2870.0);
+        assert_eq!(min(&values), Some(1.0));
+        assert_eq!(max(&values), Some(20.0));
+        assert_eq!(min(&[]), None);
+        assert_eq!(sum(&[]), 0.0);
+    }
+
+    #[test]
+    fn test_slice_is_view() {
+        let array = NumArray::new(vec![1.0, 2.0, 3.0, 4.0, 5.0]);
+        let view = array.slice(1, 4);
+        assert_eq!(view.as_slice(), &[2.0, 3.0, 4.0]);
+        assert!(view.shares_buffer(&array));
+
+        // ビューのビュー・範囲外は切り詰め
+        assert_eq!(view.slice(1, 10).as_slice(), &[3.0, 4.0]);
+        assert!(view.slice(5, 2).is_empty());
+    }
+
+    #[test]
+    fn test_elementwise() {
+        let a = NumArray::new(vec![1.0, 2.0, 3.0]);
+        let b = NumArray::new(vec![10.0, 20.0, 30.0]);
+        let expected = Value::Array(Rc::new(NumArray::new(vec![11.0, 22.0, 33.0])));
+        assert_eq!(zip(&a, &b, |x, y| x + y).unwrap(), expected);
+        assert_eq!(map(&a, |x| x * 2.0), Value::Array(Rc::new(NumArray::new(vec![2.0, 4.0, 6.0]))));
+        assert!(zip(&a, &a.slice(0, 2), |x, y| x + y).unwrap_err().contains("length mismatch"));
+        assert!(!contains_zero(&a));
+    }
+}
@@ -1,9 +1,174 @@
 /// AST (Abstract Syntax Tree) ノード定義
 /// Mumei言語の構文木構造
 
+use crate::shape::InlineCache;
 use std::fmt;
 
+/// アリーナ内のノード番号
+#[derive(Debug, Clone, Copy, PartialEq, Eq, Hash)]
+pub struct NodeId(pub u32);
+
+/// 子ノードの並び（Ast::lists 内の連続した範囲）
+/// ブロックや引数リストごとに Vec を確保せず、1つの配列を共有する
+#[derive(Debug, Clone, Copy, PartialEq, Eq, Default)]
+pub struct NodeList {
+    start: u32,
+    len: u32,
+}
+
+impl NodeList {
+    pub fn len(&self) -> usize {
+        self.len as usize
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.len == 0
+    }
+}
+
+/// 構文木のアリーナ
+/// パーサーがすべてのノードを1つの Vec に積み、親は子を NodeId で参照する。
+/// 関数値は Rc<Ast> と宣言ノードの番号を持つので、関数の宣言・呼び出しで構文木をコピーしない。
+#[derive(Debug, Clone, PartialEq, Default)]
+pub struct Ast {
+    nodes: Vec<ASTNode>,
+    lists: Vec<NodeId>,
+    root: Option<NodeId>,
+}
+
+impl Ast {
+    pub fn new() -> Self {
+        Ast::default()
+    }
+
+    /// ノードを追加して番号を返す
+    pub fn push(&mut self, node: ASTNode) -> NodeId {
+        let id = NodeId(self.nodes.len() as u32);
+        self.nodes.push(node);
+        id
+    }
+
+    /// 子ノードの並びを追加する
+    pub fn push_list<I: IntoIterator<Item = NodeId>>(&mut self, ids: I) -> NodeList {
+        let start = self.lists.len() as u32;
+        self.lists.extend(ids);
+        NodeList { start, len: self.lists.len() as u32 - start }
+    }
+
+    /// ルート（Program ノード）を設定する
+    pub fn set_root(&mut self, statements: Vec<NodeId>) -> NodeId {
+        let statements = self.push_list(statements);
+        let root = self.push(ASTNode::Program { statements });
+        self.root = Some(root);
+        root
+    }
+
+    #[inline]
+    pub fn node(&self, id: NodeId) -> &ASTNode {
+        &self.nodes[id.0 as usize]
+    }
+
+    #[inline]
+    pub fn node_mut(&mut self, id: NodeId) -> &mut ASTNode {
+        &mut self.nodes[id.0 as usize]
+    }
+
+    #[inline]
+    pub fn list(&self, list: NodeList) -> &[NodeId] {
+        &self.lists[list.start as usize..(list.start + list.len) as usize]
+    }
+
+    /// 辞書リテラルのキーと値の組
+    pub fn pairs(&self, list: NodeList) -> impl Iterator<Item = (NodeId, NodeId)> + '_ {
+        self.list(list).chunks_exact(2).map(|pair| (pair[0], pair[1]))
+    }
+
+    /// 構築が終わったら余分な容量を解放する
+    pub fn shrink_to_fit(&mut self) {
+        self.nodes.shrink_to_fit();
+        self.lists.shrink_to_fit();
+    }
+
+    /// ルートの Program ノード
+    pub fn root(&self) -> Option<NodeId> {
+        self.root
+    }
+
+    /// トップレベルの文の並び
+    pub fn statements(&self) -> &[NodeId] {
+        match self.root.map(|root| self.node(root)) {
+            Some(ASTNode::Program { statements }) => self.list(*statements),
+            _ => &[],
+        }
+    }
+
+    /// ノード数
+    pub fn len(&self) -> usize {
+        self.nodes.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.nodes.is_empty()
+    }
+
+    /// async 関数か await を含むか（インタプリタの await は入れ子のイベントループで待つので、
+    /// タスクの進む順序がVMと変わる）
+    pub fn uses_async(&self) -> bool {
+        self.nodes.iter().any(|node| {
+            matches!(node, ASTNode::AwaitExpression { .. } | ASTNode::FunctionDeclaration { is_async: true, .. })
+        })
+    }
+
+    /// 構文木が使っているメモリのおおよそのバイト数（文字列の中身を含む）
+    pub fn memory_usage(&self) -> usize {
+        use std::mem::size_of;
+        let strings: usize = self.nodes.iter().map(|node| node.string_bytes()).sum();
+        size_of::<Ast>()
+            + self.nodes.capacity() * size_of::<ASTNode>()
+            + self.lists.capacity() * size_of::<NodeId>()
+            + strings
+    }
+
+    /// ASTを読みやすい形式で出力
+    pub fn pretty_print(&self, id: NodeId, indent: usize) -> String {
+        let prefix = "  ".repeat(indent);
+        match self.node(id) {
+            ASTNode::Number(n) => format!("{}Number({})", prefix, n),
+            ASTNode::String(s) => format!("{}String(\"{}\")", prefix, s),
+            ASTNode::Boolean(b) => format!("{}Boolean({})", prefix, b),
+            ASTNode::Null => format!("{}Null", prefix),
+            ASTNode::Identifier(name) => format!("{}Identifier({})", prefix, name),
+            ASTNode::LocalVariable { name, depth, slot } => {
+                format!("{}Local({}, depth={}, slot={})", prefix, name, depth, slot)
+            }
+            ASTNode::GlobalVariable { name } => format!("{}Global({})", prefix, name),
+            ASTNode::BinaryOperation { left, operator, right } => {
+                format!("{}BinaryOp({})\n{}\n{}",
+                    prefix, operator,
+                    self.pretty_print(*left, indent + 1),
+                    self.pretty_print(*right, indent + 1))
+            }
+            ASTNode::FunctionCall { callee, arguments } => {
+                let mut result = format!("{}FunctionCall\n{}", prefix, self.pretty_print(*callee, indent + 1));
+                for &arg in self.list(*arguments) {
+                    result.push_str(&format!("\n{}", self.pretty_print(arg, indent + 1)));
+                }
+                result
+            }
+            ASTNode::Program { statements } => {
+                let mut result = format!("{}Program", prefix);
+                for &stmt in self.list(*statements) {
+                    result.push_str(&format!("\n{}", self.pretty_print(stmt, indent + 1)));
+                }
+                result
+            }
+            node => format!("{}{:?}", prefix, node),
+        }
+    }
+}
+
 /// ASTノードの基底型
+/// 子ノードは Box ではなくアリーナ（Ast）内の番号で参照する
 #[derive(Debug, Clone, PartialEq)]
 pub enum ASTNode {
     // リテラル
@@ -15,82 +180,99 @@ pub enum ASTNode {
     // 識別子
     Identifier(String),
 
+    // 解決済みローカル変数（Resolverが生成: 関数スコープの深さとスロット番号）
+    LocalVariable {
+        name: String,
+        depth: usize,
+        slot: usize,
+    },
+
+    // 解決済みグローバル変数（Resolverが生成）
+    GlobalVariable {
+        name: String,
+    },
+
     // 変数宣言
     VariableDeclaration {
         name: String,
-        value: Box<ASTNode>,
+        value: NodeId,
         is_const: bool,
+        slot: Option<usize>,
     },
 
     // 関数定義
     FunctionDeclaration {
         name: String,
         parameters: Vec<String>,
-        body: Vec<ASTNode>,
+        body: NodeList,
         is_async: bool,
+        /// 本体に yield を含むか（Resolver が設定）
+        is_generator: bool,
+        slot: Option<usize>,
     },
 
     // 関数呼び出し
     FunctionCall {
-        callee: Box<ASTNode>,
-        arguments: Vec<ASTNode>,
+        callee: NodeId,
+        arguments: NodeList,
     },
 
     // 二項演算
     BinaryOperation {
-        left: Box<ASTNode>,
+        left: NodeId,
         operator: BinaryOperator,
-        right: Box<ASTNode>,
+        right: NodeId,
     },
 
     // 単項演算
     UnaryOperation {
         operator: UnaryOperator,
-        operand: Box<ASTNode>,
+        operand: NodeId,
     },
 
     // 代入
     Assignment {
-        target: Box<ASTNode>,
-        value: Box<ASTNode>,
+        target: NodeId,
+        value: NodeId,
     },
 
     // 複合代入
     CompoundAssignment {
-        target: Box<ASTNode>,
+        target: NodeId,
         operator: BinaryOperator,
-        value: Box<ASTNode>,
+        value: NodeId,
     },
 
     // if文
     IfStatement {
-        condition: Box<ASTNode>,
-        then_body: Vec<ASTNode>,
-        elif_clauses: Vec<(ASTNode, Vec<ASTNode>)>,
-        else_body: Option<Vec<ASTNode>>,
+        condition: NodeId,
+        then_body: NodeList,
+        elif_clauses: Vec<(NodeId, NodeList)>,
+        else_body: Option<NodeList>,
     },
 
     // while文
     WhileStatement {
-        condition: Box<ASTNode>,
-        body: Vec<ASTNode>,
+        condition: NodeId,
+        body: NodeList,
     },
 
     // for文
     ForStatement {
         variable: String,
-        iterable: Box<ASTNode>,
-        body: Vec<ASTNode>,
+        iterable: NodeId,
+        body: NodeList,
+        slot: Option<usize>,
     },
 
     // return文
     ReturnStatement {
-        value: Option<Box<ASTNode>>,
+        value: Option<NodeId>,
     },
 
     // yield文
     YieldStatement {
-        value: Box<ASTNode>,
+        value: NodeId,
     },
 
     // break文
@@ -104,82 +286,103 @@ pub enum ASTNode {
 
     // リスト
     List {
-        elements: Vec<ASTNode>,
+        elements: NodeList,
     },
 
-    // 辞書
+    // 辞書（キーと値を交互に並べたリスト）
     Dictionary {
-        pairs: Vec<(ASTNode, ASTNode)>,
+        pairs: NodeList,
     },
 
     // インデックスアクセス
     IndexAccess {
-        object: Box<ASTNode>,
-        index: Box<ASTNode>,
+        object: NodeId,
+        index: NodeId,
     },
 
-    // メンバーアクセス
+    // メンバーアクセス（インスタンスの形ごとのメンバーの場所を覚える）
     MemberAccess {
-        object: Box<ASTNode>,
+        object: NodeId,
         member: String,
+        cache: InlineCache,
     },
 
     // スライス
     Slice {
-        object: Box<ASTNode>,
-        start: Option<Box<ASTNode>>,
-        end: Option<Box<ASTNode>>,
-        step: Option<Box<ASTNode>>,
+        object: NodeId,
+        start: Option<NodeId>,
+        end: Option<NodeId>,
+        step: Option<NodeId>,
     },
 
     // ラムダ式
     Lambda {
         parameters: Vec<String>,
-        body: Box<ASTNode>,
+        body: NodeList,
     },
 
     // リスト内包表記
     ListComprehension {
-        element: Box<ASTNode>,
+        element: NodeId,
+        variable: String,
+        iterable: NodeId,
+        condition: Option<NodeId>,
+        slot: Option<usize>,
+    },
+
+    // ジェネレータ式 (element for variable in iterable if condition)
+    // 本体は反復対象を引数に取るジェネレータ関数のスコープで解決される（slot は関数内のスロット）
+    GeneratorExpression {
+        element: NodeId,
         variable: String,
-        iterable: Box<ASTNode>,
-        condition: Option<Box<ASTNode>>,
+        iterable: NodeId,
+        condition: Option<NodeId>,
+        slot: Option<usize>,
     },
 
     // 辞書内包表記
     DictComprehension {
-        key: Box<ASTNode>,
-        value: Box<ASTNode>,
+        key: NodeId,
+        value: NodeId,
         variable: String,
-        iterable: Box<ASTNode>,
-        condition: Option<Box<ASTNode>>,
+        iterable: NodeId,
+        condition: Option<NodeId>,
+        slot: Option<usize>,
     },
 
     // 三項演算子
     TernaryOperation {
-        condition: Box<ASTNode>,
-        true_value: Box<ASTNode>,
-        false_value: Box<ASTNode>,
+        condition: NodeId,
+        true_value: NodeId,
+        false_value: NodeId,
     },
 
     // try-catch文
     TryCatch {
-        try_body: Vec<ASTNode>,
+        try_body: NodeList,
         catch_variable: Option<String>,
-        catch_body: Vec<ASTNode>,
-        finally_body: Option<Vec<ASTNode>>,
+        catch_body: NodeList,
+        finally_body: Option<NodeList>,
+        catch_slot: Option<usize>,
     },
 
     // throw文
     ThrowStatement {
-        value: Box<ASTNode>,
+        value: NodeId,
     },
 
-    // クラス定義
+    // クラス定義（親クラスは識別子のノード）
     ClassDeclaration {
         name: String,
-        parent: Option<String>,
-        body: Vec<ASTNode>,
+        parent: Option<NodeId>,
+        body: NodeList,
+        slot: Option<usize>,
+    },
+
+    // インスタンス生成（new クラス(引数)）
+    NewExpression {
+        class: NodeId,
+        arguments: NodeList,
     },
 
     // import文
@@ -190,18 +393,18 @@ pub enum ASTNode {
 
     // プログラム（ルートノード）
     Program {
-        statements: Vec<ASTNode>,
+        statements: NodeList,
     },
 
     // await式
     AwaitExpression {
-        expression: Box<ASTNode>,
+        expression: NodeId,
     },
 
     // assert文
     AssertStatement {
-        condition: Box<ASTNode>,
-        message: Option<Box<ASTNode>>,
+        condition: NodeId,
+        message: Option<NodeId>,
     },
 }
 
@@ -284,38 +487,37 @@ impl fmt::Display for UnaryOperator {
     }
 }
 
-// AST可視化用のヘルパー
 impl ASTNode {
-    /// ASTを読みやすい形式で出力
-    pub fn pretty_print(&self, indent: usize) -> String {
-        let prefix = "  ".repeat(indent);
+    /// ノードが持つ文字列のヒープ上のバイト数
+    fn string_bytes(&self) -> usize {
         match self {
-            ASTNode::Number(n) => format!("{}Number({})", prefix, n),
-            ASTNode::String(s) => format!("{}String(\"{}\")", prefix, s),
-            ASTNode::Boolean(b) => format!("{}Boolean({})", prefix, b),
-            ASTNode::Null => format!("{}Null", prefix),
-            ASTNode::Identifier(name) => format!("{}Identifier({})", prefix, name),
-            ASTNode::BinaryOperation { left, operator, right } => {
-                format!("{}BinaryOp({})\n{}\n{}",
-                    prefix, operator,
-                    left.pretty_print(indent + 1),
-                    right.pretty_print(indent + 1))
+            ASTNode::String(s) | ASTNode::Identifier(s) => s.capacity(),
+            ASTNode::LocalVariable { name, .. }
+            | ASTNode::GlobalVariable { name }
+            | ASTNode::VariableDeclaration { name, .. }
+            | ASTNode::MemberAccess { member: name, .. }
+            | ASTNode::ForStatement { variable: name, .. }
+            | ASTNode::ListComprehension { variable: name, .. }
+            | ASTNode::GeneratorExpression { variable: name, .. }
+            | ASTNode::DictComprehension { variable: name, .. } => name.capacity(),
+            ASTNode::FunctionDeclaration { name, parameters, .. } => {
+                name.capacity()
+                    + parameters.capacity() * std::mem::size_of::<String>()
+                    + parameters.iter().map(String::capacity).sum::<usize>()
             }
-            ASTNode::FunctionCall { callee, arguments } => {
-                let mut result = format!("{}FunctionCall\n{}", prefix, callee.pretty_print(indent + 1));
-                for arg in arguments {
-                    result.push_str(&format!("\n{}", arg.pretty_print(indent + 1)));
-                }
-                result
+            ASTNode::Lambda { parameters, .. } => {
+                parameters.capacity() * std::mem::size_of::<String>()
+                    + parameters.iter().map(String::capacity).sum::<usize>()
             }
-            ASTNode::Program { statements } => {
-                let mut result = format!("{}Program", prefix);
-                for stmt in statements {
-                    result.push_str(&format!("\n{}", stmt.pretty_print(indent + 1)));
-                }
-                result
+            ASTNode::IfStatement { elif_clauses, .. } => {
+                elif_clauses.capacity() * std::mem::size_of::<(NodeId, NodeList)>()
+            }
+            ASTNode::TryCatch { catch_variable, .. } => catch_variable.as_ref().map_or(0, String::capacity),
+            ASTNode::ClassDeclaration { name, .. } => name.capacity(),
+            ASTNode::ImportStatement { module, alias } => {
+                module.capacity() + alias.as_ref().map_or(0, String::capacity)
             }
-            _ => format!("{}{:?}", prefix, self),
+            _ => 0,
         }
     }
 }
@@ -335,19 +537,48 @@ mod tests {
 
     #[test]
     fn test_binary_operation() {
-        let left = Box::new(ASTNode::Number(1.0));
-        let right = Box::new(ASTNode::Number(2.0));
-        let binop = ASTNode::BinaryOperation {
+        let mut ast = Ast::new();
+        let left = ast.push(ASTNode::Number(1.0));
+        let right = ast.push(ASTNode::Number(2.0));
+        let binop = ast.push(ASTNode::BinaryOperation {
             left,
             operator: BinaryOperator::Add,
             right,
-        };
+        });
+        ast.set_root(vec![binop]);
 
-        match binop {
-            ASTNode::BinaryOperation { operator, .. } => {
-                assert_eq!(operator, BinaryOperator::Add);
+        match ast.node(ast.statements()[0]) {
+            ASTNode::BinaryOperation { operator, left, .. } => {
+                assert_eq!(*operator, BinaryOperator::Add);
+                assert_eq!(ast.node(*left), &ASTNode::Number(1.0));
             }
             _ => panic!("Expected BinaryOperation"),
         }
     }
+
+    #[test]
+    fn test_uses_async() {
+        let mut ast = Ast::new();
+        let number = ast.push(ASTNode::Number(1.0));
+        ast.set_root(vec![number]);
+        assert!(!ast.uses_async());
+
+        let expression = ast.push(ASTNode::Identifier("t".to_string()));
+        let awaited = ast.push(ASTNode::AwaitExpression { expression });
+        ast.set_root(vec![number, awaited]);
+        assert!(ast.uses_async());
+    }
+
+    #[test]
+    fn test_node_lists_share_one_pool() {
+        let mut ast = Ast::new();
+        let elements: Vec<NodeId> = (0..3).map(|i| ast.push(ASTNode::Number(i as f64))).collect();
+        let first = ast.push_list(elements.clone());
+        let empty = ast.push_list(Vec::new());
+        let second = ast.push_list(elements[1..].to_vec());
+
+        assert_eq!(ast.list(first), &elements[..]);
+        assert!(empty.is_empty());
+        assert_eq!(ast.list(second), &elements[1..]);
+    }
 }
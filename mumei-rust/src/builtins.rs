@@ -1,168 +1,105 @@
 /// 組み込み関数
 /// Mumei言語の標準ライブラリ（組み込み関数）
 
-use crate::value::Value;
+use crate::array::{self, NumArray};
+use crate::dict::Key;
+use crate::string::StringBuilder;
+use crate::value::{NativeFunction, Value};
 use crate::environment::Environment;
+use crate::discord;
+use crate::gateway;
+use crate::http;
+use crate::shard;
+use crate::iterator::{self, Iter, Range, Step};
+use crate::task::{self, Task};
+use crate::vm::VM;
 use std::rc::Rc;
 
+/// 組み込み関数をバイトコードVMのグローバル変数に登録
+pub fn setup_vm_builtins(vm: &mut VM) {
+    let env = Environment::new();
+    setup_builtins(&env);
+    for name in env.get_all_names() {
+        vm.define_global(&name, env.get(&name).unwrap());
+    }
+}
+
 /// 組み込み関数を環境に登録
 pub fn setup_builtins(env: &Environment) {
     // 基本的な入出力
-    env.define("print".to_string(), Value::NativeFunction {
-        name: "print".to_string(),
-        arity: 1,
-        function: builtin_print,
-    }).unwrap();
-
-    env.define("println".to_string(), Value::NativeFunction {
-        name: "println".to_string(),
-        arity: 1,
-        function: builtin_println,
-    }).unwrap();
-
-    env.define("input".to_string(), Value::NativeFunction {
-        name: "input".to_string(),
-        arity: 0,
-        function: builtin_input,
-    }).unwrap();
+    env.define("print".to_string(), Value::native_with_optional("print", 1, 8, builtin_print)).unwrap();
+    env.define("println".to_string(), Value::native_with_optional("println", 1, 8, builtin_println)).unwrap();
+    env.define("input".to_string(), Value::native("input", 0, builtin_input)).unwrap();
 
     // 型変換
-    env.define("str".to_string(), Value::NativeFunction {
-        name: "str".to_string(),
-        arity: 1,
-        function: builtin_str,
-    }).unwrap();
-
-    env.define("num".to_string(), Value::NativeFunction {
-        name: "num".to_string(),
-        arity: 1,
-        function: builtin_num,
-    }).unwrap();
-
-    env.define("bool".to_string(), Value::NativeFunction {
-        name: "bool".to_string(),
-        arity: 1,
-        function: builtin_bool,
-    }).unwrap();
+    env.define("str".to_string(), Value::native("str", 1, builtin_str)).unwrap();
+    env.define("num".to_string(), Value::native("num", 1, builtin_num)).unwrap();
+    env.define("bool".to_string(), Value::native("bool", 1, builtin_bool)).unwrap();
 
     // 型チェック
-    env.define("type".to_string(), Value::NativeFunction {
-        name: "type".to_string(),
-        arity: 1,
-        function: builtin_type,
-    }).unwrap();
+    env.define("type".to_string(), Value::native("type", 1, builtin_type)).unwrap();
 
     // コレクション操作
-    env.define("len".to_string(), Value::NativeFunction {
-        name: "len".to_string(),
-        arity: 1,
-        function: builtin_len,
-    }).unwrap();
-
-    env.define("push".to_string(), Value::NativeFunction {
-        name: "push".to_string(),
-        arity: 2,
-        function: builtin_push,
-    }).unwrap();
-
-    env.define("pop".to_string(), Value::NativeFunction {
-        name: "pop".to_string(),
-        arity: 1,
-        function: builtin_pop,
-    }).unwrap();
-
-    env.define("keys".to_string(), Value::NativeFunction {
-        name: "keys".to_string(),
-        arity: 1,
-        function: builtin_keys,
-    }).unwrap();
-
-    env.define("values".to_string(), Value::NativeFunction {
-        name: "values".to_string(),
-        arity: 1,
-        function: builtin_values,
-    }).unwrap();
+    env.define("len".to_string(), Value::native("len", 1, builtin_len)).unwrap();
+    env.define("push".to_string(), Value::native("push", 2, builtin_push)).unwrap();
+    env.define("append".to_string(), Value::native("append", 2, builtin_push)).unwrap();
+    env.define("pop".to_string(), Value::native("pop", 1, builtin_pop)).unwrap();
+    env.define("keys".to_string(), Value::native("keys", 1, builtin_keys)).unwrap();
+    env.define("values".to_string(), Value::native("values", 1, builtin_values)).unwrap();
+    env.define("list".to_string(), Value::native_collecting("list", 1, builtin_list)).unwrap();
+    env.define("extend".to_string(), Value::native_collecting("extend", 2, builtin_extend)).unwrap();
+    env.define("reverse".to_string(), Value::native("reverse", 1, builtin_reverse)).unwrap();
+    env.define("sort".to_string(), Value::native_keyed("sort", builtin_sort)).unwrap();
+    env.define("map".to_string(), Value::native("map", 2, builtin_map)).unwrap();
+    env.define("filter".to_string(), Value::native("filter", 2, builtin_filter)).unwrap();
+    env.define("take".to_string(), Value::native("take", 2, builtin_take)).unwrap();
+    env.define("zip".to_string(), Value::native_with_optional("zip", 1, 8, builtin_zip)).unwrap();
 
     // 数学関数
-    env.define("abs".to_string(), Value::NativeFunction {
-        name: "abs".to_string(),
-        arity: 1,
-        function: builtin_abs,
-    }).unwrap();
-
-    env.define("floor".to_string(), Value::NativeFunction {
-        name: "floor".to_string(),
-        arity: 1,
-        function: builtin_floor,
-    }).unwrap();
-
-    env.define("ceil".to_string(), Value::NativeFunction {
-        name: "ceil".to_string(),
-        arity: 1,
-        function: builtin_ceil,
-    }).unwrap();
-
-    env.define("round".to_string(), Value::NativeFunction {
-        name: "round".to_string(),
-        arity: 1,
-        function: builtin_round,
-    }).unwrap();
-
-    env.define("sqrt".to_string(), Value::NativeFunction {
-        name: "sqrt".to_string(),
-        arity: 1,
-        function: builtin_sqrt,
-    }).unwrap();
-
-    env.define("min".to_string(), Value::NativeFunction {
-        name: "min".to_string(),
-        arity: 2,
-        function: builtin_min,
-    }).unwrap();
-
-    env.define("max".to_string(), Value::NativeFunction {
-        name: "max".to_string(),
-        arity: 2,
-        function: builtin_max,
-    }).unwrap();
+    env.define("abs".to_string(), Value::native("abs", 1, builtin_abs)).unwrap();
+    env.define("floor".to_string(), Value::native("floor", 1, builtin_floor)).unwrap();
+    env.define("ceil".to_string(), Value::native("ceil", 1, builtin_ceil)).unwrap();
+    env.define("round".to_string(), Value::native("round", 1, builtin_round)).unwrap();
+    env.define("sqrt".to_string(), Value::native("sqrt", 1, builtin_sqrt)).unwrap();
+    env.define("min".to_string(), Value::native_with_optional("min", 1, 2, builtin_min)).unwrap();
+    env.define("max".to_string(), Value::native_with_optional("max", 1, 2, builtin_max)).unwrap();
+
+    // 数値配列
+    env.define("array".to_string(), Value::native("array", 1, builtin_array)).unwrap();
+    env.define("slice".to_string(), Value::native_with_optional("slice", 2, 3, builtin_slice)).unwrap();
+    env.define("sum".to_string(), Value::native_collecting("sum", 1, builtin_sum)).unwrap();
+    env.define("mean".to_string(), Value::native_collecting("mean", 1, builtin_mean)).unwrap();
+    env.define("dot".to_string(), Value::native("dot", 2, builtin_dot)).unwrap();
 
     // 文字列操作
-    env.define("upper".to_string(), Value::NativeFunction {
-        name: "upper".to_string(),
-        arity: 1,
-        function: builtin_upper,
-    }).unwrap();
-
-    env.define("lower".to_string(), Value::NativeFunction {
-        name: "lower".to_string(),
-        arity: 1,
-        function: builtin_lower,
-    }).unwrap();
-
-    env.define("split".to_string(), Value::NativeFunction {
-        name: "split".to_string(),
-        arity: 2,
-        function: builtin_split,
-    }).unwrap();
-
-    env.define("join".to_string(), Value::NativeFunction {
-        name: "join".to_string(),
-        arity: 2,
-        function: builtin_join,
-    }).unwrap();
+    env.define("upper".to_string(), Value::native("upper", 1, builtin_upper)).unwrap();
+    env.define("lower".to_string(), Value::native("lower", 1, builtin_lower)).unwrap();
+    env.define("split".to_string(), Value::native("split", 2, builtin_split)).unwrap();
+    env.define("join".to_string(), Value::native("join", 2, builtin_join)).unwrap();
 
     // ユーティリティ
-    env.define("range".to_string(), Value::NativeFunction {
-        name: "range".to_string(),
-        arity: 2,
-        function: builtin_range,
-    }).unwrap();
-
-    env.define("assert".to_string(), Value::NativeFunction {
-        name: "assert".to_string(),
-        arity: 2,
-        function: builtin_assert,
-    }).unwrap();
+    env.define("range".to_string(), Value::native_with_optional("range", 2, 3, builtin_range)).unwrap();
+    env.define("assert".to_string(), Value::native("assert", 2, builtin_assert)).unwrap();
+
+    // 非同期処理（タスクは await したときに回るイベントループで実行される）
+    env.define("sleep".to_string(), Value::native("sleep", 1, builtin_sleep)).unwrap();
+    env.define("spawn".to_string(), Value::native_with_optional("spawn", 1, 9, builtin_spawn)).unwrap();
+    env.define("gather".to_string(), Value::native_with_optional("gather", 1, 16, builtin_gather)).unwrap();
+    env.define("timeout".to_string(), Value::native("timeout", 2, builtin_timeout)).unwrap();
+    env.define("task_done".to_string(), Value::native("task_done", 1, builtin_task_done)).unwrap();
+    env.define("get_time".to_string(), Value::native("get_time", 0, builtin_get_time)).unwrap();
+
+    // HTTP・JSON（リクエストはタスクになり、await で応答を待つ）
+    http::setup_http_builtins(env);
+
+    // Discord REST API（レート制限に合わせて送るタスク）
+    discord::setup_discord_builtins(env);
+
+    // Discord Gateway（イベントごとにハンドラーをタスクとして呼び出す）
+    gateway::setup_gateway_builtins(env);
+
+    // Gateway のシャード（スレッドごとのVMでハンドラーのスクリプトを実行する）
+    shard::setup_shard_builtins(env);
 
     // 定数
     env.define_const("PI".to_string(), Value::Number(std::f64::consts::PI)).unwrap();
@@ -173,24 +110,29 @@ pub fn setup_builtins(env: &Environment) {
 // 組み込み関数の実装
 // ============================================
 
-/// print(value) - 値を出力（改行なし）
+/// print(value, ...) - 値を空白区切りで出力（改行なし）
 fn builtin_print(args: Vec<Value>) -> Result<Value, String> {
-    if args.len() != 1 {
-        return Err(format!("print() takes 1 argument, got {}", args.len()));
+    if args.is_empty() {
+        return Err("print() takes at least 1 argument".to_string());
     }
-    print!("{}", args[0].to_string());
+    print!("{}", joined(&args));
     Ok(Value::Null)
 }
 
-/// println(value) - 値を出力（改行あり）
+/// println(value, ...) - 値を空白区切りで出力（改行あり）
 fn builtin_println(args: Vec<Value>) -> Result<Value, String> {
-    if args.len() != 1 {
-        return Err(format!("println() takes 1 argument, got {}", args.len()));
+    if args.is_empty() {
+        return Err("println() takes at least 1 argument".to_string());
     }
-    println!("{}", args[0].to_string());
+    println!("{}", joined(&args));
     Ok(Value::Null)
 }
 
+/// 出力する値を空白でつなげる
+fn joined(args: &[Value]) -> String {
+    args.iter().map(Value::to_string).collect::<Vec<_>>().join(" ")
+}
+
 /// input() - 標準入力から1行読み込む
 fn builtin_input(_args: Vec<Value>) -> Result<Value, String> {
     use std::io::{self, BufRead};
@@ -207,7 +149,7 @@ fn builtin_input(_args: Vec<Value>) -> Result<Value, String> {
         }
     }
 
-    Ok(Value::String(line))
+    Ok(Value::String(line.into()))
 }
 
 /// str(value) - 値を文字列に変換
@@ -215,7 +157,10 @@ fn builtin_str(args: Vec<Value>) -> Result<Value, String> {
     if args.len() != 1 {
         return Err(format!("str() takes 1 argument, got {}", args.len()));
     }
-    Ok(Value::String(args[0].to_string()))
+    match &args[0] {
+        Value::String(_) => Ok(args[0].clone()),
+        value => Ok(Value::String(value.to_string().into())),
+    }
 }
 
 /// num(value) - 値を数値に変換
@@ -249,7 +194,7 @@ fn builtin_type(args: Vec<Value>) -> Result<Value, String> {
     if args.len() != 1 {
         return Err(format!("type() takes 1 argument, got {}", args.len()));
     }
-    Ok(Value::String(args[0].type_name().to_string()))
+    Ok(Value::String(args[0].type_name().into()))
 }
 
 /// len(collection) - コレクションの長さを取得
@@ -259,14 +204,16 @@ fn builtin_len(args: Vec<Value>) -> Result<Value, String> {
     }
 
     match &args[0] {
-        Value::String(s) => Ok(Value::Number(s.chars().count() as f64)),
+        Value::String(s) => Ok(Value::Number(s.char_count() as f64)),
         Value::List(list) => Ok(Value::Number(list.borrow().len() as f64)),
         Value::Dictionary(dict) => Ok(Value::Number(dict.borrow().len() as f64)),
+        Value::Array(array) => Ok(Value::Number(array.len() as f64)),
+        Value::Range(range) => Ok(Value::Number(range.len() as f64)),
         _ => Err(format!("{} has no length", args[0].type_name())),
     }
 }
 
-/// push(list, value) - リストに要素を追加
+/// push(list, value) - リストに要素を追加（append(list, value) も同じ）
 fn builtin_push(args: Vec<Value>) -> Result<Value, String> {
     if args.len() != 2 {
         return Err(format!("push() takes 2 arguments, got {}", args.len()));
@@ -307,7 +254,7 @@ fn builtin_keys(args: Vec<Value>) -> Result<Value, String> {
         Value::Dictionary(dict) => {
             let keys: Vec<Value> = dict.borrow()
                 .keys()
-                .map(|k| Value::String(k.clone()))
+                .map(Key::to_value)
                 .collect();
             Ok(Value::List(Rc::new(std::cell::RefCell::new(keys))))
         }
@@ -333,6 +280,198 @@ fn builtin_values(args: Vec<Value>) -> Result<Value, String> {
     }
 }
 
+/// list(iterable) - 範囲・イテレータなどの要素をリストにする
+fn builtin_list(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 1 {
+        return Err(format!("list() takes 1 argument, got {}", args.len()));
+    }
+    Ok(Value::List(Rc::new(std::cell::RefCell::new(items(&args[0], "list")?))))
+}
+
+/// extend(list, iterable) - リストの末尾に要素をまとめて追加
+fn builtin_extend(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 2 {
+        return Err(format!("extend() takes 2 arguments, got {}", args.len()));
+    }
+
+    let Value::List(list) = &args[0] else {
+        return Err(format!("Cannot extend {}", args[0].type_name()));
+    };
+    match &args[1] {
+        // 別のリストならスライスのまま複製する（同じリストなら先に写しを取る）
+        Value::List(other) if !Rc::ptr_eq(list, other) => list.borrow_mut().extend_from_slice(&other.borrow()),
+        Value::Array(array) => list.borrow_mut().extend(array.as_slice().iter().map(|&n| Value::Number(n))),
+        values => {
+            let values = items(values, "extend")?;
+            list.borrow_mut().extend(values);
+        }
+    }
+    Ok(Value::Null)
+}
+
+/// reverse(list) - リストをその場で逆順にする
+fn builtin_reverse(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 1 {
+        return Err(format!("reverse() takes 1 argument, got {}", args.len()));
+    }
+
+    match &args[0] {
+        Value::List(list) => {
+            list.borrow_mut().reverse();
+            Ok(Value::Null)
+        }
+        _ => Err(format!("Cannot reverse {}", args[0].type_name())),
+    }
+}
+
+/// sort(list, key = null) - リストをその場で昇順に並べ替える（安定、key は要素ごとのキーを返す関数）
+/// ユーザー定義の key は実行エンジンが要素ごとに呼び、キーのリストにして渡す
+fn builtin_sort(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 1 && args.len() != 2 {
+        return Err(format!("sort() takes 1 or 2 arguments, got {}", args.len()));
+    }
+
+    let Value::List(list) = &args[0] else {
+        return Err(format!("Cannot sort {}", args[0].type_name()));
+    };
+    // 比較の途中で失敗したら最初のエラーを返す（並べ替えは最後まで行う）
+    let mut error = None;
+    let mut order = |a: &Value, b: &Value| {
+        a.compare(b).unwrap_or_else(|e| {
+            error.get_or_insert(e);
+            std::cmp::Ordering::Equal
+        })
+    };
+
+    match args.get(1) {
+        None => list.borrow_mut().sort_by(|a, b| order(a, b)),
+        Some(key) => {
+            // キーは要素ごとに1回だけ計算する
+            let keys = match key {
+                Value::List(keys) => keys.borrow().clone(),
+                key => {
+                    let key = native_callable(key)?;
+                    list.borrow()
+                        .iter()
+                        .map(|item| (key.function)(vec![item.clone()]))
+                        .collect::<Result<Vec<Value>, String>>()?
+                }
+            };
+            if keys.len() != list.borrow().len() {
+                return Err("sort() key must give one key per element".to_string());
+            }
+            let mut list = list.borrow_mut();
+            let mut keyed: Vec<(Value, Value)> = keys.into_iter().zip(list.drain(..)).collect();
+            keyed.sort_by(|(a, _), (b, _)| order(a, b));
+            list.extend(keyed.into_iter().map(|(_, item)| item));
+        }
+    }
+
+    match error {
+        Some(error) => Err(error),
+        None => Ok(Value::Null),
+    }
+}
+
+/// map(function, iterable) - 各要素に関数を適用するイテレータ（要素は求められるたびに1つずつ計算する）
+fn builtin_map(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 2 {
+        return Err(format!("map() takes 2 arguments, got {}", args.len()));
+    }
+
+    let mut args = args.into_iter();
+    let function = callable(args.next().unwrap())?;
+    let source = iterator::source(args.next().unwrap())?;
+    Ok(lazy(Iter::Map { function, source, calling: false }))
+}
+
+/// filter(function, iterable) - 関数の結果が真になる要素だけを返すイテレータ
+fn builtin_filter(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 2 {
+        return Err(format!("filter() takes 2 arguments, got {}", args.len()));
+    }
+
+    let mut args = args.into_iter();
+    let function = callable(args.next().unwrap())?;
+    let source = iterator::source(args.next().unwrap())?;
+    Ok(lazy(Iter::Filter { function, source, candidate: None }))
+}
+
+/// take(iterable, n) - 先頭の n 要素だけを返すイテレータ（無限のジェネレータにも使える）
+fn builtin_take(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 2 {
+        return Err(format!("take() takes 2 arguments, got {}", args.len()));
+    }
+
+    let count = args[1].as_number()?;
+    if count < 0.0 || count.fract() != 0.0 {
+        return Err(format!("take() count must be a non-negative integer, got {}", count));
+    }
+    let source = iterator::source(args.into_iter().next().unwrap())?;
+    Ok(lazy(Iter::Take { source, remaining: count as usize }))
+}
+
+/// zip(a, b, ...) - 各引数から1要素ずつ取ったリストを返すイテレータ（最も短いものに合わせる）
+fn builtin_zip(args: Vec<Value>) -> Result<Value, String> {
+    if args.is_empty() {
+        return Err("zip() takes at least 1 argument".to_string());
+    }
+
+    let sources = args.into_iter().map(iterator::source).collect::<Result<Vec<_>, String>>()?;
+    let items = Vec::with_capacity(sources.len());
+    Ok(lazy(Iter::Zip { sources, items }))
+}
+
+/// イテレータの値
+fn lazy(iter: Iter) -> Value {
+    Value::Iterator(Rc::new(std::cell::RefCell::new(iter)))
+}
+
+/// map・filter に渡す関数（ユーザー定義の関数は実行エンジンが呼ぶ）
+fn callable(value: Value) -> Result<Value, String> {
+    match &value {
+        Value::NativeFunction(function) => {
+            function.check_arity(1)?;
+            Ok(value)
+        }
+        Value::Function(_) | Value::Closure(_) => Ok(value),
+        _ => Err(format!("{} is not callable", value.type_name())),
+    }
+}
+
+/// 反復できる値の要素（残りの要素数が分かれば一度に確保する）
+fn items(value: &Value, name: &str) -> Result<Vec<Value>, String> {
+    if let Value::List(list) = value {
+        return Ok(list.borrow().clone());
+    }
+
+    let iterator = iterator::source(value.clone())?;
+    let mut iterator = iterator.borrow_mut();
+    let mut items = Vec::with_capacity(iterator.len_hint());
+    loop {
+        match iterator.next()? {
+            Step::Item(item) => items.push(item),
+            Step::Done => break,
+            // 組み込み関数からはユーザー定義の関数を呼べない（list・extend なら実行エンジンが先にリストにしている）
+            Step::Call(..) | Step::Resume(_) => {
+                return Err(format!("{}() cannot consume an iterator that calls user functions; use a for loop", name))
+            }
+        }
+    }
+    Ok(items)
+}
+
+/// 要素ごとに呼ぶ組み込み関数（ユーザー定義の関数は実行エンジンが呼ぶ）
+fn native_callable(value: &Value) -> Result<&NativeFunction, String> {
+    match value {
+        Value::NativeFunction(function) => {
+            function.check_arity(1)?;
+            Ok(function)
+        }
+        _ => Err(format!("{} is not callable", value.type_name())),
+    }
+}
+
 /// abs(number) - 絶対値
 fn builtin_abs(args: Vec<Value>) -> Result<Value, String> {
     if args.len() != 1 {
@@ -381,24 +520,28 @@ fn builtin_sqrt(args: Vec<Value>) -> Result<Value, String> {
     Ok(Value::Number(n.sqrt()))
 }
 
-/// min(a, b) - 最小値
+/// min(a, b) / min(values) - 最小値（引数1つなら配列・リストの最小値）
 fn builtin_min(args: Vec<Value>) -> Result<Value, String> {
-    if args.len() != 2 {
-        return Err(format!("min() takes 2 arguments, got {}", args.len()));
+    match args.as_slice() {
+        [values] => {
+            let values = numbers(values, "min")?;
+            array::min(&values).map(Value::Number).ok_or_else(|| "min() of empty sequence".to_string())
+        }
+        [a, b] => Ok(Value::Number(a.as_number()?.min(b.as_number()?))),
+        _ => Err(format!("min() takes 1 or 2 arguments, got {}", args.len())),
     }
-    let a = args[0].as_number()?;
-    let b = args[1].as_number()?;
-    Ok(Value::Number(a.min(b)))
 }
 
-/// max(a, b) - 最大値
+/// max(a, b) / max(values) - 最大値（引数1つなら配列・リストの最大値）
 fn builtin_max(args: Vec<Value>) -> Result<Value, String> {
-    if args.len() != 2 {
-        return Err(format!("max() takes 2 arguments, got {}", args.len()));
+    match args.as_slice() {
+        [values] => {
+            let values = numbers(values, "max")?;
+            array::max(&values).map(Value::Number).ok_or_else(|| "max() of empty sequence".to_string())
+        }
+        [a, b] => Ok(Value::Number(a.as_number()?.max(b.as_number()?))),
+        _ => Err(format!("max() takes 1 or 2 arguments, got {}", args.len())),
     }
-    let a = args[0].as_number()?;
-    let b = args[1].as_number()?;
-    Ok(Value::Number(a.max(b)))
 }
 
 /// upper(string) - 大文字に変換
@@ -407,7 +550,7 @@ fn builtin_upper(args: Vec<Value>) -> Result<Value, String> {
         return Err(format!("upper() takes 1 argument, got {}", args.len()));
     }
     let s = args[0].as_string()?;
-    Ok(Value::String(s.to_uppercase()))
+    Ok(Value::String(s.to_uppercase().into()))
 }
 
 /// lower(string) - 小文字に変換
@@ -416,7 +559,7 @@ fn builtin_lower(args: Vec<Value>) -> Result<Value, String> {
         return Err(format!("lower() takes 1 argument, got {}", args.len()));
     }
     let s = args[0].as_string()?;
-    Ok(Value::String(s.to_lowercase()))
+    Ok(Value::String(s.to_lowercase().into()))
 }
 
 /// split(string, delimiter) - 文字列を分割
@@ -428,8 +571,8 @@ fn builtin_split(args: Vec<Value>) -> Result<Value, String> {
     let delimiter = args[1].as_string()?;
 
     let parts: Vec<Value> = s
-        .split(&delimiter)
-        .map(|part| Value::String(part.to_string()))
+        .split(delimiter.as_str())
+        .map(|part| Value::String(part.into()))
         .collect();
 
     Ok(Value::List(Rc::new(std::cell::RefCell::new(parts))))
@@ -444,28 +587,141 @@ fn builtin_join(args: Vec<Value>) -> Result<Value, String> {
     let list = args[0].as_list()?;
     let separator = args[1].as_string()?;
 
-    let strings: Vec<String> = list.borrow()
-        .iter()
-        .map(|v| v.to_string())
-        .collect();
+    // 文字列の要素は長さが分かるので先に容量を取り、1つのバッファに書き足す
+    let list = list.borrow();
+    let capacity = list.iter()
+        .map(|v| match v {
+            Value::String(s) => s.len(),
+            _ => 0,
+        })
+        .sum::<usize>()
+        + separator.len() * list.len().saturating_sub(1);
+    let mut builder = StringBuilder::with_capacity(capacity);
+    for (i, value) in list.iter().enumerate() {
+        if i > 0 {
+            builder.push_str(&separator);
+        }
+        builder.push_value(value);
+    }
 
-    Ok(Value::String(strings.join(&separator)))
+    Ok(Value::String(builder.finish()))
 }
 
-/// range(start, end) - 範囲のリストを生成
+/// range(start, end, step = 1) - 範囲を作成（要素は反復するときに1つずつ作る）
 fn builtin_range(args: Vec<Value>) -> Result<Value, String> {
-    if args.len() != 2 {
-        return Err(format!("range() takes 2 arguments, got {}", args.len()));
+    if args.len() != 2 && args.len() != 3 {
+        return Err(format!("range() takes 2 or 3 arguments, got {}", args.len()));
     }
 
     let start = args[0].as_number()? as i64;
     let end = args[1].as_number()? as i64;
+    let step = match args.get(2) {
+        Some(step) => step.as_number()? as i64,
+        None => 1,
+    };
 
-    let values: Vec<Value> = (start..end)
-        .map(|i| Value::Number(i as f64))
-        .collect();
+    Ok(Value::Range(Rc::new(Range::new(start, end, step)?)))
+}
+
+/// 配列・リスト・範囲・イテレータの要素を f64 のスライスとして取り出す（配列ならコピーしない）
+fn numbers<'a>(value: &'a Value, name: &str) -> Result<std::borrow::Cow<'a, [f64]>, String> {
+    use std::borrow::Cow;
+    match value {
+        Value::Array(array) => Ok(Cow::Borrowed(array.as_slice())),
+        Value::List(list) => list.borrow()
+            .iter()
+            .map(|item| item.as_number())
+            .collect::<Result<Vec<f64>, String>>()
+            .map(Cow::Owned)
+            .map_err(|_| format!("{}() requires a list of numbers", name)),
+        // 範囲・イテレータは要素を取り出してから（ジェネレータは実行エンジンがリストにしている）
+        Value::Range(_) | Value::Iterator(_) => items(value, name)?
+            .iter()
+            .map(|item| item.as_number())
+            .collect::<Result<Vec<f64>, String>>()
+            .map(Cow::Owned)
+            .map_err(|_| format!("{}() requires a list of numbers", name)),
+        _ => Err(format!("{}() requires an array or list, got {}", name, value.type_name())),
+    }
+}
 
-    Ok(Value::List(Rc::new(std::cell::RefCell::new(values))))
+/// array(values) - 数値配列を作成（リスト・範囲・配列から）
+fn builtin_array(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 1 {
+        return Err(format!("array() takes 1 argument, got {}", args.len()));
+    }
+
+    let array = match &args[0] {
+        Value::Array(_) => return Ok(args[0].clone()),
+        Value::Range(range) => NumArray::from_values((0..range.len()).map(|i| (range.start + i as i64 * range.step) as f64)),
+        Value::List(_) => NumArray::new(numbers(&args[0], "array")?.into_owned()),
+        _ => return Err(format!("Cannot make array from {}", args[0].type_name())),
+    };
+    Ok(Value::Array(Rc::new(array)))
+}
+
+/// slice(values, start, end = len) - 部分を取り出す（配列はコピーしないビュー、リストは新しいリスト）
+fn builtin_slice(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 2 && args.len() != 3 {
+        return Err(format!("slice() takes 2 or 3 arguments, got {}", args.len()));
+    }
+
+    let index = |value: &Value| -> Result<usize, String> {
+        let n = value.as_number()?;
+        if n < 0.0 || n.fract() != 0.0 {
+            return Err(format!("Slice index must be non-negative integer, got {}", n));
+        }
+        Ok(n as usize)
+    };
+    let start = index(&args[1])?;
+    let end = match args.get(2) {
+        Some(end) => index(end)?,
+        None => usize::MAX,
+    };
+
+    match &args[0] {
+        Value::Array(array) => Ok(Value::Array(Rc::new(array.slice(start, end)))),
+        Value::List(list) => {
+            let list = list.borrow();
+            let end = end.min(list.len());
+            let start = start.min(end);
+            Ok(Value::List(Rc::new(std::cell::RefCell::new(list[start..end].to_vec()))))
+        }
+        _ => Err(format!("Cannot slice {}", args[0].type_name())),
+    }
+}
+
+/// sum(values) - 合計
+fn builtin_sum(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 1 {
+        return Err(format!("sum() takes 1 argument, got {}", args.len()));
+    }
+    Ok(Value::Number(array::sum(&numbers(&args[0], "sum")?)))
+}
+
+/// mean(values) - 平均
+fn builtin_mean(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 1 {
+        return Err(format!("mean() takes 1 argument, got {}", args.len()));
+    }
+    let values = numbers(&args[0], "mean")?;
+    if values.is_empty() {
+        return Err("mean() of empty sequence".to_string());
+    }
+    Ok(Value::Number(array::sum(&values) / values.len() as f64))
+}
+
+/// dot(a, b) - 内積
+fn builtin_dot(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 2 {
+        return Err(format!("dot() takes 2 arguments, got {}", args.len()));
+    }
+    let a = numbers(&args[0], "dot")?;
+    let b = numbers(&args[1], "dot")?;
+    if a.len() != b.len() {
+        return Err(format!("Array length mismatch: {} and {}", a.len(), b.len()));
+    }
+    Ok(Value::Number(array::dot(&a, &b)))
 }
 
 /// assert(condition, message) - アサーション
@@ -481,3 +737,80 @@ fn builtin_assert(args: Vec<Value>) -> Result<Value, String> {
 
     Ok(Value::Null)
 }
+
+/// sleep(seconds) - 秒数が経つと終わるタスク（await で待つ。await している間はほかのタスクが動く）
+fn builtin_sleep(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 1 {
+        return Err(format!("sleep() takes 1 argument, got {}", args.len()));
+    }
+    Ok(Value::Task(task::sleep(seconds(&args[0], "sleep")?)))
+}
+
+/// get_time() - 現在のUNIX時間（秒、小数部あり）
+fn builtin_get_time(_args: Vec<Value>) -> Result<Value, String> {
+    let now = std::time::SystemTime::now()
+        .duration_since(std::time::UNIX_EPOCH)
+        .map_err(|e| format!("get_time() failed: {}", e))?;
+    Ok(Value::Number(now.as_secs_f64()))
+}
+
+/// spawn(function, args...) - 関数の呼び出しをタスクとして実行待ちにする
+fn builtin_spawn(args: Vec<Value>) -> Result<Value, String> {
+    let mut args = args.into_iter();
+    let function = args.next().ok_or("spawn() takes at least 1 argument")?;
+    let name = match &function {
+        Value::Function(function) => function.name.clone(),
+        Value::Closure(closure) => closure.function.name.clone(),
+        Value::NativeFunction(native) => native.name.clone(),
+        _ => return Err(format!("{} is not callable", function.type_name())),
+    };
+    Ok(Value::Task(task::spawn(&name, function, args.collect())))
+}
+
+/// gather(tasks...) / gather([tasks]) - すべてのタスクの結果のリストを結果にするタスク
+fn builtin_gather(args: Vec<Value>) -> Result<Value, String> {
+    let values = match args.as_slice() {
+        [Value::List(list)] => list.borrow().clone(),
+        _ => args,
+    };
+    let tasks = values
+        .into_iter()
+        .map(|value| awaitable(value, "gather"))
+        .collect::<Result<Vec<_>, String>>()?;
+    Ok(Value::Task(task::gather(tasks)))
+}
+
+/// timeout(task, seconds) - 秒数以内に終わらなければタスクを取り消して失敗するタスク
+fn builtin_timeout(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 2 {
+        return Err(format!("timeout() takes 2 arguments, got {}", args.len()));
+    }
+    let seconds = seconds(&args[1], "timeout")?;
+    let limited = awaitable(args.into_iter().next().unwrap(), "timeout")?;
+    Ok(Value::Task(task::timeout(limited, seconds)))
+}
+
+/// task_done(task) - タスクが終わったか
+fn builtin_task_done(args: Vec<Value>) -> Result<Value, String> {
+    if args.len() != 1 {
+        return Err(format!("task_done() takes 1 argument, got {}", args.len()));
+    }
+    Ok(Value::Boolean(awaitable(args[0].clone(), "task_done")?.is_done()))
+}
+
+/// 待つことのできるタスク
+fn awaitable(value: Value, name: &str) -> Result<Rc<Task>, String> {
+    match value {
+        Value::Task(task) => Ok(task),
+        value => Err(format!("{}() requires a task, got {}", name, value.type_name())),
+    }
+}
+
+/// 待つ秒数（0 以上の有限の数）
+fn seconds(value: &Value, name: &str) -> Result<f64, String> {
+    let seconds = value.as_number()?;
+    if !(seconds >= 0.0 && seconds.is_finite()) {
+        return Err(format!("{}() seconds must be a non-negative number, got {}", name, value));
+    }
+    Ok(seconds)
+}
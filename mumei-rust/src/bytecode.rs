@@ -1,16 +1,25 @@
 /// バイトコード命令セット
 /// ASTをコンパイルした中間表現
 
+use std::sync::Arc;
+use serde::{Deserialize, Serialize};
+use crate::string::Str;
 use crate::value::Value;
 
 /// バイトコード命令
-#[derive(Debug, Clone)]
+/// オペランドはすべてインデックスなので固定長でCopy可能（ディスパッチでヒープ確保しない）
+#[derive(Debug, Clone, Copy, PartialEq, Serialize, Deserialize)]
 pub enum Instruction {
     // スタック操作
-    LoadConst(Value),           // 定数をスタックにプッシュ
-    LoadVar(String),            // 変数をロードしてスタックにプッシュ
-    StoreVar(String),           // スタックトップの値を変数に保存
+    LoadConst(u32),             // 定数プールのインデックスの値をプッシュ
+    LoadLocal(u16),             // フレーム内スロットのローカル変数をプッシュ
+    StoreLocal(u16),            // スタックトップの値をローカル変数スロットに保存
+    LoadGlobal(u32),            // グローバル変数（名前テーブルのインデックス）をプッシュ
+    StoreGlobal(u32),           // スタックトップの値をグローバル変数に保存
+    LoadUpvalue(u16),           // クロージャが捕捉した外側の変数をプッシュ
+    StoreUpvalue(u16),          // スタックトップの値を捕捉変数に保存
     Pop,                        // スタックトップを削除
+    Dup,                        // スタックトップを複製
 
     // 算術演算（スタックトップの2つの値を演算）
     Add,                        // +
@@ -43,38 +52,301 @@ pub enum Instruction {
 
     // 関数呼び出し
     Call(usize),                // 関数呼び出し（引数の数）
+    TailCall(usize),            // 末尾呼び出し（現在のフレームを再利用）
     Return,                     // 関数から戻る
+    MakeClosure(usize),         // 関数プロトタイプからクロージャを作成（functionsのインデックス）
+    Yield,                      // スタックトップの値を返してジェネレータのフレームを中断する（generator モジュール参照）
+    Await,                      // スタックトップのタスクの結果を待つ（async 関数ではフレームを中断する、task モジュール参照）
 
     // コレクション
     MakeList(usize),            // リストを作成（要素数）
-    MakeDict(usize),            // 辞書を作成（ペア数）
-    IndexGet,                   // インデックスアクセス
-    IndexSet,                   // インデックス代入
+    MakeDict(usize),            // 辞書を作成（ペア数、キー・値の順に積む）
+    IndexGet,                   // インデックスアクセス（オブジェクト・インデックスの順に積む）
+    IndexSet,                   // インデックス代入（値・オブジェクト・インデックスの順に積む）
+    NewCollection(bool),        // 内包表記の結果をイテレータの下に積む（true なら辞書、残りの要素数で確保）
+    ListAppend,                 // 値をイテレータの下のリストに追加
+    DictInsert,                 // キー・値をイテレータの下の辞書に追加
+
+    // 反復（iterator モジュール参照）
+    GetIter,                    // スタックトップの値をイテレータに置き換える
+    ForIter(usize),             // 次の要素を積む（イテレータは残す）、尽きたらイテレータを取り除いてジャンプ
+
+    // クラス・インスタンス（shape モジュール参照、名前は文字列定数のインデックス）
+    MakeClass(u32, u16, bool),  // クラスを作成（名前, メソッド数, 親クラスの有無）。親クラス・メソッドのクロージャの順に積む
+    GetField(u32, u32),         // インスタンスのメンバーを読む（名前, インラインキャッシュの番号）
+    SetField(u32, u32),         // インスタンスのメンバーに書き込む（値・インスタンスの順に積む）
+    GetMethod(u32, u32),        // メソッドとインスタンスを積む（メソッドでなければメンバーの値とNull）
+    CallMethod(usize),          // GetMethod で積んだメソッドを呼び出す（引数の数、インスタンスは最初の引数になる）
+
+    // 複合命令（最適化で生成、optimizer モジュール参照）
+    IncrLocal(u16, u32),        // ローカル変数に定数を加算（LoadLocal; LoadConst; Add; StoreLocal）
+    IncrGlobal(u32, u32),       // グローバル変数に定数を加算（LoadGlobal; LoadConst; Add; StoreGlobal）
+    LessJumpIfFalse(usize),     // Less; JumpIfFalse
+    GreaterJumpIfFalse(usize),  // Greater; JumpIfFalse
+    LessEqualJumpIfFalse(usize),     // LessEqual; JumpIfFalse
+    GreaterEqualJumpIfFalse(usize),  // GreaterEqual; JumpIfFalse
+    EqualJumpIfFalse(usize),    // Equal; JumpIfFalse
+    NotEqualJumpIfFalse(usize), // NotEqual; JumpIfFalse
 
     // その他
     Print,                      // 出力
     Halt,                       // 停止
+
+    // 特殊化命令（実行時にVMが自分の命令列の複製を書き換えて使う、quicken モジュール参照）
+    // オペランドの型が想定と違えば元の汎用命令に戻る。コンパイラ・最適化は生成しない
+    AddNum,                     // Add（数値同士）
+    SubtractNum,                // Subtract（数値同士）
+    MultiplyNum,                // Multiply（数値同士）
+    DivideNum,                  // Divide（数値同士）
+    ConcatStr,                  // Add（文字列同士）
+    LessNum,                    // Less（数値同士）
+    GreaterNum,                 // Greater（数値同士）
+    LessEqualNum,               // LessEqual（数値同士）
+    GreaterEqualNum,            // GreaterEqual（数値同士）
+    LessNumJump(usize),         // LessJumpIfFalse（数値同士）
+    GreaterNumJump(usize),      // GreaterJumpIfFalse（数値同士）
+    LessEqualNumJump(usize),    // LessEqualJumpIfFalse（数値同士）
+    GreaterEqualNumJump(usize), // GreaterEqualJumpIfFalse（数値同士）
+    LoadGlobalCached(u32),      // LoadGlobal（定義済みのグローバル変数）
+}
+
+impl Instruction {
+    /// ジャンプ命令ならジャンプ先
+    #[inline]
+    pub fn jump_target(&self) -> Option<usize> {
+        match *self {
+            Instruction::Jump(target)
+            | Instruction::JumpIfFalse(target)
+            | Instruction::JumpIfTrue(target)
+            | Instruction::ForIter(target)
+            | Instruction::LessJumpIfFalse(target)
+            | Instruction::GreaterJumpIfFalse(target)
+            | Instruction::LessEqualJumpIfFalse(target)
+            | Instruction::GreaterEqualJumpIfFalse(target)
+            | Instruction::EqualJumpIfFalse(target)
+            | Instruction::NotEqualJumpIfFalse(target)
+            | Instruction::LessNumJump(target)
+            | Instruction::GreaterNumJump(target)
+            | Instruction::LessEqualNumJump(target)
+            | Instruction::GreaterEqualNumJump(target) => Some(target),
+            _ => None,
+        }
+    }
+
+    /// ジャンプ先を差し替えた命令（ジャンプ命令以外はそのまま）
+    pub fn with_jump_target(self, target: usize) -> Instruction {
+        match self {
+            Instruction::Jump(_) => Instruction::Jump(target),
+            Instruction::JumpIfFalse(_) => Instruction::JumpIfFalse(target),
+            Instruction::JumpIfTrue(_) => Instruction::JumpIfTrue(target),
+            Instruction::ForIter(_) => Instruction::ForIter(target),
+            Instruction::LessJumpIfFalse(_) => Instruction::LessJumpIfFalse(target),
+            Instruction::GreaterJumpIfFalse(_) => Instruction::GreaterJumpIfFalse(target),
+            Instruction::LessEqualJumpIfFalse(_) => Instruction::LessEqualJumpIfFalse(target),
+            Instruction::GreaterEqualJumpIfFalse(_) => Instruction::GreaterEqualJumpIfFalse(target),
+            Instruction::EqualJumpIfFalse(_) => Instruction::EqualJumpIfFalse(target),
+            Instruction::NotEqualJumpIfFalse(_) => Instruction::NotEqualJumpIfFalse(target),
+            Instruction::LessNumJump(_) => Instruction::LessNumJump(target),
+            Instruction::GreaterNumJump(_) => Instruction::GreaterNumJump(target),
+            Instruction::LessEqualNumJump(_) => Instruction::LessEqualNumJump(target),
+            Instruction::GreaterEqualNumJump(_) => Instruction::GreaterEqualNumJump(target),
+            other => other,
+        }
+    }
+
+    /// 条件付きジャンプか（次の命令にも進みうる）
+    #[inline]
+    pub fn is_conditional_jump(&self) -> bool {
+        self.jump_target().is_some() && !matches!(self, Instruction::Jump(_))
+    }
+
+    /// 次の命令に進まない命令か（無条件ジャンプ・復帰・停止）
+    #[inline]
+    pub fn is_terminator(&self) -> bool {
+        matches!(
+            self,
+            Instruction::Jump(_) | Instruction::Return | Instruction::TailCall(_) | Instruction::Halt
+        )
+    }
+
+    /// メンバーアクセス命令ならインラインキャッシュの番号
+    #[inline]
+    pub fn inline_cache(&self) -> Option<u32> {
+        match *self {
+            Instruction::GetField(_, cache)
+            | Instruction::SetField(_, cache)
+            | Instruction::GetMethod(_, cache) => Some(cache),
+            _ => None,
+        }
+    }
+
+    /// 特殊化命令の元の汎用命令（特殊化命令以外はそのまま）
+    pub fn generic(self) -> Instruction {
+        match self {
+            Instruction::AddNum | Instruction::ConcatStr => Instruction::Add,
+            Instruction::SubtractNum => Instruction::Subtract,
+            Instruction::MultiplyNum => Instruction::Multiply,
+            Instruction::DivideNum => Instruction::Divide,
+            Instruction::LessNum => Instruction::Less,
+            Instruction::GreaterNum => Instruction::Greater,
+            Instruction::LessEqualNum => Instruction::LessEqual,
+            Instruction::GreaterEqualNum => Instruction::GreaterEqual,
+            Instruction::LessNumJump(target) => Instruction::LessJumpIfFalse(target),
+            Instruction::GreaterNumJump(target) => Instruction::GreaterJumpIfFalse(target),
+            Instruction::LessEqualNumJump(target) => Instruction::LessEqualJumpIfFalse(target),
+            Instruction::GreaterEqualNumJump(target) => Instruction::GreaterEqualJumpIfFalse(target),
+            Instruction::LoadGlobalCached(index) => Instruction::LoadGlobal(index),
+            other => other,
+        }
+    }
+
+    /// 特殊化命令か
+    #[inline]
+    pub fn is_specialized(&self) -> bool {
+        self.generic() != *self
+    }
+
+    /// 複合命令を元の命令列に展開（基本命令ならNone）
+    /// 複合命令を個別に扱わない処理（JITなど）は展開した列を順に処理すればよい
+    pub fn fused_parts(self) -> Option<Vec<Instruction>> {
+        let (compare, target) = match self {
+            Instruction::IncrLocal(slot, index) => {
+                return Some(vec![
+                    Instruction::LoadLocal(slot),
+                    Instruction::LoadConst(index),
+                    Instruction::Add,
+                    Instruction::StoreLocal(slot),
+                ]);
+            }
+            Instruction::IncrGlobal(name, index) => {
+                return Some(vec![
+                    Instruction::LoadGlobal(name),
+                    Instruction::LoadConst(index),
+                    Instruction::Add,
+                    Instruction::StoreGlobal(name),
+                ]);
+            }
+            Instruction::LessJumpIfFalse(target) => (Instruction::Less, target),
+            Instruction::GreaterJumpIfFalse(target) => (Instruction::Greater, target),
+            Instruction::LessEqualJumpIfFalse(target) => (Instruction::LessEqual, target),
+            Instruction::GreaterEqualJumpIfFalse(target) => (Instruction::GreaterEqual, target),
+            Instruction::EqualJumpIfFalse(target) => (Instruction::Equal, target),
+            Instruction::NotEqualJumpIfFalse(target) => (Instruction::NotEqual, target),
+            _ => return None,
+        };
+        Some(vec![compare, Instruction::JumpIfFalse(target)])
+    }
+}
+
+/// 定数プールの値（リテラルのみ。バイトコードをスレッド間で共有できるようValueとは分ける）
+#[derive(Debug, Clone, PartialEq, Serialize, Deserialize)]
+pub enum Constant {
+    Number(f64),
+    String(String),
+    Boolean(bool),
+    Null,
+}
+
+impl Constant {
+    /// 実行時の値に変換
+    #[inline]
+    pub fn to_value(&self) -> Value {
+        match self {
+            Constant::Number(n) => Value::Number(*n),
+            Constant::String(s) => Value::String(Str::new(s)),
+            Constant::Boolean(b) => Value::Boolean(*b),
+            Constant::Null => Value::Null,
+        }
+    }
+
+    /// 実行時の値から定数を作る（リテラルで表せない値はNone、定数畳み込み用）
+    pub fn from_value(value: &Value) -> Option<Constant> {
+        match value {
+            Value::Number(n) => Some(Constant::Number(*n)),
+            Value::String(s) => Some(Constant::String(s.to_string())),
+            Value::Boolean(b) => Some(Constant::Boolean(*b)),
+            Value::Null => Some(Constant::Null),
+            _ => None,
+        }
+    }
 }
 
 /// コンパイル済みバイトコード
-#[derive(Debug, Clone)]
+/// 定数・関数プロトタイプともスレッド間で共有でき（Send + Sync）、.muc ファイルに保存できる
+#[derive(Debug, Clone, Serialize, Deserialize)]
 pub struct ByteCode {
     /// 命令列
     pub instructions: Vec<Instruction>,
 
     /// 定数プール
-    pub constants: Vec<Value>,
+    pub constants: Vec<Constant>,
+
+    /// グローバル変数名テーブル（LoadGlobal/StoreGlobalのオペランドが指す）
+    pub names: Vec<String>,
+
+    /// このチャンク内で定義される関数のプロトタイプ（MakeClosureのオペランドが指す）
+    pub functions: Vec<Arc<FunctionProto>>,
+
+    /// フレームが確保するローカル変数スロット数（引数を含む）
+    pub local_count: usize,
+
+    /// ローカル変数より上に同時に積まれる一時値の最大数（verifier が計算する）
+    pub max_stack: usize,
 
     /// エントリーポイント
     pub entry_point: usize,
 }
 
+/// コンパイル済み関数（独自の命令列を持つ）
+#[derive(Debug, Clone, Serialize, Deserialize)]
+pub struct FunctionProto {
+    /// 関数名
+    pub name: String,
+
+    /// パラメータ名（スロット 0..n に対応）
+    pub parameters: Vec<String>,
+
+    /// 関数本体のバイトコード
+    pub chunk: Arc<ByteCode>,
+
+    /// 捕捉する外側の変数
+    pub upvalues: Vec<UpvalueDesc>,
+
+    /// 本体に yield を含むか（呼び出すとフレームを実行せずにジェネレータを返す）
+    pub is_generator: bool,
+
+    /// async 関数か（呼び出すとフレームを実行せずにタスクを返す）
+    pub is_async: bool,
+}
+
+impl FunctionProto {
+    /// 呼び出すとフレームを実行せずにジェネレータ・タスクを返すか
+    #[inline]
+    pub fn suspends(&self) -> bool {
+        self.is_generator || self.is_async
+    }
+}
+
+/// クロージャ作成時に捕捉する変数の位置
+#[derive(Debug, Clone, Copy, PartialEq, Serialize, Deserialize)]
+pub struct UpvalueDesc {
+    /// true: 直接外側の関数のローカルスロット / false: 外側の関数の捕捉変数
+    pub is_local: bool,
+
+    /// スロット番号または外側の捕捉変数のインデックス
+    pub index: u16,
+}
+
 impl ByteCode {
     /// 新しいバイトコードを作成
     pub fn new() -> Self {
         ByteCode {
             instructions: Vec::new(),
             constants: Vec::new(),
+            names: Vec::new(),
+            functions: Vec::new(),
+            local_count: 0,
+            max_stack: 0,
             entry_point: 0,
         }
     }
@@ -87,10 +359,14 @@ impl ByteCode {
     }
 
     /// 定数を追加
-    pub fn add_constant(&mut self, value: Value) -> usize {
-        // 既存の定数を検索
+    pub fn add_constant(&mut self, value: Constant) -> usize {
+        // 既存の定数を検索（数値はビット単位で比較し、近い値を同一視しない）
         for (i, constant) in self.constants.iter().enumerate() {
-            if constant.equals(&value) {
+            let same = match (constant, &value) {
+                (Constant::Number(a), Constant::Number(b)) => a.to_bits() == b.to_bits(),
+                (a, b) => a == b,
+            };
+            if same {
                 return i;
             }
         }
@@ -101,6 +377,31 @@ impl ByteCode {
         index
     }
 
+    /// 定数をプールに登録し、それをロードする命令を追加
+    pub fn emit_constant(&mut self, value: Constant) -> usize {
+        let index = self.add_constant(value) as u32;
+        self.emit(Instruction::LoadConst(index))
+    }
+
+    /// 数値定数を取得（数値専用の実行パス用）
+    #[inline]
+    pub fn number_constant(&self, index: u32) -> Option<f64> {
+        match self.constants.get(index as usize) {
+            Some(Constant::Number(n)) => Some(*n),
+            _ => None,
+        }
+    }
+
+    /// グローバル変数名を登録（既存の名前は同じインデックスを返す）
+    pub fn add_name(&mut self, name: &str) -> u32 {
+        if let Some(index) = self.names.iter().position(|n| n == name) {
+            return index as u32;
+        }
+
+        self.names.push(name.to_string());
+        (self.names.len() - 1) as u32
+    }
+
     /// 命令のパッチ（ジャンプ先の更新）
     pub fn patch(&mut self, index: usize, instruction: Instruction) {
         self.instructions[index] = instruction;
@@ -111,18 +412,63 @@ impl ByteCode {
         self.instructions.len()
     }
 
+    /// おおよそのメモリ使用量（バイト数、キャッシュの容量管理用）
+    pub fn estimated_size(&self) -> usize {
+        use std::mem::size_of;
+
+        let mut size = size_of::<ByteCode>()
+            + self.instructions.len() * size_of::<Instruction>()
+            + self.constants.len() * size_of::<Constant>();
+        for constant in &self.constants {
+            if let Constant::String(s) = constant {
+                size += s.len();
+            }
+        }
+        for name in &self.names {
+            size += size_of::<String>() + name.len();
+        }
+        for function in &self.functions {
+            size += size_of::<FunctionProto>()
+                + function.name.len()
+                + function.parameters.iter().map(|p| size_of::<String>() + p.len()).sum::<usize>()
+                + function.upvalues.len() * size_of::<UpvalueDesc>()
+                + function.chunk.estimated_size();
+        }
+        size
+    }
+
     /// バイトコードの逆アセンブル（デバッグ用）
     pub fn disassemble(&self) -> String {
         let mut result = String::from("=== Bytecode Disassembly ===\n");
 
         result.push_str(&format!("Entry point: {}\n", self.entry_point));
+        result.push_str(&format!("Locals: {}, max stack: {}\n", self.local_count, self.max_stack));
         result.push_str(&format!("Constants: {} items\n", self.constants.len()));
+        for (i, constant) in self.constants.iter().enumerate() {
+            result.push_str(&format!("  #{} {:?}\n", i, constant));
+        }
+        result.push_str(&format!("Globals: {:?}\n", self.names));
         result.push_str(&format!("Instructions: {} items\n\n", self.instructions.len()));
 
         for (i, instruction) in self.instructions.iter().enumerate() {
             result.push_str(&format!("{:04} {:?}\n", i, instruction));
         }
 
+        for (i, function) in self.functions.iter().enumerate() {
+            result.push_str(&format!(
+                "\n--- function #{} {}({}) locals={} stack={} upvalues={:?} ---\n",
+                i,
+                function.name,
+                function.parameters.join(", "),
+                function.chunk.local_count,
+                function.chunk.max_stack,
+                function.upvalues,
+            ));
+            for (j, instruction) in function.chunk.instructions.iter().enumerate() {
+                result.push_str(&format!("{:04} {:?}\n", j, instruction));
+            }
+        }
+
         result
     }
 }
@@ -142,23 +488,83 @@ mod tests {
         let mut bytecode = ByteCode::new();
 
         // 2 + 3 のバイトコード
-        bytecode.emit(Instruction::LoadConst(Value::Number(2.0)));
-        bytecode.emit(Instruction::LoadConst(Value::Number(3.0)));
+        bytecode.emit_constant(Constant::Number(2.0));
+        bytecode.emit_constant(Constant::Number(3.0));
         bytecode.emit(Instruction::Add);
         bytecode.emit(Instruction::Halt);
 
         assert_eq!(bytecode.instructions.len(), 4);
+        assert_eq!(bytecode.instructions[1], Instruction::LoadConst(1));
+        assert_eq!(bytecode.number_constant(1), Some(3.0));
+    }
+
+    #[test]
+    fn test_instruction_is_compact() {
+        // 命令は値を埋め込まず固定長（オペランド1つ＋タグ）
+        assert!(std::mem::size_of::<Instruction>() <= 16);
+    }
+
+    #[test]
+    fn test_jump_helpers() {
+        let jump = Instruction::LessJumpIfFalse(3);
+        assert_eq!(jump.jump_target(), Some(3));
+        assert!(jump.is_conditional_jump());
+        assert_eq!(jump.with_jump_target(7), Instruction::LessJumpIfFalse(7));
+        assert!(Instruction::Jump(0).is_terminator());
+        assert!(!Instruction::Jump(0).is_conditional_jump());
+        assert_eq!(Instruction::Add.jump_target(), None);
+    }
+
+    #[test]
+    fn test_fused_parts() {
+        assert_eq!(
+            Instruction::IncrLocal(2, 5).fused_parts().unwrap(),
+            vec![
+                Instruction::LoadLocal(2),
+                Instruction::LoadConst(5),
+                Instruction::Add,
+                Instruction::StoreLocal(2),
+            ]
+        );
+        assert_eq!(
+            Instruction::NotEqualJumpIfFalse(9).fused_parts().unwrap(),
+            vec![Instruction::NotEqual, Instruction::JumpIfFalse(9)]
+        );
+        assert_eq!(Instruction::Add.fused_parts(), None);
     }
 
     #[test]
     fn test_constant_pool() {
         let mut bytecode = ByteCode::new();
 
-        let idx1 = bytecode.add_constant(Value::Number(42.0));
-        let idx2 = bytecode.add_constant(Value::Number(42.0)); // 同じ値
-        let idx3 = bytecode.add_constant(Value::Number(100.0)); // 異なる値
+        let idx1 = bytecode.add_constant(Constant::Number(42.0));
+        let idx2 = bytecode.add_constant(Constant::Number(42.0)); // 同じ値
+        let idx3 = bytecode.add_constant(Constant::Number(100.0)); // 異なる値
 
         assert_eq!(idx1, idx2); // 同じ定数は再利用
         assert_ne!(idx1, idx3); // 異なる定数は別インデックス
+
+        // 差が小さくても異なる数値は別の定数
+        let tiny = bytecode.add_constant(Constant::Number(1e-20));
+        assert_ne!(tiny, bytecode.add_constant(Constant::Number(0.0)));
+    }
+
+    #[test]
+    fn test_name_table() {
+        let mut bytecode = ByteCode::new();
+
+        let x = bytecode.add_name("x");
+        let y = bytecode.add_name("y");
+
+        assert_eq!(bytecode.add_name("x"), x);
+        assert_ne!(x, y);
+        assert_eq!(bytecode.names[y as usize], "y");
+    }
+
+    #[test]
+    fn test_bytecode_is_shareable() {
+        fn assert_send_sync<T: Send + Sync>() {}
+        assert_send_sync::<ByteCode>();
+        assert_send_sync::<Arc<ByteCode>>();
     }
 }
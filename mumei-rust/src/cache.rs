@@ -1,38 +1,156 @@
 /// コンパイル結果のキャッシュ
 /// 同じコードを再コンパイルしないことで劇的な高速化を実現
+///
+/// ソースの内容をキーに Arc<ByteCode> を共有する（ハッシュが一致してもソース全文を比較する）。
+/// エントリ数と推定バイト数の上限を超えると、最も長く使われていないものから捨てる（LRU）。
+/// エントリはソースのハッシュでシャードに振り分け、ヒット時は読み取りロックだけで済むため
+/// 複数スレッドから同時に使っても1つのロックに集中しない。
 
 use std::collections::HashMap;
-use std::sync::Mutex;
+use std::sync::atomic::{AtomicU64, AtomicUsize, Ordering};
+use std::sync::{Arc, RwLock};
 use once_cell::sync::Lazy;
 use crate::bytecode::ByteCode;
 
+/// シャード数（2のべき乗、IDの下位ビットにシャード番号を入れる）
+const SHARD_BITS: usize = 4;
+const SHARD_COUNT: usize = 1 << SHARD_BITS;
+
+/// デフォルトの最大エントリ数
+pub const DEFAULT_MAX_ENTRIES: usize = 1024;
+
+/// デフォルトの最大推定バイト数
+pub const DEFAULT_MAX_BYTES: usize = 64 * 1024 * 1024;
+
 /// グローバルコンパイルキャッシュ
-static COMPILE_CACHE: Lazy<Mutex<CompileCache>> = Lazy::new(|| {
-    Mutex::new(CompileCache::new())
-});
+static COMPILE_CACHE: Lazy<CompileCache> = Lazy::new(CompileCache::new);
+
+/// キャッシュ統計
+#[derive(Debug, Clone, Copy, Default, PartialEq)]
+pub struct CacheStats {
+    /// キャッシュヒット数
+    pub hits: u64,
+
+    /// キャッシュミス数
+    pub misses: u64,
+
+    /// 上限を超えて捨てたエントリ数
+    pub evictions: u64,
+
+    /// 現在のエントリ数
+    pub entries: usize,
+
+    /// 現在の推定バイト数
+    pub bytes: usize,
+}
+
+impl CacheStats {
+    /// ヒット率（0.0〜1.0）
+    pub fn hit_rate(&self) -> f64 {
+        let total = self.hits + self.misses;
+        if total > 0 {
+            self.hits as f64 / total as f64
+        } else {
+            0.0
+        }
+    }
+}
+
+/// キャッシュエントリ
+struct Entry {
+    /// ハッシュ衝突を区別するためのソース全文
+    source: Box<str>,
+    bytecode: Arc<ByteCode>,
+    /// 推定バイト数（ソースを含む）
+    size: usize,
+    /// 最後に使われた時刻（論理時計）
+    last_used: AtomicU64,
+}
+
+/// シャード（IDからエントリ、ハッシュからIDを引く）
+#[derive(Default)]
+struct Shard {
+    entries: HashMap<usize, Entry>,
+    by_hash: HashMap<u64, Vec<usize>>,
+}
+
+impl Shard {
+    /// ハッシュとソースが一致するエントリのID
+    fn find(&self, hash: u64, source: &str) -> Option<usize> {
+        self.by_hash
+            .get(&hash)?
+            .iter()
+            .copied()
+            .find(|id| &*self.entries[id].source == source)
+    }
+
+    /// エントリを削除し、その推定バイト数を返す
+    fn remove(&mut self, id: usize, hash: u64) -> Option<usize> {
+        let entry = self.entries.remove(&id)?;
+        if let Some(ids) = self.by_hash.get_mut(&hash) {
+            ids.retain(|&other| other != id);
+            if ids.is_empty() {
+                self.by_hash.remove(&hash);
+            }
+        }
+        Some(entry.size)
+    }
+}
 
 /// コンパイルキャッシュ
 pub struct CompileCache {
-    /// ソースコードのハッシュ → コンパイル済みバイトコード
-    cache: HashMap<u64, ByteCode>,
+    shards: Vec<RwLock<Shard>>,
 
-    /// キャッシュヒット数
-    hits: usize,
+    /// 最大エントリ数
+    max_entries: AtomicUsize,
 
-    /// キャッシュミス数
-    misses: usize,
+    /// 最大推定バイト数
+    max_bytes: AtomicUsize,
+
+    /// 現在のエントリ数・推定バイト数（全シャードの合計）
+    entries: AtomicUsize,
+    bytes: AtomicUsize,
+
+    /// LRU用の論理時計
+    clock: AtomicU64,
+
+    /// 次に割り当てるIDの連番
+    next_id: AtomicUsize,
+
+    hits: AtomicU64,
+    misses: AtomicU64,
+    evictions: AtomicU64,
 }
 
 impl CompileCache {
-    /// 新しいキャッシュを作成
+    /// デフォルトの上限で新しいキャッシュを作成
     pub fn new() -> Self {
+        Self::with_limits(DEFAULT_MAX_ENTRIES, DEFAULT_MAX_BYTES)
+    }
+
+    /// エントリ数・推定バイト数の上限を指定して作成
+    pub fn with_limits(max_entries: usize, max_bytes: usize) -> Self {
         CompileCache {
-            cache: HashMap::new(),
-            hits: 0,
-            misses: 0,
+            shards: (0..SHARD_COUNT).map(|_| RwLock::new(Shard::default())).collect(),
+            max_entries: AtomicUsize::new(max_entries),
+            max_bytes: AtomicUsize::new(max_bytes),
+            entries: AtomicUsize::new(0),
+            bytes: AtomicUsize::new(0),
+            clock: AtomicU64::new(0),
+            next_id: AtomicUsize::new(0),
+            hits: AtomicU64::new(0),
+            misses: AtomicU64::new(0),
+            evictions: AtomicU64::new(0),
         }
     }
 
+    /// 上限を変更（超えていればすぐに捨てる）
+    pub fn set_limits(&self, max_entries: usize, max_bytes: usize) {
+        self.max_entries.store(max_entries, Ordering::Relaxed);
+        self.max_bytes.store(max_bytes, Ordering::Relaxed);
+        self.evict_over_budget();
+    }
+
     /// ソースコードをハッシュ化
     fn hash_source(source: &str) -> u64 {
         use std::collections::hash_map::DefaultHasher;
@@ -43,71 +161,209 @@ impl CompileCache {
         hasher.finish()
     }
 
+    /// ハッシュの担当シャード
+    fn shard_index(hash: u64) -> usize {
+        (hash as usize) & (SHARD_COUNT - 1)
+    }
+
+    /// 使用時刻を更新
+    fn touch(&self, entry: &Entry) {
+        let now = self.clock.fetch_add(1, Ordering::Relaxed);
+        entry.last_used.store(now, Ordering::Relaxed);
+    }
+
     /// キャッシュから取得
-    pub fn get(&mut self, source: &str) -> Option<ByteCode> {
-        let hash = Self::hash_source(source);
+    pub fn get(&self, source: &str) -> Option<Arc<ByteCode>> {
+        self.get_hashed(Self::hash_source(source), source).map(|(_, bytecode)| bytecode)
+    }
 
-        if let Some(bytecode) = self.cache.get(&hash) {
-            self.hits += 1;
-            Some(bytecode.clone())
-        } else {
-            self.misses += 1;
-            None
+    fn get_hashed(&self, hash: u64, source: &str) -> Option<(usize, Arc<ByteCode>)> {
+        let shard = self.shards[Self::shard_index(hash)].read().unwrap();
+        match shard.find(hash, source) {
+            Some(id) => {
+                let entry = &shard.entries[&id];
+                self.touch(entry);
+                self.hits.fetch_add(1, Ordering::Relaxed);
+                Some((id, entry.bytecode.clone()))
+            }
+            None => {
+                self.misses.fetch_add(1, Ordering::Relaxed);
+                None
+            }
         }
     }
 
-    /// キャッシュに保存
-    pub fn insert(&mut self, source: &str, bytecode: ByteCode) {
+    /// IDで取得（compile_and_cache が返したID用）
+    pub fn get_by_id(&self, id: usize) -> Option<Arc<ByteCode>> {
+        let shard = self.shards[id & (SHARD_COUNT - 1)].read().unwrap();
+        let entry = shard.entries.get(&id)?;
+        self.touch(entry);
+        Some(entry.bytecode.clone())
+    }
+
+    /// キャッシュに保存し、IDと共有されたバイトコードを返す
+    /// 同じソースが既にあればそちらを返す
+    pub fn insert(&self, source: &str, bytecode: ByteCode) -> (usize, Arc<ByteCode>) {
+        self.insert_hashed(Self::hash_source(source), source, bytecode)
+    }
+
+    fn insert_hashed(&self, hash: u64, source: &str, bytecode: ByteCode) -> (usize, Arc<ByteCode>) {
+        let index = Self::shard_index(hash);
+        let result = {
+            let mut shard = self.shards[index].write().unwrap();
+            if let Some(id) = shard.find(hash, source) {
+                let entry = &shard.entries[&id];
+                self.touch(entry);
+                return (id, entry.bytecode.clone());
+            }
+
+            let id = (self.next_id.fetch_add(1, Ordering::Relaxed) << SHARD_BITS) | index;
+            let size = bytecode.estimated_size() + source.len();
+            let bytecode = Arc::new(bytecode);
+            let entry = Entry {
+                source: source.into(),
+                bytecode: bytecode.clone(),
+                size,
+                last_used: AtomicU64::new(self.clock.fetch_add(1, Ordering::Relaxed)),
+            };
+            shard.entries.insert(id, entry);
+            shard.by_hash.entry(hash).or_default().push(id);
+            self.entries.fetch_add(1, Ordering::Relaxed);
+            self.bytes.fetch_add(size, Ordering::Relaxed);
+            (id, bytecode)
+        };
+
+        self.evict_over_budget();
+        result
+    }
+
+    /// キャッシュから取得し、なければコンパイルして保存
+    pub fn get_or_compile<F>(&self, source: &str, compile: F) -> Result<(usize, Arc<ByteCode>), String>
+    where
+        F: FnOnce(&str) -> Result<ByteCode, String>,
+    {
         let hash = Self::hash_source(source);
-        self.cache.insert(hash, bytecode);
+        if let Some(cached) = self.get_hashed(hash, source) {
+            return Ok(cached);
+        }
+
+        // コンパイル中はロックを持たない（同じソースを同時にコンパイルしたら先に保存した方を使う）
+        let bytecode = compile(source)?;
+        Ok(self.insert_hashed(hash, source, bytecode))
+    }
+
+    /// 上限を超えている間、最も長く使われていないエントリを捨てる
+    fn evict_over_budget(&self) {
+        loop {
+            let over_entries = self.entries.load(Ordering::Relaxed) > self.max_entries.load(Ordering::Relaxed);
+            let over_bytes = self.bytes.load(Ordering::Relaxed) > self.max_bytes.load(Ordering::Relaxed);
+            if !over_entries && !over_bytes {
+                return;
+            }
+
+            // 全シャードから最も古いエントリを探す（挿入時のみなので線形探索で十分）
+            let mut oldest: Option<(u64, usize, usize, u64)> = None;
+            for (index, shard) in self.shards.iter().enumerate() {
+                let shard = shard.read().unwrap();
+                for (&hash, ids) in &shard.by_hash {
+                    for &id in ids {
+                        let last_used = shard.entries[&id].last_used.load(Ordering::Relaxed);
+                        if oldest.map_or(true, |(oldest_used, ..)| last_used < oldest_used) {
+                            oldest = Some((last_used, index, id, hash));
+                        }
+                    }
+                }
+            }
+
+            let (_, index, id, hash) = match oldest {
+                Some(oldest) => oldest,
+                None => return,
+            };
+            if let Some(size) = self.shards[index].write().unwrap().remove(id, hash) {
+                self.entries.fetch_sub(1, Ordering::Relaxed);
+                self.bytes.fetch_sub(size, Ordering::Relaxed);
+                self.evictions.fetch_add(1, Ordering::Relaxed);
+            }
+        }
     }
 
     /// キャッシュ統計を取得
-    pub fn stats(&self) -> (usize, usize, f64) {
-        let total = self.hits + self.misses;
-        let hit_rate = if total > 0 {
-            self.hits as f64 / total as f64
-        } else {
-            0.0
-        };
-        (self.hits, self.misses, hit_rate)
+    pub fn stats(&self) -> CacheStats {
+        CacheStats {
+            hits: self.hits.load(Ordering::Relaxed),
+            misses: self.misses.load(Ordering::Relaxed),
+            evictions: self.evictions.load(Ordering::Relaxed),
+            entries: self.entries.load(Ordering::Relaxed),
+            bytes: self.bytes.load(Ordering::Relaxed),
+        }
     }
 
     /// キャッシュをクリア
-    pub fn clear(&mut self) {
-        self.cache.clear();
-        self.hits = 0;
-        self.misses = 0;
+    pub fn clear(&self) {
+        for shard in &self.shards {
+            let mut shard = shard.write().unwrap();
+            let removed: usize = shard.entries.values().map(|entry| entry.size).sum();
+            self.entries.fetch_sub(shard.entries.len(), Ordering::Relaxed);
+            self.bytes.fetch_sub(removed, Ordering::Relaxed);
+            *shard = Shard::default();
+        }
+        self.hits.store(0, Ordering::Relaxed);
+        self.misses.store(0, Ordering::Relaxed);
+        self.evictions.store(0, Ordering::Relaxed);
     }
 }
 
+impl Default for CompileCache {
+    fn default() -> Self {
+        Self::new()
+    }
+}
+
+/// プロセス全体で共有するキャッシュ
+pub fn global_cache() -> &'static CompileCache {
+    &COMPILE_CACHE
+}
+
 /// グローバルキャッシュから取得
-pub fn get_cached_bytecode(source: &str) -> Option<ByteCode> {
-    COMPILE_CACHE.lock().unwrap().get(source)
+pub fn get_cached_bytecode(source: &str) -> Option<Arc<ByteCode>> {
+    COMPILE_CACHE.get(source)
 }
 
 /// グローバルキャッシュに保存
-pub fn cache_bytecode(source: &str, bytecode: ByteCode) {
-    COMPILE_CACHE.lock().unwrap().insert(source, bytecode);
+pub fn cache_bytecode(source: &str, bytecode: ByteCode) -> Arc<ByteCode> {
+    COMPILE_CACHE.insert(source, bytecode).1
+}
+
+/// グローバルキャッシュの上限を変更
+pub fn set_cache_limits(max_entries: usize, max_bytes: usize) {
+    COMPILE_CACHE.set_limits(max_entries, max_bytes);
 }
 
 /// キャッシュ統計を取得
-pub fn get_cache_stats() -> (usize, usize, f64) {
-    COMPILE_CACHE.lock().unwrap().stats()
+pub fn get_cache_stats() -> CacheStats {
+    COMPILE_CACHE.stats()
 }
 
 /// キャッシュをクリア
 pub fn clear_cache() {
-    COMPILE_CACHE.lock().unwrap().clear();
+    COMPILE_CACHE.clear();
 }
 
 #[cfg(test)]
 mod tests {
     use super::*;
+    use crate::bytecode::{Constant, Instruction};
+
+    fn constant_program(n: f64) -> ByteCode {
+        let mut bytecode = ByteCode::new();
+        bytecode.emit_constant(Constant::Number(n));
+        bytecode.emit(Instruction::Halt);
+        bytecode
+    }
 
     #[test]
     fn test_cache() {
-        let mut cache = CompileCache::new();
+        let cache = CompileCache::new();
 
         let source = "2 + 3";
         let bytecode = ByteCode::new();
@@ -116,13 +372,95 @@ mod tests {
         assert!(cache.get(source).is_none());
 
         // 保存
-        cache.insert(source, bytecode.clone());
+        let (id, shared) = cache.insert(source, bytecode);
+
+        // 次はヒットし、同じバイトコードを共有する
+        let hit = cache.get(source).unwrap();
+        assert!(Arc::ptr_eq(&hit, &shared));
+        assert!(Arc::ptr_eq(&cache.get_by_id(id).unwrap(), &shared));
+
+        let stats = cache.stats();
+        assert_eq!((stats.hits, stats.misses), (1, 1));
+        assert_eq!(stats.entries, 1);
+        assert!(stats.bytes > 0);
+    }
+
+    #[test]
+    fn test_hash_collision_compares_source() {
+        let cache = CompileCache::new();
+
+        // 同じハッシュでもソースが違えば別のエントリ
+        let (a, _) = cache.insert_hashed(7, "1", constant_program(1.0));
+        let (b, _) = cache.insert_hashed(7, "2", constant_program(2.0));
+        assert_ne!(a, b);
+
+        let found = cache.get_hashed(7, "2").unwrap().1;
+        assert_eq!(found.number_constant(0), Some(2.0));
+        assert!(cache.get_hashed(7, "3").is_none());
+    }
+
+    #[test]
+    fn test_lru_eviction() {
+        let cache = CompileCache::with_limits(2, usize::MAX);
+
+        let (first, _) = cache.insert("1", constant_program(1.0));
+        cache.insert("2", constant_program(2.0));
+        // "1" を使うと "2" が最も古くなる
+        assert!(cache.get("1").is_some());
+        cache.insert("3", constant_program(3.0));
+
+        assert!(cache.get("2").is_none());
+        assert!(cache.get_by_id(first).is_some());
+        assert!(cache.get("3").is_some());
 
-        // 次はヒット
-        assert!(cache.get(source).is_some());
+        let stats = cache.stats();
+        assert_eq!(stats.entries, 2);
+        assert_eq!(stats.evictions, 1);
+    }
+
+    #[test]
+    fn test_byte_budget() {
+        let size = constant_program(1.0).estimated_size() + 1;
+        let cache = CompileCache::with_limits(usize::MAX, size * 2);
+
+        for i in 0..10 {
+            cache.insert(&i.to_string(), constant_program(i as f64));
+        }
+
+        let stats = cache.stats();
+        assert!(stats.bytes <= size * 2);
+        assert_eq!(stats.entries, 2);
+        assert_eq!(stats.evictions, 8);
+
+        cache.set_limits(1, usize::MAX);
+        assert_eq!(cache.stats().entries, 1);
+        assert!(cache.get("9").is_some());
+    }
+
+    #[test]
+    fn test_shared_between_threads() {
+        let cache = Arc::new(CompileCache::with_limits(64, usize::MAX));
+
+        let handles: Vec<_> = (0..4)
+            .map(|t| {
+                let cache = cache.clone();
+                std::thread::spawn(move || {
+                    for i in 0..200 {
+                        let source = format!("{}", (i + t) % 32);
+                        let (_, bytecode) = cache
+                            .get_or_compile(&source, |s| Ok(constant_program(s.parse().unwrap())))
+                            .unwrap();
+                        assert_eq!(bytecode.number_constant(0), Some(((i + t) % 32) as f64));
+                    }
+                })
+            })
+            .collect();
+        for handle in handles {
+            handle.join().unwrap();
+        }
 
-        let (hits, misses, _) = cache.stats();
-        assert_eq!(hits, 1);
-        assert_eq!(misses, 1);
+        let stats = cache.stats();
+        assert_eq!(stats.entries, 32);
+        assert_eq!(stats.hits + stats.misses, 800);
     }
 }
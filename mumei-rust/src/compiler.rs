@@ -1,165 +1,288 @@
 /// バイトコードコンパイラ
 /// ASTをバイトコードにコンパイル
 
-use crate::ast::{ASTNode, BinaryOperator, UnaryOperator};
-use crate::bytecode::{ByteCode, Instruction};
-use crate::value::Value;
+use crate::ast::{ASTNode, Ast, BinaryOperator, NodeId, UnaryOperator};
+use crate::bytecode::{ByteCode, Constant, FunctionProto, Instruction, UpvalueDesc};
+use crate::optimizer::{self, OptLevel};
+use crate::resolver::{Resolver, GENERATOR_SOURCE};
+use crate::shape::INITIALIZER;
+use crate::verifier;
+use std::collections::HashMap;
+use std::sync::Arc;
+
+/// コンパイル中の関数の状態（ネストした関数のコンパイル中は退避される）
+struct FunctionState {
+    bytecode: ByteCode,
+    upvalues: Vec<UpvalueDesc>,
+    cache_count: u32,
+    initializer: bool,
+    loops: Vec<Loop>,
+}
+
+/// コンパイル中のループ（break・continue のジャンプ先）
+struct Loop {
+    /// continue のジャンプ先（while は条件、for は ForIter）
+    start: usize,
+
+    /// for 文か（break はスタック上のイテレータを取り除いてから抜ける）
+    iterates: bool,
+
+    /// ループの後ろへ飛ぶ break のジャンプ（終了位置が決まったらパッチする）
+    breaks: Vec<usize>,
+}
+
+/// 関数の種類（呼び出したときに本体を実行するか）
+#[derive(Debug, Clone, Copy, PartialEq)]
+enum FunctionKind {
+    /// 通常の関数
+    Normal,
+
+    /// yield を含む関数（呼び出すとジェネレータを返す）
+    Generator,
+
+    /// async 関数（呼び出すとタスクを返す）
+    Async,
+}
+
+impl FunctionKind {
+    /// 関数宣言の印から（async 関数の yield は Resolver が拒否している）
+    fn of(is_generator: bool, is_async: bool) -> FunctionKind {
+        match (is_generator, is_async) {
+            (_, true) => FunctionKind::Async,
+            (true, false) => FunctionKind::Generator,
+            (false, false) => FunctionKind::Normal,
+        }
+    }
+}
 
 /// コンパイラ
 pub struct Compiler {
+    /// コンパイル中のチャンク（トップレベルまたは関数本体）
     bytecode: ByteCode,
+
+    /// コンパイル中の関数が捕捉する変数
+    upvalues: Vec<UpvalueDesc>,
+
+    /// コンパイル中のチャンクで使ったインラインキャッシュの数（メンバーアクセス命令に番号を振る）
+    cache_count: u32,
+
+    /// コンパイル中の関数が __init__ か（戻り値は常に self）
+    initializer: bool,
+
+    /// コンパイル中の関数の中のループ（内側ほど後ろ）
+    loops: Vec<Loop>,
+
+    /// 外側の関数の状態（内側ほど後ろ）
+    enclosing: Vec<FunctionState>,
+
+    /// プログラム全体で共有するグローバル変数名テーブル
+    names: Vec<String>,
+    name_indices: HashMap<String, u32>,
+
+    /// 出力するバイトコードの最適化レベル
+    opt_level: OptLevel,
 }
 
 impl Compiler {
-    /// 新しいコンパイラを作成
+    /// 新しいコンパイラを作成（デフォルトの最適化レベル）
     pub fn new() -> Self {
+        Self::with_opt_level(OptLevel::default())
+    }
+
+    /// 最適化レベルを指定してコンパイラを作成
+    pub fn with_opt_level(opt_level: OptLevel) -> Self {
         Compiler {
             bytecode: ByteCode::new(),
+            upvalues: Vec::new(),
+            cache_count: 0,
+            initializer: false,
+            loops: Vec::new(),
+            enclosing: Vec::new(),
+            names: Vec::new(),
+            name_indices: HashMap::new(),
+            opt_level,
         }
     }
 
-    /// ASTノードのリストをコンパイル
-    pub fn compile(&mut self, nodes: Vec<ASTNode>) -> Result<ByteCode, String> {
-        for node in nodes {
-            self.compile_node(&node)?;
+    /// 構文木をコンパイル
+    pub fn compile(&mut self, mut ast: Ast) -> Result<ByteCode, String> {
+        // ローカル変数をスロットに解決
+        Resolver::new().resolve(&mut ast)?;
+        let ast = &ast;
+        let nodes = ast.statements();
+
+        // 最後の式の値をプログラムの結果として残す（文で終わる場合はHaltがNullを返す）
+        match nodes.split_last() {
+            Some((&last, rest)) if !Self::is_statement(ast.node(last)) => {
+                for &node in rest {
+                    self.compile_statement(ast, node)?;
+                }
+                self.compile_node(ast, last)?;
+            }
+            _ => {
+                for &node in nodes {
+                    self.compile_statement(ast, node)?;
+                }
+            }
         }
 
         // 最後にHalt命令を追加
         self.bytecode.emit(Instruction::Halt);
 
-        Ok(self.bytecode.clone())
-    }
+        let mut bytecode = std::mem::take(&mut self.bytecode);
+        bytecode.names = std::mem::take(&mut self.names);
+        self.cache_count = 0;
+        self.name_indices.clear();
 
-    /// 単一のASTノードをコンパイル
-    fn compile_node(&mut self, node: &ASTNode) -> Result<(), String> {
-        match node {
-            // リテラル
-            ASTNode::Number(n) => {
-                self.bytecode.emit(Instruction::LoadConst(Value::Number(*n)));
-                Ok(())
-            }
+        optimizer::optimize(&mut bytecode, self.opt_level);
 
-            ASTNode::String(s) => {
-                self.bytecode.emit(Instruction::LoadConst(Value::String(s.clone())));
-                Ok(())
-            }
+        // 実行時にVMが検証し直さなくて済むよう、各チャンクの最大スタック深さを記録
+        let name_count = bytecode.names.len();
+        verifier::fill_max_stack(&mut bytecode, 0, name_count)
+            .map_err(|e| format!("Internal error: generated invalid bytecode: {}", e))?;
+        Ok(bytecode)
+    }
 
-            ASTNode::Boolean(b) => {
-                self.bytecode.emit(Instruction::LoadConst(Value::Boolean(*b)));
-                Ok(())
+    /// ブロックをコンパイルし、最後の式の値（なければNull）をスタックに残す
+    fn compile_block_value(&mut self, ast: &Ast, nodes: &[NodeId]) -> Result<(), String> {
+        match nodes.split_last() {
+            Some((&last, rest)) => {
+                for &node in rest {
+                    self.compile_statement(ast, node)?;
+                }
+                if Self::is_statement(ast.node(last)) {
+                    self.compile_statement(ast, last)?;
+                    self.bytecode.emit_constant(Constant::Null);
+                } else {
+                    self.compile_node(ast, last)?;
+                }
             }
-
-            ASTNode::Null => {
-                self.bytecode.emit(Instruction::LoadConst(Value::Null));
-                Ok(())
+            None => {
+                self.bytecode.emit_constant(Constant::Null);
             }
+        }
+        Ok(())
+    }
 
-            // 識別子（変数参照）
-            ASTNode::Identifier(name) => {
-                self.bytecode.emit(Instruction::LoadVar(name.clone()));
-                Ok(())
-            }
+    /// 値を残さない文として使われるノードか
+    fn is_statement(node: &ASTNode) -> bool {
+        matches!(
+            node,
+            ASTNode::VariableDeclaration { .. }
+                | ASTNode::FunctionDeclaration { .. }
+                | ASTNode::ClassDeclaration { .. }
+                | ASTNode::IfStatement { .. }
+                | ASTNode::WhileStatement { .. }
+                | ASTNode::ForStatement { .. }
+                | ASTNode::ReturnStatement { .. }
+                | ASTNode::YieldStatement { .. }
+                | ASTNode::BreakStatement
+                | ASTNode::ContinueStatement
+                | ASTNode::PassStatement
+                | ASTNode::TryCatch { .. }
+                | ASTNode::ThrowStatement { .. }
+                | ASTNode::ImportStatement { .. }
+                | ASTNode::AssertStatement { .. }
+                | ASTNode::Program { .. }
+        )
+    }
 
+    /// 文をコンパイル（スタックに値を残さない）
+    fn compile_statement(&mut self, ast: &Ast, id: NodeId) -> Result<(), String> {
+        match ast.node(id) {
             // 変数宣言
-            ASTNode::VariableDeclaration { name, value, .. } => {
+            ASTNode::VariableDeclaration { name, value, slot, .. } => {
                 // 値をコンパイル
-                self.compile_node(value)?;
+                self.compile_node(ast, *value)?;
                 // 変数に保存
-                self.bytecode.emit(Instruction::StoreVar(name.clone()));
-                Ok(())
+                self.emit_define(name, *slot)
             }
 
-            // 代入
-            ASTNode::Assignment { target, value } => {
-                // 値をコンパイル
-                self.compile_node(value)?;
+            // 関数定義
+            ASTNode::FunctionDeclaration { name, parameters, body, is_generator, is_async, slot } => {
+                let kind = FunctionKind::of(*is_generator, *is_async);
+                self.compile_method(ast, name, parameters, ast.list(*body), false, kind)?;
+                self.emit_define(name, *slot)
+            }
 
-                match target.as_ref() {
-                    ASTNode::Identifier(name) => {
-                        self.bytecode.emit(Instruction::StoreVar(name.clone()));
-                        Ok(())
+            // クラス定義（親クラス・メソッドのクロージャを積んでクラスを作る）
+            ASTNode::ClassDeclaration { name, parent, body, slot } => {
+                if let Some(parent) = parent {
+                    self.compile_node(ast, *parent)?;
+                }
+                let methods = ast.list(*body);
+                for &method in methods {
+                    match ast.node(method) {
+                        ASTNode::FunctionDeclaration { name: method_name, parameters, body, is_generator, is_async, .. } => {
+                            let initializer = method_name == INITIALIZER;
+                            if initializer && parameters.is_empty() {
+                                return Err(format!("{} must take self", INITIALIZER));
+                            }
+                            if initializer && *is_generator {
+                                return Err(format!("{} cannot yield", INITIALIZER));
+                            }
+                            if initializer && *is_async {
+                                return Err(format!("{} cannot be async", INITIALIZER));
+                            }
+                            let kind = FunctionKind::of(*is_generator, *is_async);
+                            self.compile_method(ast, method_name, parameters, ast.list(*body), initializer, kind)?;
+                        }
+                        node => return Err(Self::unsupported(node)),
                     }
-                    _ => Err("Complex assignment not yet supported in bytecode".to_string()),
                 }
+                let count = u16::try_from(methods.len())
+                    .map_err(|_| format!("Too many methods in class '{}'", name))?;
+                let name_index = self.name_constant(name);
+                self.bytecode.emit(Instruction::MakeClass(name_index, count, parent.is_some()));
+                self.emit_define(name, *slot)
             }
 
-            // 二項演算
-            ASTNode::BinaryOperation { left, operator, right } => {
-                // 左辺をコンパイル
-                self.compile_node(left)?;
-                // 右辺をコンパイル
-                self.compile_node(right)?;
-
-                // 演算子に対応する命令を発行
-                let instruction = match operator {
-                    BinaryOperator::Add => Instruction::Add,
-                    BinaryOperator::Subtract => Instruction::Subtract,
-                    BinaryOperator::Multiply => Instruction::Multiply,
-                    BinaryOperator::Divide => Instruction::Divide,
-                    BinaryOperator::Modulo => Instruction::Modulo,
-                    BinaryOperator::Power => Instruction::Power,
-                    BinaryOperator::Less => Instruction::Less,
-                    BinaryOperator::Greater => Instruction::Greater,
-                    BinaryOperator::LessEqual => Instruction::LessEqual,
-                    BinaryOperator::GreaterEqual => Instruction::GreaterEqual,
-                    BinaryOperator::Equal => Instruction::Equal,
-                    BinaryOperator::NotEqual => Instruction::NotEqual,
-                    BinaryOperator::And => Instruction::And,
-                    BinaryOperator::Or => Instruction::Or,
-                    _ => return Err(format!("Unsupported binary operator: {:?}", operator)),
-                };
-
-                self.bytecode.emit(instruction);
-                Ok(())
+            // 代入文（値を複製せずに保存）
+            ASTNode::Assignment { target, value } => {
+                self.compile_node(ast, *value)?;
+                self.emit_store(ast, *target)
             }
 
-            // 単項演算
-            ASTNode::UnaryOperation { operator, operand } => {
-                // オペランドをコンパイル
-                self.compile_node(operand)?;
-
-                // 演算子に対応する命令を発行
-                let instruction = match operator {
-                    UnaryOperator::Negate => Instruction::Negate,
-                    UnaryOperator::Not => Instruction::Not,
-                    _ => return Err(format!("Unsupported unary operator: {:?}", operator)),
-                };
-
-                self.bytecode.emit(instruction);
-                Ok(())
+            // 複合代入文（x += y は x = x + y と同じ命令列）
+            ASTNode::CompoundAssignment { target, operator, value } => {
+                self.compile_compound(ast, *target, *operator, *value)?;
+                self.emit_store(ast, *target)
             }
 
             // if文
             ASTNode::IfStatement { condition, then_body, elif_clauses, else_body } => {
                 // 条件をコンパイル
-                self.compile_node(condition)?;
+                self.compile_node(ast, *condition)?;
 
                 // JumpIfFalseの位置を記録（後でパッチする）
                 let jump_to_else_or_end = self.bytecode.current_index();
                 self.bytecode.emit(Instruction::JumpIfFalse(0)); // 仮の値
 
                 // then_bodyをコンパイル
-                for stmt in then_body {
-                    self.compile_node(stmt)?;
+                for &stmt in ast.list(*then_body) {
+                    self.compile_statement(ast, stmt)?;
                 }
 
                 // then_bodyの後のジャンプ（end へ）
-                let jump_to_end = self.bytecode.current_index();
+                let mut jumps_to_end = vec![self.bytecode.current_index()];
                 self.bytecode.emit(Instruction::Jump(0)); // 仮の値
 
+                // 条件がfalseならelif/elseへ
+                let next_clause = self.bytecode.current_index();
+                self.bytecode.patch(jump_to_else_or_end, Instruction::JumpIfFalse(next_clause));
+
                 // elif句の処理
-                let elif_start = self.bytecode.current_index();
-                for (elif_cond, elif_body) in elif_clauses {
-                    self.compile_node(elif_cond)?;
+                for &(elif_cond, elif_body) in elif_clauses {
+                    self.compile_node(ast, elif_cond)?;
 
                     let elif_jump = self.bytecode.current_index();
                     self.bytecode.emit(Instruction::JumpIfFalse(0));
 
-                    for stmt in elif_body {
-                        self.compile_node(stmt)?;
+                    for &stmt in ast.list(elif_body) {
+                        self.compile_statement(ast, stmt)?;
                     }
 
-                    let elif_end_jump = self.bytecode.current_index();
+                    jumps_to_end.push(self.bytecode.current_index());
                     self.bytecode.emit(Instruction::Jump(0));
 
                     // elif のJumpIfFalse をパッチ
@@ -169,21 +292,16 @@ impl Compiler {
 
                 // else_bodyをコンパイル
                 if let Some(else_stmts) = else_body {
-                    for stmt in else_stmts {
-                        self.compile_node(stmt)?;
+                    for &stmt in ast.list(*else_stmts) {
+                        self.compile_statement(ast, stmt)?;
                     }
                 }
 
-                // 最終位置
+                // 各節の終わりから最終位置へのジャンプをパッチ
                 let end_index = self.bytecode.current_index();
-
-                // ジャンプ先をパッチ
-                if elif_clauses.is_empty() && else_body.is_some() {
-                    self.bytecode.patch(jump_to_else_or_end, Instruction::JumpIfFalse(elif_start));
-                } else {
-                    self.bytecode.patch(jump_to_else_or_end, Instruction::JumpIfFalse(elif_start));
+                for jump in jumps_to_end {
+                    self.bytecode.patch(jump, Instruction::Jump(end_index));
                 }
-                self.bytecode.patch(jump_to_end, Instruction::Jump(end_index));
 
                 Ok(())
             }
@@ -193,16 +311,14 @@ impl Compiler {
                 let loop_start = self.bytecode.current_index();
 
                 // 条件をコンパイル
-                self.compile_node(condition)?;
+                self.compile_node(ast, *condition)?;
 
                 // JumpIfFalseの位置を記録
                 let jump_to_end = self.bytecode.current_index();
                 self.bytecode.emit(Instruction::JumpIfFalse(0)); // 仮の値
 
                 // ループ本体をコンパイル
-                for stmt in body {
-                    self.compile_node(stmt)?;
-                }
+                let breaks = self.compile_loop_body(ast, ast.list(*body), loop_start, false)?;
 
                 // ループの先頭に戻る
                 self.bytecode.emit(Instruction::Jump(loop_start));
@@ -210,18 +326,253 @@ impl Compiler {
                 // ループ終了位置
                 let end_index = self.bytecode.current_index();
                 self.bytecode.patch(jump_to_end, Instruction::JumpIfFalse(end_index));
+                self.patch_jumps(breaks, end_index);
+
+                Ok(())
+            }
+
+            // for文（イテレータをスタックに置いたまま1要素ずつ取り出す）
+            ASTNode::ForStatement { variable, iterable, body, slot } => {
+                self.compile_node(ast, *iterable)?;
+                self.bytecode.emit(Instruction::GetIter);
+
+                // 尽きたらイテレータを取り除いてループの後ろへ
+                let loop_start = self.bytecode.current_index();
+                self.bytecode.emit(Instruction::ForIter(0)); // 仮の値
+                self.emit_define(variable, *slot)?;
+
+                let breaks = self.compile_loop_body(ast, ast.list(*body), loop_start, true)?;
+                self.bytecode.emit(Instruction::Jump(loop_start));
+
+                let end_index = self.bytecode.current_index();
+                self.bytecode.patch(loop_start, Instruction::ForIter(end_index));
+                self.patch_jumps(breaks, end_index);
+                Ok(())
+            }
+
+            // break文（for 文ならイテレータを取り除いてから抜ける）
+            ASTNode::BreakStatement => {
+                let Some(current) = self.loops.last() else {
+                    return Err("'break' outside loop".to_string());
+                };
+                if current.iterates {
+                    self.bytecode.emit(Instruction::Pop);
+                }
+                let jump = self.bytecode.current_index();
+                self.bytecode.emit(Instruction::Jump(0)); // 仮の値
+                self.loops.last_mut().unwrap().breaks.push(jump);
+                Ok(())
+            }
+
+            // continue文
+            ASTNode::ContinueStatement => {
+                let Some(current) = self.loops.last() else {
+                    return Err("'continue' outside loop".to_string());
+                };
+                self.bytecode.emit(Instruction::Jump(current.start));
+                Ok(())
+            }
+
+            // yield文（Resolver が関数の中にあることを確かめ、関数をジェネレータにしている）
+            ASTNode::YieldStatement { value } => {
+                self.compile_node(ast, *value)?;
+                self.bytecode.emit(Instruction::Yield);
+                Ok(())
+            }
+
+            // return文
+            ASTNode::ReturnStatement { value } => {
+                match value.map(|value| (value, ast.node(value))) {
+                    // __init__ の return は値を捨てて self を返す
+                    _ if self.initializer => {
+                        if let Some(value) = value {
+                            self.compile_node(ast, *value)?;
+                            self.bytecode.emit(Instruction::Pop);
+                        }
+                        self.bytecode.emit(Instruction::LoadLocal(0));
+                        self.bytecode.emit(Instruction::Return);
+                    }
+                    // 関数内の return f(...) は末尾呼び出し（メソッド呼び出しを除く）
+                    Some((_, ASTNode::FunctionCall { callee, arguments }))
+                        if !self.enclosing.is_empty() && !matches!(ast.node(*callee), ASTNode::MemberAccess { .. }) =>
+                    {
+                        self.compile_node(ast, *callee)?;
+                        for &arg in ast.list(*arguments) {
+                            self.compile_node(ast, arg)?;
+                        }
+                        self.bytecode.emit(Instruction::TailCall(arguments.len()));
+                    }
+                    Some((value, _)) => {
+                        self.compile_node(ast, value)?;
+                        self.bytecode.emit(Instruction::Return);
+                    }
+                    None => {
+                        self.bytecode.emit_constant(Constant::Null);
+                        self.bytecode.emit(Instruction::Return);
+                    }
+                }
+                Ok(())
+            }
+
+            ASTNode::PassStatement => Ok(()),
+
+            ASTNode::Program { statements } => {
+                for &stmt in ast.list(*statements) {
+                    self.compile_statement(ast, stmt)?;
+                }
+                Ok(())
+            }
+
+            // 文として未対応のノード
+            node if Self::is_statement(node) => Err(Self::unsupported(node)),
+
+            // 式文（値を捨てる）
+            _ => {
+                self.compile_node(ast, id)?;
+                self.bytecode.emit(Instruction::Pop);
+                Ok(())
+            }
+        }
+    }
+
+    /// 式をコンパイル（スタックに値を1つ残す）
+    fn compile_node(&mut self, ast: &Ast, id: NodeId) -> Result<(), String> {
+        match ast.node(id) {
+            // リテラル
+            ASTNode::Number(n) => {
+                self.bytecode.emit_constant(Constant::Number(*n));
+                Ok(())
+            }
+
+            ASTNode::String(s) => {
+                self.bytecode.emit_constant(Constant::String(s.clone()));
+                Ok(())
+            }
+
+            ASTNode::Boolean(b) => {
+                self.bytecode.emit_constant(Constant::Boolean(*b));
+                Ok(())
+            }
+
+            ASTNode::Null => {
+                self.bytecode.emit_constant(Constant::Null);
+                Ok(())
+            }
+
+            // 識別子（変数参照）
+            ASTNode::Identifier(name) | ASTNode::GlobalVariable { name } => {
+                let index = self.add_name(name);
+                self.bytecode.emit(Instruction::LoadGlobal(index));
+                Ok(())
+            }
+
+            ASTNode::LocalVariable { name, depth, slot } => {
+                let instruction = if *depth == 0 {
+                    Instruction::LoadLocal(self.local_slot(name, *slot)?)
+                } else {
+                    Instruction::LoadUpvalue(self.resolve_upvalue(name, *depth, *slot)?)
+                };
+                self.bytecode.emit(instruction);
+                Ok(())
+            }
+
+            // 代入式（代入した値を結果として残す）
+            ASTNode::Assignment { target, value } => {
+                // 値をコンパイル
+                self.compile_node(ast, *value)?;
+                self.bytecode.emit(Instruction::Dup);
+                self.emit_store(ast, *target)
+            }
+
+            // 二項演算
+            ASTNode::BinaryOperation { left, operator, right } => {
+                // 左辺をコンパイル
+                self.compile_node(ast, *left)?;
+                // 右辺をコンパイル
+                self.compile_node(ast, *right)?;
 
+                // 演算子に対応する命令を発行
+                let instruction = Self::binary_instruction(*operator)?;
+                self.bytecode.emit(instruction);
                 Ok(())
             }
 
-            // 関数呼び出し
-            ASTNode::FunctionCall { callee, arguments } => {
+            // 複合代入式（x += y、更新した値を結果として残す）
+            ASTNode::CompoundAssignment { target, operator, value } => {
+                self.compile_compound(ast, *target, *operator, *value)?;
+                self.bytecode.emit(Instruction::Dup);
+                self.emit_store(ast, *target)
+            }
+
+            // 単項演算
+            ASTNode::UnaryOperation { operator, operand } => {
+                // オペランドをコンパイル
+                self.compile_node(ast, *operand)?;
+
+                // 演算子に対応する命令を発行
+                let instruction = match operator {
+                    UnaryOperator::Negate => Instruction::Negate,
+                    UnaryOperator::Not => Instruction::Not,
+                    _ => return Err(format!("Unsupported unary operator: {:?}", operator)),
+                };
+
+                self.bytecode.emit(instruction);
+                Ok(())
+            }
+
+            // 三項演算子
+            ASTNode::TernaryOperation { condition, true_value, false_value } => {
+                self.compile_node(ast, *condition)?;
+                let jump_to_false = self.bytecode.current_index();
+                self.bytecode.emit(Instruction::JumpIfFalse(0));
+
+                self.compile_node(ast, *true_value)?;
+                let jump_to_end = self.bytecode.current_index();
+                self.bytecode.emit(Instruction::Jump(0));
+
+                let false_start = self.bytecode.current_index();
+                self.bytecode.patch(jump_to_false, Instruction::JumpIfFalse(false_start));
+                self.compile_node(ast, *false_value)?;
+
+                let end_index = self.bytecode.current_index();
+                self.bytecode.patch(jump_to_end, Instruction::Jump(end_index));
+                Ok(())
+            }
+
+            // await 式（async 関数ではフレームを中断し、それ以外ではタスクが終わるまでイベントループを回す）
+            ASTNode::AwaitExpression { expression } => {
+                self.compile_node(ast, *expression)?;
+                self.bytecode.emit(Instruction::Await);
+                Ok(())
+            }
+
+            // ラムダ式
+            ASTNode::Lambda { parameters, body } => {
+                self.compile_method(ast, "<lambda>", parameters, ast.list(*body), false, FunctionKind::Normal)
+            }
+
+            // メソッド呼び出し（インスタンスを最初の引数にする）
+            ASTNode::FunctionCall { callee, arguments } if matches!(ast.node(*callee), ASTNode::MemberAccess { .. }) => {
+                if let ASTNode::MemberAccess { object, member, .. } = ast.node(*callee) {
+                    self.compile_node(ast, *object)?;
+                    let (name, cache) = self.member_operands(member);
+                    self.bytecode.emit(Instruction::GetMethod(name, cache));
+                }
+                for &arg in ast.list(*arguments) {
+                    self.compile_node(ast, arg)?;
+                }
+                self.bytecode.emit(Instruction::CallMethod(arguments.len()));
+                Ok(())
+            }
+
+            // 関数呼び出し・インスタンス生成（クラスの呼び出し）
+            ASTNode::FunctionCall { callee, arguments } | ASTNode::NewExpression { class: callee, arguments } => {
                 // 関数をロード
-                self.compile_node(callee)?;
+                self.compile_node(ast, *callee)?;
 
                 // 引数をコンパイル
-                for arg in arguments {
-                    self.compile_node(arg)?;
+                for &arg in ast.list(*arguments) {
+                    self.compile_node(ast, arg)?;
                 }
 
                 // 呼び出し
@@ -229,11 +580,19 @@ impl Compiler {
                 Ok(())
             }
 
+            // メンバーアクセス
+            ASTNode::MemberAccess { object, member, .. } => {
+                self.compile_node(ast, *object)?;
+                let (name, cache) = self.member_operands(member);
+                self.bytecode.emit(Instruction::GetField(name, cache));
+                Ok(())
+            }
+
             // リスト
             ASTNode::List { elements } => {
                 // 要素をコンパイル
-                for elem in elements {
-                    self.compile_node(elem)?;
+                for &elem in ast.list(*elements) {
+                    self.compile_node(ast, elem)?;
                 }
 
                 // リスト作成
@@ -241,14 +600,359 @@ impl Compiler {
                 Ok(())
             }
 
-            // その他のノード（未実装）
-            _ => {
-                // とりあえずNullを返す
-                self.bytecode.emit(Instruction::LoadConst(Value::Null));
+            // 辞書（キー・値の順に積む）
+            ASTNode::Dictionary { pairs } => {
+                for &node in ast.list(*pairs) {
+                    self.compile_node(ast, node)?;
+                }
+                self.bytecode.emit(Instruction::MakeDict(pairs.len() / 2));
+                Ok(())
+            }
+
+            // インデックスアクセス
+            ASTNode::IndexAccess { object, index } => {
+                self.compile_node(ast, *object)?;
+                self.compile_node(ast, *index)?;
+                self.bytecode.emit(Instruction::IndexGet);
                 Ok(())
             }
+
+            // 内包表記
+            ASTNode::ListComprehension { element, variable, iterable, condition, slot } => {
+                self.compile_comprehension(ast, variable, *slot, *iterable, *condition, *element, None)
+            }
+            ASTNode::DictComprehension { key, value, variable, iterable, condition, slot } => {
+                self.compile_comprehension(ast, variable, *slot, *iterable, *condition, *key, Some(*value))
+            }
+
+            // ジェネレータ式（反復対象を引数に取るジェネレータ関数を作り、すぐに呼び出す）
+            ASTNode::GeneratorExpression { element, variable, iterable, condition, slot } => {
+                self.begin_function(1, false);
+                let result = self.compile_generator_body(ast, variable, *slot, *condition, *element);
+                self.end_function("<genexpr>", &[GENERATOR_SOURCE.to_string()], FunctionKind::Generator, result)?;
+
+                self.compile_node(ast, *iterable)?;
+                self.bytecode.emit(Instruction::Call(1));
+                Ok(())
+            }
+
+            // その他のノード（未実装）
+            node => Err(Self::unsupported(node)),
+        }
+    }
+
+    /// 内包表記をコンパイル（value があれば辞書、なければリスト）
+    /// 結果はイテレータの下に置き、ループを抜けると結果だけが残る
+    #[allow(clippy::too_many_arguments)]
+    fn compile_comprehension(
+        &mut self,
+        ast: &Ast,
+        variable: &str,
+        slot: Option<usize>,
+        iterable: NodeId,
+        condition: Option<NodeId>,
+        element: NodeId,
+        value: Option<NodeId>,
+    ) -> Result<(), String> {
+        self.compile_node(ast, iterable)?;
+        self.bytecode.emit(Instruction::GetIter);
+        self.bytecode.emit(Instruction::NewCollection(value.is_some()));
+
+        let loop_start = self.bytecode.current_index();
+        self.bytecode.emit(Instruction::ForIter(0)); // 仮の値
+        self.emit_define(variable, slot)?;
+
+        if let Some(condition) = condition {
+            self.compile_node(ast, condition)?;
+            self.bytecode.emit(Instruction::JumpIfFalse(loop_start));
+        }
+        self.compile_node(ast, element)?;
+        match value {
+            Some(value) => {
+                self.compile_node(ast, value)?;
+                self.bytecode.emit(Instruction::DictInsert);
+            }
+            None => {
+                self.bytecode.emit(Instruction::ListAppend);
+            }
+        }
+        self.bytecode.emit(Instruction::Jump(loop_start));
+
+        let end_index = self.bytecode.current_index();
+        self.bytecode.patch(loop_start, Instruction::ForIter(end_index));
+        Ok(())
+    }
+
+    /// ジェネレータ式の本体（スロット0の反復対象から要素を1つずつ yield する）
+    fn compile_generator_body(
+        &mut self,
+        ast: &Ast,
+        variable: &str,
+        slot: Option<usize>,
+        condition: Option<NodeId>,
+        element: NodeId,
+    ) -> Result<(), String> {
+        self.bytecode.emit(Instruction::LoadLocal(0));
+        self.bytecode.emit(Instruction::GetIter);
+
+        let loop_start = self.bytecode.current_index();
+        self.bytecode.emit(Instruction::ForIter(0)); // 仮の値
+        self.emit_define(variable, slot)?;
+
+        if let Some(condition) = condition {
+            self.compile_node(ast, condition)?;
+            self.bytecode.emit(Instruction::JumpIfFalse(loop_start));
+        }
+        self.compile_node(ast, element)?;
+        self.bytecode.emit(Instruction::Yield);
+        self.bytecode.emit(Instruction::Jump(loop_start));
+
+        let end_index = self.bytecode.current_index();
+        self.bytecode.patch(loop_start, Instruction::ForIter(end_index));
+        self.bytecode.emit_constant(Constant::Null);
+        Ok(())
+    }
+
+    /// ループ本体をコンパイルし、本体の break のジャンプを返す
+    fn compile_loop_body(&mut self, ast: &Ast, body: &[NodeId], start: usize, iterates: bool) -> Result<Vec<usize>, String> {
+        self.loops.push(Loop { start, iterates, breaks: Vec::new() });
+        let result = body.iter().try_for_each(|&stmt| self.compile_statement(ast, stmt));
+        let current = self.loops.pop().unwrap();
+        result.map(|()| current.breaks)
+    }
+
+    /// 仮の値で発行したジャンプのジャンプ先を設定
+    fn patch_jumps(&mut self, jumps: Vec<usize>, target: usize) {
+        for jump in jumps {
+            self.bytecode.patch(jump, Instruction::Jump(target));
         }
     }
+
+    /// 関数本体を独自のチャンクにコンパイルし、クロージャを作成する命令を発行
+    /// initializer なら文の後に self を返し、ジェネレータ・async 関数なら呼び出しがジェネレータ・タスクを返す
+    fn compile_method(
+        &mut self,
+        ast: &Ast,
+        name: &str,
+        parameters: &[String],
+        body: &[NodeId],
+        initializer: bool,
+        kind: FunctionKind,
+    ) -> Result<(), String> {
+        self.begin_function(parameters.len(), initializer);
+
+        // 最後の式の値を暗黙の戻り値にする（__init__ は self）
+        let result = if initializer {
+            body.iter().try_for_each(|&node| self.compile_statement(ast, node)).map(|()| {
+                self.bytecode.emit(Instruction::LoadLocal(0));
+            })
+        } else {
+            self.compile_block_value(ast, body)
+        };
+        self.end_function(name, parameters, kind, result)
+    }
+
+    /// 関数本体のチャンクのコンパイルを始める（外側の関数の状態を退避）
+    fn begin_function(&mut self, parameter_count: usize, initializer: bool) {
+        self.enclosing.push(FunctionState {
+            bytecode: std::mem::take(&mut self.bytecode),
+            upvalues: std::mem::take(&mut self.upvalues),
+            cache_count: std::mem::take(&mut self.cache_count),
+            initializer: std::mem::replace(&mut self.initializer, initializer),
+            loops: std::mem::take(&mut self.loops),
+        });
+        // パラメータはResolverがスロット 0..n に割り当て済み
+        self.bytecode.local_count = parameter_count;
+    }
+
+    /// 戻り値を積んだ本体に Return を付けて関数を閉じ、外側のチャンクにクロージャを作成する命令を発行
+    fn end_function(&mut self, name: &str, parameters: &[String], kind: FunctionKind, result: Result<(), String>) -> Result<(), String> {
+        self.bytecode.emit(Instruction::Return);
+
+        // 外側の関数の状態を復元
+        let outer = self.enclosing.pop().unwrap();
+        let chunk = std::mem::replace(&mut self.bytecode, outer.bytecode);
+        let upvalues = std::mem::replace(&mut self.upvalues, outer.upvalues);
+        self.cache_count = outer.cache_count;
+        self.initializer = outer.initializer;
+        self.loops = outer.loops;
+        result?;
+
+        let index = self.bytecode.functions.len();
+        self.bytecode.functions.push(Arc::new(FunctionProto {
+            name: name.to_string(),
+            parameters: parameters.to_vec(),
+            chunk: Arc::new(chunk),
+            upvalues,
+            is_generator: kind == FunctionKind::Generator,
+            is_async: kind == FunctionKind::Async,
+        }));
+        self.bytecode.emit(Instruction::MakeClosure(index));
+        Ok(())
+    }
+
+    /// スタックトップの値を宣言した変数に保存
+    fn emit_define(&mut self, name: &str, slot: Option<usize>) -> Result<(), String> {
+        match slot {
+            Some(slot) => {
+                let slot = self.local_slot(name, slot)?;
+                self.bytecode.emit(Instruction::StoreLocal(slot));
+            }
+            None => {
+                let index = self.add_name(name);
+                self.bytecode.emit(Instruction::StoreGlobal(index));
+            }
+        }
+        Ok(())
+    }
+
+    /// スタックトップの値を代入先に保存
+    fn emit_store(&mut self, ast: &Ast, target: NodeId) -> Result<(), String> {
+        let instruction = match ast.node(target) {
+            ASTNode::Identifier(name) | ASTNode::GlobalVariable { name } => {
+                Instruction::StoreGlobal(self.add_name(name))
+            }
+            ASTNode::LocalVariable { name, depth: 0, slot } => {
+                Instruction::StoreLocal(self.local_slot(name, *slot)?)
+            }
+            ASTNode::LocalVariable { name, depth, slot } => {
+                Instruction::StoreUpvalue(self.resolve_upvalue(name, *depth, *slot)?)
+            }
+            // 値の上にインスタンスを積んで書き込む
+            ASTNode::MemberAccess { object, member, .. } => {
+                self.compile_node(ast, *object)?;
+                let (name, cache) = self.member_operands(member);
+                Instruction::SetField(name, cache)
+            }
+            // 値の上にオブジェクト・インデックスを積んで書き込む
+            ASTNode::IndexAccess { object, index } => {
+                self.compile_node(ast, *object)?;
+                self.compile_node(ast, *index)?;
+                Instruction::IndexSet
+            }
+            _ => return Err("Complex assignment not yet supported in bytecode".to_string()),
+        };
+        self.bytecode.emit(instruction);
+        Ok(())
+    }
+
+    /// 二項演算子に対応する命令
+    fn binary_instruction(operator: BinaryOperator) -> Result<Instruction, String> {
+        Ok(match operator {
+            BinaryOperator::Add => Instruction::Add,
+            BinaryOperator::Subtract => Instruction::Subtract,
+            BinaryOperator::Multiply => Instruction::Multiply,
+            BinaryOperator::Divide => Instruction::Divide,
+            BinaryOperator::Modulo => Instruction::Modulo,
+            BinaryOperator::Power => Instruction::Power,
+            BinaryOperator::Less => Instruction::Less,
+            BinaryOperator::Greater => Instruction::Greater,
+            BinaryOperator::LessEqual => Instruction::LessEqual,
+            BinaryOperator::GreaterEqual => Instruction::GreaterEqual,
+            BinaryOperator::Equal => Instruction::Equal,
+            BinaryOperator::NotEqual => Instruction::NotEqual,
+            BinaryOperator::And => Instruction::And,
+            BinaryOperator::Or => Instruction::Or,
+            _ => return Err(format!("Unsupported binary operator: {:?}", operator)),
+        })
+    }
+
+    /// 複合代入の演算部分（変数を読み、値と演算する。保存は呼び出し側）
+    fn compile_compound(&mut self, ast: &Ast, target: NodeId, operator: BinaryOperator, value: NodeId) -> Result<(), String> {
+        if !matches!(
+            operator,
+            BinaryOperator::Add | BinaryOperator::Subtract | BinaryOperator::Multiply | BinaryOperator::Divide | BinaryOperator::Modulo
+        ) {
+            return Err(format!("Unsupported compound assignment operator: {:?}", operator));
+        }
+        if !matches!(ast.node(target), ASTNode::Identifier(_) | ASTNode::LocalVariable { .. } | ASTNode::GlobalVariable { .. }) {
+            return Err("Compound assignment target must be a variable".to_string());
+        }
+        self.compile_node(ast, target)?;
+        self.compile_node(ast, value)?;
+        self.bytecode.emit(Self::binary_instruction(operator)?);
+        Ok(())
+    }
+
+    /// 名前（クラス名・メンバー名）の文字列定数
+    fn name_constant(&mut self, name: &str) -> u32 {
+        self.bytecode.add_constant(Constant::String(name.to_string())) as u32
+    }
+
+    /// メンバーアクセス命令のオペランド（名前の定数, 新しいインラインキャッシュの番号）
+    fn member_operands(&mut self, member: &str) -> (u32, u32) {
+        let cache = self.cache_count;
+        self.cache_count += 1;
+        (self.name_constant(member), cache)
+    }
+
+    /// グローバル変数名を登録（プログラム全体で共通のインデックス）
+    fn add_name(&mut self, name: &str) -> u32 {
+        if let Some(&index) = self.name_indices.get(name) {
+            return index;
+        }
+
+        let index = self.names.len() as u32;
+        self.names.push(name.to_string());
+        self.name_indices.insert(name.to_string(), index);
+        index
+    }
+
+    /// 解決済みローカル変数のスロット番号を命令オペランドに変換（フレームサイズも更新）
+    fn local_slot(&mut self, name: &str, slot: usize) -> Result<u16, String> {
+        let operand = u16::try_from(slot)
+            .map_err(|_| format!("Too many local variables (slot {} for '{}')", slot, name))?;
+        self.bytecode.local_count = self.bytecode.local_count.max(slot + 1);
+        Ok(operand)
+    }
+
+    /// depth 階層外側の関数のスロットを、途中の各関数の捕捉変数として登録
+    fn resolve_upvalue(&mut self, name: &str, depth: usize, slot: usize) -> Result<u16, String> {
+        let current = self.enclosing.len();
+        if depth >= current {
+            return Err(format!("Variable '{}' is not defined", name));
+        }
+
+        let mut desc = UpvalueDesc {
+            is_local: true,
+            index: u16::try_from(slot)
+                .map_err(|_| format!("Too many local variables (slot {} for '{}')", slot, name))?,
+        };
+
+        // 変数を持つ関数の1つ内側から現在の関数まで順に捕捉
+        for level in (current - depth + 1)..=current {
+            let upvalues = if level == current {
+                &mut self.upvalues
+            } else {
+                &mut self.enclosing[level].upvalues
+            };
+            let index = match upvalues.iter().position(|u| *u == desc) {
+                Some(index) => index,
+                None => {
+                    upvalues.push(desc);
+                    upvalues.len() - 1
+                }
+            };
+            desc = UpvalueDesc {
+                is_local: false,
+                index: u16::try_from(index)
+                    .map_err(|_| format!("Too many captured variables in function capturing '{}'", name))?,
+            };
+        }
+
+        Ok(desc.index)
+    }
+
+    /// 未対応ノードのエラーメッセージ
+    #[cold]
+    fn unsupported(node: &ASTNode) -> String {
+        let debug = format!("{:?}", node);
+        let kind = debug
+            .split(|c: char| !c.is_alphanumeric())
+            .next()
+            .unwrap_or("node");
+        format!("{} is not yet supported in bytecode", kind)
+    }
 }
 
 impl Default for Compiler {
@@ -266,11 +970,15 @@ mod tests {
         let mut compiler = Compiler::new();
 
         // 2 + 3
-        let ast = vec![ASTNode::BinaryOperation {
-            left: Box::new(ASTNode::Number(2.0)),
+        let mut ast = Ast::new();
+        let left = ast.push(ASTNode::Number(2.0));
+        let right = ast.push(ASTNode::Number(3.0));
+        let sum = ast.push(ASTNode::BinaryOperation {
+            left,
             operator: BinaryOperator::Add,
-            right: Box::new(ASTNode::Number(3.0)),
-        }];
+            right,
+        });
+        ast.set_root(vec![sum]);
 
         let bytecode = compiler.compile(ast).unwrap();
 
@@ -282,15 +990,70 @@ mod tests {
         let mut compiler = Compiler::new();
 
         // let x = 42
-        let ast = vec![ASTNode::VariableDeclaration {
+        let mut ast = Ast::new();
+        let value = ast.push(ASTNode::Number(42.0));
+        let declaration = ast.push(ASTNode::VariableDeclaration {
             name: "x".to_string(),
-            value: Box::new(ASTNode::Number(42.0)),
+            value,
             is_const: false,
-        }];
+            slot: None,
+        });
+        ast.set_root(vec![declaration]);
 
         let bytecode = compiler.compile(ast).unwrap();
 
-        // LoadConst, StoreVar, Halt
+        // LoadConst, StoreGlobal, Halt
         assert_eq!(bytecode.instructions.len(), 3);
+        assert!(matches!(bytecode.instructions[1], Instruction::StoreGlobal(0)));
+        assert_eq!(bytecode.names, vec!["x".to_string()]);
+    }
+
+    #[test]
+    fn test_compile_function() {
+        let mut compiler = Compiler::new();
+
+        // fun add(a, b) { return a + b }
+        let mut ast = Ast::new();
+        let a = ast.push(ASTNode::Identifier("a".to_string()));
+        let b = ast.push(ASTNode::Identifier("b".to_string()));
+        let sum = ast.push(ASTNode::BinaryOperation {
+            left: a,
+            operator: BinaryOperator::Add,
+            right: b,
+        });
+        let ret = ast.push(ASTNode::ReturnStatement { value: Some(sum) });
+        let body = ast.push_list(vec![ret]);
+        let function = ast.push(ASTNode::FunctionDeclaration {
+            name: "add".to_string(),
+            parameters: vec!["a".to_string(), "b".to_string()],
+            body,
+            is_async: false,
+            is_generator: false,
+            slot: None,
+        });
+        ast.set_root(vec![function]);
+
+        let bytecode = compiler.compile(ast).unwrap();
+
+        // 関数本体は独自のチャンクに入り、トップレベルはクロージャを作って保存するだけ
+        assert!(matches!(bytecode.instructions[0], Instruction::MakeClosure(0)));
+        let function = &bytecode.functions[0];
+        assert_eq!(function.chunk.local_count, 2);
+        assert!(matches!(
+            function.chunk.instructions[..],
+            [Instruction::LoadLocal(0), Instruction::LoadLocal(1), Instruction::Add, Instruction::Return, ..]
+        ));
+    }
+
+    #[test]
+    fn test_compile_unsupported_node() {
+        let mut compiler = Compiler::new();
+
+        let mut ast = Ast::new();
+        let statement = ast.push(ASTNode::ImportStatement { module: "math".to_string(), alias: None });
+        ast.set_root(vec![statement]);
+
+        let error = compiler.compile(ast).unwrap_err();
+        assert!(error.contains("ImportStatement"));
     }
 }
@@ -0,0 +1,385 @@
+/// 辞書（挿入順を保つハッシュ表）
+/// 要素は挿入順に entries へ詰めて並べ、ハッシュ表（indices）には entries の位置だけを持つ。
+/// 反復は entries を先頭から読むだけで、表の空きを飛ばさない。
+/// キーは数値・真偽値・文字列・null をそのまま持ち（文字列に変換しない）、
+/// ハッシュには暗号強度のいらない FxHash を使う。
+
+use crate::string::Str;
+use crate::value::Value;
+use std::fmt;
+use std::hash::{BuildHasherDefault, Hasher};
+
+/// FxHash の乗数
+const SEED: u64 = 0x51_7c_c1_b7_27_22_0a_95;
+
+/// 空きスロット
+const EMPTY: u32 = u32::MAX;
+
+/// 表を作るときの最小スロット数
+const MIN_SLOTS: usize = 8;
+
+/// 高速な非暗号ハッシュ（rustc の FxHasher と同じ計算）
+#[derive(Default, Clone, Copy)]
+pub struct FxHasher {
+    hash: u64,
+}
+
+/// HashMap で FxHasher を使うための型
+pub type FxBuildHasher = BuildHasherDefault<FxHasher>;
+
+impl FxHasher {
+    #[inline]
+    fn add(&mut self, word: u64) {
+        self.hash = (self.hash.rotate_left(5) ^ word).wrapping_mul(SEED);
+    }
+}
+
+impl Hasher for FxHasher {
+    #[inline]
+    fn write(&mut self, bytes: &[u8]) {
+        let mut chunks = bytes.chunks_exact(8);
+        for chunk in &mut chunks {
+            self.add(u64::from_le_bytes(chunk.try_into().unwrap()));
+        }
+        let rest = chunks.remainder();
+        if !rest.is_empty() {
+            let mut word = [0u8; 8];
+            word[..rest.len()].copy_from_slice(rest);
+            // 長さも混ぜる（"a" と "a\0" を区別する）
+            self.add(u64::from_le_bytes(word) ^ ((rest.len() as u64) << 56));
+        }
+    }
+
+    #[inline]
+    fn write_u8(&mut self, value: u8) {
+        self.add(value as u64);
+    }
+
+    #[inline]
+    fn write_u64(&mut self, value: u64) {
+        self.add(value);
+    }
+
+    #[inline]
+    fn write_usize(&mut self, value: usize) {
+        self.add(value as u64);
+    }
+
+    #[inline]
+    fn finish(&self) -> u64 {
+        self.hash
+    }
+}
+
+/// 辞書のキー
+#[derive(Debug, Clone, PartialEq, Eq)]
+pub enum Key {
+    /// 数値（ビット列で比較する。-0 は 0 に、NaN は1つの値にそろえる）
+    Number(u64),
+
+    /// 文字列
+    Str(Str),
+
+    /// 真偽値
+    Boolean(bool),
+
+    /// Null
+    Null,
+}
+
+impl Key {
+    /// 値からキーを作成（数値・文字列・真偽値・null 以外はキーにできない）
+    #[inline]
+    pub fn from_value(value: &Value) -> Result<Key, String> {
+        match value {
+            Value::Number(n) => Ok(Key::number(*n)),
+            Value::String(s) => Ok(Key::Str(s.clone())),
+            Value::Boolean(b) => Ok(Key::Boolean(*b)),
+            Value::Null => Ok(Key::Null),
+            _ => Err(format!("Unhashable dictionary key type: {}", value.type_name())),
+        }
+    }
+
+    /// 数値のキー
+    #[inline]
+    pub fn number(n: f64) -> Key {
+        let n = if n == 0.0 { 0.0 } else if n.is_nan() { f64::NAN } else { n };
+        Key::Number(n.to_bits())
+    }
+
+    /// キーを値に戻す
+    pub fn to_value(&self) -> Value {
+        match self {
+            Key::Number(bits) => Value::Number(f64::from_bits(*bits)),
+            Key::Str(s) => Value::String(s.clone()),
+            Key::Boolean(b) => Value::Boolean(*b),
+            Key::Null => Value::Null,
+        }
+    }
+
+    /// ハッシュ値（型ごとに異なるタグを混ぜる）
+    #[inline]
+    fn hash(&self) -> u64 {
+        match self {
+            Key::Str(s) => hash_str(s),
+            Key::Number(bits) => {
+                let mut hasher = FxHasher::default();
+                hasher.write_u8(1);
+                hasher.write_u64(*bits);
+                hasher.finish()
+            }
+            Key::Boolean(b) => {
+                let mut hasher = FxHasher::default();
+                hasher.write_u8(2);
+                hasher.write_u8(*b as u8);
+                hasher.finish()
+            }
+            Key::Null => {
+                let mut hasher = FxHasher::default();
+                hasher.write_u8(3);
+                hasher.finish()
+            }
+        }
+    }
+}
+
+impl From<&str> for Key {
+    fn from(s: &str) -> Key {
+        Key::Str(Str::from(s))
+    }
+}
+
+impl fmt::Display for Key {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        match self {
+            Key::Str(s) => write!(f, "{}", s),
+            key => write!(f, "{}", key.to_value()),
+        }
+    }
+}
+
+/// 文字列キーのハッシュ値（Key::Str を作らずに引くときも同じ値になる）
+#[inline]
+fn hash_str(s: &str) -> u64 {
+    let mut hasher = FxHasher::default();
+    hasher.write(s.as_bytes());
+    hasher.finish()
+}
+
+/// 要素（ハッシュ値も持ち、表を作り直すときに再計算しない）
+#[derive(Debug)]
+struct Entry {
+    hash: u64,
+    key: Key,
+    value: Value,
+}
+
+/// 挿入順の辞書
+pub struct Dict {
+    /// 要素（挿入順）
+    entries: Vec<Entry>,
+
+    /// ハッシュ表（entries の位置、EMPTY は空き。長さは0か2の累乗）
+    indices: Box<[u32]>,
+}
+
+impl Dict {
+    /// 空の辞書（表は最初の挿入で作る）
+    pub fn new() -> Dict {
+        Dict { entries: Vec::new(), indices: Box::new([]) }
+    }
+
+    /// capacity 個までは作り直さずに入る辞書
+    pub fn with_capacity(capacity: usize) -> Dict {
+        let indices = if capacity == 0 { Box::new([]) as Box<[u32]> } else { empty_table(slots_for(capacity)) };
+        Dict { entries: Vec::with_capacity(capacity), indices }
+    }
+
+    /// 要素数
+    #[inline]
+    pub fn len(&self) -> usize {
+        self.entries.len()
+    }
+
+    /// 空か
+    #[inline]
+    pub fn is_empty(&self) -> bool {
+        self.entries.is_empty()
+    }
+
+    /// キーの値
+    #[inline]
+    pub fn get(&self, key: &Key) -> Option<&Value> {
+        let hash = key.hash();
+        self.find(hash, |other| other == key).ok().map(|index| &self.entries[index].value)
+    }
+
+    /// 文字列キーの値（メンバーアクセス用、キーを作らない）
+    #[inline]
+    pub fn get_str(&self, name: &str) -> Option<&Value> {
+        let hash = hash_str(name);
+        self.find(hash, |other| matches!(other, Key::Str(s) if s.as_str() == name))
+            .ok()
+            .map(|index| &self.entries[index].value)
+    }
+
+    /// キーがあるか
+    pub fn contains_key(&self, key: &Key) -> bool {
+        self.get(key).is_some()
+    }
+
+    /// 値を設定（既存のキーなら位置はそのままで古い値を返す）
+    pub fn insert(&mut self, key: Key, value: Value) -> Option<Value> {
+        let hash = key.hash();
+        match self.find(hash, |other| *other == key) {
+            Ok(index) => Some(std::mem::replace(&mut self.entries[index].value, value)),
+            Err(slot) => {
+                let slot = if self.needs_grow() {
+                    self.grow();
+                    self.free_slot(hash)
+                } else {
+                    slot
+                };
+                self.indices[slot] = self.entries.len() as u32;
+                self.entries.push(Entry { hash, key, value });
+                None
+            }
+        }
+    }
+
+    /// キー（挿入順）
+    pub fn keys(&self) -> impl Iterator<Item = &Key> {
+        self.entries.iter().map(|entry| &entry.key)
+    }
+
+    /// 値（挿入順）
+    pub fn values(&self) -> impl Iterator<Item = &Value> {
+        self.entries.iter().map(|entry| &entry.value)
+    }
+
+    /// キーと値（挿入順）
+    pub fn iter(&self) -> impl Iterator<Item = (&Key, &Value)> {
+        self.entries.iter().map(|entry| (&entry.key, &entry.value))
+    }
+
+    /// ハッシュ値の上位ビットから始める位置（FxHash の下位ビットは偏るため）
+    #[inline]
+    fn start(&self, hash: u64) -> usize {
+        (hash >> (64 - self.indices.len().trailing_zeros())) as usize
+    }
+
+    /// キーを探す（見つかれば entries の位置、なければ挿入できるスロット）
+    #[inline]
+    fn find(&self, hash: u64, eq: impl Fn(&Key) -> bool) -> Result<usize, usize> {
+        if self.indices.is_empty() {
+            return Err(0);
+        }
+        let mask = self.indices.len() - 1;
+        let mut slot = self.start(hash);
+        loop {
+            let index = self.indices[slot];
+            if index == EMPTY {
+                return Err(slot);
+            }
+            let entry = &self.entries[index as usize];
+            if entry.hash == hash && eq(&entry.key) {
+                return Ok(index as usize);
+            }
+            slot = (slot + 1) & mask;
+        }
+    }
+
+    /// hash の入る空きスロット（キーがないと分かっているとき）
+    fn free_slot(&self, hash: u64) -> usize {
+        let mask = self.indices.len() - 1;
+        let mut slot = self.start(hash);
+        while self.indices[slot] != EMPTY {
+            slot = (slot + 1) & mask;
+        }
+        slot
+    }
+
+    /// もう1つ入れると負荷率が 2/3 を超えるか
+    #[inline]
+    fn needs_grow(&self) -> bool {
+        (self.entries.len() + 1) * 3 > self.indices.len() * 2
+    }
+
+    /// 表を大きくして entries の位置を入れ直す
+    fn grow(&mut self) {
+        let slots = slots_for(self.entries.len() + 1).max(self.indices.len() * 2);
+        self.indices = empty_table(slots);
+        for index in 0..self.entries.len() {
+            let slot = self.free_slot(self.entries[index].hash);
+            self.indices[slot] = index as u32;
+        }
+    }
+}
+
+/// capacity 個を負荷率 2/3 以下で入れられるスロット数
+fn slots_for(capacity: usize) -> usize {
+    (capacity * 3 / 2 + 1).next_power_of_two().max(MIN_SLOTS)
+}
+
+fn empty_table(slots: usize) -> Box<[u32]> {
+    vec![EMPTY; slots].into_boxed_slice()
+}
+
+impl Default for Dict {
+    fn default() -> Self {
+        Self::new()
+    }
+}
+
+impl fmt::Debug for Dict {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        f.debug_map().entries(self.iter()).finish()
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_insertion_order() {
+        let mut dict = Dict::new();
+        for word in ["pear", "apple", "fig", "apple", "kiwi"] {
+            let count = dict.get(&Key::from(word)).map_or(0.0, |v| v.as_number().unwrap());
+            dict.insert(Key::from(word), Value::Number(count + 1.0));
+        }
+        let keys: Vec<String> = dict.keys().map(|k| k.to_string()).collect();
+        assert_eq!(keys, vec!["pear", "apple", "fig", "kiwi"]);
+        assert_eq!(dict.get_str("apple").unwrap().as_number().unwrap(), 2.0);
+        assert!(dict.get_str("plum").is_none());
+    }
+
+    #[test]
+    fn test_typed_keys() {
+        let mut dict = Dict::new();
+        dict.insert(Key::number(1.0), Value::String("number".into()));
+        dict.insert(Key::from("1"), Value::String("string".into()));
+        dict.insert(Key::Boolean(true), Value::String("bool".into()));
+        dict.insert(Key::number(-0.0), Value::String("zero".into()));
+
+        assert_eq!(dict.len(), 4);
+        assert_eq!(dict.get(&Key::number(1.0)).unwrap().to_string(), "number");
+        assert_eq!(dict.get(&Key::from("1")).unwrap().to_string(), "string");
+        assert_eq!(dict.get(&Key::number(0.0)).unwrap().to_string(), "zero");
+        assert!(Key::from_value(&Value::List(Default::default())).is_err());
+    }
+
+    #[test]
+    fn test_grow() {
+        let mut dict = Dict::with_capacity(3);
+        for i in 0..1000 {
+            dict.insert(Key::number(i as f64), Value::Number((i * 2) as f64));
+        }
+        assert_eq!(dict.len(), 1000);
+        for i in 0..1000 {
+            assert_eq!(dict.get(&Key::number(i as f64)).unwrap().as_number().unwrap(), (i * 2) as f64);
+        }
+        let keys: Vec<f64> = dict.keys().map(|k| k.to_value().as_number().unwrap()).collect();
+        assert!(keys.windows(2).all(|pair| pair[0] < pair[1]));
+    }
+}
@@ -1,387 +1,902 @@
-use pyo3::prelude::*;
-use pyo3::types::PyDict;
+/// Discord REST API
+/// discord_send_message などの組み込み関数はリクエストをタスクにして返し、await で応答（JSON を読み込んだ値）を待つ。
+/// リクエストはスレッドごとに1つのスケジューラが Discord のレート制限に合わせて送る:
+/// - ルート（メソッドと主要パラメータ）ごとにバケットを持ち、X-RateLimit-Bucket で同じバケットのルートをまとめる
+/// - バケットの中のリクエストは順に1つずつ送り、X-RateLimit-Remaining が 0 なら Reset-After まで待つ
+/// - 別のバケットのリクエストは並行に送る（グローバルの1秒あたりの上限と 429 のグローバル制限だけは共有する）
+/// - 429 が返ったら Retry-After だけ待って送り直す
+/// - 同じ URL の GET が送信中なら、新しく送らずにその結果を待つ
+
+use crate::dict::{Dict, Key};
+use crate::environment::Environment;
+use crate::http::{self, Response};
+use crate::task::{self, Task};
+use crate::value::Value;
+use reqwest::header::{HeaderMap, HeaderValue, AUTHORIZATION, CONTENT_TYPE, USER_AGENT};
+use reqwest::{Method, Url};
 use serde_json::json;
-use std::collections::HashMap;
-use std::sync::Mutex;
-use once_cell::sync::Lazy;
+use std::cell::{Cell, RefCell};
+use std::collections::{HashMap, VecDeque};
+use std::rc::Rc;
+use std::time::Duration;
+use tokio::sync::Semaphore;
+use tokio::time::Instant;
 
 const DISCORD_API_BASE: &str = "https://discord.com/api/v10";
 
-/// Global Discord bot token
-static BOT_TOKEN: Lazy<Mutex<Option<String>>> = Lazy::new(|| Mutex::new(None));
+/// 応答時間を覚えておく件数（p50・p99 の計算に使う）
+const LATENCY_SAMPLES: usize = 1024;
 
-/// Set Discord bot token
-#[pyfunction]
-pub fn discord_set_token(token: String) -> PyResult<()> {
-    let mut global_token = BOT_TOKEN.lock().unwrap();
-    *global_token = Some(token);
-    Ok(())
-}
+/// スケジューラの設定
+#[derive(Debug, Clone)]
+pub struct RestConfig {
+    /// API のベース URL（テストではローカルの偽の API を指す）
+    pub api_base: String,
 
-/// Get authorization header with bot token
-fn get_auth_header() -> Result<HashMap<String, String>, String> {
-    let global_token = BOT_TOKEN.lock().unwrap();
+    /// 1秒あたりに送るリクエストの上限（すべてのバケットで共有）
+    pub global_limit: u32,
 
-    if let Some(token) = global_token.as_ref() {
-        let mut headers = HashMap::new();
-        headers.insert("Authorization".to_string(), format!("Bot {}", token));
-        headers.insert("Content-Type".to_string(), "application/json".to_string());
-        Ok(headers)
-    } else {
-        Err("Discord token not set. Call discord_set_token() first.".to_string())
+    /// 429 が返ったときに送り直す回数の上限
+    pub max_retries: u32,
+}
+
+impl Default for RestConfig {
+    fn default() -> Self {
+        RestConfig { api_base: DISCORD_API_BASE.to_string(), global_limit: 50, max_retries: 5 }
     }
 }
 
-/// Send message to a channel
-#[pyfunction]
-pub fn discord_send_message(channel_id: String, content: String) -> PyResult<String> {
-    let url = format!("{}/channels/{}/messages", DISCORD_API_BASE, channel_id);
-    let body = json!({
-        "content": content
-    }).to_string();
+/// レート制限のバケット
+struct Bucket {
+    /// 順番待ち（バケットの中のリクエストは1つずつ、来た順に送る）
+    turn: Semaphore,
+
+    /// 残りの回数（まだ応答を受け取っていなければ None）
+    remaining: Cell<Option<u32>>,
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+    /// 残りの回数が戻る時刻
+    reset_at: Cell<Option<Instant>>,
 
-    // Use the HTTP module
-    crate::http::http_post_json(url, body, None)
+    /// 順番を待っているリクエストの数
+    queued: Cell<usize>,
 }
 
-/// Send embed message to a channel
-#[pyfunction]
-pub fn discord_send_embed(
-    channel_id: String,
-    title: String,
-    description: String,
-    color: i64,
-) -> PyResult<String> {
-    let url = format!("{}/channels/{}/messages", DISCORD_API_BASE, channel_id);
-    let body = json!({
-        "embeds": [{
-            "title": title,
-            "description": description,
-            "color": color
-        }]
-    }).to_string();
+impl Bucket {
+    fn new() -> Bucket {
+        Bucket { turn: Semaphore::new(1), remaining: Cell::new(None), reset_at: Cell::new(None), queued: Cell::new(0) }
+    }
+}
+
+/// 数えている間だけ1つ増やす（待っている間に取り消されても減らす）
+struct Counted<'a>(&'a Cell<usize>);
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+impl<'a> Counted<'a> {
+    fn new(count: &'a Cell<usize>) -> Self {
+        count.set(count.get() + 1);
+        Counted(count)
+    }
+}
 
-    crate::http::http_post_json(url, body, None)
+impl Drop for Counted<'_> {
+    fn drop(&mut self) {
+        self.0.set(self.0.get() - 1);
+    }
 }
 
-/// Get channel information
-#[pyfunction]
-pub fn discord_get_channel(py: Python, channel_id: String) -> PyResult<PyObject> {
-    let url = format!("{}/channels/{}", DISCORD_API_BASE, channel_id);
+/// 計測値
+#[derive(Default)]
+struct Metrics {
+    /// 送ったリクエストの数（送り直しを含む）
+    requests: Cell<usize>,
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+    /// 送信中のリクエストの数
+    in_flight: Cell<usize>,
 
-    let response = crate::http::http_get(url, None)?;
-    crate::http::json_parse(py, response)
-}
+    /// バケットの順番・制限が解けるのを待っているリクエストの数
+    queued: Cell<usize>,
 
-/// Get guild (server) information
-#[pyfunction]
-pub fn discord_get_guild(py: Python, guild_id: String) -> PyResult<PyObject> {
-    let url = format!("{}/guilds/{}", DISCORD_API_BASE, guild_id);
+    /// 429 が返った数
+    rate_limited: Cell<usize>,
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+    /// 送信中の GET の結果を使い回した数
+    coalesced: Cell<usize>,
 
-    let response = crate::http::http_get(url, None)?;
-    crate::http::json_parse(py, response)
+    /// 終わったリクエストの、呼び出してから応答を受け取るまでの時間（秒、新しいものから LATENCY_SAMPLES 件）
+    latencies: RefCell<VecDeque<f64>>,
 }
 
-/// Delete a message
-#[pyfunction]
-pub fn discord_delete_message(channel_id: String, message_id: String) -> PyResult<String> {
-    let url = format!("{}/channels/{}/messages/{}", DISCORD_API_BASE, channel_id, message_id);
+/// レート制限に合わせてリクエストを送るスケジューラ
+pub struct RestClient {
+    config: RefCell<RestConfig>,
+    token: RefCell<Option<String>>,
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+    /// ルート → バケットのハッシュ（X-RateLimit-Bucket で知る）
+    routes: RefCell<HashMap<String, String>>,
 
-    crate::http::http_delete(url, None)
-}
+    /// バケットのハッシュ（知らなければルート）と主要パラメータ → バケット
+    buckets: RefCell<HashMap<String, Rc<Bucket>>>,
 
-/// Edit a message
-#[pyfunction]
-pub fn discord_edit_message(
-    channel_id: String,
-    message_id: String,
-    new_content: String,
-) -> PyResult<String> {
-    let url = format!("{}/channels/{}/messages/{}", DISCORD_API_BASE, channel_id, message_id);
-    let body = json!({
-        "content": new_content
-    }).to_string();
+    /// グローバルのレート制限が解ける時刻
+    global_until: Cell<Option<Instant>>,
+
+    /// 1秒ごとの区切りの始まりと、その間に送ったリクエストの数
+    window: Cell<(Instant, u32)>,
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+    /// 送信中の GET（URL → タスク）
+    in_flight_gets: RefCell<HashMap<String, Rc<Task>>>,
 
-    crate::http::http_patch(url, body, None)
+    metrics: Metrics,
 }
 
-/// Add reaction to a message
-#[pyfunction]
-pub fn discord_add_reaction(
-    channel_id: String,
-    message_id: String,
-    emoji: String,
-) -> PyResult<String> {
-    // URL encode emoji
-    let encoded_emoji = urlencoding::encode(&emoji);
-    let url = format!(
-        "{}/channels/{}/messages/{}/reactions/{}/@me",
-        DISCORD_API_BASE, channel_id, message_id, encoded_emoji
-    );
+impl RestClient {
+    pub fn new(config: RestConfig) -> RestClient {
+        RestClient {
+            config: RefCell::new(config),
+            token: RefCell::new(None),
+            routes: RefCell::new(HashMap::new()),
+            buckets: RefCell::new(HashMap::new()),
+            global_until: Cell::new(None),
+            window: Cell::new((Instant::now(), 0)),
+            in_flight_gets: RefCell::new(HashMap::new()),
+            metrics: Metrics::default(),
+        }
+    }
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+    /// エンドポイントの URL
+    pub fn endpoint(&self, path: &str) -> String {
+        format!("{}{}", self.config.borrow().api_base.trim_end_matches('/'), path)
+    }
+
+    pub fn set_token(&self, token: String) {
+        *self.token.borrow_mut() = Some(token);
+    }
 
-    crate::http::http_put(url, String::new(), None)
+    pub fn config(&self) -> RestConfig {
+        self.config.borrow().clone()
+    }
+
+    pub fn set_config(&self, config: RestConfig) {
+        *self.config.borrow_mut() = config;
+    }
+
+    /// リクエストをタスクにする（同じ URL の GET が送信中ならそのタスク）
+    pub fn request(self: &Rc<Self>, method: Method, url: &str, body: Option<String>, reason: Option<&str>) -> Result<Rc<Task>, String> {
+        let parsed = Url::parse(url).map_err(|e| format!("Invalid URL '{}': {}", url, e))?;
+        let (route, major) = route(&method, parsed.path());
+        // トークン付きの Webhook の URL はそれ自体が認証になる
+        let webhook = route.split(' ').nth(1).is_some_and(|path| path.starts_with("webhooks/")) && major.contains('/');
+        let headers = self.headers(!webhook, body.is_some(), reason)?;
+        let coalesce = method == Method::GET;
+        if coalesce {
+            if let Some(task) = self.in_flight_gets.borrow().get(url) {
+                self.metrics.coalesced.set(self.metrics.coalesced.get() + 1);
+                return Ok(task.clone());
+            }
+        }
+
+        let client = self.clone();
+        let key = url.to_string();
+        let name = format!("{} {}", method, parsed.path());
+        let task = task::spawn_native(&name, async move {
+            let result = client.clone().send(method, parsed, route, major, body, headers).await;
+            if coalesce {
+                client.in_flight_gets.borrow_mut().remove(&key);
+            }
+            result.and_then(parse_response)
+        });
+        if coalesce {
+            self.in_flight_gets.borrow_mut().insert(url.to_string(), task.clone());
+        }
+        Ok(task)
+    }
+
+    fn headers(&self, authorize: bool, has_body: bool, reason: Option<&str>) -> Result<HeaderMap, String> {
+        let mut headers = HeaderMap::new();
+        headers.insert(USER_AGENT, HeaderValue::from_static("DiscordBot (mumei, 0.1.0)"));
+        if authorize {
+            let token = self.token.borrow();
+            let token = token.as_deref().ok_or("Discord token not set. Call discord_set_token() first.")?;
+            let value = HeaderValue::from_str(&format!("Bot {}", token)).map_err(|_| "Invalid Discord token".to_string())?;
+            headers.insert(AUTHORIZATION, value);
+        }
+        if has_body {
+            headers.insert(CONTENT_TYPE, HeaderValue::from_static("application/json"));
+        }
+        if let Some(reason) = reason {
+            let value = HeaderValue::from_str(&urlencoding::encode(reason)).map_err(|e| e.to_string())?;
+            headers.insert("X-Audit-Log-Reason", value);
+        }
+        Ok(headers)
+    }
+
+    /// ルートのバケット
+    fn bucket(&self, route: &str, major: &str) -> Rc<Bucket> {
+        let key = match self.routes.borrow().get(route) {
+            Some(hash) => format!("{}:{}", hash, major),
+            None => route.to_string(),
+        };
+        self.buckets.borrow_mut().entry(key).or_insert_with(|| Rc::new(Bucket::new())).clone()
+    }
+
+    /// バケットの順番が来てから送り、429 なら待って送り直す
+    async fn send(
+        self: Rc<Self>,
+        method: Method,
+        url: Url,
+        route: String,
+        major: String,
+        body: Option<String>,
+        headers: HeaderMap,
+    ) -> Result<Response, String> {
+        let called = Instant::now();
+        let bucket = self.bucket(&route, &major);
+        let response = {
+            let waiting = Counted::new(&self.metrics.queued);
+            let queued = Counted::new(&bucket.queued);
+            let _turn = bucket.turn.acquire().await.map_err(|e| e.to_string())?;
+            drop(queued);
+
+            let mut retries = 0;
+            loop {
+                self.wait_for_limits(&bucket).await;
+                let sending = Counted::new(&self.metrics.in_flight);
+                self.metrics.requests.set(self.metrics.requests.get() + 1);
+                let response = http::client()?.send(method.clone(), url.clone(), body.clone(), headers.clone()).await?;
+                drop(sending);
+                self.update(&route, &major, &bucket, &response);
+                if response.status != 429 {
+                    break response;
+                }
+                self.metrics.rate_limited.set(self.metrics.rate_limited.get() + 1);
+                retries += 1;
+                if retries > self.config.borrow().max_retries {
+                    drop(waiting);
+                    return Err(format!("{} {} was rate limited {} times", method, url.path(), retries));
+                }
+                self.rate_limited(&bucket, &response);
+            }
+        };
+
+        let mut latencies = self.metrics.latencies.borrow_mut();
+        if latencies.len() == LATENCY_SAMPLES {
+            latencies.pop_back();
+        }
+        latencies.push_front(called.elapsed().as_secs_f64());
+        Ok(response)
+    }
+
+    /// グローバルの制限・バケットの残りの回数・1秒あたりの上限が許すまで待つ
+    async fn wait_for_limits(&self, bucket: &Bucket) {
+        loop {
+            let now = Instant::now();
+            if let Some(until) = self.global_until.get().filter(|until| *until > now) {
+                tokio::time::sleep_until(until).await;
+                continue;
+            }
+            if bucket.remaining.get() == Some(0) {
+                if let Some(reset_at) = bucket.reset_at.get().filter(|reset_at| *reset_at > now) {
+                    tokio::time::sleep_until(reset_at).await;
+                    continue;
+                }
+            }
+            let (start, count) = self.window.get();
+            let (start, count) = if now >= start + Duration::from_secs(1) { (now, 0) } else { (start, count) };
+            if count >= self.config.borrow().global_limit {
+                tokio::time::sleep_until(start + Duration::from_secs(1)).await;
+                continue;
+            }
+            self.window.set((start, count + 1));
+            return;
+        }
+    }
+
+    /// 応答のレート制限のヘッダーでバケットを更新する
+    fn update(&self, route: &str, major: &str, bucket: &Rc<Bucket>, response: &Response) {
+        if let Some(hash) = response.header("x-ratelimit-bucket") {
+            // 初めて知ったハッシュなら、いまのバケットをそのハッシュのバケットにする（同じハッシュのルートで共有する）
+            let known = self.routes.borrow().get(route).map(|known| known == hash).unwrap_or(false);
+            if !known {
+                self.routes.borrow_mut().insert(route.to_string(), hash.to_string());
+                self.buckets.borrow_mut().entry(format!("{}:{}", hash, major)).or_insert_with(|| bucket.clone());
+            }
+        }
+        if let Some(remaining) = response.header("x-ratelimit-remaining").and_then(|value| value.parse().ok()) {
+            bucket.remaining.set(Some(remaining));
+        }
+        if let Some(reset_after) = response.header("x-ratelimit-reset-after").and_then(seconds) {
+            bucket.reset_at.set(Some(Instant::now() + reset_after));
+        }
+    }
+
+    /// 429 の応答に合わせて待つ時刻を決める
+    fn rate_limited(&self, bucket: &Bucket, response: &Response) {
+        let retry_after = response
+            .header("retry-after")
+            .and_then(seconds)
+            .or_else(|| http::from_json(&response.body).ok().and_then(|body| retry_after(&body)))
+            .unwrap_or(Duration::from_secs(1));
+        let until = Instant::now() + retry_after;
+        let global = response.header("x-ratelimit-global").is_some_and(|value| value.eq_ignore_ascii_case("true"))
+            || response.header("x-ratelimit-scope") == Some("global");
+        if global {
+            self.global_until.set(Some(until));
+        } else {
+            bucket.remaining.set(Some(0));
+            bucket.reset_at.set(Some(until));
+        }
+    }
+
+    /// {"requests", "in_flight", "queued", "rate_limited", "coalesced", "latency_p50", "latency_p99", "buckets"} の辞書
+    pub fn metrics(&self) -> Value {
+        let metrics = &self.metrics;
+        let mut latencies: Vec<f64> = metrics.latencies.borrow().iter().copied().collect();
+        latencies.sort_by(f64::total_cmp);
+        let percentile = |p: f64| match latencies.len() {
+            0 => Value::Null,
+            n => Value::Number(latencies[((n as f64 * p).ceil() as usize).clamp(1, n) - 1]),
+        };
+
+        let now = Instant::now();
+        let mut buckets = Dict::new();
+        for (key, bucket) in self.buckets.borrow().iter() {
+            let reset_after = bucket.reset_at.get().map_or(0.0, |reset_at| reset_at.saturating_duration_since(now).as_secs_f64());
+            buckets.insert(
+                Key::Str(key.as_str().into()),
+                dict([
+                    ("queued", Value::Number(bucket.queued.get() as f64)),
+                    ("remaining", bucket.remaining.get().map_or(Value::Null, |remaining| Value::Number(remaining as f64))),
+                    ("reset_after", Value::Number(reset_after)),
+                ]),
+            );
+        }
+        dict([
+            ("requests", Value::Number(metrics.requests.get() as f64)),
+            ("in_flight", Value::Number(metrics.in_flight.get() as f64)),
+            ("queued", Value::Number(metrics.queued.get() as f64)),
+            ("rate_limited", Value::Number(metrics.rate_limited.get() as f64)),
+            ("coalesced", Value::Number(metrics.coalesced.get() as f64)),
+            ("latency_p50", percentile(0.50)),
+            ("latency_p99", percentile(0.99)),
+            ("buckets", Value::Dictionary(Rc::new(RefCell::new(buckets)))),
+        ])
+    }
 }
 
-/// Create a text channel
-#[pyfunction]
-pub fn discord_create_text_channel(guild_id: String, name: String) -> PyResult<String> {
-    let url = format!("{}/guilds/{}/channels", DISCORD_API_BASE, guild_id);
-    let body = json!({
-        "name": name,
-        "type": 0  // 0 = GUILD_TEXT
-    }).to_string();
+/// ルート（メソッドと、主要パラメータ以外の ID を伏せたパス）と主要パラメータ
+/// 例: DELETE /api/v10/channels/1/messages/2 → ("DELETE channels/1/messages/:id", "1")
+fn route(method: &Method, path: &str) -> (String, String) {
+    let mut segments = path.split('/').filter(|segment| !segment.is_empty()).peekable();
+    // /api・/api/v10 は除く
+    if segments.peek() == Some(&"api") {
+        segments.next();
+        if segments.peek().is_some_and(|segment| segment.starts_with('v') && segment[1..].parse::<u32>().is_ok()) {
+            segments.next();
+        }
+    }
+    let segments: Vec<&str> = segments.collect();
+    let mut route = vec![];
+    let mut major = String::new();
+    for (i, segment) in segments.iter().enumerate() {
+        let previous = if i > 0 { segments[i - 1] } else { "" };
+        if i == 1 && matches!(previous, "channels" | "guilds" | "webhooks") {
+            major = segment.to_string();
+            route.push(*segment);
+        } else if i == 2 && segments[0] == "webhooks" {
+            // Webhook のトークンも主要パラメータ
+            major = format!("{}/{}", major, segment);
+            route.push(*segment);
+        } else if previous == "reactions" {
+            // リアクションの絵文字以降はすべて同じバケット
+            break;
+        } else if segment.bytes().all(|b| b.is_ascii_digit()) {
+            route.push(":id");
+        } else {
+            route.push(*segment);
+        }
+    }
+    (format!("{} {}", method, route.join("/")), major)
+}
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+/// 秒数の文字列
+fn seconds(value: &str) -> Option<Duration> {
+    value.trim().parse::<f64>().ok().and_then(|seconds| Duration::try_from_secs_f64(seconds).ok())
+}
 
-    crate::http::http_post_json(url, body, None)
+/// 429 の本文の retry_after（秒）
+fn retry_after(body: &Value) -> Option<Duration> {
+    match body {
+        Value::Dictionary(dict) => match dict.borrow().get_str("retry_after") {
+            Some(Value::Number(seconds)) => Duration::try_from_secs_f64(*seconds).ok(),
+            _ => None,
+        },
+        _ => None,
+    }
 }
 
-/// Create a voice channel
-#[pyfunction]
-pub fn discord_create_voice_channel(guild_id: String, name: String) -> PyResult<String> {
-    let url = format!("{}/guilds/{}/channels", DISCORD_API_BASE, guild_id);
-    let body = json!({
-        "name": name,
-        "type": 2  // 2 = GUILD_VOICE
-    }).to_string();
+/// 応答の本文を値にする（本文がなければ null、JSON でなければ文字列。失敗した応答はエラー）
+fn parse_response(response: Response) -> Result<Value, String> {
+    if !(200..300).contains(&response.status) {
+        return Err(format!("Discord API error {}: {}", response.status, response.body));
+    }
+    if response.body.is_empty() {
+        return Ok(Value::Null);
+    }
+    Ok(http::from_json(&response.body).unwrap_or_else(|_| Value::String(response.body.into())))
+}
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+pub(crate) fn dict<const N: usize>(entries: [(&str, Value); N]) -> Value {
+    let mut dict = Dict::with_capacity(N);
+    for (key, value) in entries {
+        dict.insert(Key::Str(key.into()), value);
+    }
+    Value::Dictionary(Rc::new(RefCell::new(dict)))
+}
 
-    crate::http::http_post_json(url, body, None)
+thread_local! {
+    /// このスレッドのスケジューラ
+    static REST: Rc<RestClient> = Rc::new(RestClient::new(RestConfig::default()));
 }
 
-/// Delete a channel
-#[pyfunction]
-pub fn discord_delete_channel(channel_id: String) -> PyResult<String> {
-    let url = format!("{}/channels/{}", DISCORD_API_BASE, channel_id);
+/// このスレッドのスケジューラ
+pub fn rest() -> Rc<RestClient> {
+    REST.with(|rest| rest.clone())
+}
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+// ============================================
+// 組み込み関数
+// ============================================
+
+/// Discord の組み込み関数を環境に登録
+pub fn setup_discord_builtins(env: &Environment) {
+    env.define("discord_set_token".to_string(), Value::native("discord_set_token", 1, discord_set_token)).unwrap();
+    env.define("discord_config".to_string(), Value::native("discord_config", 1, discord_config)).unwrap();
+    env.define("discord_metrics".to_string(), Value::native("discord_metrics", 0, discord_metrics)).unwrap();
+    env.define("discord_request".to_string(), Value::native_with_optional("discord_request", 2, 4, discord_request)).unwrap();
+    env.define("discord_send_message".to_string(), Value::native("discord_send_message", 2, discord_send_message)).unwrap();
+    env.define("discord_send_embed".to_string(), Value::native("discord_send_embed", 4, discord_send_embed)).unwrap();
+    env.define("discord_get_channel".to_string(), Value::native("discord_get_channel", 1, discord_get_channel)).unwrap();
+    env.define("discord_get_guild".to_string(), Value::native("discord_get_guild", 1, discord_get_guild)).unwrap();
+    env.define("discord_delete_message".to_string(), Value::native("discord_delete_message", 2, discord_delete_message)).unwrap();
+    env.define("discord_edit_message".to_string(), Value::native("discord_edit_message", 3, discord_edit_message)).unwrap();
+    env.define("discord_add_reaction".to_string(), Value::native("discord_add_reaction", 3, discord_add_reaction)).unwrap();
+    env.define("discord_create_text_channel".to_string(), Value::native("discord_create_text_channel", 2, discord_create_text_channel)).unwrap();
+    env.define("discord_create_voice_channel".to_string(), Value::native("discord_create_voice_channel", 2, discord_create_voice_channel)).unwrap();
+    env.define("discord_delete_channel".to_string(), Value::native("discord_delete_channel", 1, discord_delete_channel)).unwrap();
+    env.define("discord_rename_channel".to_string(), Value::native("discord_rename_channel", 2, discord_rename_channel)).unwrap();
+    env.define("discord_create_role".to_string(), Value::native("discord_create_role", 3, discord_create_role)).unwrap();
+    env.define("discord_add_role_to_member".to_string(), Value::native("discord_add_role_to_member", 3, discord_add_role_to_member)).unwrap();
+    env.define("discord_remove_role_from_member".to_string(), Value::native("discord_remove_role_from_member", 3, discord_remove_role_from_member)).unwrap();
+    env.define("discord_kick_member".to_string(), Value::native_with_optional("discord_kick_member", 2, 3, discord_kick_member)).unwrap();
+    env.define("discord_ban_member".to_string(), Value::native_with_optional("discord_ban_member", 2, 3, discord_ban_member)).unwrap();
+    env.define("discord_set_nickname".to_string(), Value::native("discord_set_nickname", 3, discord_set_nickname)).unwrap();
+    env.define("discord_get_message_history".to_string(), Value::native_with_optional("discord_get_message_history", 1, 2, discord_get_message_history)).unwrap();
+    env.define("discord_webhook_post".to_string(), Value::native("discord_webhook_post", 2, discord_webhook_post)).unwrap();
+    env.define("discord_webhook_post_embed".to_string(), Value::native("discord_webhook_post_embed", 2, discord_webhook_post_embed)).unwrap();
+    env.define("discord_create_webhook".to_string(), Value::native("discord_create_webhook", 2, discord_create_webhook)).unwrap();
+    env.define("discord_get_user".to_string(), Value::native("discord_get_user", 1, discord_get_user)).unwrap();
+    env.define("discord_get_gateway".to_string(), Value::native("discord_get_gateway", 0, discord_get_gateway)).unwrap();
+}
 
-    crate::http::http_delete(url, None)
+/// API のパスへのリクエスト
+pub(crate) fn call(method: Method, path: String, body: Option<serde_json::Value>, reason: Option<&str>) -> Result<Value, String> {
+    let rest = rest();
+    let url = rest.endpoint(&path);
+    Ok(Value::Task(rest.request(method, &url, body.map(|body| body.to_string()), reason)?))
 }
 
-/// Modify a channel (rename, etc.)
-#[pyfunction]
-pub fn discord_rename_channel(channel_id: String, new_name: String) -> PyResult<String> {
-    let url = format!("{}/channels/{}", DISCORD_API_BASE, channel_id);
-    let body = json!({
-        "name": new_name
-    }).to_string();
+/// Discord の ID（64ビットの整数は数値では正確に表せないので文字列で渡す。整数の数値も受け付ける）
+pub(crate) fn id(value: &Value) -> Result<String, String> {
+    match value {
+        Value::String(s) if !s.as_str().is_empty() && s.as_str().bytes().all(|b| b.is_ascii_digit()) => Ok(s.as_str().to_string()),
+        Value::Number(n) if n.fract() == 0.0 && *n >= 0.0 => Ok(format!("{}", *n as u64)),
+        other => Err(format!("Invalid Discord ID: {}", other)),
+    }
+}
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+pub(crate) fn text(value: &Value) -> Result<String, String> {
+    Ok(value.as_string()?.as_str().to_string())
+}
 
-    crate::http::http_patch(url, body, None)
+fn reason(args: &[Value], index: usize) -> Result<Option<String>, String> {
+    match args.get(index) {
+        None | Some(Value::Null) => Ok(None),
+        Some(value) => text(value).map(Some),
+    }
 }
 
-/// Create a role
-#[pyfunction]
-pub fn discord_create_role(guild_id: String, name: String, color: i64) -> PyResult<String> {
-    let url = format!("{}/guilds/{}/roles", DISCORD_API_BASE, guild_id);
-    let body = json!({
-        "name": name,
-        "color": color
-    }).to_string();
+/// discord_set_token(token)
+fn discord_set_token(args: Vec<Value>) -> Result<Value, String> {
+    rest().set_token(text(&args[0])?);
+    Ok(Value::Null)
+}
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+/// discord_config(options) - {"api_base": URL, "global_limit": 1秒あたりの数, "max_retries": 数}
+fn discord_config(args: Vec<Value>) -> Result<Value, String> {
+    let Value::Dictionary(options) = &args[0] else {
+        return Err(format!("discord_config() requires a dictionary, got {}", args[0].type_name()));
+    };
+    let rest = rest();
+    let mut config = rest.config();
+    for (key, value) in options.borrow().iter() {
+        match key.to_value().to_string().as_str() {
+            "api_base" => config.api_base = text(value)?,
+            "global_limit" => config.global_limit = value.as_number()?.max(1.0) as u32,
+            "max_retries" => config.max_retries = value.as_number()?.max(0.0) as u32,
+            name => return Err(format!("discord_config() got an unknown option '{}'", name)),
+        }
+    }
+    rest.set_config(config);
+    Ok(Value::Null)
+}
 
-    crate::http::http_post_json(url, body, None)
+/// discord_metrics() - 待ち行列の長さ・応答時間などの計測値
+fn discord_metrics(_args: Vec<Value>) -> Result<Value, String> {
+    Ok(rest().metrics())
 }
 
-/// Add role to member
-#[pyfunction]
-pub fn discord_add_role_to_member(
-    guild_id: String,
-    user_id: String,
-    role_id: String,
-) -> PyResult<String> {
-    let url = format!(
-        "{}/guilds/{}/members/{}/roles/{}",
-        DISCORD_API_BASE, guild_id, user_id, role_id
-    );
+/// discord_request(method, path, body?, reason?) - 任意のエンドポイントへのリクエスト（body は値を JSON にして送る）
+fn discord_request(args: Vec<Value>) -> Result<Value, String> {
+    let method = text(&args[0])?;
+    let method = Method::from_bytes(method.to_ascii_uppercase().as_bytes()).map_err(|_| format!("Invalid HTTP method '{}'", method))?;
+    let body = match args.get(2) {
+        None | Some(Value::Null) => None,
+        Some(value) => Some(http::to_json(value)?),
+    };
+    let rest = rest();
+    let url = rest.endpoint(&text(&args[1])?);
+    Ok(Value::Task(rest.request(method, &url, body, reason(&args, 3)?.as_deref())?))
+}
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+/// discord_send_message(channel_id, content)
+fn discord_send_message(args: Vec<Value>) -> Result<Value, String> {
+    let body = json!({ "content": text(&args[1])? });
+    call(Method::POST, format!("/channels/{}/messages", id(&args[0])?), Some(body), None)
+}
 
-    crate::http::http_put(url, String::new(), None)
+/// discord_send_embed(channel_id, title, description, color)
+fn discord_send_embed(args: Vec<Value>) -> Result<Value, String> {
+    let body = json!({
+        "embeds": [{
+            "title": text(&args[1])?,
+            "description": text(&args[2])?,
+            "color": args[3].as_number()? as i64
+        }]
+    });
+    call(Method::POST, format!("/channels/{}/messages", id(&args[0])?), Some(body), None)
 }
 
-/// Remove role from member
-#[pyfunction]
-pub fn discord_remove_role_from_member(
-    guild_id: String,
-    user_id: String,
-    role_id: String,
-) -> PyResult<String> {
-    let url = format!(
-        "{}/guilds/{}/members/{}/roles/{}",
-        DISCORD_API_BASE, guild_id, user_id, role_id
-    );
+/// discord_get_channel(channel_id)
+fn discord_get_channel(args: Vec<Value>) -> Result<Value, String> {
+    call(Method::GET, format!("/channels/{}", id(&args[0])?), None, None)
+}
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+/// discord_get_guild(guild_id)
+fn discord_get_guild(args: Vec<Value>) -> Result<Value, String> {
+    call(Method::GET, format!("/guilds/{}", id(&args[0])?), None, None)
+}
 
-    crate::http::http_delete(url, None)
+/// discord_delete_message(channel_id, message_id)
+fn discord_delete_message(args: Vec<Value>) -> Result<Value, String> {
+    call(Method::DELETE, format!("/channels/{}/messages/{}", id(&args[0])?, id(&args[1])?), None, None)
 }
 
-/// Kick member from guild
-#[pyfunction]
-pub fn discord_kick_member(guild_id: String, user_id: String, reason: Option<String>) -> PyResult<String> {
-    let url = format!("{}/guilds/{}/members/{}", DISCORD_API_BASE, guild_id, user_id);
+/// discord_edit_message(channel_id, message_id, content)
+fn discord_edit_message(args: Vec<Value>) -> Result<Value, String> {
+    let body = json!({ "content": text(&args[2])? });
+    call(Method::PATCH, format!("/channels/{}/messages/{}", id(&args[0])?, id(&args[1])?), Some(body), None)
+}
 
-    let mut headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+/// discord_add_reaction(channel_id, message_id, emoji)
+fn discord_add_reaction(args: Vec<Value>) -> Result<Value, String> {
+    let emoji = urlencoding::encode(&text(&args[2])?).into_owned();
+    let path = format!("/channels/{}/messages/{}/reactions/{}/@me", id(&args[0])?, id(&args[1])?, emoji);
+    call(Method::PUT, path, None, None)
+}
 
-    if let Some(r) = reason {
-        headers.insert("X-Audit-Log-Reason".to_string(), r);
-    }
+/// discord_create_text_channel(guild_id, name)
+fn discord_create_text_channel(args: Vec<Value>) -> Result<Value, String> {
+    let body = json!({ "name": text(&args[1])?, "type": 0 });  // 0 = GUILD_TEXT
+    call(Method::POST, format!("/guilds/{}/channels", id(&args[0])?), Some(body), None)
+}
 
-    crate::http::http_delete(url, None)
+/// discord_create_voice_channel(guild_id, name)
+fn discord_create_voice_channel(args: Vec<Value>) -> Result<Value, String> {
+    let body = json!({ "name": text(&args[1])?, "type": 2 });  // 2 = GUILD_VOICE
+    call(Method::POST, format!("/guilds/{}/channels", id(&args[0])?), Some(body), None)
 }
 
-/// Ban member from guild
-#[pyfunction]
-pub fn discord_ban_member(guild_id: String, user_id: String, reason: Option<String>) -> PyResult<String> {
-    let url = format!("{}/guilds/{}/bans/{}", DISCORD_API_BASE, guild_id, user_id);
+/// discord_delete_channel(channel_id)
+fn discord_delete_channel(args: Vec<Value>) -> Result<Value, String> {
+    call(Method::DELETE, format!("/channels/{}", id(&args[0])?), None, None)
+}
 
-    let mut headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+/// discord_rename_channel(channel_id, name)
+fn discord_rename_channel(args: Vec<Value>) -> Result<Value, String> {
+    let body = json!({ "name": text(&args[1])? });
+    call(Method::PATCH, format!("/channels/{}", id(&args[0])?), Some(body), None)
+}
 
-    if let Some(r) = reason {
-        headers.insert("X-Audit-Log-Reason".to_string(), r);
-    }
+/// discord_create_role(guild_id, name, color)
+fn discord_create_role(args: Vec<Value>) -> Result<Value, String> {
+    let body = json!({ "name": text(&args[1])?, "color": args[2].as_number()? as i64 });
+    call(Method::POST, format!("/guilds/{}/roles", id(&args[0])?), Some(body), None)
+}
 
-    let body = json!({}).to_string();
-    crate::http::http_put(url, body, None)
+/// discord_add_role_to_member(guild_id, user_id, role_id)
+fn discord_add_role_to_member(args: Vec<Value>) -> Result<Value, String> {
+    let path = format!("/guilds/{}/members/{}/roles/{}", id(&args[0])?, id(&args[1])?, id(&args[2])?);
+    call(Method::PUT, path, None, None)
 }
 
-/// Set member nickname
-#[pyfunction]
-pub fn discord_set_nickname(guild_id: String, user_id: String, nickname: String) -> PyResult<String> {
-    let url = format!("{}/guilds/{}/members/{}", DISCORD_API_BASE, guild_id, user_id);
-    let body = json!({
-        "nick": nickname
-    }).to_string();
+/// discord_remove_role_from_member(guild_id, user_id, role_id)
+fn discord_remove_role_from_member(args: Vec<Value>) -> Result<Value, String> {
+    let path = format!("/guilds/{}/members/{}/roles/{}", id(&args[0])?, id(&args[1])?, id(&args[2])?);
+    call(Method::DELETE, path, None, None)
+}
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+/// discord_kick_member(guild_id, user_id, reason?)
+fn discord_kick_member(args: Vec<Value>) -> Result<Value, String> {
+    let path = format!("/guilds/{}/members/{}", id(&args[0])?, id(&args[1])?);
+    call(Method::DELETE, path, None, reason(&args, 2)?.as_deref())
+}
 
-    crate::http::http_patch(url, body, None)
+/// discord_ban_member(guild_id, user_id, reason?)
+fn discord_ban_member(args: Vec<Value>) -> Result<Value, String> {
+    let path = format!("/guilds/{}/bans/{}", id(&args[0])?, id(&args[1])?);
+    call(Method::PUT, path, Some(json!({})), reason(&args, 2)?.as_deref())
 }
 
-/// Get message history
-#[pyfunction]
-pub fn discord_get_message_history(
-    py: Python,
-    channel_id: String,
-    limit: Option<i32>,
-) -> PyResult<PyObject> {
-    let limit_param = limit.unwrap_or(50).min(100);
-    let url = format!(
-        "{}/channels/{}/messages?limit={}",
-        DISCORD_API_BASE, channel_id, limit_param
-    );
+/// discord_set_nickname(guild_id, user_id, nickname)
+fn discord_set_nickname(args: Vec<Value>) -> Result<Value, String> {
+    let body = json!({ "nick": text(&args[2])? });
+    call(Method::PATCH, format!("/guilds/{}/members/{}", id(&args[0])?, id(&args[1])?), Some(body), None)
+}
 
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+/// discord_get_message_history(channel_id, limit?) - limit は 1〜100（省略すると 50）
+fn discord_get_message_history(args: Vec<Value>) -> Result<Value, String> {
+    let limit = match args.get(1) {
+        None | Some(Value::Null) => 50.0,
+        Some(value) => value.as_number()?.clamp(1.0, 100.0),
+    };
+    call(Method::GET, format!("/channels/{}/messages?limit={}", id(&args[0])?, limit as u32), None, None)
+}
 
-    let response = crate::http::http_get(url, None)?;
-    crate::http::json_parse(py, response)
+/// discord_webhook_post(webhook_url, content)
+fn discord_webhook_post(args: Vec<Value>) -> Result<Value, String> {
+    let body = json!({ "content": text(&args[1])? }).to_string();
+    Ok(Value::Task(rest().request(Method::POST, &text(&args[0])?, Some(body), None)?))
 }
 
-/// Send message via webhook
-#[pyfunction]
-pub fn discord_webhook_post(webhook_url: String, content: String) -> PyResult<String> {
-    let body = json!({
-        "content": content
-    }).to_string();
+/// discord_webhook_post_embed(webhook_url, embed) - embed は JSON の文字列か値
+fn discord_webhook_post_embed(args: Vec<Value>) -> Result<Value, String> {
+    let body = match &args[1] {
+        Value::String(s) => s.as_str().to_string(),
+        value => http::to_json(value)?,
+    };
+    Ok(Value::Task(rest().request(Method::POST, &text(&args[0])?, Some(body), None)?))
+}
 
-    crate::http::http_post_json(webhook_url, body, None)
+/// discord_create_webhook(channel_id, name)
+fn discord_create_webhook(args: Vec<Value>) -> Result<Value, String> {
+    let body = json!({ "name": text(&args[1])? });
+    call(Method::POST, format!("/channels/{}/webhooks", id(&args[0])?), Some(body), None)
 }
 
-/// Send embed via webhook
-#[pyfunction]
-pub fn discord_webhook_post_embed(webhook_url: String, embed_data: String) -> PyResult<String> {
-    // embed_data should already be JSON
-    crate::http::http_post_json(webhook_url, embed_data, None)
+/// discord_get_user(user_id)
+fn discord_get_user(args: Vec<Value>) -> Result<Value, String> {
+    call(Method::GET, format!("/users/{}", id(&args[0])?), None, None)
 }
 
-/// Create webhook
-#[pyfunction]
-pub fn discord_create_webhook(py: Python, channel_id: String, name: String) -> PyResult<PyObject> {
-    let url = format!("{}/channels/{}/webhooks", DISCORD_API_BASE, channel_id);
-    let body = json!({
-        "name": name
-    }).to_string();
-
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
-
-    let response = crate::http::http_post_json(url, body, None)?;
-    crate::http::json_parse(py, response)
-}
-
-/// Get user information
-#[pyfunction]
-pub fn discord_get_user(py: Python, user_id: String) -> PyResult<PyObject> {
-    let url = format!("{}/users/{}", DISCORD_API_BASE, user_id);
-
-    let headers = get_auth_header()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
-
-    let response = crate::http::http_get(url, None)?;
-    crate::http::json_parse(py, response)
-}
-
-/// Register Discord functions with Python module
-pub fn register_discord_functions(m: &PyModule) -> PyResult<()> {
-    m.add_function(wrap_pyfunction!(discord_set_token, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_send_message, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_send_embed, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_get_channel, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_get_guild, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_delete_message, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_edit_message, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_add_reaction, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_create_text_channel, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_create_voice_channel, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_delete_channel, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_rename_channel, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_create_role, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_add_role_to_member, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_remove_role_from_member, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_kick_member, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_ban_member, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_set_nickname, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_get_message_history, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_webhook_post, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_webhook_post_embed, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_create_webhook, m)?)?;
-    m.add_function(wrap_pyfunction!(discord_get_user, m)?)?;
-    Ok(())
+/// discord_get_gateway() - Gateway の URL・推奨シャード数（/gateway/bot）
+fn discord_get_gateway(_args: Vec<Value>) -> Result<Value, String> {
+    call(Method::GET, "/gateway/bot".to_string(), None, None)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::sync::atomic::{AtomicUsize, Ordering};
+    use std::sync::{Arc, Mutex};
+    use tokio::io::{AsyncBufReadExt, AsyncReadExt, AsyncWriteExt, BufReader};
+
+    /// バケット "messages" の1回の区切りで送れるメッセージの数（チャンネルごと）
+    const MESSAGE_LIMIT: usize = 2;
+
+    /// バケット "messages" の区切りの長さ
+    const MESSAGE_WINDOW: Duration = Duration::from_millis(100);
+
+    /// 偽の API が数えた値
+    #[derive(Default)]
+    struct Stats {
+        /// 制限を超えて 429 を返した数（グローバルの 429 を除く）
+        violations: AtomicUsize,
+        /// GET /channels/{id} を受け取った数
+        channel_gets: AtomicUsize,
+        in_flight: AtomicUsize,
+        peak: AtomicUsize,
+    }
+
+    /// レート制限のヘッダーを返す偽の Discord API を別スレッドで起動する
+    /// - POST /api/v10/channels/{id}/messages: チャンネルごとに MESSAGE_WINDOW あたり MESSAGE_LIMIT 件（超えると 429）
+    /// - GET /api/v10/channels/{id}: 30ms 後に {"id": id}
+    /// - GET /api/v10/guilds/{id}: 最初の1回だけグローバルの 429
+    /// - それ以外は 404
+    fn start_fake_api() -> (u16, Arc<Stats>) {
+        let stats = Arc::new(Stats::default());
+        let windows: Arc<Mutex<HashMap<String, (std::time::Instant, usize)>>> = Arc::default();
+        let global_once = Arc::new(AtomicUsize::new(0));
+        let (sender, receiver) = std::sync::mpsc::channel();
+        let counted = stats.clone();
+        std::thread::spawn(move || {
+            let runtime = tokio::runtime::Builder::new_multi_thread().enable_all().build().unwrap();
+            runtime.block_on(async move {
+                let listener = tokio::net::TcpListener::bind("127.0.0.1:0").await.unwrap();
+                sender.send(listener.local_addr().unwrap().port()).unwrap();
+                loop {
+                    let (stream, _) = listener.accept().await.unwrap();
+                    let (stats, windows, global_once) = (counted.clone(), windows.clone(), global_once.clone());
+                    tokio::spawn(async move {
+                        let mut stream = BufReader::new(stream);
+                        loop {
+                            let mut request_line = String::new();
+                            if stream.read_line(&mut request_line).await.unwrap_or(0) == 0 {
+                                return;
+                            }
+                            let mut length = 0;
+                            let mut authorized = false;
+                            loop {
+                                let mut line = String::new();
+                                stream.read_line(&mut line).await.unwrap();
+                                if line.trim().is_empty() {
+                                    break;
+                                }
+                                if let Some((name, value)) = line.split_once(':') {
+                                    if name.eq_ignore_ascii_case("content-length") {
+                                        length = value.trim().parse().unwrap();
+                                    }
+                                    authorized |= name.eq_ignore_ascii_case("authorization") && value.trim() == "Bot test";
+                                }
+                            }
+                            let mut body = vec![0; length];
+                            stream.read_exact(&mut body).await.unwrap();
+
+                            let running = stats.in_flight.fetch_add(1, Ordering::SeqCst) + 1;
+                            stats.peak.fetch_max(running, Ordering::SeqCst);
+                            let mut parts = request_line.split_whitespace();
+                            let (method, path) = (parts.next().unwrap(), parts.next().unwrap());
+                            let segments: Vec<&str> = path.trim_start_matches("/api/v10/").split('/').collect();
+                            let (status, headers, content) = match (method, segments.as_slice()) {
+                                _ if !authorized => (401, String::new(), "{\"message\": \"401: Unauthorized\"}".to_string()),
+                                ("POST", ["channels", channel, "messages"]) => {
+                                    tokio::time::sleep(Duration::from_millis(5)).await;
+                                    let now = std::time::Instant::now();
+                                    let (count, reset_after) = {
+                                        let mut windows = windows.lock().unwrap();
+                                        let window = windows.entry(channel.to_string()).or_insert((now, 0));
+                                        if now >= window.0 + MESSAGE_WINDOW {
+                                            *window = (now, 0);
+                                        }
+                                        window.1 += 1;
+                                        (window.1, (window.0 + MESSAGE_WINDOW).saturating_duration_since(now).as_secs_f64())
+                                    };
+                                    if count > MESSAGE_LIMIT {
+                                        stats.violations.fetch_add(1, Ordering::SeqCst);
+                                        let headers = format!("Retry-After: {:.3}\r\nX-RateLimit-Scope: user\r\n", reset_after);
+                                        (429, headers, format!("{{\"retry_after\": {:.3}, \"global\": false}}", reset_after))
+                                    } else {
+                                        let headers = format!(
+                                            "X-RateLimit-Limit: {}\r\nX-RateLimit-Remaining: {}\r\nX-RateLimit-Reset-After: {:.3}\r\nX-RateLimit-Bucket: messages\r\n",
+                                            MESSAGE_LIMIT,
+                                            MESSAGE_LIMIT - count,
+                                            reset_after
+                                        );
+                                        (200, headers, format!("{{\"channel_id\": \"{}\", \"content\": {}}}", channel, String::from_utf8_lossy(&body)))
+                                    }
+                                }
+                                ("GET", ["channels", channel]) => {
+                                    stats.channel_gets.fetch_add(1, Ordering::SeqCst);
+                                    tokio::time::sleep(Duration::from_millis(30)).await;
+                                    (200, String::new(), format!("{{\"id\": \"{}\"}}", channel))
+                                }
+                                ("GET", ["guilds", guild]) => {
+                                    if global_once.fetch_add(1, Ordering::SeqCst) == 0 {
+                                        let headers = "Retry-After: 0.05\r\nX-RateLimit-Global: true\r\nX-RateLimit-Scope: global\r\n".to_string();
+                                        (429, headers, "{\"retry_after\": 0.05, \"global\": true}".to_string())
+                                    } else {
+                                        (200, String::new(), format!("{{\"id\": \"{}\"}}", guild))
+                                    }
+                                }
+                                _ => (404, String::new(), "{\"message\": \"Unknown\", \"code\": 0}".to_string()),
+                            };
+                            stats.in_flight.fetch_sub(1, Ordering::SeqCst);
+                            let response = format!(
+                                "HTTP/1.1 {} Fake\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n{}",
+                                status,
+                                content.len(),
+                                headers,
+                                content
+                            );
+                            stream.get_mut().write_all(response.as_bytes()).await.unwrap();
+                        }
+                    });
+                }
+            });
+        });
+        (receiver.recv().unwrap(), stats)
+    }
+
+    fn run(source: &str) -> Result<Value, String> {
+        let tokens = crate::lexer::Lexer::new(source).tokenize().unwrap();
+        let ast = crate::parser::Parser::new(tokens).parse().unwrap();
+        let bytecode = crate::compiler::Compiler::new().compile(ast)?;
+        let mut vm = crate::vm::VM::new();
+        crate::builtins::setup_vm_builtins(&mut vm);
+        vm.execute(bytecode)
+    }
+
+    #[test]
+    fn test_route() {
+        let route = |method, path| super::route(&method, path);
+        assert_eq!(route(Method::POST, "/api/v10/channels/1/messages"), ("POST channels/1/messages".to_string(), "1".to_string()));
+        assert_eq!(route(Method::DELETE, "/api/v10/channels/1/messages/2"), ("DELETE channels/1/messages/:id".to_string(), "1".to_string()));
+        assert_eq!(route(Method::PUT, "/api/v10/channels/1/messages/2/reactions/%F0%9F%91%8D/@me").0, "PUT channels/1/messages/:id/reactions");
+        assert_eq!(route(Method::PUT, "/api/v10/guilds/5/members/6/roles/7").0, "PUT guilds/5/members/:id/roles/:id");
+        assert_eq!(route(Method::POST, "/api/webhooks/8/abc"), ("POST webhooks/8/abc".to_string(), "8/abc".to_string()));
+        assert_eq!(route(Method::GET, "/api/v10/users/9"), ("GET users/:id".to_string(), String::new()));
+    }
+
+    #[test]
+    fn test_buckets_pace_requests() {
+        let (port, stats) = start_fake_api();
+        let source = r#"
+discord_config({"api_base": "http://127.0.0.1:PORT/api/v10"})
+discord_set_token("test")
+let sent = await gather([discord_send_message(str(100 + i % 2), "m" + str(i)) for i in range(0, 12)])
+let metrics = discord_metrics()
+let out = str(len(sent)) + " " + sent[0]["channel_id"] + " " + sent[0]["content"]["content"] + " " + sent[11]["channel_id"]
+out + " " + str(metrics["requests"]) + " " + str(metrics["rate_limited"]) + " " + str(metrics["queued"]) + " " + str(metrics["buckets"]["messages:100"]["remaining"])
+"#;
+        let started = std::time::Instant::now();
+        let result = run(&source.replace("PORT", &port.to_string())).unwrap();
+        let elapsed = started.elapsed();
+        // 6件ずつのチャンネルは MESSAGE_LIMIT 件ごとに区切りを待つが、429 は一度も返らない
+        assert_eq!(result.to_string(), "12 100 m0 101 12 0 0 0");
+        assert_eq!(stats.violations.load(Ordering::SeqCst), 0);
+        assert!(elapsed >= MESSAGE_WINDOW * 2, "{:?}", elapsed);
+        // 別のチャンネル（別のバケット）へのリクエストは並行に送る
+        assert_eq!(stats.peak.load(Ordering::SeqCst), 2);
+
+        let metrics = rest().metrics();
+        let Value::Dictionary(metrics) = metrics else { unreachable!() };
+        let metrics = metrics.borrow();
+        let p50 = metrics.get_str("latency_p50").unwrap().as_number().unwrap();
+        let p99 = metrics.get_str("latency_p99").unwrap().as_number().unwrap();
+        assert!(0.0 < p50 && p50 <= p99 && p99 < elapsed.as_secs_f64());
+    }
+
+    #[test]
+    fn test_retries_and_coalesces() {
+        let (port, stats) = start_fake_api();
+        let base = format!("discord_config({{\"api_base\": \"http://127.0.0.1:{}/api/v10\"}})\n", port);
+        assert!(run(&format!("{}discord_get_user(\"1\")", base)).unwrap_err().contains("Discord token not set"));
+
+        let source = r#"
+discord_set_token("test")
+let channels = await gather([discord_get_channel("7") for i in range(0, 5)])
+let guild = await discord_get_guild(9)
+let metrics = discord_metrics()
+channels[4]["id"] + " " + guild["id"] + " " + str(metrics["coalesced"]) + " " + str(metrics["rate_limited"]) + " " + str(metrics["requests"])
+"#;
+        let started = std::time::Instant::now();
+        let result = run(&format!("{}{}", base, source)).unwrap();
+        // 同じ GET は1回だけ送り、グローバルの 429 は Retry-After だけ待って送り直す
+        assert_eq!(result.to_string(), "7 9 4 1 3");
+        assert_eq!(stats.channel_gets.load(Ordering::SeqCst), 1);
+        assert!(started.elapsed() >= Duration::from_millis(80));
+
+        let error = run("await discord_get_user(\"1\")").unwrap_err();
+        assert!(error.contains("Discord API error 404: {\"message\": \"Unknown\""), "{}", error);
+        assert!(run("discord_get_channel(\"abc\")").unwrap_err().contains("Invalid Discord ID"));
+        assert!(run("discord_config({\"retries\": 1})").unwrap_err().contains("unknown option 'retries'"));
+    }
 }
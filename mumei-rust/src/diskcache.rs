@@ -0,0 +1,203 @@
+/// コンパイル済みバイトコードのディスクキャッシュ（.muc ファイル）
+/// 起動のたびに字句解析・構文解析・コンパイルをやり直さずに済むようにする
+///
+/// ファイル形式（数値はリトルエンディアン）:
+///   "MUC\0" | 形式バージョン u32 | ソースのハッシュ u64 | ソースのバイト数 u64 |
+///   コンパイラのバージョン長 u16 | コンパイラのバージョン | bincode化した ByteCode
+/// ヘッダーがソース・コンパイラと一致しないキャッシュは古いものとして無視する。
+
+use std::fs;
+use std::io::Write;
+use std::path::{Path, PathBuf};
+use crate::bytecode::ByteCode;
+
+/// ファイルの先頭
+const MAGIC: &[u8; 4] = b"MUC\0";
+
+/// ファイル形式のバージョン（ByteCode・命令セットを変えたら上げる）
+pub const MUC_FORMAT_VERSION: u32 = 8;
+
+/// このキャッシュを書いたコンパイラのバージョン
+const COMPILER_VERSION: &str = env!("CARGO_PKG_VERSION");
+
+/// キャッシュディレクトリを指定する環境変数（未指定ならソースの隣に置く）
+pub const CACHE_DIR_ENV: &str = "MUMEI_CACHE_DIR";
+
+/// キャッシュを無効にする環境変数
+pub const NO_CACHE_ENV: &str = "MUMEI_NO_CACHE";
+
+/// ソースのハッシュ（FNV-1a、ビルドやプラットフォームによらず同じ値になる）
+pub fn source_hash(source: &str) -> u64 {
+    let mut hash: u64 = 0xcbf2_9ce4_8422_2325;
+    for &byte in source.as_bytes() {
+        hash ^= byte as u64;
+        hash = hash.wrapping_mul(0x0100_0000_01b3);
+    }
+    hash
+}
+
+/// キャッシュが環境変数で無効にされているか
+pub fn is_disabled() -> bool {
+    std::env::var_os(NO_CACHE_ENV).map_or(false, |value| !value.is_empty() && value != "0")
+}
+
+/// ソースファイルに対応するキャッシュファイルのパス
+/// MUMEI_CACHE_DIR があればそこに（別のディレクトリの同名ファイルと衝突しないようパスのハッシュを付ける）、
+/// なければソースの隣に拡張子 .muc で置く
+pub fn cache_path(source_path: &Path) -> PathBuf {
+    match std::env::var_os(CACHE_DIR_ENV) {
+        Some(dir) if !dir.is_empty() => {
+            let absolute = fs::canonicalize(source_path).unwrap_or_else(|_| source_path.to_path_buf());
+            let stem = source_path.file_stem().and_then(|s| s.to_str()).unwrap_or("script");
+            let key = source_hash(&absolute.to_string_lossy());
+            PathBuf::from(dir).join(format!("{}-{:016x}.muc", stem, key))
+        }
+        _ => source_path.with_extension("muc"),
+    }
+}
+
+/// バイトコードを .muc 形式にする
+pub fn encode(source: &str, bytecode: &ByteCode) -> Result<Vec<u8>, String> {
+    let payload = bincode::serialize(bytecode)
+        .map_err(|e| format!("Failed to serialize bytecode: {}", e))?;
+
+    let mut bytes = Vec::with_capacity(32 + COMPILER_VERSION.len() + payload.len());
+    bytes.extend_from_slice(MAGIC);
+    bytes.extend_from_slice(&MUC_FORMAT_VERSION.to_le_bytes());
+    bytes.extend_from_slice(&source_hash(source).to_le_bytes());
+    bytes.extend_from_slice(&(source.len() as u64).to_le_bytes());
+    bytes.extend_from_slice(&(COMPILER_VERSION.len() as u16).to_le_bytes());
+    bytes.extend_from_slice(COMPILER_VERSION.as_bytes());
+    bytes.extend_from_slice(&payload);
+    Ok(bytes)
+}
+
+/// ヘッダーを読み飛ばしながら確認する
+struct Reader<'a> {
+    bytes: &'a [u8],
+}
+
+impl<'a> Reader<'a> {
+    fn take(&mut self, len: usize) -> Option<&'a [u8]> {
+        if self.bytes.len() < len {
+            return None;
+        }
+        let (head, rest) = self.bytes.split_at(len);
+        self.bytes = rest;
+        Some(head)
+    }
+
+    fn u16(&mut self) -> Option<u16> {
+        Some(u16::from_le_bytes(self.take(2)?.try_into().ok()?))
+    }
+
+    fn u32(&mut self) -> Option<u32> {
+        Some(u32::from_le_bytes(self.take(4)?.try_into().ok()?))
+    }
+
+    fn u64(&mut self) -> Option<u64> {
+        Some(u64::from_le_bytes(self.take(8)?.try_into().ok()?))
+    }
+}
+
+/// .muc の内容がこのソース・このコンパイラのものならバイトコードを返す（古い・壊れていればNone）
+pub fn decode(bytes: &[u8], source: &str) -> Option<ByteCode> {
+    let mut reader = Reader { bytes };
+    if reader.take(MAGIC.len())? != MAGIC
+        || reader.u32()? != MUC_FORMAT_VERSION
+        || reader.u64()? != source_hash(source)
+        || reader.u64()? != source.len() as u64
+    {
+        return None;
+    }
+    let version_len = reader.u16()? as usize;
+    if reader.take(version_len)? != COMPILER_VERSION.as_bytes() {
+        return None;
+    }
+    bincode::deserialize(reader.bytes).ok()
+}
+
+/// キャッシュファイルを読む（ファイル全体を一度に読み、その場でデコードする）
+pub fn load(cache_path: &Path, source: &str) -> Option<ByteCode> {
+    let bytes = fs::read(cache_path).ok()?;
+    decode(&bytes, source)
+}
+
+/// キャッシュファイルを書く（書きかけのファイルを読まないよう一時ファイルから置き換える）
+pub fn store(cache_path: &Path, source: &str, bytecode: &ByteCode) -> Result<(), String> {
+    let bytes = encode(source, bytecode)?;
+    if let Some(dir) = cache_path.parent() {
+        if !dir.as_os_str().is_empty() {
+            fs::create_dir_all(dir)
+                .map_err(|e| format!("Failed to create cache directory '{}': {}", dir.display(), e))?;
+        }
+    }
+
+    let temp_path = cache_path.with_extension(format!("muc.{}.tmp", std::process::id()));
+    let written = fs::File::create(&temp_path)
+        .and_then(|mut file| file.write_all(&bytes))
+        .and_then(|_| fs::rename(&temp_path, cache_path));
+    if let Err(e) = written {
+        let _ = fs::remove_file(&temp_path);
+        return Err(format!("Failed to write cache '{}': {}", cache_path.display(), e));
+    }
+    Ok(())
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn compile(source: &str) -> ByteCode {
+        crate::bytecode_cache::compile_source(source).unwrap()
+    }
+
+    #[test]
+    fn test_roundtrip() {
+        let source = "fun add(a, b) { a + b }\nlet greeting = \"hi\"\nadd(40, 2)";
+        let bytecode = compile(source);
+
+        let bytes = encode(source, &bytecode).unwrap();
+        let decoded = decode(&bytes, source).unwrap();
+        assert_eq!(decoded.instructions, bytecode.instructions);
+        assert_eq!(decoded.constants, bytecode.constants);
+        assert_eq!(decoded.names, bytecode.names);
+        assert_eq!(decoded.functions[0].chunk.instructions, bytecode.functions[0].chunk.instructions);
+
+        let mut vm = crate::vm::VM::new();
+        assert_eq!(vm.execute(decoded).unwrap(), crate::value::Value::Number(42.0));
+    }
+
+    #[test]
+    fn test_stale_cache_is_ignored() {
+        let bytes = encode("1 + 2", &compile("1 + 2")).unwrap();
+
+        // ソースが変わった・壊れた・別の形式のキャッシュは使わない
+        assert!(decode(&bytes, "1 + 3").is_none());
+        assert!(decode(&bytes[..bytes.len() / 2], "1 + 2").is_none());
+        let mut other_format = bytes.clone();
+        other_format[4] ^= 0xff;
+        assert!(decode(&other_format, "1 + 2").is_none());
+    }
+
+    #[test]
+    fn test_store_and_load() {
+        let dir = std::env::temp_dir().join(format!("mumei-diskcache-test-{}", std::process::id()));
+        let path = dir.join("script.muc");
+        let source = "let x = 6\nx * 7";
+
+        store(&path, source, &compile(source)).unwrap();
+        let loaded = load(&path, source).unwrap();
+        assert_eq!(crate::vm::VM::new().execute(loaded).unwrap(), crate::value::Value::Number(42.0));
+        assert!(load(&path, "x").is_none());
+
+        let _ = fs::remove_dir_all(&dir);
+    }
+
+    #[test]
+    fn test_cache_path_next_to_source() {
+        if std::env::var_os(CACHE_DIR_ENV).is_none() {
+            assert_eq!(cache_path(Path::new("bots/d.mu")), PathBuf::from("bots/d.muc"));
+        }
+    }
+}
@@ -18,6 +18,9 @@ pub struct Environment {
 
     /// 定数（const）の名前を追跡
     constants: Rc<RefCell<Vec<String>>>,
+
+    /// 解決済みローカル変数のスロット（Resolverが割り当てた番号で直接アクセス）
+    slots: Rc<RefCell<Vec<Value>>>,
 }
 
 impl Environment {
@@ -27,6 +30,7 @@ impl Environment {
             values: Rc::new(RefCell::new(HashMap::new())),
             parent: None,
             constants: Rc::new(RefCell::new(Vec::new())),
+            slots: Rc::new(RefCell::new(Vec::new())),
         }
     }
 
@@ -36,6 +40,60 @@ impl Environment {
             values: Rc::new(RefCell::new(HashMap::new())),
             parent: Some(parent),
             constants: Rc::new(RefCell::new(Vec::new())),
+            slots: Rc::new(RefCell::new(Vec::new())),
+        }
+    }
+
+    /// 引数をスロットに格納した関数フレーム用の環境を作成
+    pub fn with_slots(parent: Rc<Environment>, slots: Vec<Value>) -> Self {
+        Environment {
+            values: Rc::new(RefCell::new(HashMap::new())),
+            parent: Some(parent),
+            constants: Rc::new(RefCell::new(Vec::new())),
+            slots: Rc::new(RefCell::new(slots)),
+        }
+    }
+
+    /// depth 階層上の環境を取得
+    #[inline]
+    fn ancestor(&self, depth: usize) -> Option<&Environment> {
+        let mut env = self;
+        for _ in 0..depth {
+            env = env.parent.as_deref()?;
+        }
+        Some(env)
+    }
+
+    /// 解決済みローカル変数の値を取得
+    #[inline]
+    pub fn get_slot(&self, depth: usize, slot: usize, name: &str) -> Result<Value, String> {
+        self.ancestor(depth)
+            .and_then(|env| env.slots.borrow().get(slot).cloned())
+            .ok_or_else(|| format!("Variable '{}' is not defined", name))
+    }
+
+    /// 現在のスコープのスロットに変数を定義
+    #[inline]
+    pub fn define_slot(&self, slot: usize, value: Value) {
+        let mut slots = self.slots.borrow_mut();
+        if slot >= slots.len() {
+            slots.resize(slot + 1, Value::Null);
+        }
+        slots[slot] = value;
+    }
+
+    /// 解決済みローカル変数に値を代入
+    #[inline]
+    pub fn assign_slot(&self, depth: usize, slot: usize, name: &str, value: Value) -> Result<(), String> {
+        let env = self.ancestor(depth)
+            .ok_or_else(|| format!("Variable '{}' is not defined", name))?;
+        let mut slots = env.slots.borrow_mut();
+        match slots.get_mut(slot) {
+            Some(target) => {
+                *target = value;
+                Ok(())
+            }
+            None => Err(format!("Variable '{}' is not defined", name)),
         }
     }
 
@@ -45,6 +103,17 @@ impl Environment {
         Ok(())
     }
 
+    /// 現在のスコープの変数を上書きし、なければ定義（既存の変数ならキーの文字列を作らない）
+    pub fn define_or_update(&self, name: &str, value: Value) {
+        let mut values = self.values.borrow_mut();
+        match values.get_mut(name) {
+            Some(slot) => *slot = value,
+            None => {
+                values.insert(name.to_string(), value);
+            }
+        }
+    }
+
     /// 定数を定義（const）
     pub fn define_const(&self, name: String, value: Value) -> Result<(), String> {
         // 定数リストに追加
@@ -301,4 +370,20 @@ mod tests {
         assert!(child_env.has("x"));
         assert!(child_env.has("y"));
     }
+
+    #[test]
+    fn test_slots() {
+        let outer = Rc::new(Environment::with_slots(Rc::new(Environment::new()), vec![Value::Number(1.0)]));
+        let inner = Environment::with_slots(outer.clone(), vec![]);
+
+        inner.define_slot(2, Value::Number(3.0));
+        assert_eq!(inner.get_slot(0, 2, "z").unwrap(), Value::Number(3.0));
+
+        // 外側の関数のスロットを深さ指定で参照・代入できる
+        assert_eq!(inner.get_slot(1, 0, "a").unwrap(), Value::Number(1.0));
+        inner.assign_slot(1, 0, "a", Value::Number(10.0)).unwrap();
+        assert_eq!(outer.get_slot(0, 0, "a").unwrap(), Value::Number(10.0));
+
+        assert!(inner.get_slot(0, 5, "missing").unwrap_err().contains("is not defined"));
+    }
 }
@@ -1,369 +1,1012 @@
-use pyo3::prelude::*;
-use pyo3::types::{PyDict, PyList};
-use tokio_tungstenite::{connect_async, tungstenite::Message};
+/// Discord Gateway（WebSocket でイベントを受け取る）
+/// gateway_on で登録したハンドラーは、イベントごとにタスクとして呼び出す（await gateway_connect(...) の間にイベントループが実行する）。
+/// 接続はスレッドのスケジューラの上で動く組み込みの非同期処理で:
+/// - Hello の heartbeat_interval ごとに別のタスクがハートビートを送り、ACK が返らなければ接続を張り直す
+/// - READY の session_id と最後のシーケンス番号を覚えておき、切れたら RESUME で続きから受け取る
+/// - zlib-stream で圧縮して受け取り（接続ごとに1つの展開のコンテキスト）、ペイロードは1回で値に読み込む
+/// - イベントは上限のあるチャネルでハンドラーに渡し、ハンドラーが追いつかなければソケットの読み込みを止める
+
+use crate::discord;
+use crate::environment::Environment;
+use crate::http::Parsed;
+use crate::shard::{self, IdentifyQueue};
+use crate::task;
+use crate::value::Value;
+use flate2::{Decompress, FlushDecompress, Status};
+use futures_util::stream::SplitStream;
 use futures_util::{SinkExt, StreamExt};
-use serde_json::{json, Value as JsonValue};
-use std::sync::{Arc, Mutex};
-use tokio::sync::mpsc;
+use reqwest::Method;
+use serde::Deserialize;
+use serde_json::json;
+use std::cell::{Cell, RefCell};
 use std::collections::HashMap;
+use std::rc::Rc;
+use std::sync::Arc;
+use std::time::Duration;
+use tokio::net::TcpStream;
+use tokio::sync::{mpsc, Notify, Semaphore};
+use tokio::task::JoinHandle;
+use tokio::time::Instant;
+use tokio_tungstenite::tungstenite::protocol::CloseFrame;
+use tokio_tungstenite::tungstenite::Message;
+use tokio_tungstenite::{connect_async_with_config, MaybeTlsStream, WebSocketStream};
+
+pub const GATEWAY_URL: &str = "wss://gateway.discord.gg";
+
+/// zlib-stream の1つのペイロードの終わり（Z_SYNC_FLUSH）
+const ZLIB_SUFFIX: [u8; 4] = [0x00, 0x00, 0xff, 0xff];
+
+/// 続けて接続に失敗したらあきらめる回数
+const MAX_FAILURES: u32 = 5;
+
+/// 再接続までの待ち時間の上限
+const MAX_RECONNECT_DELAY: Duration = Duration::from_secs(30);
+
+/// Gateway のオペコード
+mod op {
+    pub const DISPATCH: u8 = 0;
+    pub const HEARTBEAT: u8 = 1;
+    pub const IDENTIFY: u8 = 2;
+    pub const RESUME: u8 = 6;
+    pub const RECONNECT: u8 = 7;
+    pub const INVALID_SESSION: u8 = 9;
+    pub const HELLO: u8 = 10;
+    pub const HEARTBEAT_ACK: u8 = 11;
+}
 
-const GATEWAY_URL: &str = "wss://gateway.discord.gg/?v=10&encoding=json";
+type Socket = WebSocketStream<MaybeTlsStream<TcpStream>>;
 
-/// Discord Gateway client
-pub struct Gateway {
-    token: String,
-    intents: u32,
-    session_id: Option<String>,
-    sequence: Option<u64>,
-}
+/// Gateway の設定
+#[derive(Debug, Clone)]
+pub struct GatewayConfig {
+    /// 接続先（RESUME では READY の resume_gateway_url に接続する）
+    pub url: String,
 
-/// Event handler type
-type EventHandler = Arc<Mutex<Option<PyObject>>>;
+    pub token: String,
 
-/// Global event handlers
-static EVENT_HANDLERS: once_cell::sync::Lazy<Arc<Mutex<HashMap<String, Vec<PyObject>>>>> =
-    once_cell::sync::Lazy::new(|| Arc::new(Mutex::new(HashMap::new())));
+    pub intents: u64,
 
-/// Global gateway client
-static GATEWAY_CLIENT: once_cell::sync::Lazy<Arc<Mutex<Option<String>>>> =
-    once_cell::sync::Lazy::new(|| Arc::new(Mutex::new(None)));
+    /// zlib-stream で圧縮して受け取る
+    pub compress: bool,
 
-impl Gateway {
-    pub fn new(token: String, intents: u32) -> Self {
-        Gateway {
+    /// ハンドラーに渡す前のイベントを溜めておく数（超えたらソケットの読み込みを止める）
+    pub queue: usize,
+
+    /// 同時に実行するハンドラーの数
+    pub max_handlers: usize,
+
+    /// 再接続までの待ち時間（続けて失敗するたびに倍にする）
+    pub reconnect_delay: Duration,
+
+    /// [シャードの番号, シャードの数]（IDENTIFY で送る）
+    pub shard: Option<(u32, u32)>,
+
+    /// IDENTIFY の順番を待つ（ほかのシャードと IDENTIFY の間隔を合わせる）
+    pub identify: Option<Arc<IdentifyQueue>>,
+}
+
+impl GatewayConfig {
+    pub fn new(token: String, intents: u64) -> Self {
+        GatewayConfig {
+            url: GATEWAY_URL.to_string(),
             token,
             intents,
-            session_id: None,
-            sequence: None,
+            compress: true,
+            queue: 256,
+            max_handlers: 64,
+            reconnect_delay: Duration::from_secs(1),
+            shard: None,
+            identify: None,
         }
     }
+}
 
-    /// Connect to Discord Gateway
-    pub async fn connect(&mut self) -> Result<(), String> {
-        let url = url::Url::parse(GATEWAY_URL)
-            .map_err(|e| format!("Invalid gateway URL: {}", e))?;
+/// 受け取ったペイロード（d は JSON から直接値に読み込む）
+#[derive(Deserialize)]
+struct Payload {
+    op: u8,
+    #[serde(default)]
+    d: Option<Parsed>,
+    #[serde(default)]
+    s: Option<u64>,
+    #[serde(default)]
+    t: Option<String>,
+}
 
-        let (ws_stream, _) = connect_async(url)
-            .await
-            .map_err(|e| format!("WebSocket connection failed: {}", e))?;
+impl Payload {
+    fn data(&self) -> Option<&Value> {
+        self.d.as_ref().map(|parsed| &parsed.0)
+    }
 
-        let (mut write, mut read) = ws_stream.split();
+    /// d の辞書のフィールド
+    fn field(&self, name: &str) -> Option<Value> {
+        match self.data()? {
+            Value::Dictionary(dict) => dict.borrow().get_str(name).cloned(),
+            _ => None,
+        }
+    }
+}
 
-        // Send identify payload
-        let identify = json!({
-            "op": 2,
-            "d": {
-                "token": self.token,
-                "intents": self.intents,
-                "properties": {
-                    "$os": "linux",
-                    "$browser": "mumei-rust",
-                    "$device": "mumei-rust"
-                }
-            }
-        });
+/// ハンドラーに渡すイベント
+struct Event {
+    name: String,
+    data: Value,
+}
 
-        write
-            .send(Message::Text(identify.to_string()))
-            .await
-            .map_err(|e| format!("Failed to send identify: {}", e))?;
+/// 接続が終わった理由
+enum Closed {
+    /// gateway_close() で閉じた
+    Shutdown,
 
-        // Event loop
-        while let Some(msg) = read.next().await {
-            match msg {
-                Ok(Message::Text(text)) => {
-                    self.handle_message(&text).await?;
-                }
-                Ok(Message::Close(_)) => {
-                    println!("Gateway connection closed");
-                    break;
-                }
-                Err(e) => {
-                    return Err(format!("WebSocket error: {}", e));
-                }
-                _ => {}
-            }
-        }
+    /// RESUME で続けられる（Reconnect・ACK が返らない・再開できる Invalid Session）
+    Resume,
+
+    /// セッションが無効になった（IDENTIFY からやり直す）
+    Invalidated,
+
+    /// 接続できなかった・切れた（待ってから RESUME する）
+    Failed(String),
+}
+
+/// 1本の接続の状態（ハートビートのタスクと共有する）
+struct Connection {
+    /// 送信するメッセージ（送信のタスクが順に送る）
+    outgoing: mpsc::UnboundedSender<Message>,
+
+    /// 最後にハートビートを送った時刻（ACK を受け取ったら None）
+    awaiting_ack: Cell<Option<Instant>>,
 
-        Ok(())
+    /// イベントのチャネルが一杯で読み込みを止めている（その間は ACK を読めないので、返らなくても張り直さない）
+    stalled: Cell<bool>,
+
+    /// ACK が返らなかった
+    zombie: Notify,
+}
+
+/// 捨てられたら止める tokio のタスク
+struct Background(JoinHandle<()>);
+
+impl Drop for Background {
+    fn drop(&mut self) {
+        self.0.abort();
     }
+}
 
-    /// Handle incoming gateway message
-    async fn handle_message(&mut self, text: &str) -> Result<(), String> {
-        let payload: JsonValue = serde_json::from_str(text)
-            .map_err(|e| format!("Failed to parse payload: {}", e))?;
+/// zlib-stream の展開（接続ごとに1つのコンテキストで、ZLIB_SUFFIX で終わるまでのメッセージをまとめて展開する）
+struct Inflater {
+    decompress: Decompress,
+    buffer: Vec<u8>,
+    output: Vec<u8>,
+}
 
-        let op = payload["op"].as_u64().unwrap_or(0);
-        let data = &payload["d"];
-        let seq = payload["s"].as_u64();
+impl Inflater {
+    fn new() -> Self {
+        Inflater { decompress: Decompress::new(true), buffer: Vec::new(), output: Vec::with_capacity(64 * 1024) }
+    }
 
-        if let Some(s) = seq {
-            self.sequence = Some(s);
+    /// 受け取ったバイナリのメッセージを足し、ペイロードが揃ったら展開したもの
+    fn push(&mut self, bytes: &[u8]) -> Result<Option<&[u8]>, String> {
+        self.buffer.extend_from_slice(bytes);
+        if !self.buffer.ends_with(&ZLIB_SUFFIX) {
+            return Ok(None);
         }
-
-        match op {
-            0 => {
-                // Dispatch event
-                let event_name = payload["t"].as_str().unwrap_or("");
-                self.dispatch_event(event_name, data).await?;
+        self.output.clear();
+        let mut offset = 0;
+        loop {
+            if self.output.len() == self.output.capacity() {
+                self.output.reserve(self.output.capacity().max(4096));
             }
-            1 => {
-                // Heartbeat request
-                // TODO: Send heartbeat
+            let (read, written) = (self.decompress.total_in(), self.output.len());
+            let status = self
+                .decompress
+                .decompress_vec(&self.buffer[offset..], &mut self.output, FlushDecompress::Sync)
+                .map_err(|e| format!("Failed to inflate gateway payload: {}", e))?;
+            offset += (self.decompress.total_in() - read) as usize;
+            if offset == self.buffer.len() && self.output.len() < self.output.capacity() {
+                break;
             }
-            10 => {
-                // Hello
-                let heartbeat_interval = data["heartbeat_interval"].as_u64().unwrap_or(41250);
-                println!("Gateway connected, heartbeat interval: {}ms", heartbeat_interval);
+            if status == Status::BufError && offset == self.buffer.len() && self.output.len() == written {
+                return Err("Failed to inflate gateway payload: truncated stream".to_string());
             }
-            11 => {
-                // Heartbeat ACK
-                println!("Heartbeat ACK received");
-            }
-            _ => {
-                println!("Unknown opcode: {}", op);
+        }
+        self.buffer.clear();
+        Ok(Some(&self.output))
+    }
+}
+
+/// 受け取ったもの
+enum Incoming {
+    Payload(Payload),
+
+    /// 閉じられた（閉じたときのコードと理由）
+    Closed(Option<u16>, String),
+}
+
+/// 次のペイロードを受け取る
+async fn receive(read: &mut SplitStream<Socket>, inflater: &mut Option<Inflater>) -> Result<Incoming, String> {
+    loop {
+        let bytes = match read.next().await {
+            None => return Ok(Incoming::Closed(None, "connection lost".to_string())),
+            Some(Err(e)) => return Ok(Incoming::Closed(None, e.to_string())),
+            Some(Ok(Message::Close(frame))) => {
+                let (code, reason) = frame.map_or((None, String::new()), |frame| (Some(frame.code.into()), frame.reason.into_owned()));
+                return Ok(Incoming::Closed(code, reason));
             }
+            Some(Ok(Message::Text(text))) => return parse(text.as_bytes()),
+            Some(Ok(Message::Binary(bytes))) => bytes,
+            // Ping への応答は tungstenite が送る
+            Some(Ok(_)) => continue,
+        };
+        match inflater {
+            Some(inflater) => match inflater.push(&bytes)? {
+                Some(payload) => return parse(payload),
+                None => continue,
+            },
+            None => return parse(&bytes),
         }
+    }
+}
+
+fn parse(bytes: &[u8]) -> Result<Incoming, String> {
+    serde_json::from_slice(bytes).map(Incoming::Payload).map_err(|e| format!("Invalid gateway payload: {}", e))
+}
+
+/// Gateway のクライアント
+pub struct Gateway {
+    config: GatewayConfig,
+
+    session_id: RefCell<Option<String>>,
+    resume_url: RefCell<Option<String>>,
+    sequence: Cell<Option<u64>>,
+
+    /// "connecting"・"resuming"・"ready"・"closed"
+    state: Cell<&'static str>,
+
+    /// 接続中の接続
+    connection: RefCell<Option<Rc<Connection>>>,
+
+    /// 最後のハートビートの往復時間
+    latency: Cell<Option<Duration>>,
+
+    heartbeats: Cell<usize>,
+    events: Cell<usize>,
+
+    /// チャネルでハンドラーを待っているイベントの数
+    queued: Cell<usize>,
+
+    reconnects: Cell<usize>,
+    resumes: Cell<usize>,
+
+    /// gateway_close() で閉じられた
+    closed: Cell<bool>,
+    shutdown: Notify,
+}
 
-        Ok(())
+impl Gateway {
+    pub fn new(config: GatewayConfig) -> Rc<Gateway> {
+        Rc::new(Gateway {
+            config,
+            session_id: RefCell::new(None),
+            resume_url: RefCell::new(None),
+            sequence: Cell::new(None),
+            state: Cell::new("connecting"),
+            connection: RefCell::new(None),
+            latency: Cell::new(None),
+            heartbeats: Cell::new(0),
+            events: Cell::new(0),
+            queued: Cell::new(0),
+            reconnects: Cell::new(0),
+            resumes: Cell::new(0),
+            closed: Cell::new(false),
+            shutdown: Notify::new(),
+        })
+    }
+
+    /// 閉じられるか、続けられないエラーになるまで接続を続ける（閉じたらハンドラーが終わるのを待つ）
+    pub async fn run(self: Rc<Self>) -> Result<Value, String> {
+        let (sender, receiver) = mpsc::channel(self.config.queue.max(1));
+        let dispatcher = tokio::task::spawn_local(dispatch(self.clone(), receiver));
+        let result = self.clone().connect(sender).await;
+        self.state.set("closed");
+        // 送信側を捨てたので、ディスパッチャーは残りのイベントを渡し終えたら終わる
+        let _ = dispatcher.await;
+        result.map(|_| Value::Null)
+    }
+
+    /// 閉じる
+    pub fn close(&self) {
+        self.closed.set(true);
+        self.shutdown.notify_one();
+    }
+
+    /// ペイロードを送る（接続していなければエラー）
+    pub fn send(&self, op: u8, data: serde_json::Value) -> Result<(), String> {
+        let connection = self.connection.borrow();
+        let connection = connection.as_ref().ok_or("Gateway is not connected")?;
+        let payload = json!({ "op": op, "d": data }).to_string();
+        connection.outgoing.send(Message::Text(payload)).map_err(|_| "Gateway is not connected".to_string())
     }
 
-    /// Dispatch event to handlers
-    async fn dispatch_event(&self, event_name: &str, data: &JsonValue) -> Result<(), String> {
-        match event_name {
-            "READY" => {
-                println!("✅ Bot is ready!");
-                if let Some(session_id) = data["session_id"].as_str() {
-                    println!("   Session ID: {}", session_id);
+    /// 接続し、切れたら張り直す
+    async fn connect(self: Rc<Self>, events: mpsc::Sender<Event>) -> Result<(), String> {
+        let mut failures = 0;
+        loop {
+            let resuming = self.session_id.borrow().is_some();
+            self.state.set(if resuming { "resuming" } else { "connecting" });
+            let base = match resuming {
+                true => self.resume_url.borrow().clone().unwrap_or_else(|| self.config.url.clone()),
+                false => self.config.url.clone(),
+            };
+            if let (false, Some(queue), Some((shard, _))) = (resuming, &self.config.identify, self.config.shard) {
+                tokio::select! {
+                    _ = queue.wait(shard) => {}
+                    _ = self.shutdown.notified() => return Ok(()),
+                }
+            }
+            let compress = if self.config.compress { "&compress=zlib-stream" } else { "" };
+            let url = format!("{}/?v=10&encoding=json{}", base.trim_end_matches('/'), compress);
+            // ハートビートなどの小さなメッセージを Nagle のアルゴリズムで遅らせない
+            let closed = match connect_async_with_config(url.as_str(), None, true).await {
+                Ok((socket, _)) => self.session(socket, &events).await?,
+                Err(e) => Closed::Failed(format!("WebSocket connection to {} failed: {}", base, e)),
+            };
+
+            let delay = match closed {
+                Closed::Shutdown => return Ok(()),
+                Closed::Resume => Duration::ZERO,
+                Closed::Invalidated => {
+                    *self.session_id.borrow_mut() = None;
+                    *self.resume_url.borrow_mut() = None;
+                    self.sequence.set(None);
+                    self.config.reconnect_delay
                 }
-                trigger_event("ready", vec![]);
+                Closed::Failed(reason) => {
+                    // READY・RESUMED を受け取れば数え直す
+                    failures = if self.state.get() == "ready" { 1 } else { failures + 1 };
+                    if failures > MAX_FAILURES {
+                        return Err(format!("Gateway gave up after {} failed connections: {}", MAX_FAILURES, reason));
+                    }
+                    (self.config.reconnect_delay * 2u32.pow(failures - 1)).min(MAX_RECONNECT_DELAY)
+                }
+            };
+            self.reconnects.set(self.reconnects.get() + 1);
+            if self.closed.get() {
+                return Ok(());
+            }
+            tokio::select! {
+                _ = tokio::time::sleep(delay) => {}
+                _ = self.shutdown.notified() => return Ok(()),
             }
-            "MESSAGE_CREATE" => {
-                trigger_event_with_data("message", data.clone());
+        }
+    }
+
+    /// 1本の接続（Hello を受け取って IDENTIFY か RESUME を送り、閉じるまでペイロードを受け取る）
+    async fn session(self: &Rc<Self>, socket: Socket, events: &mpsc::Sender<Event>) -> Result<Closed, String> {
+        let (mut write, mut read) = socket.split();
+        let mut inflater = self.config.compress.then(Inflater::new);
+        let interval = match receive(&mut read, &mut inflater).await {
+            Ok(Incoming::Payload(hello)) if hello.op == op::HELLO => match hello.field("heartbeat_interval") {
+                Some(Value::Number(ms)) if ms > 0.0 => Duration::from_secs_f64(ms / 1000.0),
+                _ => return Ok(Closed::Failed("Hello without heartbeat_interval".to_string())),
+            },
+            Ok(Incoming::Payload(payload)) => return Ok(Closed::Failed(format!("Expected Hello, got opcode {}", payload.op))),
+            Ok(Incoming::Closed(code, reason)) => return self.closed_by_server(code, reason),
+            Err(e) => return Ok(Closed::Failed(e)),
+        };
+
+        // 送信は別のタスク（イベントのチャネルが一杯で読み込みを止めている間もハートビートを送る）
+        let (outgoing, mut outbox) = mpsc::unbounded_channel();
+        let writer = tokio::task::spawn_local(async move {
+            while let Some(message) = outbox.recv().await {
+                let close = matches!(message, Message::Close(_));
+                if write.send(message).await.is_err() || close {
+                    break;
+                }
             }
-            "INTERACTION_CREATE" => {
-                trigger_event_with_data("interaction", data.clone());
+        });
+        let connection = Rc::new(Connection { outgoing, awaiting_ack: Cell::new(None), stalled: Cell::new(false), zombie: Notify::new() });
+        *self.connection.borrow_mut() = Some(connection.clone());
+        let _heartbeat = Background(tokio::task::spawn_local(self.clone().heartbeat(connection.clone(), interval)));
+
+        let session_id = self.session_id.borrow().clone();
+        let first = match session_id {
+            Some(session_id) => json!({
+                "op": op::RESUME,
+                "d": { "token": self.config.token, "session_id": session_id, "seq": self.sequence.get() }
+            }),
+            None => {
+                let mut identify = json!({
+                    "op": op::IDENTIFY,
+                    "d": {
+                        "token": self.config.token,
+                        "intents": self.config.intents,
+                        "properties": { "os": std::env::consts::OS, "browser": "mumei", "device": "mumei" }
+                    }
+                });
+                if let Some((shard, shards)) = self.config.shard {
+                    identify["d"]["shard"] = json!([shard, shards]);
+                }
+                identify
             }
-            _ => {
-                println!("Unhandled event: {}", event_name);
+        };
+        let _ = connection.outgoing.send(Message::Text(first.to_string()));
+
+        let closed = loop {
+            let incoming = tokio::select! {
+                incoming = receive(&mut read, &mut inflater) => incoming,
+                _ = connection.zombie.notified() => break Closed::Resume,
+                _ = self.shutdown.notified() => break Closed::Shutdown,
+            };
+            let payload = match incoming {
+                Ok(Incoming::Payload(payload)) => payload,
+                Ok(Incoming::Closed(code, reason)) => break self.closed_by_server(code, reason)?,
+                Err(e) => break Closed::Failed(e),
+            };
+            match payload.op {
+                op::DISPATCH => {
+                    if payload.s.is_some() {
+                        self.sequence.set(payload.s);
+                    }
+                    let name = payload.t.clone().unwrap_or_default();
+                    match name.as_str() {
+                        "READY" => {
+                            *self.session_id.borrow_mut() = payload.field("session_id").map(|id| id.to_string());
+                            *self.resume_url.borrow_mut() = payload.field("resume_gateway_url").map(|url| url.to_string());
+                            self.state.set("ready");
+                        }
+                        "RESUMED" => {
+                            self.resumes.set(self.resumes.get() + 1);
+                            self.state.set("ready");
+                        }
+                        _ => {}
+                    }
+                    self.events.set(self.events.get() + 1);
+                    let event = Event { name, data: payload.d.map_or(Value::Null, |parsed| parsed.0) };
+                    // ハンドラーが追いつかなければここで待つ（その間はソケットを読まない）
+                    connection.stalled.set(true);
+                    let sent = tokio::select! {
+                        sent = events.send(event) => sent,
+                        _ = self.shutdown.notified() => break Closed::Shutdown,
+                    };
+                    connection.stalled.set(false);
+                    if sent.is_err() {
+                        break Closed::Shutdown;
+                    }
+                    self.queued.set(self.queued.get() + 1);
+                }
+                op::HEARTBEAT => self.beat(&connection),
+                op::HEARTBEAT_ACK => {
+                    if let Some(sent) = connection.awaiting_ack.take() {
+                        self.latency.set(Some(sent.elapsed()));
+                    }
+                }
+                op::RECONNECT => break Closed::Resume,
+                op::INVALID_SESSION => {
+                    break match payload.data() {
+                        Some(Value::Boolean(true)) => Closed::Resume,
+                        _ => Closed::Invalidated,
+                    }
+                }
+                _ => {}
             }
+        };
+
+        // 1000 で閉じるとセッションが無効になるので、RESUME するときは別のコードで閉じる
+        let code: u16 = match closed {
+            Closed::Shutdown | Closed::Invalidated => 1000,
+            Closed::Resume | Closed::Failed(_) => 4000,
+        };
+        let _ = connection.outgoing.send(Message::Close(Some(CloseFrame { code: code.into(), reason: "".into() })));
+        *self.connection.borrow_mut() = None;
+        let _ = tokio::time::timeout(Duration::from_secs(1), writer).await;
+        Ok(closed)
+    }
+
+    /// サーバーが閉じたときのコードで、続けられるか決める
+    fn closed_by_server(&self, code: Option<u16>, reason: String) -> Result<Closed, String> {
+        match code {
+            // 認証の失敗・シャードや intents の誤りは張り直しても直らない
+            Some(code @ (4004 | 4010..=4014)) => Err(format!("Gateway closed with {}: {}", code, reason)),
+            // シーケンス番号の誤り・セッションの期限切れ
+            Some(4007 | 4009) => Ok(Closed::Invalidated),
+            Some(code) => Ok(Closed::Failed(format!("Gateway closed with {}: {}", code, reason))),
+            None => Ok(Closed::Failed(reason)),
         }
+    }
 
-        Ok(())
+    /// heartbeat_interval ごとにハートビートを送る（前のハートビートの ACK が返っていなければ接続を張り直させる）
+    async fn heartbeat(self: Rc<Self>, connection: Rc<Connection>, interval: Duration) {
+        // 最初のハートビートは間隔のうちのランダムな時刻に送る（多数のクライアントが同時に送らないように）
+        tokio::time::sleep(interval.mul_f64(jitter())).await;
+        loop {
+            if connection.awaiting_ack.get().is_some() && !connection.stalled.get() {
+                connection.zombie.notify_one();
+                return;
+            }
+            self.beat(&connection);
+            tokio::time::sleep(interval).await;
+        }
     }
-}
 
-/// Trigger event with no data
-fn trigger_event(event_name: &str, _args: Vec<PyObject>) {
-    let handlers = EVENT_HANDLERS.lock().unwrap();
-    if let Some(handler_list) = handlers.get(event_name) {
-        for _handler in handler_list {
-            // TODO: Call Python handler
-            println!("Triggering event: {}", event_name);
+    fn beat(&self, connection: &Connection) {
+        let payload = json!({ "op": op::HEARTBEAT, "d": self.sequence.get() }).to_string();
+        if connection.outgoing.send(Message::Text(payload)).is_ok() {
+            connection.awaiting_ack.set(Some(Instant::now()));
+            self.heartbeats.set(self.heartbeats.get() + 1);
         }
     }
-}
 
-/// Trigger event with JSON data
-fn trigger_event_with_data(event_name: &str, data: JsonValue) {
-    let handlers = EVENT_HANDLERS.lock().unwrap();
-    if let Some(handler_list) = handlers.get(event_name) {
-        for _handler in handler_list {
-            // TODO: Convert JSON to Python object and call handler
-            println!("Triggering event: {} with data", event_name);
+    /// 今の状態（ほかのスレッドに渡せる）
+    pub fn stats(&self) -> Stats {
+        Stats {
+            state: self.state.get(),
+            session_id: self.session_id.borrow().clone(),
+            sequence: self.sequence.get(),
+            latency: self.latency.get(),
+            heartbeats: self.heartbeats.get(),
+            events: self.events.get(),
+            queued: self.queued.get(),
+            reconnects: self.reconnects.get(),
+            resumes: self.resumes.get(),
         }
     }
+
+    /// {"state", "session_id", "sequence", "latency", "heartbeats", "events", "queued", "reconnects", "resumes"} の辞書
+    pub fn status(&self) -> Value {
+        self.stats().to_value()
+    }
 }
 
-/// Register event handler
-#[pyfunction]
-pub fn gateway_on(event_name: String, handler: PyObject) -> PyResult<()> {
-    let mut handlers = EVENT_HANDLERS.lock().unwrap();
-    handlers
-        .entry(event_name.clone())
-        .or_insert_with(Vec::new)
-        .push(handler);
+/// Gateway の状態
+#[derive(Debug, Clone, Default)]
+pub struct Stats {
+    pub state: &'static str,
+    pub session_id: Option<String>,
+    pub sequence: Option<u64>,
+
+    /// 最後のハートビートの往復時間
+    pub latency: Option<Duration>,
+
+    pub heartbeats: usize,
+
+    /// 受け取ったイベントの数
+    pub events: usize,
+
+    /// チャネルでハンドラーを待っているイベントの数
+    pub queued: usize,
 
-    println!("Registered handler for event: {}", event_name);
-    Ok(())
+    pub reconnects: usize,
+    pub resumes: usize,
 }
 
-/// Start Discord Gateway connection
-#[pyfunction]
-pub fn gateway_connect(token: String, intents: Option<u32>) -> PyResult<()> {
-    let intents = intents.unwrap_or(32767); // Default: all intents
+impl Stats {
+    pub fn to_value(&self) -> Value {
+        let text = |value: &Option<String>| value.as_deref().map_or(Value::Null, |s| Value::String(s.into()));
+        discord::dict([
+            ("state", Value::String(self.state.into())),
+            ("session_id", text(&self.session_id)),
+            ("sequence", self.sequence.map_or(Value::Null, |s| Value::Number(s as f64))),
+            ("latency", self.latency.map_or(Value::Null, |latency| Value::Number(latency.as_secs_f64()))),
+            ("heartbeats", Value::Number(self.heartbeats as f64)),
+            ("events", Value::Number(self.events as f64)),
+            ("queued", Value::Number(self.queued as f64)),
+            ("reconnects", Value::Number(self.reconnects as f64)),
+            ("resumes", Value::Number(self.resumes as f64)),
+        ])
+    }
+}
 
-    // Store token
-    let mut client = GATEWAY_CLIENT.lock().unwrap();
-    *client = Some(token.clone());
+/// 0 以上 1 未満の乱数（プロセスごとに鍵の変わる RandomState から作る）
+fn jitter() -> f64 {
+    use std::hash::{BuildHasher, Hasher};
+    let random = std::collections::hash_map::RandomState::new().build_hasher().finish();
+    (random % 1_000_000) as f64 / 1_000_000.0
+}
 
-    // Start gateway in background
-    tokio::spawn(async move {
-        let mut gateway = Gateway::new(token, intents);
-        if let Err(e) = gateway.connect().await {
-            eprintln!("Gateway error: {}", e);
+/// イベントを受け取り、登録されたハンドラーをタスクとして呼び出す（同時に実行するのは max_handlers 個まで）
+async fn dispatch(gateway: Rc<Gateway>, mut events: mpsc::Receiver<Event>) {
+    let limit = Arc::new(Semaphore::new(gateway.config.max_handlers.max(1)));
+    while let Some(event) = events.recv().await {
+        gateway.queued.set(gateway.queued.get() - 1);
+        let handlers = HANDLERS.with(|handlers| handlers.borrow().get(&event.name).cloned()).unwrap_or_default();
+        for handler in handlers {
+            let Ok(permit) = limit.clone().acquire_owned().await else { return };
+            let task = task::spawn(&event.name, handler, vec![event.data.clone()]);
+            tokio::task::spawn_local(async move {
+                if let Err(error) = task::join(&task).await {
+                    eprintln!("Gateway handler for {} failed: {}", task.name(), error);
+                }
+                drop(permit);
+            });
         }
+    }
+    // 実行中のハンドラーが終わるまで待つ
+    let _ = limit.acquire_many(gateway.config.max_handlers.max(1) as u32).await;
+}
+
+thread_local! {
+    /// イベント名 → ハンドラー
+    static HANDLERS: RefCell<HashMap<String, Vec<Value>>> = RefCell::new(HashMap::new());
+
+    /// このスレッドで接続した Gateway（最後のものが gateway_status() の対象）
+    static GATEWAYS: RefCell<Vec<Rc<Gateway>>> = const { RefCell::new(Vec::new()) };
+}
+
+/// このスレッドのハンドラー・Gateway をすべて捨てる（VMが新しいプログラムを実行する前に呼ぶ）
+pub fn reset() {
+    HANDLERS.with(|handlers| handlers.borrow_mut().clear());
+    GATEWAYS.with(|gateways| gateways.borrow_mut().clear());
+    shard::reset();
+}
+
+/// gateway_status()・gateway_send()・gateway_close() の対象にする
+pub fn register(gateway: Rc<Gateway>) {
+    GATEWAYS.with(|gateways| {
+        let mut gateways = gateways.borrow_mut();
+        gateways.retain(|gateway| gateway.state.get() != "closed");
+        gateways.push(gateway);
     });
+}
 
-    Ok(())
-}
-
-/// Send slash command registration
-#[pyfunction]
-pub fn gateway_register_slash_command(
-    application_id: String,
-    command_name: String,
-    description: String,
-    guild_id: Option<String>,
-) -> PyResult<String> {
-    let token = GATEWAY_CLIENT.lock().unwrap().clone();
-    if token.is_none() {
-        return Err(PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(
-            "Gateway not connected"
-        ));
-    }
-
-    let url = if let Some(gid) = guild_id {
-        format!(
-            "https://discord.com/api/v10/applications/{}/guilds/{}/commands",
-            application_id, gid
-        )
-    } else {
-        format!(
-            "https://discord.com/api/v10/applications/{}/commands",
-            application_id
-        )
-    };
+/// イベント名（Discord の名前。"message"・"interaction" は MESSAGE_CREATE・INTERACTION_CREATE の別名）
+fn event_name(name: &str) -> String {
+    match name {
+        "message" => "MESSAGE_CREATE".to_string(),
+        "interaction" => "INTERACTION_CREATE".to_string(),
+        name => name.to_ascii_uppercase(),
+    }
+}
 
-    let body = json!({
-        "name": command_name,
-        "description": description,
-        "type": 1
-    })
-    .to_string();
-
-    let mut headers = HashMap::new();
-    headers.insert("Authorization".to_string(), format!("Bot {}", token.unwrap()));
-
-    crate::http::http_post_json(url, body, None)
-}
-
-/// Send interaction response
-#[pyfunction]
-pub fn gateway_interaction_respond(
-    interaction_id: String,
-    interaction_token: String,
-    content: String,
-) -> PyResult<String> {
-    let url = format!(
-        "https://discord.com/api/v10/interactions/{}/{}/callback",
-        interaction_id, interaction_token
-    );
+// ============================================
+// 組み込み関数
+// ============================================
+
+/// Gateway の組み込み関数を環境に登録
+pub fn setup_gateway_builtins(env: &Environment) {
+    env.define("gateway_on".to_string(), Value::native("gateway_on", 2, gateway_on)).unwrap();
+    env.define("gateway_connect".to_string(), Value::native_with_optional("gateway_connect", 1, 3, gateway_connect)).unwrap();
+    env.define("gateway_close".to_string(), Value::native("gateway_close", 0, gateway_close)).unwrap();
+    env.define("gateway_status".to_string(), Value::native("gateway_status", 0, gateway_status)).unwrap();
+    env.define("gateway_send".to_string(), Value::native_with_optional("gateway_send", 2, 3, gateway_send)).unwrap();
+    env.define(
+        "gateway_register_slash_command".to_string(),
+        Value::native_with_optional("gateway_register_slash_command", 3, 4, gateway_register_slash_command),
+    )
+    .unwrap();
+    env.define(
+        "gateway_interaction_respond".to_string(),
+        Value::native("gateway_interaction_respond", 3, gateway_interaction_respond),
+    )
+    .unwrap();
+    env.define("gateway_send_button".to_string(), Value::native_with_optional("gateway_send_button", 4, 5, gateway_send_button)).unwrap();
+    env.define("gateway_send_select".to_string(), Value::native("gateway_send_select", 4, gateway_send_select)).unwrap();
+}
 
-    let body = json!({
-        "type": 4,
-        "data": {
-            "content": content
+/// gateway_on(event, handler) - イベントのハンドラーを登録（handler はイベントの d を引数に呼び出す）
+fn gateway_on(args: Vec<Value>) -> Result<Value, String> {
+    let name = event_name(&discord::text(&args[0])?);
+    match &args[1] {
+        Value::Function(_) | Value::Closure(_) | Value::NativeFunction(_) => {}
+        other => return Err(format!("{} is not callable", other.type_name())),
+    }
+    HANDLERS.with(|handlers| handlers.borrow_mut().entry(name).or_default().push(args[1].clone()));
+    Ok(Value::Null)
+}
+
+/// gateway_connect(token, intents?, options?) - gateway_close() で閉じるまで接続を続けるタスク
+/// options: {"url": 接続先, "compress": 真偽値, "queue": 数, "max_handlers": 数, "reconnect_delay": 秒}
+fn gateway_connect(args: Vec<Value>) -> Result<Value, String> {
+    let intents = match args.get(1) {
+        None | Some(Value::Null) => 32767, // すべての intents
+        Some(value) => value.as_number()? as u64,
+    };
+    let mut config = GatewayConfig::new(discord::text(&args[0])?, intents);
+    match args.get(2) {
+        None | Some(Value::Null) => {}
+        Some(Value::Dictionary(options)) => {
+            for (key, value) in options.borrow().iter() {
+                let name = key.to_value().to_string();
+                if !configure(&mut config, &name, value)? {
+                    return Err(format!("gateway_connect() got an unknown option '{}'", name));
+                }
+            }
         }
-    })
-    .to_string();
+        Some(other) => return Err(format!("gateway_connect() options must be a dictionary, got {}", other.type_name())),
+    }
+    let gateway = Gateway::new(config);
+    register(gateway.clone());
+    Ok(Value::Task(task::spawn_native("gateway", gateway.run())))
+}
 
-    crate::http::http_post_json(url, body, None)
+/// 接続のオプションを設定に読み込む（gateway_connect()・gateway_shards() で共通。知らない名前なら false）
+pub(crate) fn configure(config: &mut GatewayConfig, name: &str, value: &Value) -> Result<bool, String> {
+    match name {
+        "url" => config.url = discord::text(value)?,
+        "compress" => config.compress = value.as_boolean()?,
+        "queue" => config.queue = value.as_number()?.max(1.0) as usize,
+        "max_handlers" => config.max_handlers = value.as_number()?.max(1.0) as usize,
+        "reconnect_delay" => config.reconnect_delay = Duration::try_from_secs_f64(value.as_number()?).map_err(|e| e.to_string())?,
+        _ => return Ok(false),
+    }
+    Ok(true)
 }
 
-/// Send message with button
-#[pyfunction]
-pub fn gateway_send_button(
-    channel_id: String,
-    content: String,
-    button_label: String,
-    button_custom_id: String,
-    button_style: Option<i32>,
-) -> PyResult<String> {
-    let url = format!("https://discord.com/api/v10/channels/{}/messages", channel_id);
+/// gateway_close() - このスレッドの Gateway・gateway_shards() で起動したシャードをすべて閉じる
+fn gateway_close(_args: Vec<Value>) -> Result<Value, String> {
+    GATEWAYS.with(|gateways| gateways.borrow().iter().for_each(|gateway| gateway.close()));
+    shard::close();
+    Ok(Value::Null)
+}
 
-    let style = button_style.unwrap_or(1); // Default: Primary (blue)
+/// gateway_status() - 接続の状態・ハートビートの往復時間などの辞書（接続していなければ null）
+fn gateway_status(_args: Vec<Value>) -> Result<Value, String> {
+    Ok(GATEWAYS.with(|gateways| gateways.borrow().last().map_or(Value::Null, |gateway| gateway.status())))
+}
 
+/// gateway_send(op, data, shard?) - ペイロードを送る（例: op 3 でプレゼンスを更新する）
+/// シャードのスレッドでは shard にこのスレッドのシャードの番号を渡す（op 4 などサーバーのものはそのサーバーのシャードで送る）
+fn gateway_send(args: Vec<Value>) -> Result<Value, String> {
+    let op = args[0].as_number()?;
+    if !(0.0..=255.0).contains(&op) {
+        return Err(format!("Invalid gateway opcode {}", args[0]));
+    }
+    let data: serde_json::Value = serde_json::from_str(&crate::http::to_json(&args[1])?).map_err(|e| e.to_string())?;
+    let gateway = match args.get(2) {
+        None | Some(Value::Null) => GATEWAYS.with(|gateways| gateways.borrow().last().cloned()).ok_or("Gateway is not connected")?,
+        Some(value) => {
+            let shard = value.as_number()? as u32;
+            GATEWAYS
+                .with(|gateways| gateways.borrow().iter().find(|gateway| gateway.config.shard.map(|(id, _)| id) == Some(shard)).cloned())
+                .ok_or_else(|| format!("Shard {} is not connected on this thread", shard))?
+        }
+    };
+    gateway.send(op as u8, data)?;
+    Ok(Value::Null)
+}
+
+/// gateway_register_slash_command(application_id, name, description, guild_id?)
+fn gateway_register_slash_command(args: Vec<Value>) -> Result<Value, String> {
+    let application = discord::id(&args[0])?;
+    let path = match args.get(3) {
+        None | Some(Value::Null) => format!("/applications/{}/commands", application),
+        Some(guild) => format!("/applications/{}/guilds/{}/commands", application, discord::id(guild)?),
+    };
+    let body = json!({ "name": discord::text(&args[1])?, "description": discord::text(&args[2])?, "type": 1 });
+    discord::call(Method::POST, path, Some(body), None)
+}
+
+/// gateway_interaction_respond(interaction_id, interaction_token, content)
+fn gateway_interaction_respond(args: Vec<Value>) -> Result<Value, String> {
+    let path = format!("/interactions/{}/{}/callback", discord::id(&args[0])?, discord::text(&args[1])?);
+    let body = json!({ "type": 4, "data": { "content": discord::text(&args[2])? } });
+    discord::call(Method::POST, path, Some(body), None)
+}
+
+/// gateway_send_button(channel_id, content, label, custom_id, style?) - style は省略すると 1（Primary）
+fn gateway_send_button(args: Vec<Value>) -> Result<Value, String> {
+    let style = match args.get(4) {
+        None | Some(Value::Null) => 1,
+        Some(value) => value.as_number()? as i64,
+    };
     let body = json!({
-        "content": content,
+        "content": discord::text(&args[1])?,
         "components": [{
             "type": 1,
             "components": [{
                 "type": 2,
-                "label": button_label,
+                "label": discord::text(&args[2])?,
                 "style": style,
-                "custom_id": button_custom_id
+                "custom_id": discord::text(&args[3])?
             }]
         }]
-    })
-    .to_string();
-
-    let token = GATEWAY_CLIENT.lock().unwrap().clone();
-    if token.is_none() {
-        return Err(PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(
-            "Gateway not connected"
-        ));
-    }
-
-    let mut headers = HashMap::new();
-    headers.insert("Authorization".to_string(), format!("Bot {}", token.unwrap()));
-
-    crate::http::http_post_json(url, body, None)
+    });
+    discord::call(Method::POST, format!("/channels/{}/messages", discord::id(&args[0])?), Some(body), None)
 }
 
-/// Send message with select menu
-#[pyfunction]
-pub fn gateway_send_select(
-    channel_id: String,
-    content: String,
-    custom_id: String,
-    options: Vec<(String, String)>, // (label, value) pairs
-) -> PyResult<String> {
-    let url = format!("https://discord.com/api/v10/channels/{}/messages", channel_id);
-
-    let select_options: Vec<JsonValue> = options
+/// gateway_send_select(channel_id, content, custom_id, options) - options は [label, value] のリスト
+fn gateway_send_select(args: Vec<Value>) -> Result<Value, String> {
+    let options = args[3]
+        .as_list()?
+        .borrow()
         .iter()
-        .map(|(label, value)| {
-            json!({
-                "label": label,
-                "value": value
-            })
+        .map(|option| match option {
+            Value::List(pair) => match pair.borrow().as_slice() {
+                [label, value] => Ok(json!({ "label": discord::text(label)?, "value": discord::text(value)? })),
+                _ => Err("gateway_send_select() options must be [label, value] pairs".to_string()),
+            },
+            _ => Err("gateway_send_select() options must be [label, value] pairs".to_string()),
         })
-        .collect();
-
+        .collect::<Result<Vec<_>, String>>()?;
     let body = json!({
-        "content": content,
+        "content": discord::text(&args[1])?,
         "components": [{
             "type": 1,
-            "components": [{
-                "type": 3,
-                "custom_id": custom_id,
-                "options": select_options
-            }]
+            "components": [{ "type": 3, "custom_id": discord::text(&args[2])?, "options": options }]
         }]
-    })
-    .to_string();
+    });
+    discord::call(Method::POST, format!("/channels/{}/messages", discord::id(&args[0])?), Some(body), None)
+}
 
-    let token = GATEWAY_CLIENT.lock().unwrap().clone();
-    if token.is_none() {
-        return Err(PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(
-            "Gateway not connected"
-        ));
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use flate2::{Compress, Compression, FlushCompress};
+    use serde_json::Value as Json;
+    use std::sync::Mutex;
+    use tokio_tungstenite::accept_async;
+
+    /// 3本目の接続で READY のあとに続けて送るメッセージの数
+    const BURST: usize = 30;
+
+    /// 偽の Gateway が受け取ったもの
+    #[derive(Default)]
+    struct Log {
+        /// 接続ごとの最初のペイロード（IDENTIFY・RESUME）
+        first: Vec<Json>,
+        /// 接続ごとに受け取ったハートビートの数
+        heartbeats: Vec<usize>,
     }
 
-    let mut headers = HashMap::new();
-    headers.insert("Authorization".to_string(), format!("Bot {}", token.unwrap()));
+    /// zlib-stream で送る（1つの圧縮のコンテキストで圧縮し、2つのメッセージに分けて送る）
+    async fn send<S>(socket: &mut S, compress: &mut Compress, payload: Json)
+    where
+        S: futures_util::Sink<Message> + Unpin,
+        S::Error: std::fmt::Debug,
+    {
+        let input = payload.to_string().into_bytes();
+        let mut output = Vec::with_capacity(input.len() * 2 + 64);
+        compress.compress_vec(&input, &mut output, FlushCompress::Sync).unwrap();
+        assert!(output.ends_with(&ZLIB_SUFFIX));
+        let (head, tail) = output.split_at(output.len() / 2);
+        socket.send(Message::Binary(head.to_vec())).await.unwrap();
+        socket.send(Message::Binary(tail.to_vec())).await.unwrap();
+    }
 
-    crate::http::http_post_json(url, body, None)
-}
+    /// 台本どおりに応答する偽の Gateway を別スレッドで起動する
+    /// 1本目: READY のあとハートビートに ACK を返さない（クライアントが張り直して RESUME する）
+    /// 2本目: RESUMED のあと ACK を1回返してから、再開できない Invalid Session を送る
+    /// 3本目: IDENTIFY からやり直した READY のあと、BURST 件のメッセージと "done" を続けて送る
+    fn start_fake_gateway() -> (u16, Arc<Mutex<Log>>) {
+        let log = Arc::new(Mutex::new(Log::default()));
+        let (sender, receiver) = std::sync::mpsc::channel();
+        let recorded = log.clone();
+        std::thread::spawn(move || {
+            let runtime = tokio::runtime::Builder::new_multi_thread().enable_all().build().unwrap();
+            runtime.block_on(async move {
+                let listener = tokio::net::TcpListener::bind("127.0.0.1:0").await.unwrap();
+                let port = listener.local_addr().unwrap().port();
+                sender.send(port).unwrap();
+                for index in 0..3 {
+                    let (stream, _) = listener.accept().await.unwrap();
+                    stream.set_nodelay(true).unwrap();
+                    let mut socket = accept_async(stream).await.unwrap();
+                    let mut compress = Compress::new(Compression::default(), true);
+                    send(&mut socket, &mut compress, json!({"op": 10, "d": {"heartbeat_interval": 30}})).await;
+                    let Some(Ok(Message::Text(first))) = socket.next().await else { panic!("no identify") };
+                    recorded.lock().unwrap().first.push(serde_json::from_str(&first).unwrap());
+                    recorded.lock().unwrap().heartbeats.push(0);
+
+                    let dispatch = |t: &str, s: u64, d: Json| json!({"op": 0, "t": t, "s": s, "d": d});
+                    let mut acks = match index {
+                        0 => {
+                            let ready = json!({"session_id": "abc", "resume_gateway_url": format!("ws://127.0.0.1:{}", port)});
+                            send(&mut socket, &mut compress, dispatch("READY", 1, ready)).await;
+                            for s in 2..=3 {
+                                send(&mut socket, &mut compress, dispatch("MESSAGE_CREATE", s, json!({"content": format!("m{}", s)}))).await;
+                            }
+                            0
+                        }
+                        1 => {
+                            send(&mut socket, &mut compress, dispatch("RESUMED", 4, Json::Null)).await;
+                            send(&mut socket, &mut compress, dispatch("MESSAGE_CREATE", 5, json!({"content": "m5"}))).await;
+                            1
+                        }
+                        _ => {
+                            send(&mut socket, &mut compress, dispatch("READY", 1, json!({"session_id": "def"}))).await;
+                            for s in 0..BURST {
+                                let message = json!({"content": format!("e{}", s)});
+                                send(&mut socket, &mut compress, dispatch("MESSAGE_CREATE", s as u64 + 2, message)).await;
+                            }
+                            send(&mut socket, &mut compress, dispatch("MESSAGE_CREATE", BURST as u64 + 2, json!({"content": "done"}))).await;
+                            usize::MAX
+                        }
+                    };
+                    // クライアントが閉じるまでハートビートを受け取る
+                    while let Some(Ok(message)) = socket.next().await {
+                        let Message::Text(text) = message else { continue };
+                        let payload: Json = serde_json::from_str(&text).unwrap();
+                        if payload["op"] != 1 {
+                            continue;
+                        }
+                        *recorded.lock().unwrap().heartbeats.last_mut().unwrap() += 1;
+                        if acks > 0 {
+                            acks -= 1;
+                            send(&mut socket, &mut compress, json!({"op": 11})).await;
+                            if index == 1 {
+                                send(&mut socket, &mut compress, json!({"op": 9, "d": false})).await;
+                            }
+                        }
+                    }
+                }
+            });
+        });
+        (receiver.recv().unwrap(), log)
+    }
 
-/// Register gateway functions
-pub fn register_gateway_functions(m: &PyModule) -> PyResult<()> {
-    m.add_function(wrap_pyfunction!(gateway_on, m)?)?;
-    m.add_function(wrap_pyfunction!(gateway_connect, m)?)?;
-    m.add_function(wrap_pyfunction!(gateway_register_slash_command, m)?)?;
-    m.add_function(wrap_pyfunction!(gateway_interaction_respond, m)?)?;
-    m.add_function(wrap_pyfunction!(gateway_send_button, m)?)?;
-    m.add_function(wrap_pyfunction!(gateway_send_select, m)?)?;
-    Ok(())
+    fn run(source: &str) -> Result<Value, String> {
+        let tokens = crate::lexer::Lexer::new(source).tokenize().unwrap();
+        let ast = crate::parser::Parser::new(tokens).parse().unwrap();
+        let bytecode = crate::compiler::Compiler::new().compile(ast)?;
+        let mut vm = crate::vm::VM::new();
+        crate::builtins::setup_vm_builtins(&mut vm);
+        vm.execute(bytecode)
+    }
+
+    #[test]
+    fn test_inflater() {
+        let mut compress = Compress::new(Compression::default(), true);
+        let mut inflater = Inflater::new();
+        for text in ["{\"op\": 10}", &"x".repeat(200_000)] {
+            let mut output = Vec::with_capacity(text.len() + 1024);
+            compress.compress_vec(text.as_bytes(), &mut output, FlushCompress::Sync).unwrap();
+            let (head, tail) = output.split_at(output.len() - 2);
+            assert_eq!(inflater.push(head).unwrap(), None);
+            assert_eq!(inflater.push(tail).unwrap(), Some(text.as_bytes()));
+        }
+        assert!(Inflater::new().push(&[1, 2, 3, 0, 0, 0xff, 0xff]).unwrap_err().contains("Failed to inflate"));
+    }
+
+    #[test]
+    fn test_gateway() {
+        let (port, log) = start_fake_gateway();
+        let source = r#"
+let seen = []
+let peak = [0]
+async fun on_message(message) {
+    push(seen, message["content"])
+    let queued = gateway_status()["queued"]
+    if (queued > peak[0]) {
+        peak[0] = queued
+    }
+    await sleep(0.001)
+    if (message["content"] == "done") {
+        gateway_close()
+    }
+}
+fun on_ready(ready) {
+    push(seen, "ready " + ready["session_id"])
+}
+gateway_on("message", on_message)
+gateway_on("READY", on_ready)
+await gateway_connect("test", 513, {"url": "ws://127.0.0.1:PORT", "queue": 4, "max_handlers": 1, "reconnect_delay": 0.01})
+let status = gateway_status()
+let out = join(seen, ",") + "|" + str(peak[0]) + "|" + status["state"] + " " + status["session_id"] + " " + str(status["sequence"])
+out + " " + str(status["resumes"]) + " " + str(status["reconnects"]) + " " + str(status["events"])
+"#;
+        let result = run(&source.replace("PORT", &port.to_string())).unwrap().to_string();
+        let burst: Vec<String> = (0..BURST).map(|i| format!("e{}", i)).collect();
+        let (seen, rest) = result.split_once('|').unwrap();
+        // ハンドラーは受け取った順に1つずつ呼ばれ、RESUME で切れる前のメッセージの続きから受け取る
+        assert_eq!(seen, format!("ready abc,m2,m3,m5,ready def,{},done", burst.join(",")));
+        let (peak, status) = rest.split_once('|').unwrap();
+        // チャネルに溜まるイベントは queue までで、それ以上はソケットの読み込みを止める
+        let peak: usize = peak.parse().unwrap();
+        assert!((1..=4).contains(&peak), "{}", peak);
+        assert_eq!(status, format!("closed def {} 1 2 {}", BURST + 2, BURST + 7));
+
+        let log = log.lock().unwrap();
+        assert_eq!(log.first[0]["op"], 2);
+        assert_eq!(log.first[0]["d"]["token"], "test");
+        assert_eq!(log.first[0]["d"]["intents"], 513);
+        assert_eq!(log.first[1], json!({"op": 6, "d": {"token": "test", "session_id": "abc", "seq": 3}}));
+        assert_eq!(log.first[2]["op"], 2);
+        // ACK が返らなかった1本目は2回目のハートビートの前に張り直す
+        assert_eq!(log.heartbeats[0], 1);
+        assert!(log.heartbeats[1] >= 1);
+
+        let error = run("await gateway_connect(\"test\", 1, {\"url\": \"ws://127.0.0.1:1\", \"reconnect_delay\": 0.001})").unwrap_err();
+        assert!(error.contains("Gateway gave up after 5 failed connections"), "{}", error);
+        assert!(run("gateway_on(\"ready\", 1)").unwrap_err().contains("number is not callable"));
+        assert!(run("gateway_send(3, {})").unwrap_err().contains("Gateway is not connected"));
+    }
 }
@@ -0,0 +1,90 @@
+/// ジェネレータ
+/// yield を含む関数を呼び出すと、本体を実行せずにジェネレータ（を反復するイテレータ）を返す。
+/// VMは yield したフレーム（呼び出された関数・ローカル変数・一時値のスタック部分）をヒープに移して保存し、
+/// 次の要素を求められたらスタックに戻して続きから実行する（要素は1つずつ作られ、メモリは一定）。
+/// ツリー走査インタプリタは評価を途中で止められないため、最初に要素を求められたときに
+/// 本体を最後まで実行し、yield された値をためておく。
+
+use crate::value::{Function, Value};
+use crate::vm::{Closure, Upvalue};
+use std::cell::RefCell;
+use std::fmt;
+use std::rc::Rc;
+
+/// VMで中断したフレーム
+pub struct Frame {
+    /// 実行中のクロージャ
+    pub(crate) closure: Rc<Closure>,
+
+    /// 再開位置
+    pub(crate) pc: usize,
+
+    /// フレームのスタック部分 [呼び出された関数, ローカル変数..., 一時値...]
+    pub(crate) stack: Vec<Value>,
+
+    /// このフレームのローカル変数を捕捉した変数と、保存したスタック上の位置
+    /// （中断中は値を持ち、再開するとスタックを指すよう戻す）
+    pub(crate) captured: Vec<(usize, Rc<RefCell<Upvalue>>)>,
+}
+
+/// ジェネレータの状態
+pub enum State {
+    /// VM: 中断したフレーム（まだ実行していなければ先頭で止まっている）
+    Suspended(Frame),
+
+    /// インタプリタ: まだ実行していない呼び出し
+    Unstarted { function: Rc<Function>, args: Vec<Value> },
+
+    /// インタプリタ: yield された値の残り
+    Buffered(std::vec::IntoIter<Value>),
+
+    /// 実行中
+    Running,
+
+    /// 終了した
+    Done,
+}
+
+/// ジェネレータ
+pub struct Generator {
+    /// 関数名（表示用）
+    name: String,
+
+    state: RefCell<State>,
+}
+
+impl Generator {
+    /// ジェネレータを作成
+    pub fn new(name: &str, state: State) -> Rc<Generator> {
+        Rc::new(Generator {
+            name: name.to_string(),
+            state: RefCell::new(state),
+        })
+    }
+
+    /// 関数名
+    pub fn name(&self) -> &str {
+        &self.name
+    }
+
+    /// 再開するために状態を取り出す（実行中にする）
+    /// 実行中のジェネレータを再開しようとした（自分自身を反復した）場合はエラー
+    pub fn start(&self) -> Result<State, String> {
+        match std::mem::replace(&mut *self.state.borrow_mut(), State::Running) {
+            State::Running => Err(format!("Generator {} is already running", self.name)),
+            state => Ok(state),
+        }
+    }
+
+    /// 実行を終えたあとの状態を設定
+    pub fn set(&self, state: State) {
+        *self.state.borrow_mut() = state;
+    }
+}
+
+impl fmt::Debug for Generator {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        // フレームは自分自身を参照しうるため名前のみ出力
+        write!(f, "<generator {}>", self.name)
+    }
+}
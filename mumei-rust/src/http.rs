@@ -1,420 +1,645 @@
-use pyo3::prelude::*;
-use pyo3::types::{PyDict, PyList};
-use reqwest::blocking::{Client, Response};
-use reqwest::header::{HeaderMap, HeaderName, HeaderValue, AUTHORIZATION, CONTENT_TYPE};
-use serde_json::Value as JsonValue;
+/// HTTPクライアント
+/// http_get などの組み込み関数はリクエストをタスク（組み込みの非同期処理）にして返し、await で応答を待つ。
+/// スレッドごとに1つの非同期クライアントを共有し、keep-alive の接続をホストごとにプールして使い回す。
+/// ホストごとの同時接続数には上限があり、超えた分のリクエストは接続が空くまで待つ。
+
+use crate::dict::{Dict, Key};
+use crate::environment::Environment;
+use crate::task::{self, Task};
+use crate::value::Value;
+use reqwest::header::{HeaderMap, HeaderName, HeaderValue, CONTENT_TYPE};
+use reqwest::{Method, Url};
+use serde::de::{Deserialize, Deserializer, MapAccess, SeqAccess, Visitor};
+use serde::ser::{Error as _, Serialize, SerializeMap, SerializeSeq, Serializer};
+use std::cell::RefCell;
 use std::collections::HashMap;
+use std::fmt;
+use std::rc::Rc;
 use std::time::Duration;
+use tokio::sync::Semaphore;
 
-/// HTTP Client for making REST API requests
-pub struct HttpClient {
-    client: Client,
-    default_headers: HeaderMap,
-}
+/// JSON に変換できる入れ子の深さの上限（自分自身を含むリストで止まらないように）
+const MAX_JSON_DEPTH: usize = 128;
 
-impl HttpClient {
-    pub fn new() -> Result<Self, String> {
-        let client = Client::builder()
-            .timeout(Duration::from_secs(30))
-            .build()
-            .map_err(|e| format!("Failed to create HTTP client: {}", e))?;
+/// クライアントの設定
+#[derive(Debug, Clone)]
+pub struct HttpConfig {
+    /// リクエスト全体の期限（接続してから応答の本文を読み終えるまで）
+    pub timeout: Duration,
 
-        Ok(HttpClient {
-            client,
-            default_headers: HeaderMap::new(),
-        })
-    }
+    /// 接続の期限
+    pub connect_timeout: Duration,
 
-    pub fn set_default_header(&mut self, key: &str, value: &str) -> Result<(), String> {
-        let header_name = HeaderName::from_bytes(key.as_bytes())
-            .map_err(|e| format!("Invalid header name: {}", e))?;
-        let header_value = HeaderValue::from_str(value)
-            .map_err(|e| format!("Invalid header value: {}", e))?;
+    /// ホストごとの同時接続数の上限（プールに残す keep-alive の接続もこの数まで）
+    pub max_per_host: usize,
 
-        self.default_headers.insert(header_name, header_value);
-        Ok(())
+    /// 使われていない keep-alive の接続を閉じるまでの時間
+    pub idle_timeout: Duration,
+}
+
+impl Default for HttpConfig {
+    fn default() -> Self {
+        HttpConfig {
+            timeout: Duration::from_secs(30),
+            connect_timeout: Duration::from_secs(10),
+            max_per_host: 16,
+            idle_timeout: Duration::from_secs(90),
+        }
     }
+}
 
-    pub fn get(&self, url: &str, headers: Option<HashMap<String, String>>) -> Result<String, String> {
-        let mut request = self.client.get(url);
+/// 応答
+#[derive(Debug, Clone)]
+pub struct Response {
+    pub status: u16,
+    pub headers: Vec<(String, String)>,
+    pub body: String,
+}
 
-        // Add default headers
-        request = request.headers(self.default_headers.clone());
+impl Response {
+    /// ヘッダーの値（名前は大文字・小文字を区別しない）
+    pub fn header(&self, name: &str) -> Option<&str> {
+        self.headers
+            .iter()
+            .find(|(key, _)| key.eq_ignore_ascii_case(name))
+            .map(|(_, value)| value.as_str())
+    }
 
-        // Add custom headers
-        if let Some(custom_headers) = headers {
-            for (key, value) in custom_headers {
-                request = request.header(key, value);
-            }
+    /// {"status": ..., "headers": {...}, "body": ...} の辞書にする
+    pub fn to_value(&self) -> Value {
+        let mut headers = Dict::with_capacity(self.headers.len());
+        for (name, value) in &self.headers {
+            headers.insert(Key::Str(name.as_str().into()), Value::String(value.as_str().into()));
         }
-
-        let response = request
-            .send()
-            .map_err(|e| format!("GET request failed: {}", e))?;
-
-        response
-            .text()
-            .map_err(|e| format!("Failed to read response: {}", e))
+        let mut response = Dict::with_capacity(3);
+        response.insert(Key::Str("status".into()), Value::Number(self.status as f64));
+        response.insert(Key::Str("headers".into()), Value::Dictionary(Rc::new(RefCell::new(headers))));
+        response.insert(Key::Str("body".into()), Value::String(self.body.as_str().into()));
+        Value::Dictionary(Rc::new(RefCell::new(response)))
     }
+}
 
-    pub fn post(&self, url: &str, body: &str, headers: Option<HashMap<String, String>>) -> Result<String, String> {
-        let mut request = self.client.post(url);
+/// 共有のHTTPクライアント
+pub struct HttpClient {
+    client: reqwest::Client,
+    config: HttpConfig,
 
-        // Add default headers
-        request = request.headers(self.default_headers.clone());
+    /// すべてのリクエストに付けるヘッダー
+    default_headers: HeaderMap,
 
-        // Add custom headers
-        if let Some(custom_headers) = headers {
-            for (key, value) in custom_headers {
-                request = request.header(key, value);
-            }
-        }
+    /// ホスト（scheme://host:port）ごとの同時接続数の上限
+    hosts: RefCell<HashMap<String, Rc<Semaphore>>>,
+}
 
-        let response = request
-            .body(body.to_string())
-            .send()
-            .map_err(|e| format!("POST request failed: {}", e))?;
+impl HttpClient {
+    pub fn new(config: HttpConfig, default_headers: HeaderMap) -> Result<Self, String> {
+        let client = reqwest::Client::builder()
+            .timeout(config.timeout)
+            .connect_timeout(config.connect_timeout)
+            .pool_max_idle_per_host(config.max_per_host)
+            .pool_idle_timeout(config.idle_timeout)
+            .tcp_keepalive(Duration::from_secs(60))
+            .tcp_nodelay(true)
+            .build()
+            .map_err(|e| format!("Failed to create HTTP client: {}", e))?;
+        Ok(HttpClient { client, config, default_headers, hosts: RefCell::new(HashMap::new()) })
+    }
 
-        response
-            .text()
-            .map_err(|e| format!("Failed to read response: {}", e))
+    pub fn config(&self) -> &HttpConfig {
+        &self.config
     }
 
-    pub fn post_json(&self, url: &str, json_body: &str, headers: Option<HashMap<String, String>>) -> Result<String, String> {
-        let mut request = self.client.post(url);
+    /// ホストの同時接続数を数えるセマフォ
+    fn host_limit(&self, url: &Url) -> Rc<Semaphore> {
+        let host = format!("{}://{}:{}", url.scheme(), url.host_str().unwrap_or(""), url.port_or_known_default().unwrap_or(0));
+        let max_per_host = self.config.max_per_host;
+        self.hosts
+            .borrow_mut()
+            .entry(host)
+            .or_insert_with(|| Rc::new(Semaphore::new(max_per_host)))
+            .clone()
+    }
 
-        // Add default headers
-        request = request.headers(self.default_headers.clone());
-        request = request.header(CONTENT_TYPE, "application/json");
+    /// リクエストを送り、応答の本文まで読む（ホストの接続が空くまで待ってから送る）
+    pub async fn send(self: Rc<Self>, method: Method, url: Url, body: Option<String>, headers: HeaderMap) -> Result<Response, String> {
+        let limit = self.host_limit(&url);
+        let _permit = limit.acquire().await.map_err(|e| e.to_string())?;
 
-        // Add custom headers
-        if let Some(custom_headers) = headers {
-            for (key, value) in custom_headers {
-                request = request.header(key, value);
+        let mut request = self.client.request(method.clone(), url.clone()).headers(self.default_headers.clone()).headers(headers);
+        if let Some(body) = body {
+            request = request.body(body);
+        }
+        let failed = |e: reqwest::Error| {
+            if e.is_timeout() {
+                format!("{} {} timed out after {} seconds", method, url, Value::Number(self.config.timeout.as_secs_f64()))
+            } else {
+                format!("{} {} failed: {}", method, url, e)
             }
+        };
+        let response = request.send().await.map_err(failed)?;
+        let status = response.status().as_u16();
+        let headers = response
+            .headers()
+            .iter()
+            .map(|(name, value)| (name.to_string(), String::from_utf8_lossy(value.as_bytes()).into_owned()))
+            .collect();
+        let body = response.text().await.map_err(failed)?;
+        Ok(Response { status, headers, body })
+    }
+}
+
+thread_local! {
+    /// このスレッドのクライアント（最初のリクエストで作る）
+    static CLIENT: RefCell<Option<Rc<HttpClient>>> = RefCell::new(None);
+}
+
+/// このスレッドの共有のクライアント
+pub fn client() -> Result<Rc<HttpClient>, String> {
+    CLIENT.with(|client| {
+        let mut client = client.borrow_mut();
+        if let Some(client) = &*client {
+            return Ok(client.clone());
         }
+        Ok(client.insert(Rc::new(HttpClient::new(HttpConfig::default(), HeaderMap::new())?)).clone())
+    })
+}
 
-        let response = request
-            .body(json_body.to_string())
-            .send()
-            .map_err(|e| format!("POST JSON request failed: {}", e))?;
+/// クライアントを作り直す（プールした接続は捨てる。送信中のリクエストは古いクライアントで続く）
+pub fn configure(config: HttpConfig, default_headers: HeaderMap) -> Result<(), String> {
+    let created = Rc::new(HttpClient::new(config, default_headers)?);
+    CLIENT.with(|client| *client.borrow_mut() = Some(created));
+    Ok(())
+}
 
-        response
-            .text()
-            .map_err(|e| format!("Failed to read response: {}", e))
-    }
+/// リクエストをタスクにする（応答は finish で結果の値にする）
+pub fn request(
+    method: Method,
+    url: &str,
+    body: Option<String>,
+    headers: HeaderMap,
+    finish: fn(Response) -> Result<Value, String>,
+) -> Result<Rc<Task>, String> {
+    let url = Url::parse(url).map_err(|e| format!("Invalid URL '{}': {}", url, e))?;
+    let client = client()?;
+    let name = method.to_string();
+    Ok(task::spawn_native(&name, async move { finish(client.send(method, url, body, headers).await?) }))
+}
 
-    pub fn put(&self, url: &str, body: &str, headers: Option<HashMap<String, String>>) -> Result<String, String> {
-        let mut request = self.client.put(url);
+/// 応答の本文
+fn text(response: Response) -> Result<Value, String> {
+    Ok(Value::String(response.body.into()))
+}
 
-        request = request.headers(self.default_headers.clone());
+/// 応答の辞書
+fn full(response: Response) -> Result<Value, String> {
+    Ok(response.to_value())
+}
 
-        if let Some(custom_headers) = headers {
-            for (key, value) in custom_headers {
-                request = request.header(key, value);
-            }
-        }
+// ============================================
+// 組み込み関数
+// ============================================
+
+/// HTTP の組み込み関数を環境に登録
+pub fn setup_http_builtins(env: &Environment) {
+    env.define("http_get".to_string(), Value::native_with_optional("http_get", 1, 2, http_get)).unwrap();
+    env.define("http_get_many".to_string(), Value::native_with_optional("http_get_many", 1, 2, http_get_many)).unwrap();
+    env.define("http_post".to_string(), Value::native_with_optional("http_post", 2, 3, http_post)).unwrap();
+    env.define("http_post_json".to_string(), Value::native_with_optional("http_post_json", 2, 3, http_post_json)).unwrap();
+    env.define("http_put".to_string(), Value::native_with_optional("http_put", 2, 3, http_put)).unwrap();
+    env.define("http_patch".to_string(), Value::native_with_optional("http_patch", 2, 3, http_patch)).unwrap();
+    env.define("http_delete".to_string(), Value::native_with_optional("http_delete", 1, 2, http_delete)).unwrap();
+    env.define("http_request".to_string(), Value::native_with_optional("http_request", 2, 4, http_request)).unwrap();
+    env.define("http_set_header".to_string(), Value::native("http_set_header", 2, http_set_header)).unwrap();
+    env.define("http_config".to_string(), Value::native("http_config", 1, http_config)).unwrap();
+    env.define("json_parse".to_string(), Value::native("json_parse", 1, json_parse)).unwrap();
+    env.define("json_stringify".to_string(), Value::native("json_stringify", 1, json_stringify)).unwrap();
+}
 
-        let response = request
-            .body(body.to_string())
-            .send()
-            .map_err(|e| format!("PUT request failed: {}", e))?;
+/// http_get(url, headers?) - 応答の本文を結果にするタスク
+fn http_get(args: Vec<Value>) -> Result<Value, String> {
+    let headers = header_map(args.get(1))?;
+    Ok(Value::Task(request(Method::GET, &args[0].as_string()?, None, headers, text)?))
+}
 
-        response
-            .text()
-            .map_err(|e| format!("Failed to read response: {}", e))
-    }
+/// http_get_many(urls, headers?) - すべての URL を並行に GET し、本文のリストを結果にするタスク
+fn http_get_many(args: Vec<Value>) -> Result<Value, String> {
+    let urls = match &args[0] {
+        Value::List(urls) => urls.borrow().clone(),
+        other => return Err(format!("http_get_many() requires a list of URLs, got {}", other.type_name())),
+    };
+    let headers = header_map(args.get(1))?;
+    let tasks = urls
+        .iter()
+        .map(|url| request(Method::GET, &url.as_string()?, None, headers.clone(), text))
+        .collect::<Result<Vec<_>, String>>()?;
+    Ok(Value::Task(task::gather(tasks)))
+}
 
-    pub fn delete(&self, url: &str, headers: Option<HashMap<String, String>>) -> Result<String, String> {
-        let mut request = self.client.delete(url);
+/// http_post(url, body, headers?)
+fn http_post(args: Vec<Value>) -> Result<Value, String> {
+    send_body(Method::POST, args)
+}
 
-        request = request.headers(self.default_headers.clone());
+/// http_post_json(url, value, headers?) - 文字列はそのまま、それ以外は JSON にして送る
+fn http_post_json(args: Vec<Value>) -> Result<Value, String> {
+    let mut headers = header_map(args.get(2))?;
+    headers.insert(CONTENT_TYPE, HeaderValue::from_static("application/json"));
+    let json = match &args[1] {
+        Value::String(s) => s.as_str().to_string(),
+        value => to_json(value)?,
+    };
+    Ok(Value::Task(request(Method::POST, &args[0].as_string()?, Some(json), headers, text)?))
+}
 
-        if let Some(custom_headers) = headers {
-            for (key, value) in custom_headers {
-                request = request.header(key, value);
-            }
-        }
+/// http_put(url, body, headers?)
+fn http_put(args: Vec<Value>) -> Result<Value, String> {
+    send_body(Method::PUT, args)
+}
 
-        let response = request
-            .send()
-            .map_err(|e| format!("DELETE request failed: {}", e))?;
+/// http_patch(url, body, headers?)
+fn http_patch(args: Vec<Value>) -> Result<Value, String> {
+    send_body(Method::PATCH, args)
+}
 
-        response
-            .text()
-            .map_err(|e| format!("Failed to read response: {}", e))
-    }
+/// http_delete(url, headers?)
+fn http_delete(args: Vec<Value>) -> Result<Value, String> {
+    let headers = header_map(args.get(1))?;
+    Ok(Value::Task(request(Method::DELETE, &args[0].as_string()?, None, headers, text)?))
+}
 
-    pub fn patch(&self, url: &str, body: &str, headers: Option<HashMap<String, String>>) -> Result<String, String> {
-        let mut request = self.client.patch(url);
+/// http_request(method, url, body?, headers?) - 状態コード・ヘッダー・本文の辞書を結果にするタスク
+fn http_request(args: Vec<Value>) -> Result<Value, String> {
+    let method = args[0].as_string()?;
+    let method = Method::from_bytes(method.as_str().to_ascii_uppercase().as_bytes())
+        .map_err(|_| format!("Invalid HTTP method '{}'", method))?;
+    let body = match args.get(2) {
+        None | Some(Value::Null) => None,
+        Some(value) => Some(value.as_string()?.as_str().to_string()),
+    };
+    let headers = header_map(args.get(3))?;
+    Ok(Value::Task(request(method, &args[1].as_string()?, body, headers, full)?))
+}
 
-        request = request.headers(self.default_headers.clone());
+fn send_body(method: Method, args: Vec<Value>) -> Result<Value, String> {
+    let headers = header_map(args.get(2))?;
+    let body = args[1].as_string()?.as_str().to_string();
+    Ok(Value::Task(request(method, &args[0].as_string()?, Some(body), headers, text)?))
+}
 
-        if let Some(custom_headers) = headers {
-            for (key, value) in custom_headers {
-                request = request.header(key, value);
-            }
-        }
+/// http_set_header(name, value) - すべてのリクエストに付けるヘッダーを設定
+fn http_set_header(args: Vec<Value>) -> Result<Value, String> {
+    let (name, value) = header(&args[0].as_string()?, &args[1].as_string()?)?;
+    let client = client()?;
+    let mut headers = client.default_headers.clone();
+    headers.insert(name, value);
+    configure(client.config.clone(), headers)?;
+    Ok(Value::Null)
+}
 
-        let response = request
-            .body(body.to_string())
-            .send()
-            .map_err(|e| format!("PATCH request failed: {}", e))?;
+/// http_config(options) - 期限（秒）・ホストごとの同時接続数を設定
+/// options: {"timeout": 秒, "connect_timeout": 秒, "max_per_host": 数, "idle_timeout": 秒}
+fn http_config(args: Vec<Value>) -> Result<Value, String> {
+    let Value::Dictionary(options) = &args[0] else {
+        return Err(format!("http_config() requires a dictionary, got {}", args[0].type_name()));
+    };
+    let client = client()?;
+    let mut config = client.config.clone();
+    for (key, value) in options.borrow().iter() {
+        let name = key.to_value().to_string();
+        let number = value.as_number()?;
+        if !(number > 0.0 && number.is_finite()) {
+            return Err(format!("http_config() {} must be a positive number, got {}", name, value));
+        }
+        match name.as_str() {
+            "timeout" => config.timeout = Duration::from_secs_f64(number),
+            "connect_timeout" => config.connect_timeout = Duration::from_secs_f64(number),
+            "idle_timeout" => config.idle_timeout = Duration::from_secs_f64(number),
+            "max_per_host" => config.max_per_host = number as usize,
+            _ => return Err(format!("http_config() got an unknown option '{}'", name)),
+        }
+    }
+    configure(config, client.default_headers.clone())?;
+    Ok(Value::Null)
+}
 
-        response
-            .text()
-            .map_err(|e| format!("Failed to read response: {}", e))
+/// ヘッダーの辞書（省略・null は空）
+fn header_map(value: Option<&Value>) -> Result<HeaderMap, String> {
+    let mut headers = HeaderMap::new();
+    match value {
+        None | Some(Value::Null) => {}
+        Some(Value::Dictionary(dict)) => {
+            for (name, value) in dict.borrow().iter() {
+                let (name, value) = header(&name.to_value().to_string(), &value.to_string())?;
+                headers.insert(name, value);
+            }
+        }
+        Some(other) => return Err(format!("HTTP headers must be a dictionary, got {}", other.type_name())),
     }
+    Ok(headers)
 }
 
-// Global HTTP client instance
-use once_cell::sync::Lazy;
-use std::sync::Mutex;
+fn header(name: &str, value: &str) -> Result<(HeaderName, HeaderValue), String> {
+    let name = HeaderName::from_bytes(name.as_bytes()).map_err(|e| format!("Invalid header name '{}': {}", name, e))?;
+    let value = HeaderValue::from_str(value).map_err(|e| format!("Invalid header value for '{}': {}", name, e))?;
+    Ok((name, value))
+}
 
-static HTTP_CLIENT: Lazy<Mutex<Option<HttpClient>>> = Lazy::new(|| Mutex::new(None));
+// ============================================
+// JSON（辞書は挿入順のまま読み書きする）
+// ============================================
 
-/// Initialize HTTP client
-#[pyfunction]
-pub fn http_init() -> PyResult<bool> {
-    let client = HttpClient::new()
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
+/// json_parse(text) - JSON を辞書・リストなどの値にする
+fn json_parse(args: Vec<Value>) -> Result<Value, String> {
+    from_json(args[0].as_string()?.as_str())
+}
 
-    let mut global_client = HTTP_CLIENT.lock().unwrap();
-    *global_client = Some(client);
+/// json_stringify(value) - 値を JSON の文字列にする
+fn json_stringify(args: Vec<Value>) -> Result<Value, String> {
+    Ok(Value::String(to_json(&args[0])?.into()))
+}
 
-    Ok(true)
+/// JSON を値にする（整数も数値になる）
+pub fn from_json(text: &str) -> Result<Value, String> {
+    serde_json::from_str::<Parsed>(text).map(|parsed| parsed.0).map_err(|e| format!("JSON parse error: {}", e))
 }
 
-/// Set default header for all requests
-#[pyfunction]
-pub fn http_set_header(key: String, value: String) -> PyResult<bool> {
-    let mut global_client = HTTP_CLIENT.lock().unwrap();
+/// 値を JSON にする（整数の数値は小数点なしで書く。辞書のキーは文字列にする）
+pub fn to_json(value: &Value) -> Result<String, String> {
+    serde_json::to_string(&Json { value, depth: 0 }).map_err(|e| e.to_string())
+}
 
-    if let Some(client) = global_client.as_mut() {
-        client.set_default_header(&key, &value)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))?;
-        Ok(true)
-    } else {
-        Err(PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(
-            "HTTP client not initialized. Call http_init() first."
-        ))
-    }
+/// JSON に書き出す値
+struct Json<'a> {
+    value: &'a Value,
+    depth: usize,
 }
 
-/// Convert Python dict to HashMap
-fn py_dict_to_hashmap(py_dict: &PyDict) -> HashMap<String, String> {
-    let mut map = HashMap::new();
-    for (key, value) in py_dict.iter() {
-        if let (Ok(k), Ok(v)) = (key.extract::<String>(), value.extract::<String>()) {
-            map.insert(k, v);
+impl Serialize for Json<'_> {
+    fn serialize<S: Serializer>(&self, serializer: S) -> Result<S::Ok, S::Error> {
+        if self.depth > MAX_JSON_DEPTH {
+            return Err(S::Error::custom("Cannot convert to JSON: nested too deeply"));
+        }
+        let nested = |value| Json { value, depth: self.depth + 1 };
+        match self.value {
+            Value::Null => serializer.serialize_unit(),
+            Value::Boolean(b) => serializer.serialize_bool(*b),
+            Value::Number(n) => serialize_number(*n, serializer),
+            Value::String(s) => serializer.serialize_str(s.as_str()),
+            Value::List(items) => serializer.collect_seq(items.borrow().iter().map(nested)),
+            Value::Array(array) => {
+                let mut seq = serializer.serialize_seq(Some(array.len()))?;
+                for n in array.as_slice() {
+                    seq.serialize_element(&Number(*n))?;
+                }
+                seq.end()
+            }
+            Value::Dictionary(dict) => {
+                let dict = dict.borrow();
+                let mut map = serializer.serialize_map(Some(dict.len()))?;
+                for (key, value) in dict.iter() {
+                    match key {
+                        Key::Str(name) => map.serialize_entry(name.as_str(), &nested(value))?,
+                        key => map.serialize_entry(&key.to_value().to_string(), &nested(value))?,
+                    }
+                }
+                map.end()
+            }
+            other => Err(S::Error::custom(format!("Cannot convert {} to JSON", other.type_name()))),
         }
     }
-    map
 }
 
-/// HTTP GET request
-#[pyfunction]
-pub fn http_get(url: String, headers: Option<&PyDict>) -> PyResult<String> {
-    let global_client = HTTP_CLIENT.lock().unwrap();
+/// JSON に書き出す数値
+struct Number(f64);
 
-    if let Some(client) = global_client.as_ref() {
-        let headers_map = headers.map(py_dict_to_hashmap);
-        client.get(&url, headers_map)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))
-    } else {
-        http_init()?;
-        drop(global_client);
-        http_get(url, headers)
+impl Serialize for Number {
+    fn serialize<S: Serializer>(&self, serializer: S) -> Result<S::Ok, S::Error> {
+        serialize_number(self.0, serializer)
     }
 }
 
-/// HTTP POST request
-#[pyfunction]
-pub fn http_post(url: String, body: String, headers: Option<&PyDict>) -> PyResult<String> {
-    let global_client = HTTP_CLIENT.lock().unwrap();
-
-    if let Some(client) = global_client.as_ref() {
-        let headers_map = headers.map(py_dict_to_hashmap);
-        client.post(&url, &body, headers_map)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))
+fn serialize_number<S: Serializer>(n: f64, serializer: S) -> Result<S::Ok, S::Error> {
+    if n.fract() == 0.0 && n.abs() < 9007199254740992.0 {
+        serializer.serialize_i64(n as i64)
+    } else if n.is_finite() {
+        serializer.serialize_f64(n)
     } else {
-        http_init()?;
-        drop(global_client);
-        http_post(url, body, headers)
+        Err(S::Error::custom(format!("Cannot convert {} to JSON", Value::Number(n))))
     }
 }
 
-/// HTTP POST JSON request
-#[pyfunction]
-pub fn http_post_json(url: String, json_body: String, headers: Option<&PyDict>) -> PyResult<String> {
-    let global_client = HTTP_CLIENT.lock().unwrap();
+/// JSON から読み込んだ値（serde で読み込む構造体のフィールドにも使う）
+pub(crate) struct Parsed(pub(crate) Value);
 
-    if let Some(client) = global_client.as_ref() {
-        let headers_map = headers.map(py_dict_to_hashmap);
-        client.post_json(&url, &json_body, headers_map)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))
-    } else {
-        http_init()?;
-        drop(global_client);
-        http_post_json(url, json_body, headers)
+impl<'de> Deserialize<'de> for Parsed {
+    fn deserialize<D: Deserializer<'de>>(deserializer: D) -> Result<Self, D::Error> {
+        deserializer.deserialize_any(ParsedVisitor)
     }
 }
 
-/// HTTP PUT request
-#[pyfunction]
-pub fn http_put(url: String, body: String, headers: Option<&PyDict>) -> PyResult<String> {
-    let global_client = HTTP_CLIENT.lock().unwrap();
+struct ParsedVisitor;
 
-    if let Some(client) = global_client.as_ref() {
-        let headers_map = headers.map(py_dict_to_hashmap);
-        client.put(&url, &body, headers_map)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))
-    } else {
-        http_init()?;
-        drop(global_client);
-        http_put(url, body, headers)
+impl<'de> Visitor<'de> for ParsedVisitor {
+    type Value = Parsed;
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        f.write_str("a JSON value")
     }
-}
 
-/// HTTP DELETE request
-#[pyfunction]
-pub fn http_delete(url: String, headers: Option<&PyDict>) -> PyResult<String> {
-    let global_client = HTTP_CLIENT.lock().unwrap();
+    fn visit_unit<E>(self) -> Result<Parsed, E> {
+        Ok(Parsed(Value::Null))
+    }
 
-    if let Some(client) = global_client.as_ref() {
-        let headers_map = headers.map(py_dict_to_hashmap);
-        client.delete(&url, headers_map)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))
-    } else {
-        http_init()?;
-        drop(global_client);
-        http_delete(url, headers)
+    fn visit_bool<E>(self, b: bool) -> Result<Parsed, E> {
+        Ok(Parsed(Value::Boolean(b)))
     }
-}
 
-/// HTTP PATCH request
-#[pyfunction]
-pub fn http_patch(url: String, body: String, headers: Option<&PyDict>) -> PyResult<String> {
-    let global_client = HTTP_CLIENT.lock().unwrap();
+    fn visit_i64<E>(self, n: i64) -> Result<Parsed, E> {
+        Ok(Parsed(Value::Number(n as f64)))
+    }
 
-    if let Some(client) = global_client.as_ref() {
-        let headers_map = headers.map(py_dict_to_hashmap);
-        client.patch(&url, &body, headers_map)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e))
-    } else {
-        http_init()?;
-        drop(global_client);
-        http_patch(url, body, headers)
+    fn visit_u64<E>(self, n: u64) -> Result<Parsed, E> {
+        Ok(Parsed(Value::Number(n as f64)))
     }
-}
 
-/// Parse JSON string to Python object
-#[pyfunction]
-pub fn json_parse(py: Python, json_str: String) -> PyResult<PyObject> {
-    let value: JsonValue = serde_json::from_str(&json_str)
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("JSON parse error: {}", e)))?;
+    fn visit_f64<E>(self, n: f64) -> Result<Parsed, E> {
+        Ok(Parsed(Value::Number(n)))
+    }
 
-    json_value_to_py(py, &value)
-}
+    fn visit_str<E>(self, s: &str) -> Result<Parsed, E> {
+        Ok(Parsed(Value::String(s.into())))
+    }
 
-/// Convert serde_json::Value to PyObject
-fn json_value_to_py(py: Python, value: &JsonValue) -> PyResult<PyObject> {
-    match value {
-        JsonValue::Null => Ok(py.None()),
-        JsonValue::Bool(b) => Ok(b.to_object(py)),
-        JsonValue::Number(n) => {
-            if let Some(i) = n.as_i64() {
-                Ok(i.to_object(py))
-            } else if let Some(f) = n.as_f64() {
-                Ok(f.to_object(py))
-            } else {
-                Ok(n.to_string().to_object(py))
-            }
-        }
-        JsonValue::String(s) => Ok(s.to_object(py)),
-        JsonValue::Array(arr) => {
-            let py_list = PyList::empty(py);
-            for item in arr {
-                py_list.append(json_value_to_py(py, item)?)?;
-            }
-            Ok(py_list.to_object(py))
-        }
-        JsonValue::Object(obj) => {
-            let py_dict = PyDict::new(py);
-            for (key, val) in obj {
-                py_dict.set_item(key, json_value_to_py(py, val)?)?;
-            }
-            Ok(py_dict.to_object(py))
+    fn visit_seq<A: SeqAccess<'de>>(self, mut seq: A) -> Result<Parsed, A::Error> {
+        let mut items = Vec::with_capacity(seq.size_hint().unwrap_or(0));
+        while let Some(Parsed(item)) = seq.next_element()? {
+            items.push(item);
         }
+        Ok(Parsed(Value::List(Rc::new(RefCell::new(items)))))
     }
-}
-
-/// Stringify Python object to JSON
-#[pyfunction]
-pub fn json_stringify(py: Python, obj: PyObject) -> PyResult<String> {
-    let value = py_object_to_json_value(py, &obj)?;
-    serde_json::to_string(&value)
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("JSON stringify error: {}", e)))
-}
 
-/// Convert PyObject to serde_json::Value
-fn py_object_to_json_value(py: Python, obj: &PyObject) -> PyResult<JsonValue> {
-    if obj.is_none(py) {
-        return Ok(JsonValue::Null);
+    fn visit_map<A: MapAccess<'de>>(self, mut map: A) -> Result<Parsed, A::Error> {
+        let mut dict = Dict::with_capacity(map.size_hint().unwrap_or(0));
+        while let Some((key, Parsed(value))) = map.next_entry::<String, Parsed>()? {
+            dict.insert(Key::Str(key.into()), value);
+        }
+        Ok(Parsed(Value::Dictionary(Rc::new(RefCell::new(dict)))))
     }
+}
 
-    if let Ok(b) = obj.extract::<bool>(py) {
-        return Ok(JsonValue::Bool(b));
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::sync::atomic::{AtomicUsize, Ordering};
+    use std::sync::Arc;
+    use tokio::io::{AsyncBufReadExt, AsyncReadExt, AsyncWriteExt, BufReader};
+
+    /// モックサーバーが数えた接続数と同時に処理したリクエスト数の最大
+    #[derive(Default)]
+    struct Stats {
+        connections: AtomicUsize,
+        in_flight: AtomicUsize,
+        peak: AtomicUsize,
     }
 
-    if let Ok(i) = obj.extract::<i64>(py) {
-        return Ok(JsonValue::Number(i.into()));
+    /// keep-alive で "メソッド パス 本文" を返すHTTPサーバーを別スレッドで起動する
+    /// /status/N への応答は状態コード N になる
+    fn start_mock_server(latency: Duration) -> (u16, Arc<Stats>) {
+        let stats = Arc::new(Stats::default());
+        let (sender, receiver) = std::sync::mpsc::channel();
+        let counted = stats.clone();
+        std::thread::spawn(move || {
+            let runtime = tokio::runtime::Builder::new_multi_thread().enable_all().build().unwrap();
+            runtime.block_on(async move {
+                let listener = tokio::net::TcpListener::bind("127.0.0.1:0").await.unwrap();
+                sender.send(listener.local_addr().unwrap().port()).unwrap();
+                loop {
+                    let (stream, _) = listener.accept().await.unwrap();
+                    counted.connections.fetch_add(1, Ordering::SeqCst);
+                    let stats = counted.clone();
+                    tokio::spawn(async move {
+                        let mut stream = BufReader::new(stream);
+                        loop {
+                            let mut request_line = String::new();
+                            if stream.read_line(&mut request_line).await.unwrap_or(0) == 0 {
+                                return;
+                            }
+                            let mut length = 0;
+                            loop {
+                                let mut line = String::new();
+                                stream.read_line(&mut line).await.unwrap();
+                                if line.trim().is_empty() {
+                                    break;
+                                }
+                                if let Some((name, value)) = line.split_once(':') {
+                                    if name.eq_ignore_ascii_case("content-length") {
+                                        length = value.trim().parse().unwrap();
+                                    }
+                                }
+                            }
+                            let mut body = vec![0; length];
+                            stream.read_exact(&mut body).await.unwrap();
+
+                            let running = stats.in_flight.fetch_add(1, Ordering::SeqCst) + 1;
+                            stats.peak.fetch_max(running, Ordering::SeqCst);
+                            tokio::time::sleep(latency).await;
+                            stats.in_flight.fetch_sub(1, Ordering::SeqCst);
+
+                            let mut parts = request_line.split_whitespace();
+                            let (method, path) = (parts.next().unwrap(), parts.next().unwrap());
+                            let status = path.strip_prefix("/status/").unwrap_or("200");
+                            let content = format!("{} {} {}", method, path, String::from_utf8_lossy(&body));
+                            let response = format!(
+                                "HTTP/1.1 {} Mock\r\nContent-Length: {}\r\nX-Mock-Method: {}\r\n\r\n{}",
+                                status,
+                                content.len(),
+                                method,
+                                content
+                            );
+                            stream.get_mut().write_all(response.as_bytes()).await.unwrap();
+                        }
+                    });
+                }
+            });
+        });
+        (receiver.recv().unwrap(), stats)
     }
 
-    if let Ok(f) = obj.extract::<f64>(py) {
-        if let Some(n) = serde_json::Number::from_f64(f) {
-            return Ok(JsonValue::Number(n));
-        }
+    fn run(source: &str) -> Result<Value, String> {
+        let tokens = crate::lexer::Lexer::new(source).tokenize().unwrap();
+        let ast = crate::parser::Parser::new(tokens).parse().unwrap();
+        let bytecode = crate::compiler::Compiler::new().compile(ast)?;
+        let mut vm = crate::vm::VM::new();
+        crate::builtins::setup_vm_builtins(&mut vm);
+        vm.execute(bytecode)
     }
 
-    if let Ok(s) = obj.extract::<String>(py) {
-        return Ok(JsonValue::String(s));
+    #[test]
+    fn test_requests() {
+        let (port, stats) = start_mock_server(Duration::ZERO);
+        let source = r#"
+let base = "http://127.0.0.1:PORT"
+let got = await http_get(base + "/a", {"X-Test": "1"})
+let posted = await http_post_json(base + "/json", {"n": 1, "xs": [1.5, true, null]})
+let response = await http_request("delete", base + "/status/404")
+let out = got + "|" + posted + "|" + str(response["status"]) + " " + response["headers"]["x-mock-method"]
+for (i in range(0, 5)) {
+    out = out + "|" + await http_put(base + "/put", str(i))
+}
+out
+"#;
+        let result = run(&source.replace("PORT", &port.to_string())).unwrap();
+        assert_eq!(
+            result.to_string(),
+            "GET /a |POST /json {\"n\":1,\"xs\":[1.5,true,null]}|404 DELETE|PUT /put 0|PUT /put 1|PUT /put 2|PUT /put 3|PUT /put 4"
+        );
+        // 順に送ったリクエストは keep-alive の1本の接続を使い回す
+        assert_eq!(stats.connections.load(Ordering::SeqCst), 1);
+
+        assert!(run("http_get(\"not a url\")").unwrap_err().contains("Invalid URL"));
+        assert!(run("http_get(\"http://127.0.0.1:1/\", {\"bad header\": 1})").unwrap_err().contains("Invalid header name"));
+        let error = run("await http_get(\"http://127.0.0.1:1/\")").unwrap_err();
+        assert!(error.contains("GET http://127.0.0.1:1/ failed"));
     }
 
-    if let Ok(list) = obj.downcast::<PyList>(py) {
-        let mut arr = Vec::new();
-        for item in list.iter() {
-            arr.push(py_object_to_json_value(py, &item.to_object(py))?);
-        }
-        return Ok(JsonValue::Array(arr));
+    #[test]
+    fn test_get_many_limits_connections_per_host() {
+        let (port, stats) = start_mock_server(Duration::from_millis(20));
+        let source = r#"
+http_config({"max_per_host": 3, "timeout": 5})
+let urls = ["http://127.0.0.1:PORT/" + str(i) for i in range(0, 12)]
+let bodies = await http_get_many(urls)
+str(len(bodies)) + " " + bodies[0] + " " + bodies[11]
+"#;
+        let result = run(&source.replace("PORT", &port.to_string())).unwrap();
+        assert_eq!(result.to_string(), "12 GET /0  GET /11 ");
+        assert_eq!(stats.peak.load(Ordering::SeqCst), 3);
+        assert!(stats.connections.load(Ordering::SeqCst) <= 3);
+
+        // 期限を過ぎた応答はエラーになる
+        let source = "http_config({\"timeout\": 0.005})\nawait http_get(\"http://127.0.0.1:PORT/slow\")";
+        let error = run(&source.replace("PORT", &port.to_string())).unwrap_err();
+        assert!(error.contains("timed out after 0.005 seconds"));
+        configure(HttpConfig::default(), HeaderMap::new()).unwrap();
+        assert!(run("http_config({\"retries\": 1})").unwrap_err().contains("unknown option 'retries'"));
     }
 
-    if let Ok(dict) = obj.downcast::<PyDict>(py) {
-        let mut map = serde_json::Map::new();
-        for (key, value) in dict.iter() {
-            if let Ok(k) = key.extract::<String>() {
-                map.insert(k, py_object_to_json_value(py, &value.to_object(py))?);
-            }
-        }
-        return Ok(JsonValue::Object(map));
+    #[test]
+    fn test_json() {
+        let result = run(r#"
+let data = json_parse(json_stringify({"b": [1, 2.5, "x"], "a": {"ok": true, "none": null}}))
+data["b"][1] + data["b"][0] + len(data) + len(data["a"])
+"#);
+        assert_eq!(result.unwrap(), Value::Number(7.5));
+        let result = run("json_stringify({\"z\": 1, 2: [array([1, 2]), \"s\", false]})");
+        assert_eq!(result.unwrap().to_string(), "{\"z\":1,\"2\":[[1,2],\"s\",false]}");
+
+        assert!(run("json_parse(\"{\")").unwrap_err().contains("JSON parse error"));
+        // 有限でない数（オーバーフローした乗算）はJSONにできない
+        let overflow = format!("json_stringify(1{} * 10)", "0".repeat(308));
+        assert!(run(&overflow).unwrap_err().contains("Cannot convert"));
+        assert!(run("fun f() {\n return 1\n}\njson_stringify([f])").unwrap_err().contains("Cannot convert function to JSON"));
+        let nested = run("let xs = [1]\nfor (i in range(0, 200)) {\n xs = [xs]\n}\njson_stringify(xs)");
+        assert!(nested.unwrap_err().contains("nested too deeply"));
     }
-
-    Err(PyErr::new::<pyo3::exceptions::PyTypeError, _>(
-        "Unsupported type for JSON serialization"
-    ))
-}
-
-/// Register HTTP functions with Python module
-pub fn register_http_functions(m: &PyModule) -> PyResult<()> {
-    m.add_function(wrap_pyfunction!(http_init, m)?)?;
-    m.add_function(wrap_pyfunction!(http_set_header, m)?)?;
-    m.add_function(wrap_pyfunction!(http_get, m)?)?;
-    m.add_function(wrap_pyfunction!(http_post, m)?)?;
-    m.add_function(wrap_pyfunction!(http_post_json, m)?)?;
-    m.add_function(wrap_pyfunction!(http_put, m)?)?;
-    m.add_function(wrap_pyfunction!(http_delete, m)?)?;
-    m.add_function(wrap_pyfunction!(http_patch, m)?)?;
-    m.add_function(wrap_pyfunction!(json_parse, m)?)?;
-    m.add_function(wrap_pyfunction!(json_stringify, m)?)?;
-    Ok(())
 }
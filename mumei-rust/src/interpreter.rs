@@ -3,10 +3,46 @@
 
 use std::rc::Rc;
 use std::cell::RefCell;
-use std::collections::HashMap;
-use crate::ast::ASTNode;
-use crate::value::Value;
+use crate::ast::{ASTNode, Ast, BinaryOperator, NodeId};
+use crate::dict::{Dict, Key};
+use crate::value::{Function, Value};
 use crate::environment::Environment;
+use crate::generator::{Generator, State};
+use crate::iterator::{self, Iter, Step};
+use crate::resolver::Resolver;
+use crate::shape::{Class, InlineCache, Instance, Member};
+use crate::string::Str;
+use crate::task::{self, Task};
+
+/// ジェネレータの本体が1回の実行でためられる値の数
+/// インタプリタは本体を最後まで実行してから値を返すため、終わらないジェネレータはここでエラーにする
+pub const MAX_BUFFERED_YIELDS: usize = 1_000_000;
+
+/// ノードを評価した結果の制御の流れ
+/// return/break/continue/throw は文字列化したエラーではなくこの値で呼び出し元へ伝える
+#[derive(Debug, Clone, PartialEq)]
+pub enum ControlFlow {
+    /// 通常どおり次へ進む（式・ブロックの値）
+    Normal(Value),
+    /// return 文（関数呼び出しまで戻る）
+    Return(Value),
+    /// break 文（最も内側のループまで戻る）
+    Break,
+    /// continue 文（最も内側のループの次の反復へ）
+    Continue,
+    /// throw 文（try-catch まで戻る）
+    Throw(Value),
+}
+
+/// 式を評価して値を取り出す（Normal 以外の制御の流れはそのまま呼び出し元へ返す）
+macro_rules! eval_value {
+    ($interpreter:expr, $ast:expr, $id:expr) => {
+        match $interpreter.eval_node($ast, $id)? {
+            ControlFlow::Normal(value) => value,
+            flow => return Ok(flow),
+        }
+    };
+}
 
 /// インタプリタ
 pub struct Interpreter {
@@ -15,6 +51,9 @@ pub struct Interpreter {
 
     /// 現在の環境（スコープ）
     current_env: Rc<Environment>,
+
+    /// 実行中のジェネレータの本体が yield した値（内側ほど後ろ）
+    yields: Vec<Vec<Value>>,
 }
 
 impl Interpreter {
@@ -25,6 +64,7 @@ impl Interpreter {
         Interpreter {
             global_env: global_env.clone(),
             current_env: global_env,
+            yields: Vec::new(),
         }
     }
 
@@ -33,479 +73,849 @@ impl Interpreter {
         self.global_env.clone()
     }
 
-    /// ASTノードのリストを評価
-    pub fn evaluate(&mut self, nodes: Vec<ASTNode>) -> Result<Value, String> {
-        let mut last_value = Value::Null;
-
-        for node in nodes {
-            last_value = self.eval_node(&node)?;
+    /// 構文木を評価
+    pub fn evaluate(&mut self, mut ast: Ast) -> Result<Value, String> {
+        // ローカル変数をスロットに解決してから実行
+        Resolver::new().resolve(&mut ast)?;
+        // 関数値が本体を参照できるよう構文木は共有する
+        let ast = Rc::new(ast);
+        match self.eval_block(&ast, ast.statements())? {
+            ControlFlow::Normal(value) | ControlFlow::Return(value) => Ok(value),
+            flow => Err(Self::escaped(flow)),
         }
-
-        Ok(last_value)
     }
 
     /// 単一のASTノードを評価
-    fn eval_node(&mut self, node: &ASTNode) -> Result<Value, String> {
-        match node {
+    fn eval_node(&mut self, ast: &Rc<Ast>, id: NodeId) -> Result<ControlFlow, String> {
+        let node = ast.node(id);
+        let value = match node {
             // リテラル
-            ASTNode::Number(n) => Ok(Value::Number(*n)),
-            ASTNode::String(s) => Ok(Value::String(s.clone())),
-            ASTNode::Boolean(b) => Ok(Value::Boolean(*b)),
-            ASTNode::Null => Ok(Value::Null),
+            ASTNode::Number(n) => Value::Number(*n),
+            ASTNode::String(s) => Value::String(Str::new(s)),
+            ASTNode::Boolean(b) => Value::Boolean(*b),
+            ASTNode::Null => Value::Null,
 
             // リスト
             ASTNode::List { elements } => {
-                let mut values = Vec::new();
-                for elem in elements {
-                    values.push(self.eval_node(elem)?);
+                let mut values = Vec::with_capacity(elements.len());
+                for &elem in ast.list(*elements) {
+                    values.push(eval_value!(self, ast, elem));
                 }
-                Ok(Value::List(Rc::new(RefCell::new(values))))
+                Value::List(Rc::new(RefCell::new(values)))
             }
 
             // 辞書
             ASTNode::Dictionary { pairs } => {
-                let mut map = HashMap::new();
-                for (key_expr, value_expr) in pairs {
-                    // キーを評価して文字列に変換
-                    let key_value = self.eval_node(key_expr)?;
-                    let key = key_value.to_string();
-
-                    let value = self.eval_node(value_expr)?;
-                    map.insert(key, value);
+                // 要素数は分かっているので表を作り直さない大きさで作る
+                let mut dict = Dict::with_capacity(ast.list(*pairs).len() / 2);
+                for (key_expr, value_expr) in ast.pairs(*pairs) {
+                    let key = Key::from_value(&eval_value!(self, ast, key_expr))?;
+                    let value = eval_value!(self, ast, value_expr);
+                    dict.insert(key, value);
                 }
-                Ok(Value::Dictionary(Rc::new(RefCell::new(map))))
+                Value::Dictionary(Rc::new(RefCell::new(dict)))
             }
 
             // 識別子（変数参照）
-            ASTNode::Identifier(name) => self.current_env.get(name),
+            ASTNode::Identifier(name) => self.current_env.get(name)?,
+
+            // 解決済みローカル変数
+            ASTNode::LocalVariable { name, depth, slot } => {
+                self.current_env.get_slot(*depth, *slot, name)?
+            }
+
+            // 解決済みグローバル変数
+            ASTNode::GlobalVariable { name } => self.global_env.get(name)?,
 
             // 変数宣言
-            ASTNode::VariableDeclaration { name, value, is_const } => {
-                let val = self.eval_node(value)?;
+            ASTNode::VariableDeclaration { name, value, is_const, slot } => {
+                let val = eval_value!(self, ast, *value);
 
-                if *is_const {
+                if let Some(slot) = slot {
+                    self.current_env.define_slot(*slot, val);
+                } else if *is_const {
                     self.current_env.define_const(name.clone(), val)?;
                 } else {
                     self.current_env.define(name.clone(), val)?;
                 }
 
-                Ok(Value::Null)
+                Value::Null
             }
 
             // 代入
             ASTNode::Assignment { target, value } => {
-                let val = self.eval_node(value)?;
+                // x = x + y は x += y と同じく変数を更新する（文字列はその場で伸ばせる）
+                if let ASTNode::BinaryOperation { left, operator: BinaryOperator::Add, right } = ast.node(*value) {
+                    if Self::same_variable(ast, *left, *target) {
+                        let current = eval_value!(self, ast, *left);
+                        let operand = eval_value!(self, ast, *right);
+                        return self.update_variable(ast, *target, current, BinaryOperator::Add, operand).map(ControlFlow::Normal);
+                    }
+                }
 
-                match target.as_ref() {
-                    ASTNode::Identifier(name) => {
-                        self.current_env.assign(name, val.clone())?;
-                        Ok(val)
+                let val = eval_value!(self, ast, *value);
+
+                match ast.node(*target) {
+                    ASTNode::Identifier(_) | ASTNode::LocalVariable { .. } | ASTNode::GlobalVariable { .. } => {
+                        self.store_variable(ast, *target, val.clone())?;
+                        val
                     }
                     ASTNode::IndexAccess { object, index } => {
-                        self.eval_index_assignment(object, index, val)
+                        return self.eval_index_assignment(ast, *object, *index, val);
                     }
-                    ASTNode::MemberAccess { object, member } => {
-                        self.eval_member_assignment(object, member, val)
+                    ASTNode::MemberAccess { object, member, cache } => {
+                        return self.eval_member_assignment(ast, *object, member, cache, val);
                     }
-                    _ => Err("Invalid assignment target".to_string()),
+                    _ => return Err("Invalid assignment target".to_string()),
                 }
             }
 
+            // 複合代入（x += y など、対象は変数）
+            ASTNode::CompoundAssignment { target, operator, value } => {
+                if !matches!(ast.node(*target), ASTNode::Identifier(_) | ASTNode::LocalVariable { .. } | ASTNode::GlobalVariable { .. }) {
+                    return Err("Compound assignment target must be a variable".to_string());
+                }
+                let current = eval_value!(self, ast, *target);
+                let operand = eval_value!(self, ast, *value);
+                self.update_variable(ast, *target, current, *operator, operand)?
+            }
+
             // 二項演算
             ASTNode::BinaryOperation { left, operator, right } => {
-                use crate::ast::BinaryOperator;
-                let left_val = self.eval_node(left)?;
-                let right_val = self.eval_node(right)?;
+                let left_val = eval_value!(self, ast, *left);
+                let right_val = eval_value!(self, ast, *right);
 
                 match operator {
-                    BinaryOperator::Add => left_val.add(&right_val),
-                    BinaryOperator::Subtract => left_val.subtract(&right_val),
-                    BinaryOperator::Multiply => left_val.multiply(&right_val),
-                    BinaryOperator::Divide => left_val.divide(&right_val),
-                    BinaryOperator::Modulo => left_val.modulo(&right_val),
-                    BinaryOperator::Power => left_val.power(&right_val),
-                    BinaryOperator::Less => left_val.less_than(&right_val),
-                    BinaryOperator::Greater => left_val.greater_than(&right_val),
-                    BinaryOperator::LessEqual => Ok(Value::Boolean(!left_val.greater_than(&right_val)?.as_boolean()?)),
-                    BinaryOperator::GreaterEqual => Ok(Value::Boolean(!left_val.less_than(&right_val)?.as_boolean()?)),
-                    BinaryOperator::Equal => Ok(Value::Boolean(left_val.equals(&right_val))),
-                    BinaryOperator::NotEqual => Ok(Value::Boolean(!left_val.equals(&right_val))),
+                    BinaryOperator::Add => left_val.add(&right_val)?,
+                    BinaryOperator::Subtract => left_val.subtract(&right_val)?,
+                    BinaryOperator::Multiply => left_val.multiply(&right_val)?,
+                    BinaryOperator::Divide => left_val.divide(&right_val)?,
+                    BinaryOperator::Modulo => left_val.modulo(&right_val)?,
+                    BinaryOperator::Power => left_val.power(&right_val)?,
+                    BinaryOperator::Less => left_val.less_than(&right_val)?,
+                    BinaryOperator::Greater => left_val.greater_than(&right_val)?,
+                    BinaryOperator::LessEqual => Value::Boolean(!left_val.greater_than(&right_val)?.as_boolean()?),
+                    BinaryOperator::GreaterEqual => Value::Boolean(!left_val.less_than(&right_val)?.as_boolean()?),
+                    BinaryOperator::Equal => Value::Boolean(left_val.equals(&right_val)),
+                    BinaryOperator::NotEqual => Value::Boolean(!left_val.equals(&right_val)),
                     BinaryOperator::And => {
                         if !left_val.is_truthy() {
-                            Ok(left_val)
+                            left_val
                         } else {
-                            Ok(right_val)
+                            right_val
                         }
                     }
                     BinaryOperator::Or => {
                         if left_val.is_truthy() {
-                            Ok(left_val)
+                            left_val
                         } else {
-                            Ok(right_val)
+                            right_val
                         }
                     }
-                    _ => Err(format!("Unknown binary operator: {}", operator)),
+                    _ => return Err(format!("Unknown binary operator: {}", operator)),
                 }
             }
 
             // 単項演算
             ASTNode::UnaryOperation { operator, operand } => {
                 use crate::ast::UnaryOperator;
-                let val = self.eval_node(operand)?;
+                let val = eval_value!(self, ast, *operand);
 
                 match operator {
                     UnaryOperator::Negate => {
                         let num = val.as_number()?;
-                        Ok(Value::Number(-num))
+                        Value::Number(-num)
                     }
-                    UnaryOperator::Not => Ok(Value::Boolean(!val.is_truthy())),
-                    _ => Err(format!("Unknown unary operator: {}", operator)),
+                    UnaryOperator::Not => Value::Boolean(!val.is_truthy()),
+                    _ => return Err(format!("Unknown unary operator: {}", operator)),
                 }
             }
 
             // 関数呼び出し
             ASTNode::FunctionCall { callee, arguments } => {
-                self.eval_function_call(callee, arguments)
+                return self.eval_function_call(ast, *callee, ast.list(*arguments));
+            }
+
+            // インスタンス生成（クラスの呼び出しと同じ）
+            ASTNode::NewExpression { class, arguments } => {
+                return self.eval_function_call(ast, *class, ast.list(*arguments));
             }
 
             // インデックスアクセス
             ASTNode::IndexAccess { object, index } => {
-                let obj = self.eval_node(object)?;
-                let idx = self.eval_node(index)?;
-
-                match obj {
-                    Value::List(list) => {
-                        let index_num = idx.as_number()?;
-                        if index_num < 0.0 || index_num.fract() != 0.0 {
-                            return Err(format!("List index must be non-negative integer, got {}", index_num));
-                        }
-                        list.borrow()
-                            .get(index_num as usize)
-                            .cloned()
-                            .ok_or_else(|| format!("Index {} out of range", index_num))
-                    }
-                    Value::Dictionary(dict) => {
-                        let key = idx.to_string();
-                        dict.borrow()
-                            .get(&key)
-                            .cloned()
-                            .ok_or_else(|| format!("Key '{}' not found", key))
-                    }
-                    Value::String(s) => {
-                        let index_num = idx.as_number()?;
-                        if index_num < 0.0 || index_num.fract() != 0.0 {
-                            return Err(format!("String index must be non-negative integer, got {}", index_num));
-                        }
-                        s.chars()
-                            .nth(index_num as usize)
-                            .map(|c| Value::String(c.to_string()))
-                            .ok_or_else(|| format!("Index {} out of range", index_num))
-                    }
-                    _ => Err(format!("Cannot index {}", obj.type_name())),
-                }
+                let obj = eval_value!(self, ast, *object);
+                let idx = eval_value!(self, ast, *index);
+                obj.get_index(&idx)?
             }
 
             // メンバーアクセス
-            ASTNode::MemberAccess { object, member } => {
-                let obj = self.eval_node(object)?;
+            ASTNode::MemberAccess { object, member, cache } => {
+                let obj = eval_value!(self, ast, *object);
 
                 match obj {
-                    Value::Dictionary(dict) => {
-                        dict.borrow()
-                            .get(member)
-                            .cloned()
-                            .ok_or_else(|| format!("Property '{}' not found", member))
-                    }
-                    Value::Instance { fields, .. } => {
-                        fields.borrow()
-                            .get(member)
-                            .cloned()
-                            .ok_or_else(|| format!("Property '{}' not found", member))
+                    Value::Instance(instance) => {
+                        instance.get(member, cache)
+                            .map(Member::into_value)
+                            .ok_or_else(|| format!("Property '{}' not found", member))?
                     }
-                    _ => Err(format!("Cannot access member of {}", obj.type_name())),
+                    obj => Self::member(obj, member)?,
                 }
             }
 
             // 条件分岐（if）
             ASTNode::IfStatement { condition, then_body, elif_clauses, else_body } => {
-                let cond_val = self.eval_node(condition)?;
+                let cond_val = eval_value!(self, ast, *condition);
 
                 if cond_val.is_truthy() {
-                    self.eval_block(then_body)
-                } else {
-                    // elif句を評価
-                    for (elif_cond, elif_body) in elif_clauses {
-                        let elif_val = self.eval_node(elif_cond)?;
-                        if elif_val.is_truthy() {
-                            return self.eval_block(elif_body);
-                        }
-                    }
+                    return self.eval_block(ast, ast.list(*then_body));
+                }
 
-                    // else句を評価
-                    if let Some(else_nodes) = else_body {
-                        self.eval_block(else_nodes)
-                    } else {
-                        Ok(Value::Null)
+                // elif句を評価
+                for &(elif_cond, elif_body) in elif_clauses {
+                    let elif_val = eval_value!(self, ast, elif_cond);
+                    if elif_val.is_truthy() {
+                        return self.eval_block(ast, ast.list(elif_body));
                     }
                 }
+
+                // else句を評価
+                match else_body {
+                    Some(else_nodes) => return self.eval_block(ast, ast.list(*else_nodes)),
+                    None => Value::Null,
+                }
             }
 
             // while ループ
             ASTNode::WhileStatement { condition, body } => {
                 let mut last_value = Value::Null;
 
+                let body = ast.list(*body);
+
                 loop {
-                    let cond_val = self.eval_node(condition)?;
+                    let cond_val = eval_value!(self, ast, *condition);
                     if !cond_val.is_truthy() {
                         break;
                     }
 
-                    last_value = self.eval_block(body)?;
+                    // 前の周回の値は手放してから実行する（x = x + y の文字列を共有したままにしない）
+                    last_value = Value::Null;
+                    match self.eval_block(ast, body)? {
+                        ControlFlow::Normal(value) => last_value = value,
+                        ControlFlow::Break => break,
+                        ControlFlow::Continue => continue,
+                        flow => return Ok(flow),
+                    }
                 }
 
-                Ok(last_value)
+                last_value
             }
 
             // for-in ループ
-            ASTNode::ForStatement { variable, iterable, body } => {
-                let iter_val = self.eval_node(iterable)?;
-
-                match iter_val {
-                    Value::List(list) => {
-                        let mut last_value = Value::Null;
+            ASTNode::ForStatement { variable, iterable, body, slot } => {
+                let iter_val = eval_value!(self, ast, *iterable);
+                let body = ast.list(*body);
+                let mut last_value = Value::Null;
 
-                        for item in list.borrow().iter() {
-                            self.current_env.define(variable.clone(), item.clone())?;
-                            last_value = self.eval_block(body)?;
-                        }
+                // 要素は1つずつ取り出す（リスト全体を借りたまま本体を実行しない）
+                let iterator = iterator::source(iter_val)?;
 
-                        Ok(last_value)
+                loop {
+                    let item = match self.next_item(&iterator)? {
+                        Some(ControlFlow::Normal(item)) => item,
+                        Some(flow) => return Ok(flow),
+                        None => break,
+                    };
+
+                    self.bind_loop_variable(variable, *slot, item);
+                    // 前の周回の値は手放してから実行する（x = x + y の文字列を共有したままにしない）
+                    last_value = Value::Null;
+                    match self.eval_block(ast, body)? {
+                        ControlFlow::Normal(value) => last_value = value,
+                        ControlFlow::Break => break,
+                        ControlFlow::Continue => continue,
+                        flow => return Ok(flow),
                     }
-                    Value::String(s) => {
-                        let mut last_value = Value::Null;
+                }
 
-                        for ch in s.chars() {
-                            self.current_env.define(variable.clone(), Value::String(ch.to_string()))?;
-                            last_value = self.eval_block(body)?;
-                        }
+                last_value
+            }
+
+            // 内包表記
+            ASTNode::ListComprehension { element, variable, iterable, condition, slot } => {
+                let iterable = eval_value!(self, ast, *iterable);
+                return self.eval_comprehension(ast, variable, *slot, iterable, *condition, *element, None);
+            }
+            ASTNode::DictComprehension { key, value, variable, iterable, condition, slot } => {
+                let iterable = eval_value!(self, ast, *iterable);
+                return self.eval_comprehension(ast, variable, *slot, iterable, *condition, *key, Some(*value));
+            }
 
-                        Ok(last_value)
+            // ジェネレータ式（ジェネレータ関数と同じく、要素をまとめて作ってためておく）
+            // Resolver は本体を反復対象をスロット0に持つ関数のスコープで解決している
+            ASTNode::GeneratorExpression { element, variable, iterable, condition, slot } => {
+                let iterable = eval_value!(self, ast, *iterable);
+                let env = Rc::new(Environment::with_slots(self.current_env.clone(), vec![iterable.clone()]));
+                let prev_env = std::mem::replace(&mut self.current_env, env);
+                let result = self.eval_comprehension(ast, variable, *slot, iterable, *condition, *element, None);
+                self.current_env = prev_env;
+
+                let items = match result? {
+                    ControlFlow::Normal(Value::List(items)) => std::mem::take(&mut *items.borrow_mut()),
+                    flow => return Ok(flow),
+                };
+                let generator = Generator::new("<genexpr>", State::Buffered(items.into_iter()));
+                Value::Iterator(Rc::new(RefCell::new(Iter::Generator(generator))))
+            }
+
+            // yield 文（実行中のジェネレータの値としてためる）
+            ASTNode::YieldStatement { value } => {
+                let value = eval_value!(self, ast, *value);
+                match self.yields.last_mut() {
+                    Some(items) if items.len() >= MAX_BUFFERED_YIELDS => {
+                        return Err(format!(
+                            "Generator yielded more than {} values: the interpreter runs a generator to completion, so infinite generators require the bytecode VM",
+                            MAX_BUFFERED_YIELDS
+                        ));
                     }
-                    _ => Err(format!("Cannot iterate over {}", iter_val.type_name())),
+                    Some(items) => items.push(value),
+                    None => return Err("'yield' outside generator".to_string()),
                 }
+                Value::Null
             }
 
+            // await 式（タスクが終わるまでイベントループを回す。タスクの throw はここから throw される）
+            ASTNode::AwaitExpression { expression } => match eval_value!(self, ast, *expression) {
+                Value::Task(task) => return self.run_until(&task),
+                value => return Err(format!("Cannot await {}", value.type_name())),
+            },
+
             // 関数定義
-            ASTNode::FunctionDeclaration { name, parameters, body, is_async } => {
-                let func = Value::Function {
+            ASTNode::FunctionDeclaration { name, is_async, slot, .. } => {
+                let func = Value::Function(Rc::new(Function {
                     name: name.clone(),
-                    parameters: parameters.clone(),
-                    body: body.clone(),
+                    ast: ast.clone(),
+                    declaration: id,
                     closure: self.current_env.clone(),
                     is_async: *is_async,
-                };
+                }));
 
-                self.current_env.define(name.clone(), func)?;
-                Ok(Value::Null)
+                self.define_variable(name, *slot, func)?;
+                Value::Null
             }
 
+            // ラムダ式（関数定義と同じく定義した環境を捕捉する）
+            ASTNode::Lambda { .. } => Value::Function(Rc::new(Function {
+                name: "<lambda>".to_string(),
+                ast: ast.clone(),
+                declaration: id,
+                closure: self.current_env.clone(),
+                is_async: false,
+            })),
+
             // return 文
             ASTNode::ReturnStatement { value } => {
-                let return_value = if let Some(e) = value {
-                    self.eval_node(e)?
-                } else {
-                    Value::Null
+                let return_value = match value {
+                    Some(e) => eval_value!(self, ast, *e),
+                    None => Value::Null,
                 };
+                return Ok(ControlFlow::Return(return_value));
+            }
+
+            // break / continue 文
+            ASTNode::BreakStatement => return Ok(ControlFlow::Break),
+            ASTNode::ContinueStatement => return Ok(ControlFlow::Continue),
+            ASTNode::PassStatement => Value::Null,
 
-                // returnの値を特別な形で返す（エラーとして）
-                // TODO: より良い方法でreturnを実装する
-                Err(format!("RETURN:{}", return_value.to_string()))
+            // throw 文
+            ASTNode::ThrowStatement { value } => {
+                let thrown = eval_value!(self, ast, *value);
+                return Ok(ControlFlow::Throw(thrown));
             }
 
             // try-catch
-            ASTNode::TryCatch { try_body, catch_variable, catch_body, finally_body } => {
-                let try_result = match self.eval_block(try_body) {
-                    Ok(val) => Ok(val),
-                    Err(e) => {
-                        // エラーメッセージを変数に格納（catch_variableがある場合）
+            ASTNode::TryCatch { try_body, catch_variable, catch_body, finally_body, catch_slot } => {
+                // throw された値、または実行時エラーのメッセージを捕捉する
+                let caught = match self.eval_block(ast, ast.list(*try_body)) {
+                    Ok(ControlFlow::Throw(value)) => Err(value),
+                    Ok(flow) => Ok(flow),
+                    Err(message) => Err(Value::String(message.into())),
+                };
+
+                let result = match caught {
+                    Ok(flow) => Ok(flow),
+                    Err(exception) => {
                         if let Some(var) = catch_variable {
-                            self.current_env.define(
-                                var.clone(),
-                                Value::String(e.clone())
-                            )?;
+                            self.define_variable(var, *catch_slot, exception)?;
                         }
-
-                        self.eval_block(catch_body)?;
-                        Ok(Value::Null)
+                        self.eval_block(ast, ast.list(*catch_body))
                     }
                 };
 
-                // finally句を実行
+                // finally句を実行（finally 内の return/break などはそちらを優先する）
                 if let Some(finally_nodes) = finally_body {
-                    self.eval_block(finally_nodes)?;
+                    match self.eval_block(ast, ast.list(*finally_nodes))? {
+                        ControlFlow::Normal(_) => {}
+                        flow => return Ok(flow),
+                    }
                 }
 
-                try_result
+                return match result? {
+                    ControlFlow::Normal(_) => Ok(ControlFlow::Normal(Value::Null)),
+                    flow => Ok(flow),
+                };
             }
 
-            // クラス定義
-            ASTNode::ClassDeclaration { name, parent, body } => {
-                let parent_val = if let Some(parent_name) = parent {
-                    Some(Box::new(self.current_env.get(parent_name)?))
-                } else {
-                    None
+            // クラス定義（メソッドはクラスを定義した環境を捕捉する関数）
+            ASTNode::ClassDeclaration { name, parent, body, slot } => {
+                let parent = match parent {
+                    Some(parent) => match eval_value!(self, ast, *parent) {
+                        Value::Class(class) => Some(class),
+                        other => return Err(format!("Superclass must be a class, got {}", other.type_name())),
+                    },
+                    None => None,
                 };
 
-                let mut method_map = HashMap::new();
-                for method_node in body {
-                    if let ASTNode::FunctionDeclaration { name: method_name, parameters, body: method_body, is_async } = method_node {
-                        let func = Value::Function {
+                let mut methods = Vec::with_capacity(body.len());
+                for &method_id in ast.list(*body) {
+                    if let ASTNode::FunctionDeclaration { name: method_name, is_async, .. } = ast.node(method_id) {
+                        let function = Value::Function(Rc::new(Function {
                             name: method_name.clone(),
-                            parameters: parameters.clone(),
-                            body: method_body.clone(),
+                            ast: ast.clone(),
+                            declaration: method_id,
                             closure: self.current_env.clone(),
                             is_async: *is_async,
-                        };
-                        method_map.insert(method_name.clone(), func);
+                        }));
+                        methods.push((method_name.clone(), function));
                     }
                 }
 
-                let class = Value::Class {
-                    name: name.clone(),
-                    methods: method_map,
-                    parent: parent_val,
-                };
-
-                self.current_env.define(name.clone(), class)?;
-                Ok(Value::Null)
+                let class = Value::Class(Rc::new(Class::new(name.clone(), methods, parent)));
+                self.define_variable(name, *slot, class)?;
+                Value::Null
             }
 
             // その他
-            _ => Err(format!("Unimplemented AST node: {:?}", node)),
+            _ => return Err(format!("Unimplemented AST node: {:?}", node)),
+        };
+
+        Ok(ControlFlow::Normal(value))
+    }
+
+    /// 変数を定義（解決済みならスロット、トップレベルなら名前で）
+    #[inline]
+    fn define_variable(&self, name: &str, slot: Option<usize>, value: Value) -> Result<(), String> {
+        match slot {
+            Some(slot) => {
+                self.current_env.define_slot(slot, value);
+                Ok(())
+            }
+            None => self.current_env.define(name.to_string(), value),
         }
     }
 
-    /// ブロック（複数のノード）を評価
-    fn eval_block(&mut self, nodes: &[ASTNode]) -> Result<Value, String> {
-        let mut last_value = Value::Null;
+    /// ループ変数に次の要素を入れる（2回目以降は名前の文字列を作らずに上書き）
+    #[inline]
+    fn bind_loop_variable(&self, name: &str, slot: Option<usize>, value: Value) {
+        match slot {
+            Some(slot) => self.current_env.define_slot(slot, value),
+            None => self.current_env.define_or_update(name, value),
+        }
+    }
 
-        for node in nodes {
-            last_value = self.eval_node(node)?;
+    /// 内包表記を評価（value があれば辞書、なければリスト）
+    /// 反復対象の残りの要素数が分かれば結果をその大きさで確保する
+    #[allow(clippy::too_many_arguments)]
+    fn eval_comprehension(
+        &mut self,
+        ast: &Rc<Ast>,
+        variable: &str,
+        slot: Option<usize>,
+        iterable: Value,
+        condition: Option<NodeId>,
+        element: NodeId,
+        value: Option<NodeId>,
+    ) -> Result<ControlFlow, String> {
+        let iterator = iterator::source(iterable)?;
+        let capacity = iterator.borrow().len_hint();
+        let (mut list, mut dict) = match value {
+            Some(_) => (Vec::new(), Dict::with_capacity(capacity)),
+            None => (Vec::with_capacity(capacity), Dict::new()),
+        };
+
+        loop {
+            let item = match self.next_item(&iterator)? {
+                Some(ControlFlow::Normal(item)) => item,
+                Some(flow) => return Ok(flow),
+                None => break,
+            };
+
+            self.bind_loop_variable(variable, slot, item);
+            if let Some(condition) = condition {
+                if !eval_value!(self, ast, condition).is_truthy() {
+                    continue;
+                }
+            }
+            let element = eval_value!(self, ast, element);
+            match value {
+                Some(value) => {
+                    let key = Key::from_value(&element)?;
+                    dict.insert(key, eval_value!(self, ast, value));
+                }
+                None => list.push(element),
+            }
         }
 
-        Ok(last_value)
+        Ok(ControlFlow::Normal(match value {
+            Some(_) => Value::Dictionary(Rc::new(RefCell::new(dict))),
+            None => Value::List(Rc::new(RefCell::new(list))),
+        }))
     }
 
-    /// 関数呼び出しを評価
-    fn eval_function_call(&mut self, function: &ASTNode, arguments: &[ASTNode]) -> Result<Value, String> {
-        let func_value = self.eval_node(function)?;
-
-        // 引数を評価
-        let mut args = Vec::new();
-        for arg in arguments {
-            args.push(self.eval_node(arg)?);
+    /// イテレータの次の要素（尽きたら None）
+    /// 関数の呼び出し・ジェネレータの再開を頼まれたら実行して結果を返し、throw はそのまま返す
+    #[inline]
+    fn next_item(&mut self, iterator: &Rc<RefCell<Iter>>) -> Result<Option<ControlFlow>, String> {
+        let mut step = iterator.borrow_mut().next()?;
+        loop {
+            // 呼び出しの間はイテレータを借りない
+            let result = match step {
+                Step::Item(item) => return Ok(Some(ControlFlow::Normal(item))),
+                Step::Done => return Ok(None),
+                Step::Call(function, args) => match self.call_value(function, args)? {
+                    ControlFlow::Normal(result) => Some(result),
+                    flow => return Ok(Some(flow)),
+                },
+                Step::Resume(generator) => match self.resume(&generator)? {
+                    Some(ControlFlow::Normal(item)) => Some(item),
+                    Some(flow) => return Ok(Some(flow)),
+                    None => None,
+                },
+            };
+            step = iterator.borrow_mut().complete(result)?;
         }
+    }
 
-        match func_value {
-            Value::Function { parameters, body, closure, .. } => {
-                // パラメータ数チェック
-                if parameters.len() != args.len() {
-                    return Err(format!(
-                        "Function expects {} arguments, got {}",
-                        parameters.len(),
-                        args.len()
-                    ));
+    /// ジェネレータの次の値（終わったら None）
+    /// 評価を途中で止められないので、最初の再開で本体を最後まで実行して yield された値をためる
+    /// （終わらないジェネレータは MAX_BUFFERED_YIELDS 個を超えたところでエラーにする）
+    fn resume(&mut self, generator: &Generator) -> Result<Option<ControlFlow>, String> {
+        let mut items = match generator.start()? {
+            State::Buffered(items) => items,
+            State::Unstarted { function, args } => {
+                self.yields.push(Vec::new());
+                let result = self.call_function(&function, args);
+                let items = self.yields.pop().unwrap();
+                match result {
+                    Ok(ControlFlow::Normal(_)) => items.into_iter(),
+                    Ok(flow) => {
+                        generator.set(State::Done);
+                        return Ok(Some(flow));
+                    }
+                    Err(error) => {
+                        generator.set(State::Done);
+                        return Err(error);
+                    }
                 }
+            }
+            State::Done => {
+                generator.set(State::Done);
+                return Ok(None);
+            }
+            _ => return Err(format!("Generator {} was not created by the interpreter", generator.name())),
+        };
+
+        let item = items.next();
+        generator.set(match item {
+            Some(_) => State::Buffered(items),
+            None => State::Done,
+        });
+        Ok(item.map(ControlFlow::Normal))
+    }
+
+    /// タスクが終わるまでイベントループを回し、その結果を得る（失敗したらVMと同じくそのメッセージのエラー）
+    /// 評価を途中で止められないので、タスクの中の await はそこで入れ子のイベントループを回す
+    fn run_until(&mut self, target: &Rc<Task>) -> Result<ControlFlow, String> {
+        loop {
+            match target.result() {
+                Some(Ok(value)) => return Ok(ControlFlow::Normal(value)),
+                Some(Err(error)) => return Err(error.to_string()),
+                None => {}
+            }
+            if let Some(message) = task::interrupted() {
+                // 取り消されたタスクが待っていたものも取り消す
+                task::cancel(target);
+                return Err(message);
+            }
+            match task::next_ready() {
+                Some(task) => task::run(&task, || self.step_task(&task)),
+                None => task::wait_for_io(target)?,
+            }
+        }
+    }
 
-                // 新しい環境を作成（クロージャを親に）
-                let func_env = Rc::new(Environment::with_parent(closure));
+    /// タスクの関数を最後まで実行し、その結果でタスクを終わらせる
+    fn step_task(&mut self, task: &Rc<Task>) {
+        let result = match task.start() {
+            // async 関数は本体を直接実行する（call_value はもう一度タスクを作る）
+            task::State::Call { function: Value::Function(function), args } if function.is_async => {
+                self.call_function(&function, args)
+            }
+            task::State::Call { function, args } => self.call_value(function, args),
+            // 組み込みの非同期処理・組み合わせのタスクは実行エンジンを使わない（取り消し済みのタスクも）
+            state => return task.set(state),
+        };
+        let result = match result {
+            Ok(ControlFlow::Normal(value)) => Ok(value),
+            Ok(ControlFlow::Throw(thrown)) => Err(thrown),
+            Ok(flow) => Err(Value::String(Self::escaped(flow).into())),
+            Err(message) => Err(Value::String(message.into())),
+        };
+        task::complete(task, result);
+    }
 
-                // パラメータをバインド
-                for (param, arg) in parameters.iter().zip(args.iter()) {
-                    func_env.define(param.clone(), arg.clone())?;
+    /// ユーザー定義の関数を呼ぶイテレータの引数を、最後まで回したリストに置き換える（list・extend など）
+    fn collect_arguments(&mut self, args: &mut [Value]) -> Result<Option<ControlFlow>, String> {
+        for arg in args {
+            let iterator = match arg {
+                Value::Iterator(iterator) if iterator.borrow().needs_engine() => iterator.clone(),
+                _ => continue,
+            };
+            let mut items = Vec::with_capacity(iterator.borrow().len_hint());
+            loop {
+                match self.next_item(&iterator)? {
+                    Some(ControlFlow::Normal(item)) => items.push(item),
+                    Some(flow) => return Ok(Some(flow)),
+                    None => break,
                 }
+            }
+            *arg = Value::List(Rc::new(RefCell::new(items)));
+        }
+        Ok(None)
+    }
 
-                // 環境を切り替えて実行
-                let prev_env = self.current_env.clone();
-                self.current_env = func_env;
-
-                let result = match self.eval_block(&body) {
-                    Ok(val) => Ok(val),
-                    Err(e) => {
-                        // return文の処理
-                        if e.starts_with("RETURN:") {
-                            // TODO: return値のパース実装
-                            // 暫定的に最後に評価された値を返す
-                            Ok(Value::Null)
-                        } else {
-                            Err(e)
-                        }
+    /// ユーザー定義のキー関数（sort の第2引数）を、map と同じく各要素に呼んだキーのリストに置き換える
+    fn apply_key(&mut self, args: &mut [Value]) -> Result<Option<ControlFlow>, String> {
+        if let [items @ Value::List(_), key @ (Value::Function(_) | Value::Closure(_))] = args {
+            *key = iterator::map(key.clone(), items)?;
+            return self.collect_arguments(std::slice::from_mut(key));
+        }
+        Ok(None)
+    }
+
+    /// ブロック（複数のノード）を評価
+    /// 値は最後の文の値。return/break/continue/throw に出会ったらそこで止めて返す
+    fn eval_block(&mut self, ast: &Rc<Ast>, nodes: &[NodeId]) -> Result<ControlFlow, String> {
+        // 最後の文以外の値はすぐに捨てる
+        let Some((&last, rest)) = nodes.split_last() else {
+            return Ok(ControlFlow::Normal(Value::Null));
+        };
+        for &node in rest {
+            eval_value!(self, ast, node);
+        }
+
+        Ok(ControlFlow::Normal(eval_value!(self, ast, last)))
+    }
+
+    /// 関数・ループの外へ出てしまった制御の流れのエラーメッセージ
+    #[cold]
+    fn escaped(flow: ControlFlow) -> String {
+        match flow {
+            ControlFlow::Break => "'break' outside loop".to_string(),
+            ControlFlow::Continue => "'continue' outside loop".to_string(),
+            ControlFlow::Throw(value) => format!("Uncaught exception: {}", value),
+            ControlFlow::Normal(_) | ControlFlow::Return(_) => "'return' outside function".to_string(),
+        }
+    }
+
+    /// 関数呼び出しを評価
+    fn eval_function_call(&mut self, ast: &Rc<Ast>, function: NodeId, arguments: &[NodeId]) -> Result<ControlFlow, String> {
+        // obj.method(...) はメソッドを値として取り出さず、インスタンスを最初の引数にして呼ぶ
+        let mut args = Vec::with_capacity(arguments.len() + 1);
+        let func_value = match ast.node(function) {
+            ASTNode::MemberAccess { object, member, cache } => match eval_value!(self, ast, *object) {
+                Value::Instance(instance) => match instance.get(member, cache) {
+                    Some(Member::Method(method)) => {
+                        args.push(Value::Instance(instance));
+                        method
                     }
-                };
+                    Some(Member::Field(value)) => value,
+                    None => return Err(format!("Property '{}' not found", member)),
+                },
+                obj => Self::member(obj, member)?,
+            },
+            _ => eval_value!(self, ast, function),
+        };
 
-                // 環境を戻す
-                self.current_env = prev_env;
+        // 引数を評価
+        for &arg in arguments {
+            args.push(eval_value!(self, ast, arg));
+        }
+
+        self.call_value(func_value, args)
+    }
 
-                result
+    /// インスタンス以外の値のメンバー（辞書の要素）
+    fn member(obj: Value, member: &str) -> Result<Value, String> {
+        match obj {
+            Value::Dictionary(dict) => dict.borrow()
+                .get_str(member)
+                .cloned()
+                .ok_or_else(|| format!("Property '{}' not found", member)),
+            _ => Err(format!("Cannot access member of {}", obj.type_name())),
+        }
+    }
+
+    /// 関数の値を評価済みの引数で呼び出す
+    fn call_value(&mut self, func_value: Value, mut args: Vec<Value>) -> Result<ControlFlow, String> {
+        match func_value {
+            // ジェネレータ関数は本体を実行せず、最初に要素を求められたときに実行する
+            Value::Function(function) if function.is_generator() => {
+                Self::check_arity(&function, &args)?;
+                let name = function.name.clone();
+                let generator = Generator::new(&name, State::Unstarted { function, args });
+                Ok(ControlFlow::Normal(Value::Iterator(Rc::new(RefCell::new(Iter::Generator(generator))))))
             }
-            Value::NativeFunction { arity, function, .. } => {
-                if arity != args.len() {
-                    return Err(format!(
-                        "Native function expects {} arguments, got {}",
-                        arity,
-                        args.len()
-                    ));
+            // async 関数は本体を実行せず、タスクを作って実行待ちにする
+            Value::Function(function) if function.is_async => {
+                Self::check_arity(&function, &args)?;
+                let name = function.name.clone();
+                Ok(ControlFlow::Normal(Value::Task(task::spawn(&name, Value::Function(function), args))))
+            }
+            Value::Function(function) => self.call_function(&function, args),
+            Value::NativeFunction(native) => {
+                native.check_arity(args.len())?;
+                if native.collects {
+                    if let Some(flow) = self.collect_arguments(&mut args)? {
+                        return Ok(flow);
+                    }
                 }
-
-                function(args)
+                if native.keyed {
+                    if let Some(flow) = self.apply_key(&mut args)? {
+                        return Ok(flow);
+                    }
+                }
+                (native.function)(args).map(ControlFlow::Normal)
             }
+            Value::Class(class) => self.instantiate(class, args),
             _ => Err(format!("Cannot call {}", func_value.type_name())),
         }
     }
 
-    /// インデックスへの代入
-    fn eval_index_assignment(&mut self, object: &ASTNode, index: &ASTNode, value: Value) -> Result<Value, String> {
-        let obj = self.eval_node(object)?;
-        let idx = self.eval_node(index)?;
+    /// 関数の本体を評価済みの引数で実行する
+    fn call_function(&mut self, function: &Function, args: Vec<Value>) -> Result<ControlFlow, String> {
+        Self::check_arity(function, &args)?;
 
-        match obj {
-            Value::List(list) => {
-                let index_num = idx.as_number()?;
-                if index_num < 0.0 || index_num.fract() != 0.0 {
-                    return Err(format!("List index must be non-negative integer"));
-                }
+        // 新しい環境を作成（クロージャを親に）
+        // パラメータはResolverがスロット 0..n に割り当て済み
+        let func_env = Rc::new(Environment::with_slots(function.closure.clone(), args));
 
-                let mut borrowed = list.borrow_mut();
-                let i = index_num as usize;
+        // 環境を切り替えて実行
+        let prev_env = std::mem::replace(&mut self.current_env, func_env);
 
-                if i >= borrowed.len() {
-                    return Err(format!("Index {} out of range", i));
-                }
+        // 本体は関数が持つ構文木を参照するだけ（コピーしない）
+        let result = self.eval_block(&function.ast, function.body());
+
+        // 環境を戻す
+        self.current_env = prev_env;
+
+        // return の値（なければ最後の式の値）が呼び出しの値になる
+        match result? {
+            ControlFlow::Normal(value) | ControlFlow::Return(value) => Ok(ControlFlow::Normal(value)),
+            ControlFlow::Throw(value) => Ok(ControlFlow::Throw(value)),
+            flow => Err(Self::escaped(flow)),
+        }
+    }
 
-                borrowed[i] = value.clone();
-                Ok(value)
+    /// パラメータ数チェック
+    fn check_arity(function: &Function, args: &[Value]) -> Result<(), String> {
+        let arity = function.parameters().len();
+        if arity != args.len() {
+            return Err(format!("Function expects {} arguments, got {}", arity, args.len()));
+        }
+        Ok(())
+    }
+
+    /// インスタンスを作成し、初期化メソッドがあればインスタンスと引数で呼ぶ（戻り値は使わない）
+    fn instantiate(&mut self, class: Rc<Class>, mut args: Vec<Value>) -> Result<ControlFlow, String> {
+        let instance = Value::Instance(Rc::new(Instance::new(class.clone())));
+        match class.initializer() {
+            Some(initializer) => {
+                args.insert(0, instance.clone());
+                if let ControlFlow::Throw(value) = self.call_value(initializer.clone(), args)? {
+                    return Ok(ControlFlow::Throw(value));
+                }
             }
-            Value::Dictionary(dict) => {
-                let key = idx.to_string();
-                dict.borrow_mut().insert(key, value.clone());
-                Ok(value)
+            None if !args.is_empty() => {
+                return Err(format!("{}() takes no arguments, got {}", class.name, args.len()));
             }
-            _ => Err(format!("Cannot index assign to {}", obj.type_name())),
+            None => {}
         }
+        Ok(ControlFlow::Normal(instance))
+    }
+
+    /// 2つのノードが同じ変数を指すか
+    fn same_variable(ast: &Ast, a: NodeId, b: NodeId) -> bool {
+        match (ast.node(a), ast.node(b)) {
+            (ASTNode::Identifier(x), ASTNode::Identifier(y)) => x == y,
+            (ASTNode::GlobalVariable { name: x }, ASTNode::GlobalVariable { name: y }) => x == y,
+            (ASTNode::LocalVariable { depth: d1, slot: s1, .. }, ASTNode::LocalVariable { depth: d2, slot: s2, .. }) => {
+                d1 == d2 && s1 == s2
+            }
+            _ => false,
+        }
+    }
+
+    /// 変数に保存
+    fn store_variable(&self, ast: &Ast, target: NodeId, value: Value) -> Result<(), String> {
+        match ast.node(target) {
+            ASTNode::Identifier(name) => self.current_env.assign(name, value),
+            ASTNode::LocalVariable { name, depth, slot } => self.current_env.assign_slot(*depth, *slot, name, value),
+            ASTNode::GlobalVariable { name } => self.global_env.assign(name, value),
+            _ => Err("Invalid assignment target".to_string()),
+        }
+    }
+
+    /// 変数を演算結果で更新（x += y・x = x + y）
+    /// 加算では先に変数から値を外しておき、共有されていない文字列ならその場で追記する
+    fn update_variable(&mut self, ast: &Ast, target: NodeId, mut current: Value, operator: BinaryOperator, operand: Value) -> Result<Value, String> {
+        let result = match operator {
+            BinaryOperator::Add => {
+                if matches!(current, Value::String(_)) {
+                    self.store_variable(ast, target, Value::Null)?;
+                }
+                current.add_assign(&operand)?;
+                current
+            }
+            BinaryOperator::Subtract => current.subtract(&operand)?,
+            BinaryOperator::Multiply => current.multiply(&operand)?,
+            BinaryOperator::Divide => current.divide(&operand)?,
+            BinaryOperator::Modulo => current.modulo(&operand)?,
+            _ => return Err(format!("Unsupported compound assignment operator: {}", operator)),
+        };
+        self.store_variable(ast, target, result.clone())?;
+        Ok(result)
+    }
+
+    /// インデックスへの代入
+    fn eval_index_assignment(&mut self, ast: &Rc<Ast>, object: NodeId, index: NodeId, value: Value) -> Result<ControlFlow, String> {
+        let obj = eval_value!(self, ast, object);
+        let idx = eval_value!(self, ast, index);
+        obj.set_index(&idx, value.clone())?;
+        Ok(ControlFlow::Normal(value))
     }
 
     /// メンバーへの代入
-    fn eval_member_assignment(&mut self, object: &ASTNode, member: &str, value: Value) -> Result<Value, String> {
-        let obj = self.eval_node(object)?;
+    fn eval_member_assignment(&mut self, ast: &Rc<Ast>, object: NodeId, member: &str, cache: &InlineCache, value: Value) -> Result<ControlFlow, String> {
+        let obj = eval_value!(self, ast, object);
 
         match obj {
             Value::Dictionary(dict) => {
-                dict.borrow_mut().insert(member.to_string(), value.clone());
-                Ok(value)
+                dict.borrow_mut().insert(Key::from(member), value.clone());
+                Ok(ControlFlow::Normal(value))
             }
-            Value::Instance { fields, .. } => {
-                fields.borrow_mut().insert(member.to_string(), value.clone());
-                Ok(value)
+            Value::Instance(instance) => {
+                instance.set(member, value.clone(), cache);
+                Ok(ControlFlow::Normal(value))
             }
             _ => Err(format!("Cannot set member on {}", obj.type_name())),
         }
@@ -525,7 +935,7 @@ mod tests {
     use crate::parser::Parser;
 
     fn parse_and_eval(source: &str) -> Result<Value, String> {
-        let lexer = Lexer::new(source.to_string());
+        let lexer = Lexer::new(source);
         let tokens = lexer.tokenize().map_err(|e| format!("Lexer error: {}", e))?;
 
         let parser = Parser::new(tokens);
@@ -535,6 +945,16 @@ mod tests {
         interpreter.evaluate(ast)
     }
 
+    /// 組み込み関数を登録して評価
+    fn eval_with_builtins(source: &str) -> Result<Value, String> {
+        let tokens = Lexer::new(source).tokenize().unwrap();
+        let ast = Parser::new(tokens).parse().unwrap();
+
+        let mut interpreter = Interpreter::new();
+        crate::builtins::setup_builtins(&*interpreter.global_env());
+        interpreter.evaluate(ast)
+    }
+
     #[test]
     fn test_arithmetic() {
         let result = parse_and_eval("2 + 3 * 4").unwrap();
@@ -550,7 +970,7 @@ mod tests {
     #[test]
     fn test_string_concat() {
         let result = parse_and_eval("\"Hello, \" + \"World!\"").unwrap();
-        assert_eq!(result, Value::String("Hello, World!".to_string()));
+        assert_eq!(result, Value::String("Hello, World!".into()));
     }
 
     #[test]
@@ -577,4 +997,525 @@ mod tests {
         assert!(result.is_err());
         assert!(result.unwrap_err().contains("Cannot assign to constant"));
     }
+
+    #[test]
+    fn test_function_locals_and_closure() {
+        let source = r#"
+fun make_adder(n) {
+    let base = n * 2
+    fun add(x) {
+        x + base
+    }
+    base = base + 1
+    add
+}
+let f = make_adder(10)
+f(1)
+"#;
+        // addはmake_adderのフレーム（depth=1）のbaseを参照する
+        let result = parse_and_eval(source).unwrap();
+        assert_eq!(result, Value::Number(22.0));
+    }
+
+    #[test]
+    fn test_lambda() {
+        let source = r#"
+fun make_adder(n) {
+    return lambda(x) { x + n }
+}
+let add5 = make_adder(5)
+let square = lambda(x) { x * x }
+let ops = [square, lambda(x) { x - 1 }, add5]
+let value = 3
+for (op in ops) {
+    value = op(value)
+}
+let pair = lambda(a, b) {
+    let first = a * 10;
+    [first, b]
+}
+str(value) + str(list(map(lambda(x) { x * 2 }, [1, 2, 3]))) + str(pair(1, 2)) + str((lambda() { 7 })())
+"#;
+        assert_eq!(eval_with_builtins(source).unwrap().to_string(), "13[2, 4, 6][10, 2]7");
+        assert!(eval_with_builtins("let f = lambda() {\n yield 1\n}").unwrap_err().contains("lambda cannot yield"));
+    }
+
+    #[test]
+    fn test_function_body_is_shared_not_copied() {
+        let source = r#"
+fun f() {
+    1
+}
+let g = f
+g
+"#;
+        let value = parse_and_eval(source).unwrap();
+        let function = match value {
+            Value::Function(function) => function,
+            other => panic!("Expected function, got {:?}", other),
+        };
+
+        // 関数値はプログラム全体の構文木を共有している
+        assert!(Rc::strong_count(&function.ast) >= 1);
+        assert_eq!(function.parameters().len(), 0);
+        assert!(matches!(function.ast.node(function.body()[0]), ASTNode::Number(n) if *n == 1.0));
+    }
+
+    #[test]
+    fn test_return_value() {
+        let source = r#"
+fun fib(n) {
+    if n < 2 {
+        return n
+    }
+    return fib(n - 1) + fib(n - 2)
+}
+fib(15)
+"#;
+        let result = parse_and_eval(source).unwrap();
+        assert_eq!(result, Value::Number(610.0));
+    }
+
+    #[test]
+    fn test_early_return_from_loop() {
+        let source = r#"
+fun find(limit) {
+    let i = 0
+    while true {
+        if i * i > limit {
+            return i
+        }
+        i = i + 1
+    }
+}
+find(50)
+"#;
+        let result = parse_and_eval(source).unwrap();
+        assert_eq!(result, Value::Number(8.0));
+    }
+
+    #[test]
+    fn test_break_and_continue() {
+        let source = r#"
+let i = 0
+let total = 0
+while i < 100 {
+    i = i + 1
+    if i % 2 == 0 {
+        continue
+    }
+    if i > 9 {
+        break
+    }
+    total = total + i
+}
+total
+"#;
+        // 1 + 3 + 5 + 7 + 9
+        let result = parse_and_eval(source).unwrap();
+        assert_eq!(result, Value::Number(25.0));
+    }
+
+    #[test]
+    fn test_break_only_exits_inner_loop() {
+        let source = r#"
+let count = 0
+for (x in [1, 2, 3]) {
+    for (y in [1, 2, 3]) {
+        if y == 2 {
+            break
+        }
+        count = count + 1
+    }
+}
+count
+"#;
+        let result = parse_and_eval(source).unwrap();
+        assert_eq!(result, Value::Number(3.0));
+    }
+
+    #[test]
+    fn test_for_loops() {
+        let result = eval_with_builtins(r#"
+let total = 0
+for (i in range(10, 0, -2)) {
+    total = total + i
+}
+for (c in "ab") {
+    total = total + len(c)
+}
+for (k in {"a": 1, "b": 2}) {
+    total = total + len(k) * 100
+}
+total
+"#).unwrap();
+        assert_eq!(result, Value::Number(30.0 + 2.0 + 200.0));
+
+        // リストは要素を1つずつ借りるので、本体でリストを変更できる
+        let result = eval_with_builtins(r#"
+let items = [1, 2]
+let count = 0
+for (x in items) {
+    if x < 3 {
+        push(items, x + 2)
+    }
+    count = count + 1
+}
+count
+"#).unwrap();
+        assert_eq!(result, Value::Number(4.0));
+    }
+
+    #[test]
+    fn test_range_is_lazy() {
+        assert_eq!(eval_with_builtins("len(range(0, 10000000000000))").unwrap(), Value::Number(1e13));
+        assert_eq!(eval_with_builtins("range(0, 100, 7)[3]").unwrap(), Value::Number(21.0));
+        assert_eq!(eval_with_builtins("list(range(0, 3))").unwrap().to_string(), "[0, 1, 2]");
+        assert!(eval_with_builtins("range(0, 3, 0)").unwrap_err().contains("must not be zero"));
+    }
+
+    #[test]
+    fn test_string_append_and_index() {
+        let result = eval_with_builtins(r#"
+let s = "こんにちは"
+let alias = s
+let i = 0
+while i < 3 {
+    s = s + "!"
+    s += "?"
+    i += 1
+}
+[s, alias, s[4], s[6], len(s)]
+"#).unwrap();
+        assert_eq!(result.to_string(), "[こんにちは!?!?!?, こんにちは, は, ?, 11]");
+        assert!(eval_with_builtins("let xs = [1]\nxs[0] += 1").unwrap_err().contains("must be a variable"));
+    }
+
+    #[test]
+    fn test_arrays() {
+        assert_eq!(eval_with_builtins("array([1, 2, 3]) * 2 - 1").unwrap().to_string(), "array([1, 3, 5])");
+        assert_eq!(eval_with_builtins("slice(array(range(0, 10)), 2, 5)[1]").unwrap(), Value::Number(3.0));
+        assert_eq!(eval_with_builtins("min(array([3, 1, 2])) + max([3, 1, 2]) + min(4, 5)").unwrap(), Value::Number(8.0));
+        assert_eq!(eval_with_builtins("len(array(range(0, 5)))").unwrap(), Value::Number(5.0));
+        assert!(eval_with_builtins("array([1, \"a\"])").unwrap_err().contains("list of numbers"));
+        assert!(eval_with_builtins("mean(array([]))").unwrap_err().contains("empty"));
+    }
+
+    #[test]
+    fn test_classes() {
+        let result = eval_with_builtins(r#"
+class Shape {
+    fun __init__(self, name) {
+        self.name = name
+    }
+    fun area(self) {
+        return 0
+    }
+    fun describe(self) {
+        return self.name + ":" + str(self.area())
+    }
+}
+class Square extends Shape {
+    fun __init__(self, side) {
+        self.name = "square"
+        self.side = side
+    }
+    fun area(self) {
+        return self.side * self.side
+    }
+}
+let out = ""
+for (shape in [new Shape("blob"), new Square(3), Square(2)]) {
+    out += shape.describe() + " "
+}
+out
+"#).unwrap();
+        assert_eq!(result.to_string(), "blob:0 square:9 square:4 ");
+
+        // フィールドは代入で増え、メソッドと同名のフィールドはメソッドより優先する
+        let result = eval_with_builtins(r#"
+class Counter {
+    fun bump(self) {
+        self.count = self.count + 1
+        return self
+    }
+}
+let c = new Counter()
+c.count = 0
+c.bump().bump()
+fun field() {
+    return "field"
+}
+c.bump = field
+str(c.count) + c.bump()
+"#);
+        assert_eq!(result.unwrap().to_string(), "2field");
+
+        assert!(eval_with_builtins("class A {}\nnew A(1)").unwrap_err().contains("takes no arguments"));
+        assert!(eval_with_builtins("class A {}\nnew A().x").unwrap_err().contains("Property 'x' not found"));
+        assert!(eval_with_builtins("let B = 1\nclass A extends B {}").unwrap_err().contains("Superclass"));
+    }
+
+    #[test]
+    fn test_dictionaries() {
+        // 数値と文字列のキーは区別し、挿入順に反復する
+        let result = eval_with_builtins(r#"
+let d = {2: "two", "2": "string", true: "yes"}
+d[1] = "one"
+str(d[2]) + str(d["2"]) + str(d[true]) + str(keys(d))
+"#);
+        assert_eq!(result.unwrap().to_string(), "twostringyes[2, 2, true, 1]");
+
+        let result = eval_with_builtins(r#"
+let words = ["b", "a", "b", "c", "a", "b"]
+let counts = {w: 0 for w in words}
+for (w in words) {
+    counts[w] = counts[w] + 1
+}
+let squares = [i * i for i in range(0, 6) if i % 2 == 0]
+str(counts) + str(squares) + str({i: i * 10 for i in range(0, 3)}[2])
+"#);
+        assert_eq!(result.unwrap().to_string(), "{b: 3, a: 2, c: 1}[0, 4, 16]20");
+
+        assert!(eval_with_builtins("let d = {}\nd[[1]] = 2").unwrap_err().contains("Unhashable"));
+        assert!(eval_with_builtins("{1: 2}[\"1\"]").unwrap_err().contains("Key '1' not found"));
+    }
+
+    #[test]
+    fn test_list_builtins() {
+        let result = eval_with_builtins(r#"
+let xs = [3, -1, 2]
+extend(xs, range(0, 2))
+extend(xs, xs)
+let words = split("pear fig banana kiwi", " ")
+sort(words, len)
+let ys = [5, 1, 4]
+sort(ys)
+reverse(ys)
+str(xs) + str(words) + str(ys) + str(list(map(abs, [-1, 2, -3]))) + str(list(filter(bool, [0, 1, "", "a"])))
+"#);
+        assert_eq!(
+            result.unwrap().to_string(),
+            "[3, -1, 2, 0, 1, 3, -1, 2, 0, 1][fig, pear, kiwi, banana][5, 4, 1][1, 2, 3][1, a]"
+        );
+
+        assert!(eval_with_builtins("sort([1, \"a\"])").unwrap_err().contains("Cannot compare"));
+        assert!(eval_with_builtins("map(1, [1])").unwrap_err().contains("not callable"));
+    }
+
+    #[test]
+    fn test_sort_with_user_key() {
+        // ユーザー定義の key は map と同じく要素ごとに1回だけ呼ぶ
+        let result = eval_with_builtins(r#"
+let words = split("pear fig banana kiwi", " ")
+sort(words, lambda(w) { 0 - len(w) })
+fun last(w) {
+    return w[len(w) - 1]
+}
+let ys = ["ab", "ca", "bb"]
+sort(ys, last)
+let calls = 0
+let zs = [3, 1, 2]
+sort(zs, lambda(x) {
+    calls = calls + 1
+    x
+})
+str(words) + str(ys) + str(zs) + str(calls)
+"#);
+        assert_eq!(result.unwrap().to_string(), "[banana, pear, kiwi, fig][ca, ab, bb][1, 2, 3]3");
+
+        let error = eval_with_builtins("sort([1, 2], lambda(x) { x + null })").unwrap_err();
+        assert!(error.contains("Cannot add"), "{}", error);
+        assert!(eval_with_builtins("sort([1, 2], 3)").unwrap_err().contains("not callable"));
+    }
+
+    #[test]
+    fn test_append_is_push() {
+        let result = eval_with_builtins("let xs = [1]\nappend(xs, 2)\npush(xs, 3)\nstr(xs)");
+        assert_eq!(result.unwrap().to_string(), "[1, 2, 3]");
+        assert!(eval_with_builtins("append(1, 2)").unwrap_err().contains("Cannot push to"));
+    }
+
+    #[test]
+    fn test_generators() {
+        let result = eval_with_builtins(r#"
+fun squares(n) {
+    for (i in range(0, n)) {
+        yield i * i
+    }
+}
+fun evens() {
+    let i = 0
+    while i < 10 {
+        yield i
+        i = i + 2
+    }
+}
+let total = 0
+for (x in squares(4)) {
+    total = total + x
+}
+fun double(x) {
+    return x * 2
+}
+let doubled = list(map(double, take(evens(), 3)))
+let pairs = list(zip(squares(3), (w + "!" for w in ["a", "b", "c", "d"])))
+str(total) + str(doubled) + str(pairs) + str([x for x in filter(double, evens()) if x > 4])
+"#);
+        assert_eq!(result.unwrap().to_string(), "14[0, 4, 8][[0, a!], [1, b!], [4, c!]][6, 8]");
+
+        // 終わらないジェネレータは止まらずに待ち続けるのではなくエラーになる
+        let error = eval_with_builtins(r#"
+fun nat() {
+    let i = 0
+    while true {
+        yield i
+        i = i + 1
+    }
+}
+fun sq(x) {
+    return x * x
+}
+list(take(map(sq, nat()), 4))
+"#).unwrap_err();
+        assert!(error.contains("infinite generators require the bytecode VM"), "{}", error);
+    }
+
+    #[test]
+    fn test_async() {
+        // 2つの sleep は並行に進むので、合わせて約0.2秒で終わる
+        let started = std::time::Instant::now();
+        let result = eval_with_builtins(r#"
+async fun work(name, seconds) {
+    await sleep(seconds)
+    return name + "!"
+}
+async fun twice(name) {
+    let first = await work(name, 0.1)
+    return first + await work(name, 0.1)
+}
+fun double(x) {
+    return x * 2
+}
+let a = twice("a")
+let b = twice("b")
+let both = await gather(a, b)
+str(both) + str(task_done(a)) + str(await spawn(double, 21)) + str(await timeout(work("c", 0), 1))
+"#);
+        assert_eq!(result.unwrap().to_string(), "[a!a!, b!b!]true42c!");
+        assert!(started.elapsed() < std::time::Duration::from_millis(350));
+
+        // 期限切れの await はそこで入れ子のイベントループを抜ける（sleep(5) を待たない）
+        let started = std::time::Instant::now();
+        let source = "async fun slow() {\n await sleep(5)\n}\nawait timeout(slow(), 0.05)";
+        assert_eq!(eval_with_builtins(source).unwrap_err(), "Task slow timed out after 0.05 seconds");
+        assert!(started.elapsed() < std::time::Duration::from_secs(1));
+
+        let source = "async fun bad() {\n await sleep(0)\n return 1 + null\n}\nasync fun outer() {\n return await bad()\n}\nawait outer()";
+        assert!(eval_with_builtins(source).unwrap_err().contains("Cannot add number and null"));
+        let source = "let t = null\nasync fun me() {\n return await t\n}\nt = me()\nawait t";
+        assert!(eval_with_builtins(source).unwrap_err().contains("Deadlock: task me can never complete"));
+        assert!(eval_with_builtins("await 1").unwrap_err().contains("Cannot await number"));
+    }
+
+    #[test]
+    fn test_sleep_statement() {
+        // sleep は await したときだけ待つ（async 関数の中ではほかのタスクに譲る）
+        let started = std::time::Instant::now();
+        let source = r#"
+let start = get_time()
+async fun nap(label) {
+    await sleep(0.05)
+    return label
+}
+fun pause() {
+    await sleep(0.05)
+}
+let steps = 0
+sleep(5)
+await sleep(0.05)
+pause()
+for (i in range(0, 2)) {
+    if (i >= 0) {
+        await sleep(0.025)
+    }
+    steps = steps + 1
+}
+let both = await gather(nap("a"), nap("b"))
+let timer = sleep(5)
+str(both) + str(steps) + str(task_done(timer)) + str(get_time() - start >= 0.2)
+"#;
+        assert_eq!(eval_with_builtins(source).unwrap().to_string(), "[a, b]2falsetrue");
+        let elapsed = started.elapsed();
+        assert!(elapsed >= std::time::Duration::from_millis(200), "{:?}", elapsed);
+        assert!(elapsed < std::time::Duration::from_millis(450), "{:?}", elapsed);
+    }
+
+    #[test]
+    fn test_iterator_function() {
+        let result = eval_with_builtins(r#"
+let n = 0
+fun next() {
+    if n == 3 {
+        null
+    } else {
+        n = n + 1
+        n
+    }
+}
+let total = 0
+for (x in next) {
+    total = total * 10 + x
+}
+total
+"#).unwrap();
+        assert_eq!(result, Value::Number(123.0));
+    }
+
+    #[test]
+    fn test_break_outside_loop() {
+        let source = r#"
+fun f() {
+    break
+}
+f()
+"#;
+        let result = parse_and_eval(source);
+        assert!(result.unwrap_err().contains("'break' outside loop"));
+    }
+
+    #[test]
+    fn test_throw_and_catch() {
+        // パーサーは throw / try をまだ解析しないので構文木を直接組み立てる
+        // try { throw "boom" } catch (e) { e }  →  "boom"
+        let mut ast = Ast::new();
+        let message = ast.push(ASTNode::String("boom".to_string()));
+        let throw = ast.push(ASTNode::ThrowStatement { value: message });
+        let caught = ast.push(ASTNode::Identifier("e".to_string()));
+        let try_body = ast.push_list([throw]);
+        let catch_body = ast.push_list([caught]);
+        let try_catch = ast.push(ASTNode::TryCatch {
+            try_body,
+            catch_variable: Some("e".to_string()),
+            catch_body,
+            finally_body: None,
+            catch_slot: None,
+        });
+        let read = ast.push(ASTNode::Identifier("e".to_string()));
+        ast.set_root(vec![try_catch, read]);
+
+        let result = Interpreter::new().evaluate(ast).unwrap();
+        assert_eq!(result, Value::String("boom".into()));
+    }
+
+    #[test]
+    fn test_uncaught_throw() {
+        let mut ast = Ast::new();
+        let message = ast.push(ASTNode::String("boom".to_string()));
+        let throw = ast.push(ASTNode::ThrowStatement { value: message });
+        ast.set_root(vec![throw]);
+
+        let result = Interpreter::new().evaluate(ast);
+        assert_eq!(result.unwrap_err(), "Uncaught exception: boom");
+    }
 }
@@ -0,0 +1,456 @@
+/// 遅延イテレータ
+/// range() は要素を持たない Range を返し、for 文（VMでは GetIter/ForIter）は
+/// そこから1要素ずつ取り出す（range(0, 10000000) を回してもメモリは一定）。
+/// リスト・文字列・辞書・ユーザー定義のイテレータ関数・ジェネレータも同じ方法で回す。
+/// map・filter・take・zip は元のイテレータを包み、求められるたびに1要素ずつ引き出す。
+
+use crate::array::NumArray;
+use crate::dict::Key;
+use crate::generator::Generator;
+use crate::string::Str;
+use crate::value::Value;
+use std::cell::RefCell;
+use std::rc::Rc;
+
+/// 整数の範囲 start..end（step 刻み、end は含まない）
+#[derive(Debug, Clone, Copy, PartialEq)]
+pub struct Range {
+    pub start: i64,
+    pub end: i64,
+    pub step: i64,
+}
+
+impl Range {
+    /// 範囲を作成（step は 0 以外）
+    pub fn new(start: i64, end: i64, step: i64) -> Result<Range, String> {
+        if step == 0 {
+            return Err("range() step must not be zero".to_string());
+        }
+        Ok(Range { start, end, step })
+    }
+
+    /// 要素数
+    pub fn len(&self) -> usize {
+        let (start, end, step) = (self.start as i128, self.end as i128, self.step as i128);
+        let span = if step > 0 { end - start } else { start - end };
+        if span <= 0 {
+            return 0;
+        }
+        let step = step.abs();
+        ((span + step - 1) / step).min(usize::MAX as i128) as usize
+    }
+
+    /// 要素がないか
+    pub fn is_empty(&self) -> bool {
+        self.len() == 0
+    }
+
+    /// index 番目の要素
+    pub fn get(&self, index: usize) -> Option<i64> {
+        if index < self.len() {
+            Some(self.start + index as i64 * self.step)
+        } else {
+            None
+        }
+    }
+}
+
+/// 反復の状態
+#[derive(Debug)]
+pub enum Iter {
+    /// 範囲（次の要素の位置と要素数だけを持つ）
+    Range { range: Range, index: usize, len: usize },
+
+    /// リスト（要素は1つずつ借りる。ループ中の追加・削除も見える）
+    List { list: Rc<RefCell<Vec<Value>>>, index: usize },
+
+    /// 数値配列
+    Array { array: Rc<NumArray>, index: usize },
+
+    /// 文字列の文字（バイト位置で進める）
+    Chars { string: Str, offset: usize },
+
+    /// 辞書のキー（反復開始時点のキー）
+    Keys { keys: std::vec::IntoIter<Value> },
+
+    /// ユーザー定義のイテレータ関数（引数なしで呼ぶたびに次の要素を返し、null で終わる）
+    Function(Value),
+
+    /// ジェネレータ（再開するたびに yield された値が次の要素になる）
+    Generator(Rc<Generator>),
+
+    /// map(f, xs): 要素に関数を適用する（calling は f の呼び出しの結果を待っているか）
+    Map { function: Value, source: Rc<RefCell<Iter>>, calling: bool },
+
+    /// filter(f, xs): 関数が真を返す要素だけ（candidate は f の呼び出しの結果を待っている要素）
+    Filter { function: Value, source: Rc<RefCell<Iter>>, candidate: Option<Value> },
+
+    /// take(xs, n): 先頭の n 要素
+    Take { source: Rc<RefCell<Iter>>, remaining: usize },
+
+    /// zip(xs, ys, ...): 各イテレータから1要素ずつ取ったリスト（items はそろった分）
+    Zip { sources: Vec<Rc<RefCell<Iter>>>, items: Vec<Value> },
+}
+
+/// 1ステップの結果
+#[derive(Debug)]
+pub enum Step {
+    /// 次の要素
+    Item(Value),
+
+    /// 尽きた
+    Done,
+
+    /// 関数を呼び出し、その結果を complete に渡す（呼び出しは実行エンジンが行う）
+    Call(Value, Vec<Value>),
+
+    /// ジェネレータを再開し、yield された値（終わったら None）を complete に渡す
+    Resume(Rc<Generator>),
+}
+
+impl Iter {
+    /// 値を反復する状態を作成
+    pub fn new(value: &Value) -> Result<Iter, String> {
+        Ok(match value {
+            Value::Range(range) => Iter::Range { range: **range, index: 0, len: range.len() },
+            Value::List(list) => Iter::List { list: list.clone(), index: 0 },
+            Value::Array(array) => Iter::Array { array: array.clone(), index: 0 },
+            Value::String(string) => Iter::Chars { string: string.clone(), offset: 0 },
+            Value::Dictionary(dict) => Iter::Keys { keys: dict.borrow().keys().map(Key::to_value).collect::<Vec<_>>().into_iter() },
+            Value::Function(_) | Value::Closure(_) | Value::NativeFunction(_) => Iter::Function(value.clone()),
+            _ => return Err(format!("Cannot iterate over {}", value.type_name())),
+        })
+    }
+
+    /// 残りの要素数の見積もり（結果を確保する大きさ、分からなければ 0）
+    pub fn len_hint(&self) -> usize {
+        match self {
+            Iter::Range { index, len, .. } => len - index,
+            Iter::List { list, index } => list.borrow().len().saturating_sub(*index),
+            Iter::Array { array, index } => array.len().saturating_sub(*index),
+            Iter::Chars { string, offset } => string.len() - offset,
+            Iter::Keys { keys } => keys.len(),
+            Iter::Map { source, .. } => source.borrow().len_hint(),
+            Iter::Take { source, remaining } => source.borrow().len_hint().min(*remaining),
+            Iter::Zip { sources, .. } => sources.iter().map(|source| source.borrow().len_hint()).min().unwrap_or(0),
+            Iter::Function(_) | Iter::Generator(_) | Iter::Filter { .. } => 0,
+        }
+    }
+
+    /// 要素を取り出すのに実行エンジンの助け（ユーザー定義の関数の呼び出し・ジェネレータの再開）が要るか
+    pub fn needs_engine(&self) -> bool {
+        match self {
+            Iter::Function(_) | Iter::Generator(_) => true,
+            Iter::Map { function, source, .. } | Iter::Filter { function, source, .. } => {
+                !matches!(function, Value::NativeFunction(_)) || source.borrow().needs_engine()
+            }
+            Iter::Take { source, .. } => source.borrow().needs_engine(),
+            Iter::Zip { sources, .. } => sources.iter().any(|source| source.borrow().needs_engine()),
+            _ => false,
+        }
+    }
+
+    /// 次の要素を取り出す
+    /// Call・Resume が返ったら、実行エンジンが呼び出し・再開の結果を complete に渡して続ける
+    #[inline]
+    pub fn next(&mut self) -> Result<Step, String> {
+        Ok(match self {
+            Iter::Range { range, index, len } => {
+                if *index >= *len {
+                    return Ok(Step::Done);
+                }
+                let value = range.start + *index as i64 * range.step;
+                *index += 1;
+                Step::Item(Value::Number(value as f64))
+            }
+            Iter::List { list, index } => match list.borrow().get(*index) {
+                Some(value) => {
+                    *index += 1;
+                    Step::Item(value.clone())
+                }
+                None => Step::Done,
+            },
+            Iter::Array { array, index } => match array.get(*index) {
+                Some(value) => {
+                    *index += 1;
+                    Step::Item(Value::Number(value))
+                }
+                None => Step::Done,
+            },
+            Iter::Chars { string, offset } => match string[*offset..].chars().next() {
+                Some(ch) => {
+                    *offset += ch.len_utf8();
+                    Step::Item(Value::String(Str::from(ch)))
+                }
+                None => Step::Done,
+            },
+            Iter::Keys { keys } => match keys.next() {
+                Some(key) => Step::Item(key),
+                None => Step::Done,
+            },
+            Iter::Function(function) => Step::Call(function.clone(), Vec::new()),
+            Iter::Generator(generator) => Step::Resume(generator.clone()),
+            Iter::Map { function, source, calling } => {
+                let step = source.borrow_mut().next()?;
+                map_step(function, calling, step)?
+            }
+            Iter::Filter { function, source, candidate } => {
+                let step = source.borrow_mut().next()?;
+                filter_step(function, source, candidate, step)?
+            }
+            Iter::Take { source, remaining } => {
+                if *remaining == 0 {
+                    return Ok(Step::Done);
+                }
+                *remaining -= 1;
+                source.borrow_mut().next()?
+            }
+            Iter::Zip { sources, items } => {
+                items.clear();
+                let step = sources[0].borrow_mut().next()?;
+                zip_step(sources, items, step)?
+            }
+        })
+    }
+
+    /// 直前の next・complete が返した Call の戻り値、Resume の結果を渡して続ける
+    pub fn complete(&mut self, result: Option<Value>) -> Result<Step, String> {
+        Ok(match self {
+            Iter::Function(_) => match result.and_then(function_step) {
+                Some(item) => Step::Item(item),
+                None => Step::Done,
+            },
+            Iter::Generator(_) => match result {
+                Some(item) => Step::Item(item),
+                None => Step::Done,
+            },
+            Iter::Map { function, source, calling } => {
+                if std::mem::take(calling) {
+                    Step::Item(result.unwrap_or(Value::Null))
+                } else {
+                    let step = source.borrow_mut().complete(result)?;
+                    map_step(function, calling, step)?
+                }
+            }
+            Iter::Filter { function, source, candidate } => {
+                let step = match candidate.take() {
+                    Some(item) if result.as_ref().is_some_and(Value::is_truthy) => return Ok(Step::Item(item)),
+                    Some(_) => source.borrow_mut().next()?,
+                    None => source.borrow_mut().complete(result)?,
+                };
+                filter_step(function, source, candidate, step)?
+            }
+            Iter::Take { source, .. } => source.borrow_mut().complete(result)?,
+            Iter::Zip { sources, items } => {
+                let step = sources[items.len()].borrow_mut().complete(result)?;
+                zip_step(sources, items, step)?
+            }
+            _ => return Err("Iterator is not waiting for a call".to_string()),
+        })
+    }
+}
+
+/// map の元の要素に関数を適用する（組み込み関数はその場で呼び、それ以外は呼び出しを実行エンジンに頼む）
+fn map_step(function: &Value, calling: &mut bool, step: Step) -> Result<Step, String> {
+    match step {
+        Step::Item(item) => match function {
+            Value::NativeFunction(native) => Ok(Step::Item((native.function)(vec![item])?)),
+            function => {
+                *calling = true;
+                Ok(Step::Call(function.clone(), vec![item]))
+            }
+        },
+        step => Ok(step),
+    }
+}
+
+/// filter の元の要素を関数で調べ、真になる要素が見つかるまで進める
+fn filter_step(
+    function: &Value,
+    source: &Rc<RefCell<Iter>>,
+    candidate: &mut Option<Value>,
+    mut step: Step,
+) -> Result<Step, String> {
+    loop {
+        let item = match step {
+            Step::Item(item) => item,
+            step => return Ok(step),
+        };
+        match function {
+            Value::NativeFunction(native) => {
+                if (native.function)(vec![item.clone()])?.is_truthy() {
+                    return Ok(Step::Item(item));
+                }
+            }
+            function => {
+                let call = Step::Call(function.clone(), vec![item.clone()]);
+                *candidate = Some(item);
+                return Ok(call);
+            }
+        }
+        step = source.borrow_mut().next()?;
+    }
+}
+
+/// zip の各イテレータから要素を集め、そろったらリストにする（どれかが尽きたら終わり）
+fn zip_step(sources: &[Rc<RefCell<Iter>>], items: &mut Vec<Value>, mut step: Step) -> Result<Step, String> {
+    loop {
+        match step {
+            Step::Item(item) => items.push(item),
+            Step::Done => {
+                items.clear();
+                return Ok(Step::Done);
+            }
+            step => return Ok(step),
+        }
+        if items.len() == sources.len() {
+            let row = std::mem::replace(items, Vec::with_capacity(sources.len()));
+            return Ok(Step::Item(Value::List(Rc::new(RefCell::new(row)))));
+        }
+        step = sources[items.len()].borrow_mut().next()?;
+    }
+}
+
+/// 値のイテレータ（イテレータはそのまま、それ以外は新しく作る）
+pub fn iterate(value: Value) -> Result<Value, String> {
+    match value {
+        Value::Iterator(_) => Ok(value),
+        _ => Ok(Value::Iterator(Rc::new(RefCell::new(Iter::new(&value)?)))),
+    }
+}
+
+/// map(f, xs) と同じく要素に関数を適用するイテレータ（sort のキーを実行エンジンが求めるときに使う）
+pub fn map(function: Value, items: &Value) -> Result<Value, String> {
+    Ok(Value::Iterator(Rc::new(RefCell::new(Iter::Map { function, source: source(items.clone())?, calling: false }))))
+}
+
+/// 値を反復する共有の状態（map・filter などが包む元のイテレータ）
+pub fn source(value: Value) -> Result<Rc<RefCell<Iter>>, String> {
+    match iterate(value)? {
+        Value::Iterator(iterator) => Ok(iterator),
+        _ => unreachable!(),
+    }
+}
+
+/// ユーザー定義のイテレータ関数の戻り値（null なら尽きた）
+#[inline]
+fn function_step(result: Value) -> Option<Value> {
+    match result {
+        Value::Null => None,
+        value => Some(value),
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn collect(value: Value) -> Vec<Value> {
+        let iterator = iterate(value).unwrap();
+        let mut items = Vec::new();
+        if let Value::Iterator(iter) = iterator {
+            while let Step::Item(item) = iter.borrow_mut().next().unwrap() {
+                items.push(item);
+            }
+        }
+        items
+    }
+
+    fn numbers(values: &[i64]) -> Vec<Value> {
+        values.iter().map(|&n| Value::Number(n as f64)).collect()
+    }
+
+    #[test]
+    fn test_range_len_and_get() {
+        assert_eq!(Range::new(0, 10, 1).unwrap().len(), 10);
+        assert_eq!(Range::new(0, 10, 3).unwrap().len(), 4);
+        assert_eq!(Range::new(10, 0, -3).unwrap().len(), 4);
+        assert_eq!(Range::new(5, 5, 1).unwrap().len(), 0);
+        assert_eq!(Range::new(5, 0, 1).unwrap().len(), 0);
+        assert_eq!(Range::new(0, 10, 3).unwrap().get(3), Some(9));
+        assert_eq!(Range::new(0, 10, 3).unwrap().get(4), None);
+        assert!(Range::new(0, 10, 0).is_err());
+    }
+
+    #[test]
+    fn test_iterate_values() {
+        let range = Value::Range(Rc::new(Range::new(10, 0, -4).unwrap()));
+        assert_eq!(collect(range), numbers(&[10, 6, 2]));
+
+        let list = Value::List(Rc::new(RefCell::new(numbers(&[1, 2]))));
+        assert_eq!(collect(list), numbers(&[1, 2]));
+
+        let string = Value::String("aé".into());
+        assert_eq!(collect(string), vec![Value::String("a".into()), Value::String("é".into())]);
+
+        assert!(iterate(Value::Number(1.0)).unwrap_err().contains("Cannot iterate over number"));
+    }
+
+    #[test]
+    fn test_iterator_is_shared() {
+        // イテレータをもう一度回すと続きから
+        let range = Value::Range(Rc::new(Range::new(0, 3, 1).unwrap()));
+        let iterator = iterate(range).unwrap();
+        if let Value::Iterator(iter) = &iterator {
+            assert!(matches!(iter.borrow_mut().next().unwrap(), Step::Item(Value::Number(n)) if n == 0.0));
+        }
+        assert_eq!(collect(iterator), numbers(&[1, 2]));
+    }
+
+    fn negate(args: Vec<Value>) -> Result<Value, String> {
+        Ok(Value::Number(-args[0].as_number()?))
+    }
+
+    fn is_even(args: Vec<Value>) -> Result<Value, String> {
+        Ok(Value::Boolean(args[0].as_number()? % 2.0 == 0.0))
+    }
+
+    #[test]
+    fn test_adapters_pull_one_element_at_a_time() {
+        // 組み込み関数だけなら実行エンジンなしで回せる
+        let naturals = || source(Value::Range(Rc::new(Range::new(0, i64::MAX, 1).unwrap()))).unwrap();
+        let evens = Rc::new(RefCell::new(Iter::Filter {
+            function: Value::native("is_even", 1, is_even),
+            source: naturals(),
+            candidate: None,
+        }));
+        let negated = Rc::new(RefCell::new(Iter::Map {
+            function: Value::native("negate", 1, negate),
+            source: naturals(),
+            calling: false,
+        }));
+        let zipped = Rc::new(RefCell::new(Iter::Zip { sources: vec![evens, negated], items: Vec::new() }));
+        let taken = Iter::Take { source: zipped, remaining: 3 };
+        assert!(!taken.needs_engine());
+
+        let rows: Vec<String> = collect(Value::Iterator(Rc::new(RefCell::new(taken))))
+            .iter()
+            .map(Value::to_string)
+            .collect();
+        assert_eq!(rows, ["[0, 0]", "[2, -1]", "[4, -2]"]);
+    }
+
+    #[test]
+    fn test_user_function_is_called_by_engine() {
+        // 組み込み関数以外はユーザー定義の関数として扱う（ここでは Null を代わりに使う）
+        let list = Value::List(Rc::new(RefCell::new(numbers(&[7]))));
+        let mut mapped = Iter::Map { function: Value::Null, source: source(list).unwrap(), calling: false };
+        assert!(mapped.needs_engine());
+        // 呼び出しを頼まれ、結果を渡すとそれが要素になる
+        assert!(matches!(mapped.next().unwrap(), Step::Call(Value::Null, args) if args == numbers(&[7])));
+        assert!(matches!(mapped.complete(Some(Value::Number(49.0))).unwrap(), Step::Item(Value::Number(n)) if n == 49.0));
+        assert!(matches!(mapped.next().unwrap(), Step::Done));
+
+        // filter は結果が真なら候補を返し、偽なら次の要素で呼び出しを頼む
+        let list = Value::List(Rc::new(RefCell::new(numbers(&[1, 2]))));
+        let mut filtered = Iter::Filter { function: Value::Null, source: source(list).unwrap(), candidate: None };
+        assert!(matches!(filtered.next().unwrap(), Step::Call(_, args) if args == numbers(&[1])));
+        assert!(matches!(filtered.complete(Some(Value::Boolean(false))).unwrap(), Step::Call(_, args) if args == numbers(&[2])));
+        assert!(matches!(filtered.complete(Some(Value::Boolean(true))).unwrap(), Step::Item(Value::Number(n)) if n == 2.0));
+        assert!(matches!(filtered.next().unwrap(), Step::Done));
+
+        let mut calls = Iter::Function(Value::native("f", 0, |_| Ok(Value::Null)));
+        assert!(matches!(calls.next().unwrap(), Step::Call(_, args) if args.is_empty()));
+        assert!(matches!(calls.complete(Some(Value::Null)).unwrap(), Step::Done));
+    }
+}
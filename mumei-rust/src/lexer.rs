@@ -1,4 +1,4 @@
-use crate::token::{keyword_to_token_type, Token, TokenType};
+use crate::token::{keyword_to_token_type, Interner, Token, TokenType};
 use thiserror::Error;
 
 #[derive(Error, Debug)]
@@ -13,22 +13,33 @@ pub enum LexerError {
     InvalidNumber(usize, usize),
 }
 
-pub struct Lexer {
-    source: Vec<char>,
-    tokens: Vec<Token>,
+/// 字句解析器
+/// ソースをバイト列のまま走査し、トークンはソースのスライスを借用する。
+/// UTF-8 を解釈するのは非ASCII文字が識別子に現れたときとエラー報告のときだけ。
+pub struct Lexer<'src> {
+    source: &'src str,
+    bytes: &'src [u8],
+    tokens: Vec<Token<'src>>,
+    /// 識別子のインターン表（tokenize_interned のときだけ作る）
+    interner: Option<Interner<'src>>,
     start: usize,
+    start_column: usize,
     current: usize,
     line: usize,
     column: usize,
     indent_stack: Vec<usize>,
 }
 
-impl Lexer {
-    pub fn new(source: String) -> Self {
+impl<'src> Lexer<'src> {
+    pub fn new(source: &'src str) -> Self {
         Lexer {
-            source: source.chars().collect(),
-            tokens: Vec::new(),
+            source,
+            bytes: source.as_bytes(),
+            // トークン数はおおよそソースの1/4程度なので先に確保しておく
+            tokens: Vec::with_capacity(source.len() / 4 + 1),
+            interner: None,
             start: 0,
+            start_column: 1,
             current: 0,
             line: 1,
             column: 1,
@@ -36,21 +47,36 @@ impl Lexer {
         }
     }
 
-    /// ソースコードをトークン化
-    pub fn tokenize(mut self) -> Result<Vec<Token>, LexerError> {
+    /// ソースコードをトークン化（識別子はインターンしない）
+    pub fn tokenize(self) -> Result<Vec<Token<'src>>, LexerError> {
+        self.scan_tokens().map(|lexer| lexer.tokens)
+    }
+
+    /// ソースコードをトークン化し、識別子のインターン表も返す
+    pub fn tokenize_interned(mut self) -> Result<(Vec<Token<'src>>, Interner<'src>), LexerError> {
+        self.interner = Some(Interner::new());
+        let lexer = self.scan_tokens()?;
+        Ok((lexer.tokens, lexer.interner.unwrap_or_default()))
+    }
+
+    /// ソースの終わりまで走査してトークンを並べる
+    fn scan_tokens(mut self) -> Result<Self, LexerError> {
         while !self.is_at_end() {
             self.start = self.current;
+            self.start_column = self.column;
             self.scan_token()?;
         }
 
         // 最後にインデント解除トークンを追加
+        self.start = self.current;
+        self.start_column = self.column;
         while self.indent_stack.len() > 1 {
             self.indent_stack.pop();
             self.add_token(TokenType::Dedent);
         }
 
         self.add_token(TokenType::Eof);
-        Ok(self.tokens)
+        Ok(self)
     }
 
     fn scan_token(&mut self) -> Result<(), LexerError> {
@@ -58,8 +84,8 @@ impl Lexer {
 
         match c {
             // 空白とインデント
-            ' ' | '\t' | '\r' => Ok(()),
-            '\n' => {
+            b' ' | b'\t' | b'\r' => Ok(()),
+            b'\n' => {
                 self.add_token(TokenType::Newline);
                 self.line += 1;
                 self.column = 1;
@@ -67,108 +93,108 @@ impl Lexer {
             }
 
             // コメント
-            '#' => {
-                while self.peek() != '\n' && !self.is_at_end() {
+            b'#' => {
+                while self.peek() != b'\n' && !self.is_at_end() {
                     self.advance();
                 }
                 Ok(())
             }
 
             // 演算子と区切り文字
-            '(' => {
+            b'(' => {
                 self.add_token(TokenType::LeftParen);
                 Ok(())
             }
-            ')' => {
+            b')' => {
                 self.add_token(TokenType::RightParen);
                 Ok(())
             }
-            '{' => {
+            b'{' => {
                 self.add_token(TokenType::LeftBrace);
                 Ok(())
             }
-            '}' => {
+            b'}' => {
                 self.add_token(TokenType::RightBrace);
                 Ok(())
             }
-            '[' => {
+            b'[' => {
                 self.add_token(TokenType::LeftBracket);
                 Ok(())
             }
-            ']' => {
+            b']' => {
                 self.add_token(TokenType::RightBracket);
                 Ok(())
             }
-            ',' => {
+            b',' => {
                 self.add_token(TokenType::Comma);
                 Ok(())
             }
-            '.' => {
+            b'.' => {
                 self.add_token(TokenType::Dot);
                 Ok(())
             }
-            ';' => {
+            b';' => {
                 self.add_token(TokenType::Semicolon);
                 Ok(())
             }
-            '?' => {
+            b'?' => {
                 self.add_token(TokenType::Question);
                 Ok(())
             }
-            '@' => {
+            b'@' => {
                 self.add_token(TokenType::At);
                 Ok(())
             }
 
             // 演算子（複数文字の可能性あり）
-            '+' => {
-                if self.match_char('=') {
+            b'+' => {
+                if self.match_char(b'=') {
                     self.add_token(TokenType::PlusAssign);
                 } else {
                     self.add_token(TokenType::Plus);
                 }
                 Ok(())
             }
-            '-' => {
-                if self.match_char('=') {
+            b'-' => {
+                if self.match_char(b'=') {
                     self.add_token(TokenType::MinusAssign);
-                } else if self.match_char('>') {
+                } else if self.match_char(b'>') {
                     self.add_token(TokenType::Arrow);
                 } else {
                     self.add_token(TokenType::Minus);
                 }
                 Ok(())
             }
-            '*' => {
-                if self.match_char('*') {
-                    if self.match_char('=') {
+            b'*' => {
+                if self.match_char(b'*') {
+                    if self.match_char(b'=') {
                         self.add_token(TokenType::PowerAssign);
                     } else {
                         self.add_token(TokenType::Power);
                     }
-                } else if self.match_char('=') {
+                } else if self.match_char(b'=') {
                     self.add_token(TokenType::StarAssign);
                 } else {
                     self.add_token(TokenType::Star);
                 }
                 Ok(())
             }
-            '/' => {
-                if self.match_char('/') {
-                    if self.match_char('=') {
+            b'/' => {
+                if self.match_char(b'/') {
+                    if self.match_char(b'=') {
                         self.add_token(TokenType::FloorDivAssign);
                     } else {
                         self.add_token(TokenType::FloorDiv);
                     }
-                } else if self.match_char('=') {
+                } else if self.match_char(b'=') {
                     self.add_token(TokenType::SlashAssign);
                 } else {
                     self.add_token(TokenType::Slash);
                 }
                 Ok(())
             }
-            '%' => {
-                if self.match_char('=') {
+            b'%' => {
+                if self.match_char(b'=') {
                     self.add_token(TokenType::PercentAssign);
                 } else {
                     self.add_token(TokenType::Percent);
@@ -176,38 +202,38 @@ impl Lexer {
                 Ok(())
             }
 
-            '=' => {
-                if self.match_char('=') {
+            b'=' => {
+                if self.match_char(b'=') {
                     self.add_token(TokenType::Equal);
-                } else if self.match_char('>') {
+                } else if self.match_char(b'>') {
                     self.add_token(TokenType::FatArrow);
                 } else {
                     self.add_token(TokenType::Assign);
                 }
                 Ok(())
             }
-            '!' => {
-                if self.match_char('=') {
+            b'!' => {
+                if self.match_char(b'=') {
                     self.add_token(TokenType::NotEqual);
                     Ok(())
                 } else {
-                    Err(LexerError::UnexpectedCharacter(c, self.line, self.column))
+                    Err(LexerError::UnexpectedCharacter(c as char, self.line, self.column))
                 }
             }
-            '<' => {
-                if self.match_char('=') {
+            b'<' => {
+                if self.match_char(b'=') {
                     self.add_token(TokenType::LessEqual);
-                } else if self.match_char('<') {
+                } else if self.match_char(b'<') {
                     self.add_token(TokenType::LeftShift);
                 } else {
                     self.add_token(TokenType::Less);
                 }
                 Ok(())
             }
-            '>' => {
-                if self.match_char('=') {
+            b'>' => {
+                if self.match_char(b'=') {
                     self.add_token(TokenType::GreaterEqual);
-                } else if self.match_char('>') {
+                } else if self.match_char(b'>') {
                     self.add_token(TokenType::RightShift);
                 } else {
                     self.add_token(TokenType::Greater);
@@ -215,8 +241,8 @@ impl Lexer {
                 Ok(())
             }
 
-            ':' => {
-                if self.match_char('=') {
+            b':' => {
+                if self.match_char(b'=') {
                     self.add_token(TokenType::Walrus);
                 } else {
                     self.add_token(TokenType::Colon);
@@ -224,47 +250,60 @@ impl Lexer {
                 Ok(())
             }
 
-            '&' => {
+            b'&' => {
                 self.add_token(TokenType::BitwiseAnd);
                 Ok(())
             }
-            '|' => {
+            b'|' => {
                 self.add_token(TokenType::BitwiseOr);
                 Ok(())
             }
-            '^' => {
+            b'^' => {
                 self.add_token(TokenType::BitwiseXor);
                 Ok(())
             }
-            '~' => {
+            b'~' => {
                 self.add_token(TokenType::BitwiseNot);
                 Ok(())
             }
 
             // 文字列リテラル
-            '"' => self.string('"'),
-            '\'' => self.string('\''),
+            b'"' => self.string(b'"'),
+            b'\'' => self.string(b'\''),
 
             // 数値リテラル
             _ if c.is_ascii_digit() => self.number(),
 
             // 識別子とキーワード
-            _ if c.is_alphabetic() || c == '_' => {
+            _ if c.is_ascii_alphabetic() || c == b'_' => {
                 self.identifier();
                 Ok(())
             }
 
-            _ => Err(LexerError::UnexpectedCharacter(c, self.line, self.column)),
+            // 非ASCII文字（識別子に使える文字だけ受け付ける）
+            _ if c >= 0x80 => {
+                let ch = self.char_at(self.start);
+                self.skip_char_tail();
+                if ch.is_alphabetic() {
+                    self.identifier();
+                    Ok(())
+                } else {
+                    Err(LexerError::UnexpectedCharacter(ch, self.line, self.column))
+                }
+            }
+
+            _ => Err(LexerError::UnexpectedCharacter(c as char, self.line, self.column)),
         }
     }
 
-    fn string(&mut self, quote: char) -> Result<(), LexerError> {
+    fn string(&mut self, quote: u8) -> Result<(), LexerError> {
+        // クォートと改行・エスケープはすべてASCIIなので、UTF-8のままバイト単位で読み進めてよい
         while self.peek() != quote && !self.is_at_end() {
-            if self.peek() == '\n' {
+            if self.peek() == b'\n' {
                 self.line += 1;
                 self.column = 1;
             }
-            if self.peek() == '\\' {
+            if self.peek() == b'\\' {
                 self.advance(); // エスケープ文字をスキップ
                 if !self.is_at_end() {
                     self.advance(); // エスケープされた文字
@@ -289,7 +328,7 @@ impl Lexer {
         }
 
         // 小数点チェック
-        if self.peek() == '.' && self.peek_next().is_ascii_digit() {
+        if self.peek() == b'.' && self.peek_next().is_ascii_digit() {
             self.advance(); // .を消費
 
             while self.peek().is_ascii_digit() {
@@ -302,19 +341,37 @@ impl Lexer {
     }
 
     fn identifier(&mut self) {
-        while self.peek().is_alphanumeric() || self.peek() == '_' {
-            self.advance();
+        loop {
+            let c = self.peek();
+            if c.is_ascii_alphanumeric() || c == b'_' {
+                self.advance();
+            } else if c >= 0x80 && self.char_at(self.current).is_alphanumeric() {
+                self.advance();
+                self.skip_char_tail();
+            } else {
+                break;
+            }
         }
 
-        let text: String = self.source[self.start..self.current].iter().collect();
-        let token_type = keyword_to_token_type(&text).unwrap_or(TokenType::Identifier);
-        self.add_token(token_type);
+        let text = &self.source[self.start..self.current];
+        match keyword_to_token_type(text) {
+            Some(token_type) => self.add_token(token_type),
+            None => {
+                self.add_token(TokenType::Identifier);
+                if let Some(interner) = &mut self.interner {
+                    let symbol = interner.intern(text);
+                    if let Some(token) = self.tokens.last_mut() {
+                        token.symbol = Some(symbol);
+                    }
+                }
+            }
+        }
     }
 
     fn handle_indentation(&mut self) -> Result<(), LexerError> {
         let mut indent = 0;
-        while self.peek() == ' ' || self.peek() == '\t' {
-            if self.peek() == ' ' {
+        while self.peek() == b' ' || self.peek() == b'\t' {
+            if self.peek() == b' ' {
                 indent += 1;
             } else {
                 indent += 4; // タブは4スペース相当
@@ -323,7 +380,7 @@ impl Lexer {
         }
 
         // 空行はスキップ
-        if self.peek() == '\n' || self.peek() == '#' {
+        if self.peek() == b'\n' || self.peek() == b'#' {
             return Ok(());
         }
 
@@ -347,34 +404,49 @@ impl Lexer {
 
     // ヘルパー関数
     fn is_at_end(&self) -> bool {
-        self.current >= self.source.len()
+        self.current >= self.bytes.len()
     }
 
-    fn advance(&mut self) -> char {
-        let c = self.source[self.current];
+    /// 1バイト進める（列はUTF-8の継続バイトでは進めない＝文字単位で数える）
+    fn advance(&mut self) -> u8 {
+        let c = self.bytes[self.current];
         self.current += 1;
-        self.column += 1;
+        if c & 0xC0 != 0x80 {
+            self.column += 1;
+        }
         c
     }
 
-    fn peek(&self) -> char {
+    /// 非ASCII文字の残りのバイト（継続バイト）を読み飛ばす
+    fn skip_char_tail(&mut self) {
+        while !self.is_at_end() && self.bytes[self.current] & 0xC0 == 0x80 {
+            self.current += 1;
+        }
+    }
+
+    /// 指定位置から始まる文字をUTF-8として読む
+    fn char_at(&self, index: usize) -> char {
+        self.source[index..].chars().next().unwrap_or('\0')
+    }
+
+    fn peek(&self) -> u8 {
         if self.is_at_end() {
-            '\0'
+            b'\0'
         } else {
-            self.source[self.current]
+            self.bytes[self.current]
         }
     }
 
-    fn peek_next(&self) -> char {
-        if self.current + 1 >= self.source.len() {
-            '\0'
+    fn peek_next(&self) -> u8 {
+        if self.current + 1 >= self.bytes.len() {
+            b'\0'
         } else {
-            self.source[self.current + 1]
+            self.bytes[self.current + 1]
         }
     }
 
-    fn match_char(&mut self, expected: char) -> bool {
-        if self.is_at_end() || self.source[self.current] != expected {
+    fn match_char(&mut self, expected: u8) -> bool {
+        if self.is_at_end() || self.bytes[self.current] != expected {
             false
         } else {
             self.current += 1;
@@ -384,12 +456,11 @@ impl Lexer {
     }
 
     fn add_token(&mut self, token_type: TokenType) {
-        let lexeme: String = self.source[self.start..self.current].iter().collect();
         self.tokens.push(Token::new(
             token_type,
-            lexeme,
+            &self.source[self.start..self.current],
             self.line,
-            self.column - (self.current - self.start),
+            self.start_column,
         ));
     }
 }
@@ -400,7 +471,7 @@ mod tests {
 
     #[test]
     fn test_simple_tokens() {
-        let source = "let x = 42".to_string();
+        let source = "let x = 42";
         let lexer = Lexer::new(source);
         let tokens = lexer.tokenize().unwrap();
 
@@ -414,7 +485,7 @@ mod tests {
 
     #[test]
     fn test_string_literal() {
-        let source = r#"let s = "hello world""#.to_string();
+        let source = r#"let s = "hello world""#;
         let lexer = Lexer::new(source);
         let tokens = lexer.tokenize().unwrap();
 
@@ -424,7 +495,7 @@ mod tests {
 
     #[test]
     fn test_operators() {
-        let source = "+ - * / ** // % == != < > <= >=".to_string();
+        let source = "+ - * / ** // % == != < > <= >=";
         let lexer = Lexer::new(source);
         let tokens = lexer.tokenize().unwrap();
 
@@ -435,4 +506,52 @@ mod tests {
         assert!(matches!(tokens[4].token_type, TokenType::Power));
         assert!(matches!(tokens[5].token_type, TokenType::FloorDiv));
     }
+
+    #[test]
+    fn test_tokens_borrow_source() {
+        let source = "let name = \"名前\"  # コメント";
+        let tokens = Lexer::new(source).tokenize().unwrap();
+
+        // 字句はソースのスライスそのもの（コピーされていない）
+        let range = source.as_bytes().as_ptr_range();
+        for token in &tokens {
+            assert!(range.contains(&token.lexeme.as_ptr()) || token.lexeme.is_empty());
+        }
+        assert_eq!(tokens[3].lexeme, "\"名前\"");
+    }
+
+    #[test]
+    fn test_unicode_identifiers_and_columns() {
+        let source = "let 値 = café + 1";
+        let tokens = Lexer::new(source).tokenize().unwrap();
+
+        assert!(matches!(tokens[1].token_type, TokenType::Identifier));
+        assert_eq!(tokens[1].lexeme, "値");
+        assert_eq!(tokens[3].lexeme, "café");
+        // 列は文字単位で数える
+        assert_eq!(tokens[3].column, 9);
+        assert_eq!(tokens[4].column, 14);
+
+        assert!(matches!(
+            Lexer::new("let x = ★").tokenize(),
+            Err(LexerError::UnexpectedCharacter('★', 1, _))
+        ));
+    }
+
+    #[test]
+    fn test_identifiers_are_interned() {
+        let (tokens, interner) = Lexer::new("let x = y\nx = x + y").tokenize_interned().unwrap();
+
+        let symbols: Vec<_> = tokens.iter().filter_map(|t| t.symbol).collect();
+        assert_eq!(symbols.len(), 5);
+        assert_eq!(interner.len(), 2);
+        assert_eq!(symbols[0], symbols[2]);
+        assert_eq!(symbols[1], symbols[4]);
+        assert_eq!(interner.resolve(symbols[0]), "x");
+        assert_eq!(interner.resolve(symbols[1]), "y");
+
+        // tokenize はインターンしない
+        let tokens = Lexer::new("let x = y").tokenize().unwrap();
+        assert!(tokens.iter().all(|t| t.symbol.is_none()));
+    }
 }
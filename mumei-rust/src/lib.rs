@@ -7,86 +7,83 @@ pub mod token;
 pub mod lexer;
 pub mod ast;
 pub mod parser;
+pub mod resolver;  // 変数解決（ローカル変数のスロット割り当て）
 pub mod value;
+pub mod string;  // 文字列の値（短い文字列はその場に、長い文字列は共有）
+pub mod iterator;  // 遅延イテレータ（range・for 文の反復）
+pub mod generator;  // ジェネレータ（中断・再開できるフレーム）
+pub mod task;  // 非同期タスクとイベントループ（async/await、tokio の上の組み込み I/O）
+pub mod array;  // 数値配列（連続した f64・要素ごとの演算と集計）
+pub mod dict;  // 挿入順の辞書（FxHash・型付きキー）
+pub mod shape;  // クラスとインスタンス（隠れクラス・インラインキャッシュ）
 pub mod environment;
 pub mod interpreter;
 pub mod builtins;
 pub mod bytecode;
 pub mod compiler;
+pub mod optimizer;  // バイトコード最適化（定数畳み込み・複合命令）
+pub mod verifier;  // バイトコード検証（最大スタック深さ・ジャンプ先）
+pub mod quicken;  // 実行時の命令特殊化（quickening）
 pub mod vm;
 pub mod vm_fast;  // 超高速数値演算専用VM
-pub mod jit;
+pub mod cache;    // コンパイル結果の共有キャッシュ（LRU）
+pub mod diskcache;  // コンパイル結果のディスクキャッシュ（.muc）
 
-// 外部機能モジュール（一時的に無効化 - PyO3依存を削除中）
-// TODO: これらをbuilt-in関数として再実装する
-// pub mod http;      // HTTP client module (Rust-based, no Python dependency)
-// pub mod discord;   // Discord API module (Rust-based, REST API)
-// pub mod gateway;   // Discord Gateway (WebSocket, real-time events)
+pub mod http;  // HTTPクライアント（共有の非同期クライアント、http_get などの組み込み関数）
+pub mod discord;  // Discord REST API（レート制限のバケットに合わせて送るスケジューラ）
+pub mod gateway;  // Discord Gateway（WebSocket のイベントをハンドラーのタスクに渡す）
+pub mod shard;  // Gateway のシャード（シャードをスレッドに分け、スレッドごとのVMでハンドラーを実行する）
 
-use std::collections::HashMap;
-use std::cell::RefCell;
 use bytecode::ByteCode as RustByteCode;
 
-/// コンパイル済みバイトコードのキャッシュ（スレッドローカル）
-thread_local! {
-    static BYTECODE_CACHE: RefCell<HashMap<usize, RustByteCode>> = RefCell::new(HashMap::new());
-    static NEXT_BYTECODE_ID: RefCell<usize> = RefCell::new(0);
-}
-
 /// バイトコードキャッシュAPI
+/// コンパイル結果は cache モジュールの共有キャッシュに置き、IDで実行する
+/// （同じソースは同じIDとバイトコードを共有し、上限を超えると古いものから捨てられる）
 pub mod bytecode_cache {
     use super::*;
+    use std::sync::Arc;
 
-    pub fn compile_and_cache(source: &str) -> Result<usize, String> {
+    /// ソースをバイトコードにコンパイル（キャッシュを通さない）
+    pub fn compile_source(source: &str) -> Result<RustByteCode, String> {
         use lexer::Lexer;
         use parser::Parser;
         use compiler::Compiler;
-        use ast::ASTNode;
 
         // Tokenize
-        let lexer = Lexer::new(source.to_string());
+        let lexer = Lexer::new(source);
         let tokens = lexer.tokenize().map_err(|e| format!("Lexer error: {}", e))?;
 
         // Parse
         let parser = Parser::new(tokens);
         let ast = parser.parse().map_err(|e| format!("Parser error: {}", e))?;
 
-        // Extract statements
-        let statements = match ast {
-            ASTNode::Program { statements } => statements,
-            single_node => vec![single_node],
-        };
-
         // Compile to bytecode
         let mut compiler = Compiler::new();
-        let bytecode = compiler.compile(statements).map_err(|e| format!("Compile error: {}", e))?;
-
-        // Cache and return ID
-        let id = NEXT_BYTECODE_ID.with(|counter| {
-            let mut c = counter.borrow_mut();
-            let id = *c;
-            *c += 1;
-            id
-        });
-
-        BYTECODE_CACHE.with(|cache| {
-            cache.borrow_mut().insert(id, bytecode);
-        });
+        compiler.compile(ast).map_err(|e| format!("Compile error: {}", e))
+    }
 
+    pub fn compile_and_cache(source: &str) -> Result<usize, String> {
+        let (id, _) = cache::global_cache().get_or_compile(source, compile_source)?;
         Ok(id)
     }
 
+    /// IDからキャッシュ済みバイトコードを取得（複製しない）
+    fn cached(bytecode_id: usize) -> Result<Arc<RustByteCode>, String> {
+        cache::global_cache()
+            .get_by_id(bytecode_id)
+            .ok_or_else(|| format!("Invalid bytecode ID: {}", bytecode_id))
+    }
+
     pub fn execute_cached(bytecode_id: usize) -> Result<String, String> {
         use vm::VM;
 
         // Get bytecode from cache
-        let bytecode = BYTECODE_CACHE.with(|cache| {
-            cache.borrow().get(&bytecode_id).cloned()
-        }).ok_or_else(|| format!("Invalid bytecode ID: {}", bytecode_id))?;
+        let bytecode = cached(bytecode_id)?;
 
         // Execute on VM
         let mut vm = VM::new();
-        let result = vm.execute(bytecode).map_err(|e| format!("Runtime error: {}", e))?;
+        builtins::setup_vm_builtins(&mut vm);
+        let result = vm.execute_shared(bytecode).map_err(|e| format!("Runtime error: {}", e))?;
 
         Ok(result.to_string())
     }
@@ -97,9 +94,7 @@ pub mod bytecode_cache {
         use value::Value;
 
         // Get bytecode from cache
-        let bytecode = BYTECODE_CACHE.with(|cache| {
-            cache.borrow().get(&bytecode_id).cloned()
-        }).ok_or_else(|| format!("Invalid bytecode ID: {}", bytecode_id))?;
+        let bytecode = cached(bytecode_id)?;
 
         // Try fast path for numeric-only code
         if vm_fast::is_numeric_only(&bytecode) {
@@ -108,7 +103,8 @@ pub mod bytecode_cache {
 
         // Fallback to normal VM
         let mut vm = VM::new();
-        let result = vm.execute(bytecode).map_err(|e| format!("Runtime error: {}", e))?;
+        builtins::setup_vm_builtins(&mut vm);
+        let result = vm.execute_shared(bytecode).map_err(|e| format!("Runtime error: {}", e))?;
 
         // Extract number
         match result {
@@ -127,25 +123,19 @@ mod tests {
         use lexer::Lexer;
         use parser::Parser;
         use interpreter::Interpreter;
-        use ast::ASTNode;
 
         let source = "let x = 42; x";
 
-        let lexer = Lexer::new(source.to_string());
+        let lexer = Lexer::new(source);
         let tokens = lexer.tokenize().unwrap();
 
         let parser = Parser::new(tokens);
         let ast = parser.parse().unwrap();
 
-        let statements = match ast {
-            ASTNode::Program { statements } => statements,
-            single_node => vec![single_node],
-        };
-
         let mut interpreter = Interpreter::new();
         builtins::setup_builtins(&*interpreter.global_env());
 
-        let result = interpreter.evaluate(statements).unwrap();
+        let result = interpreter.evaluate(ast).unwrap();
         assert_eq!(result.to_string(), "42");
     }
 
@@ -156,4 +146,29 @@ mod tests {
         let result = bytecode_cache::execute_cached(id).unwrap();
         assert_eq!(result, "6");
     }
+
+    #[test]
+    fn test_bytecode_cache_functions() {
+        let source = r#"
+fun fib(n) {
+    if (n <= 1) {
+        return n;
+    }
+    return fib(n - 1) + fib(n - 2);
+}
+str(fib(10))
+"#;
+        let id = bytecode_cache::compile_and_cache(source).unwrap();
+        assert_eq!(bytecode_cache::execute_cached(id).unwrap(), "55");
+    }
+
+    #[test]
+    fn test_bytecode_cache_reuses_compilation() {
+        // 同じソースは再コンパイルせず同じIDを返す
+        let source = "let cached_x = 20\ncached_x + 22";
+        let id = bytecode_cache::compile_and_cache(source).unwrap();
+        assert_eq!(bytecode_cache::compile_and_cache(source).unwrap(), id);
+        assert_eq!(bytecode_cache::execute_cached(id).unwrap(), "42");
+        assert!(bytecode_cache::execute_cached(usize::MAX).is_err());
+    }
 }
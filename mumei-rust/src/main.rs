@@ -5,6 +5,7 @@ use mumei_rust::*;
 use std::env;
 use std::fs;
 use std::io::{self, Write};
+use std::path::Path;
 use std::process;
 
 fn main() {
@@ -53,6 +54,12 @@ fn print_help() {
     println!("  mumei hello.mu            # Run hello.mu");
     println!("  mumei -i                  # Start REPL");
     println!();
+    println!("Environment:");
+    println!("  {}=<n>        Maximum call depth (default {})", vm::MAX_FRAMES_ENV, vm::DEFAULT_MAX_FRAMES);
+    println!("  {}=1               Trace bytecode execution", vm::TRACE_ENV);
+    println!("  {}=1       Print instruction specialization stats", vm::QUICKEN_STATS_ENV);
+    println!("  {}=1            Do not read or write .muc bytecode caches", diskcache::NO_CACHE_ENV);
+    println!();
     println!("Features:");
     println!("  ✓ 100% Rust implementation");
     println!("  ✓ No Python dependencies");
@@ -72,19 +79,97 @@ fn run_file(file_path: &str) {
     };
 
     // 実行
-    match execute_mumei(&source) {
+    match execute_file(Path::new(file_path), &source) {
         Ok(result) => {
             if result != "null" && !result.is_empty() {
                 println!("{}", result);
             }
         }
         Err(e) => {
-            eprintln!("Runtime error: {}", e);
+            // エラーには "Lexer error:" や "Runtime error:" などの段階名が付いている
+            eprintln!("{}", e);
             process::exit(1);
         }
     }
 }
 
+/// ファイルを実行
+/// バイトコードにコンパイルできるスクリプトはVMで実行し、コンパイル結果を .muc にキャッシュする。
+/// 次回以降はソースが変わっていなければ .muc を読み込むだけで実行を始める。
+fn execute_file(path: &Path, source: &str) -> Result<String, String> {
+    use compiler::Compiler;
+
+    let use_cache = !diskcache::is_disabled();
+    let cache_path = diskcache::cache_path(path);
+    if use_cache {
+        if let Some(bytecode) = diskcache::load(&cache_path, source) {
+            return execute_bytecode(bytecode);
+        }
+    }
+
+    // コンパイラはASTを消費するので、バイトコード未対応の構文を含む場合だけ
+    // もう一度パースしてインタプリタで実行する
+    match Compiler::new().compile(parse_source(source)?) {
+        Ok(bytecode) => {
+            if use_cache {
+                // キャッシュを書けなくても（読み取り専用のディレクトリなど）実行は続ける
+                let _ = diskcache::store(&cache_path, source, &bytecode);
+            }
+            execute_bytecode(bytecode)
+        }
+        Err(compile_error) => {
+            let ast = parse_source(source)?;
+            // インタプリタのタスクは await で中断できず、gather などの終わる順序がVMと変わるので実行しない
+            if ast.uses_async() {
+                return Err(format!(
+                    "Compile error: {}\nasync programs run only on the bytecode VM; the interpreter fallback cannot suspend tasks",
+                    compile_error
+                ));
+            }
+            execute_ast(ast)
+        }
+    }
+}
+
+/// ソースを字句解析・構文解析してASTにする
+fn parse_source(source: &str) -> Result<ast::Ast, String> {
+    use lexer::Lexer;
+    use parser::Parser;
+
+    // Lexer
+    let lexer = Lexer::new(source);
+    let tokens = lexer.tokenize().map_err(|e| format!("Lexer error: {}", e))?;
+
+    // Parser
+    let parser = Parser::new(tokens);
+    parser.parse().map_err(|e| format!("Parser error: {}", e))
+}
+
+/// バイトコードをVMで実行
+fn execute_bytecode(bytecode: bytecode::ByteCode) -> Result<String, String> {
+    let mut vm = vm::VM::with_max_frames(vm::max_frames_requested()?);
+    vm.set_trace(vm::trace_requested());
+    let show_stats = vm::quicken_stats_requested();
+    vm.set_quicken_stats(show_stats);
+    builtins::setup_vm_builtins(&mut vm);
+    let result = vm.execute(bytecode);
+    if show_stats {
+        eprint!("{}", vm.quicken_stats().report());
+    }
+    let result = result.map_err(|e| format!("Runtime error: {}", e))?;
+    Ok(result.to_string())
+}
+
+/// 構文木をインタプリタで実行
+fn execute_ast(ast: ast::Ast) -> Result<String, String> {
+    let mut interpreter = interpreter::Interpreter::new();
+    builtins::setup_builtins(&*interpreter.global_env());
+
+    let result = interpreter.evaluate(ast).map_err(|e| format!("Runtime error: {}", e))?;
+
+    Ok(result.to_string())
+}
+
 fn run_repl() {
     println!("Mumei Language REPL v{}", env!("CARGO_PKG_VERSION"));
     println!("Type 'exit' or Ctrl+C to quit");
@@ -132,57 +217,20 @@ fn run_repl() {
     }
 }
 
-fn execute_mumei(source: &str) -> Result<String, String> {
-    use lexer::Lexer;
-    use parser::Parser;
-    use interpreter::Interpreter;
-    use ast::ASTNode;
-
-    // Lexer
-    let lexer = Lexer::new(source.to_string());
-    let tokens = lexer.tokenize().map_err(|e| format!("Lexer error: {}", e))?;
-
-    // Parser
-    let parser = Parser::new(tokens);
-    let ast = parser.parse().map_err(|e| format!("Parser error: {}", e))?;
-
-    // Interpreter
-    let mut interpreter = Interpreter::new();
-    builtins::setup_builtins(&*interpreter.global_env());
-
-    // Extract statements from Program node
-    let statements = match ast {
-        ASTNode::Program { statements } => statements,
-        single_node => vec![single_node],
-    };
-
-    // Execute
-    let result = interpreter.evaluate(statements).map_err(|e| format!("Runtime error: {}", e))?;
-
-    Ok(result.to_string())
-}
-
 fn execute_line(interpreter: &mut interpreter::Interpreter, source: &str) -> Result<String, String> {
     use lexer::Lexer;
     use parser::Parser;
-    use ast::ASTNode;
 
     // Lexer
-    let lexer = Lexer::new(source.to_string());
+    let lexer = Lexer::new(source);
     let tokens = lexer.tokenize().map_err(|e| format!("Lexer error: {}", e))?;
 
     // Parser
     let parser = Parser::new(tokens);
     let ast = parser.parse().map_err(|e| format!("Parser error: {}", e))?;
 
-    // Extract statements
-    let statements = match ast {
-        ASTNode::Program { statements } => statements,
-        single_node => vec![single_node],
-    };
-
     // Execute
-    let result = interpreter.evaluate(statements).map_err(|e| format!("Runtime error: {}", e))?;
+    let result = interpreter.evaluate(ast).map_err(|e| format!("Runtime error: {}", e))?;
 
     Ok(result.to_string())
 }
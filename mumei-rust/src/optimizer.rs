@@ -0,0 +1,630 @@
+/// バイトコード最適化
+/// コンパイラが出力した命令列を実行前に書き換える
+/// （定数畳み込み・定数伝播・ジャンプ整理・不要命令の削除・複合命令への融合）
+
+use crate::bytecode::{ByteCode, Constant, Instruction};
+use crate::value::Value;
+use std::collections::HashMap;
+use std::sync::Arc;
+
+/// 定数畳み込みで作る文字列の上限（"a" * 1e9 のような式をコンパイル時に展開しない）
+const MAX_FOLDED_STRING: usize = 1024;
+
+/// 畳み込み・ジャンプ整理を繰り返す上限（通常は数回で変化がなくなる）
+const MAX_ROUNDS: usize = 16;
+
+/// 最適化レベル
+#[derive(Debug, Clone, Copy, PartialEq, Eq, PartialOrd, Ord, Hash)]
+pub enum OptLevel {
+    /// 最適化しない（コンパイラの出力そのまま）
+    None,
+    /// 定数畳み込み・定数伝播・ジャンプ整理・不要な命令の削除
+    Basic,
+    /// Basic に加えて、よく現れる命令列を複合命令に融合
+    Full,
+}
+
+impl OptLevel {
+    /// 数値（0/1/2）から最適化レベルを得る（-O2 などの指定用）
+    pub fn from_level(level: u8) -> Option<OptLevel> {
+        match level {
+            0 => Some(OptLevel::None),
+            1 => Some(OptLevel::Basic),
+            2 => Some(OptLevel::Full),
+            _ => None,
+        }
+    }
+}
+
+impl Default for OptLevel {
+    fn default() -> Self {
+        OptLevel::Full
+    }
+}
+
+/// バイトコードを最適化（ネストした関数のチャンクも含む）
+pub fn optimize(bytecode: &mut ByteCode, level: OptLevel) {
+    if level == OptLevel::None {
+        return;
+    }
+
+    // コンパイル直後の関数プロトタイプは共有されていないので複製されない
+    for function in &mut bytecode.functions {
+        let function = Arc::make_mut(function);
+        optimize(Arc::make_mut(&mut function.chunk), level);
+    }
+
+    ChunkOptimizer::new(bytecode).run(level);
+}
+
+/// 1チャンク分の最適化
+/// 削除した命令は None にしておき、最後に詰めてジャンプ先を付け直す
+/// （ジャンプ先が削除された場合はその後ろの最初の命令に飛ぶ）
+struct ChunkOptimizer<'a> {
+    chunk: &'a mut ByteCode,
+    code: Vec<Option<Instruction>>,
+}
+
+impl<'a> ChunkOptimizer<'a> {
+    fn new(chunk: &'a mut ByteCode) -> Self {
+        let code = chunk.instructions.iter().copied().map(Some).collect();
+        ChunkOptimizer { chunk, code }
+    }
+
+    fn run(mut self, level: OptLevel) {
+        for _ in 0..MAX_ROUNDS {
+            let mut changed = self.fold_constants();
+            changed |= self.thread_jumps();
+            changed |= self.remove_unreachable();
+            changed |= self.remove_useless();
+            if !changed {
+                break;
+            }
+        }
+
+        if level >= OptLevel::Full {
+            self.fuse();
+        }
+
+        self.compact();
+    }
+
+    /// 残っている命令の位置
+    fn live(&self) -> Vec<usize> {
+        (0..self.code.len()).filter(|&i| self.code[i].is_some()).collect()
+    }
+
+    /// 各位置がジャンプ先になっているか（ジャンプ先をまたぐ命令列は書き換えない）
+    fn jump_targets(&self) -> Vec<bool> {
+        let mut targets = vec![false; self.code.len() + 1];
+        for instruction in self.code.iter().flatten() {
+            if let Some(target) = instruction.jump_target() {
+                targets[self.resolve(target)] = true;
+            }
+        }
+        targets
+    }
+
+    /// target 以降で最初に残っている命令の位置（なければ末尾）
+    fn resolve(&self, target: usize) -> usize {
+        let mut position = target.min(self.code.len());
+        while position < self.code.len() && self.code[position].is_none() {
+            position += 1;
+        }
+        position
+    }
+
+    /// 定数畳み込みと直線的なコード内での定数伝播
+    fn fold_constants(&mut self) -> bool {
+        let targets = self.jump_targets();
+        let live = self.live();
+        let mut changed = false;
+
+        // 定数を保存した直後の変数（ジャンプ先・呼び出しで忘れる）
+        let mut local_constants: HashMap<u16, u32> = HashMap::new();
+        let mut global_constants: HashMap<u32, u32> = HashMap::new();
+
+        let mut i = 0;
+        while i < live.len() {
+            let position = live[i];
+            let instruction = match self.code[position] {
+                Some(instruction) => instruction,
+                None => {
+                    i += 1;
+                    continue;
+                }
+            };
+            if targets[position] {
+                local_constants.clear();
+                global_constants.clear();
+            }
+
+            // 直後の命令（ジャンプ先でなく、まだ残っているもの）
+            let next = |offset: usize| -> Option<(usize, Instruction)> {
+                let p = *live.get(i + offset)?;
+                if targets[p] {
+                    return None;
+                }
+                self.code[p].map(|instruction| (p, instruction))
+            };
+            let (next1, next2) = (next(1), next(2));
+
+            match instruction {
+                Instruction::LoadConst(a) => {
+                    // 二項演算: LoadConst a; LoadConst b; op
+                    if let (Some((p1, Instruction::LoadConst(b))), Some((p2, op))) = (next1, next2) {
+                        if let Some(result) = self.fold_binary(op, a, b) {
+                            self.code[position] = Some(Instruction::LoadConst(result));
+                            self.code[p1] = None;
+                            self.code[p2] = None;
+                            changed = true;
+                            i += 3;
+                            continue;
+                        }
+                    }
+
+                    match next1 {
+                        // 単項演算: LoadConst a; op
+                        Some((p1, op @ (Instruction::Negate | Instruction::Not))) => {
+                            if let Some(result) = self.fold_unary(op, a) {
+                                self.code[position] = Some(Instruction::LoadConst(result));
+                                self.code[p1] = None;
+                                changed = true;
+                                i += 2;
+                                continue;
+                            }
+                        }
+                        // 条件が定数の分岐: 常に飛ぶならJump、常に進むなら両方削除
+                        Some((p1, branch @ (Instruction::JumpIfFalse(target) | Instruction::JumpIfTrue(target)))) => {
+                            let truthy = self.chunk.constants[a as usize].to_value().is_truthy();
+                            let jumps = truthy == matches!(branch, Instruction::JumpIfTrue(_));
+                            self.code[position] = if jumps { Some(Instruction::Jump(target)) } else { None };
+                            self.code[p1] = None;
+                            changed = true;
+                            i += 2;
+                            continue;
+                        }
+                        // 定数の保存: 以後の読み込みを定数に置き換えられる
+                        Some((_, Instruction::StoreLocal(slot))) => {
+                            local_constants.insert(slot, a);
+                            i += 2;
+                            continue;
+                        }
+                        Some((_, Instruction::StoreGlobal(index))) => {
+                            global_constants.insert(index, a);
+                            i += 2;
+                            continue;
+                        }
+                        _ => {}
+                    }
+                }
+
+                Instruction::LoadLocal(slot) => {
+                    if let Some(&constant) = local_constants.get(&slot) {
+                        self.code[position] = Some(Instruction::LoadConst(constant));
+                        changed = true;
+                        // 置き換えた定数がさらに畳み込めるか見直す
+                        continue;
+                    }
+                }
+
+                Instruction::LoadGlobal(index) => {
+                    if let Some(&constant) = global_constants.get(&index) {
+                        self.code[position] = Some(Instruction::LoadConst(constant));
+                        changed = true;
+                        continue;
+                    }
+                }
+
+                Instruction::StoreLocal(slot) => {
+                    local_constants.remove(&slot);
+                }
+
+                Instruction::StoreGlobal(index) => {
+                    global_constants.remove(&index);
+                }
+
+                // 呼び出し先（中断中のジェネレータを読む側・await の間に動くタスクも）は捕捉変数・グローバル変数を書き換えうる
+                Instruction::Call(_)
+                | Instruction::TailCall(_)
+                | Instruction::CallMethod(_)
+                | Instruction::Yield
+                | Instruction::Await => {
+                    local_constants.clear();
+                    global_constants.clear();
+                }
+
+                _ => {}
+            }
+
+            if instruction.is_terminator() {
+                local_constants.clear();
+                global_constants.clear();
+            }
+            i += 1;
+        }
+
+        changed
+    }
+
+    /// 定数同士の二項演算を実行時と同じ規則で計算（エラーになる式は実行時に任せる）
+    fn fold_binary(&mut self, op: Instruction, a: u32, b: u32) -> Option<u32> {
+        let left = self.chunk.constants[a as usize].to_value();
+        let right = self.chunk.constants[b as usize].to_value();
+
+        let result = match op {
+            Instruction::Add => left.add(&right),
+            Instruction::Subtract => left.subtract(&right),
+            Instruction::Multiply => left.multiply(&right),
+            Instruction::Divide => left.divide(&right),
+            Instruction::Modulo => left.modulo(&right),
+            Instruction::Power => left.power(&right),
+            Instruction::Less => left.less_than(&right),
+            Instruction::Greater => left.greater_than(&right),
+            Instruction::LessEqual => left.greater_than(&right).and_then(|v| v.as_boolean()).map(|b| Value::Boolean(!b)),
+            Instruction::GreaterEqual => left.less_than(&right).and_then(|v| v.as_boolean()).map(|b| Value::Boolean(!b)),
+            Instruction::Equal => Ok(Value::Boolean(left.equals(&right))),
+            Instruction::NotEqual => Ok(Value::Boolean(!left.equals(&right))),
+            _ => return None,
+        };
+
+        self.intern(result.ok()?)
+    }
+
+    /// 定数の単項演算
+    fn fold_unary(&mut self, op: Instruction, a: u32) -> Option<u32> {
+        let value = self.chunk.constants[a as usize].to_value();
+        let result = match op {
+            Instruction::Negate => Value::Number(-value.as_number().ok()?),
+            Instruction::Not => Value::Boolean(!value.is_truthy()),
+            _ => return None,
+        };
+        self.intern(result)
+    }
+
+    /// 畳み込んだ値を定数プールに登録
+    fn intern(&mut self, value: Value) -> Option<u32> {
+        if matches!(&value, Value::String(s) if s.len() > MAX_FOLDED_STRING) {
+            return None;
+        }
+        let constant = Constant::from_value(&value)?;
+        u32::try_from(self.chunk.add_constant(constant)).ok()
+    }
+
+    /// ジャンプ先がJumpならその先へ直接飛ぶ（次の命令へのジャンプは削除）
+    fn thread_jumps(&mut self) -> bool {
+        let mut changed = false;
+
+        for position in 0..self.code.len() {
+            let instruction = match self.code[position] {
+                Some(instruction) => instruction,
+                None => continue,
+            };
+            let target = match instruction.jump_target() {
+                Some(target) => target,
+                None => continue,
+            };
+
+            // Jumpの連鎖をたどる（無限ループのJumpでも止まるよう回数を制限）
+            let mut resolved = self.resolve(target);
+            for _ in 0..self.code.len() {
+                match self.code.get(resolved).copied().flatten() {
+                    Some(Instruction::Jump(next)) if self.resolve(next) != resolved => {
+                        resolved = self.resolve(next);
+                    }
+                    _ => break,
+                }
+            }
+
+            if resolved == self.resolve(position + 1) {
+                // 次の命令へのジャンプ: 無条件なら不要、条件付きなら条件を捨てるだけ
+                self.code[position] = match instruction {
+                    Instruction::Jump(_) => None,
+                    Instruction::JumpIfFalse(_) | Instruction::JumpIfTrue(_) => Some(Instruction::Pop),
+                    _ => continue,
+                };
+                changed = true;
+            } else if resolved != target {
+                self.code[position] = Some(instruction.with_jump_target(resolved));
+                changed = true;
+            }
+        }
+
+        changed
+    }
+
+    /// 到達できない命令を削除
+    fn remove_unreachable(&mut self) -> bool {
+        let mut reachable = vec![false; self.code.len()];
+        let mut worklist = vec![self.resolve(0)];
+
+        while let Some(position) = worklist.pop() {
+            if position >= self.code.len() || reachable[position] {
+                continue;
+            }
+            reachable[position] = true;
+
+            let instruction = self.code[position].unwrap();
+            if let Some(target) = instruction.jump_target() {
+                worklist.push(self.resolve(target));
+            }
+            if !instruction.is_terminator() {
+                worklist.push(self.resolve(position + 1));
+            }
+        }
+
+        let mut changed = false;
+        for (slot, reachable) in self.code.iter_mut().zip(reachable) {
+            if slot.is_some() && !reachable {
+                *slot = None;
+                changed = true;
+            }
+        }
+        changed
+    }
+
+    /// 結果を捨てるだけの命令列を削除
+    /// LoadConst/LoadLocal/LoadUpvalue/Dup の直後の Pop、Dup; Store; Pop の Dup と Pop
+    fn remove_useless(&mut self) -> bool {
+        let targets = self.jump_targets();
+        let live = self.live();
+        let mut changed = false;
+
+        let mut i = 0;
+        while i + 1 < live.len() {
+            let (first, second) = (live[i], live[i + 1]);
+            if targets[second] {
+                i += 1;
+                continue;
+            }
+
+            match (self.code[first], self.code[second]) {
+                (
+                    Some(Instruction::LoadConst(_) | Instruction::LoadLocal(_) | Instruction::LoadUpvalue(_) | Instruction::Dup),
+                    Some(Instruction::Pop),
+                ) => {
+                    self.code[first] = None;
+                    self.code[second] = None;
+                    changed = true;
+                    i += 2;
+                    continue;
+                }
+                (
+                    Some(Instruction::Dup),
+                    Some(Instruction::StoreLocal(_) | Instruction::StoreGlobal(_) | Instruction::StoreUpvalue(_)),
+                ) => {
+                    if let Some(&third) = live.get(i + 2) {
+                        if !targets[third] && self.code[third] == Some(Instruction::Pop) {
+                            self.code[first] = None;
+                            self.code[third] = None;
+                            changed = true;
+                            i += 3;
+                            continue;
+                        }
+                    }
+                }
+                _ => {}
+            }
+            i += 1;
+        }
+
+        changed
+    }
+
+    /// よく現れる命令列を複合命令に融合
+    fn fuse(&mut self) {
+        let targets = self.jump_targets();
+        let live = self.live();
+
+        let mut i = 0;
+        while i < live.len() {
+            let window: Vec<Instruction> = live[i..live.len().min(i + 4)]
+                .iter()
+                .enumerate()
+                .take_while(|&(k, &p)| k == 0 || !targets[p])
+                .filter_map(|(_, &p)| self.code[p])
+                .collect();
+
+            let (fused, length) = match window[..] {
+                // x = x + k
+                [Instruction::LoadLocal(a), Instruction::LoadConst(k), Instruction::Add, Instruction::StoreLocal(b), ..] if a == b => {
+                    (Instruction::IncrLocal(a, k), 4)
+                }
+                [Instruction::LoadGlobal(a), Instruction::LoadConst(k), Instruction::Add, Instruction::StoreGlobal(b), ..] if a == b => {
+                    (Instruction::IncrGlobal(a, k), 4)
+                }
+                // 比較してすぐ分岐
+                [compare, Instruction::JumpIfFalse(target), ..] => match compare {
+                    Instruction::Less => (Instruction::LessJumpIfFalse(target), 2),
+                    Instruction::Greater => (Instruction::GreaterJumpIfFalse(target), 2),
+                    Instruction::LessEqual => (Instruction::LessEqualJumpIfFalse(target), 2),
+                    Instruction::GreaterEqual => (Instruction::GreaterEqualJumpIfFalse(target), 2),
+                    Instruction::Equal => (Instruction::EqualJumpIfFalse(target), 2),
+                    Instruction::NotEqual => (Instruction::NotEqualJumpIfFalse(target), 2),
+                    _ => {
+                        i += 1;
+                        continue;
+                    }
+                },
+                _ => {
+                    i += 1;
+                    continue;
+                }
+            };
+
+            // 先頭の位置に複合命令を置き、残りは削除（先頭へのジャンプはそのまま有効）
+            self.code[live[i]] = Some(fused);
+            for &position in &live[i + 1..i + length] {
+                self.code[position] = None;
+            }
+            i += length;
+        }
+    }
+
+    /// 削除した命令を詰め、ジャンプ先を新しい位置に付け直す
+    fn compact(self) {
+        // 元の位置 → 新しい位置（削除された位置はその後ろの最初の命令の位置）
+        let mut new_index = Vec::with_capacity(self.code.len() + 1);
+        let mut count = 0;
+        for slot in &self.code {
+            new_index.push(count);
+            if slot.is_some() {
+                count += 1;
+            }
+        }
+        new_index.push(count);
+
+        let instructions = self.code
+            .iter()
+            .flatten()
+            .map(|instruction| match instruction.jump_target() {
+                Some(target) => instruction.with_jump_target(new_index[target.min(self.code.len())]),
+                None => *instruction,
+            })
+            .collect();
+
+        self.chunk.entry_point = new_index[self.chunk.entry_point.min(self.code.len())];
+        self.chunk.instructions = instructions;
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::compiler::Compiler;
+    use crate::lexer::Lexer;
+    use crate::parser::Parser;
+    use crate::vm::VM;
+
+    fn compile(source: &str, level: OptLevel) -> ByteCode {
+        let tokens = Lexer::new(source).tokenize().unwrap();
+        let ast = Parser::new(tokens).parse().unwrap();
+        Compiler::with_opt_level(level).compile(ast).unwrap()
+    }
+
+    fn run(bytecode: ByteCode) -> Result<Value, String> {
+        let mut vm = VM::new();
+        crate::builtins::setup_vm_builtins(&mut vm);
+        vm.execute(bytecode)
+    }
+
+    #[test]
+    fn test_constant_folding() {
+        let bytecode = compile("1 + 2 * 3 - -4", OptLevel::Basic);
+        assert!(matches!(bytecode.instructions[..], [Instruction::LoadConst(_), Instruction::Halt]));
+        assert_eq!(run(bytecode).unwrap(), Value::Number(11.0));
+    }
+
+    #[test]
+    fn test_folding_keeps_runtime_errors() {
+        // 型エラーになる式は畳み込まず、実行時に同じエラーを出す
+        let bytecode = compile("\"a\" - 1", OptLevel::Full);
+        assert!(bytecode.instructions.contains(&Instruction::Subtract));
+        assert!(run(bytecode).is_err());
+
+        // 巨大な文字列は展開しない
+        let bytecode = compile("\"ab\" * 100000", OptLevel::Full);
+        assert!(bytecode.instructions.contains(&Instruction::Multiply));
+    }
+
+    #[test]
+    fn test_constant_propagation() {
+        let source = r#"
+fun f() {
+    let a = 6
+    let b = a * 7
+    b
+}
+f()
+"#;
+        let bytecode = compile(source, OptLevel::Basic);
+        let body = &bytecode.functions[0].chunk.instructions;
+        assert!(!body.contains(&Instruction::Multiply));
+        assert_eq!(run(bytecode).unwrap(), Value::Number(42.0));
+    }
+
+    #[test]
+    fn test_constant_branch_and_dead_code() {
+        let bytecode = compile("if (false) { print(1) } else { 2 }\n3", OptLevel::Basic);
+        // 条件が定数なので分岐ごと消え、then 節は到達不能として削除される
+        assert!(bytecode.instructions.iter().all(|i| i.jump_target().is_none()));
+        assert!(!bytecode.instructions.iter().any(|i| matches!(i, Instruction::Call(_))));
+    }
+
+    #[test]
+    fn test_load_pop_removed() {
+        let bytecode = compile("1\n\"unused\"\nlet x = 2", OptLevel::Basic);
+        assert!(!bytecode.instructions.contains(&Instruction::Pop));
+    }
+
+    #[test]
+    fn test_superinstructions() {
+        let source = r#"
+fun count(n) {
+    let i = 0
+    while i < n {
+        i = i + 1
+    }
+    i
+}
+count(10)
+"#;
+        let bytecode = compile(source, OptLevel::Full);
+        let body = &bytecode.functions[0].chunk.instructions;
+        assert!(body.iter().any(|i| matches!(i, Instruction::IncrLocal(_, _))));
+        assert!(body.iter().any(|i| matches!(i, Instruction::LessJumpIfFalse(_))));
+        assert_eq!(run(bytecode).unwrap(), Value::Number(10.0));
+
+        // Basic では融合しない
+        let basic = compile(source, OptLevel::Basic);
+        assert!(basic.functions[0].chunk.instructions.iter().all(|i| i.fused_parts().is_none()));
+    }
+
+    #[test]
+    fn test_opt_level_none_is_identity() {
+        let source = "let x = 1 + 2\nx";
+        let mut unoptimized = compile(source, OptLevel::None);
+        let before = unoptimized.instructions.clone();
+        optimize(&mut unoptimized, OptLevel::None);
+        assert_eq!(unoptimized.instructions, before);
+        assert!(before.contains(&Instruction::Add));
+    }
+
+    /// 最適化前後で同じ結果（またはどちらもエラー）になることを確認する
+    #[test]
+    fn test_differential_against_unoptimized() {
+        let programs = [
+            "1 + 2 * 3",
+            "(10 - 4) / 3 * 2 % 5",
+            "\"foo\" + \"bar\"",
+            "not (1 < 2) == false",
+            "-(3 - 5) >= 2",
+            "let x = 5\nlet y = x * 2\nx = x + 1\nx + y",
+            "let s = \"a\"\ns = s + \"b\"\ns = s + \"c\"\ns",
+            "let t = 0\nlet i = 0\nwhile i < 100 {\n    if i % 3 == 0 {\n        t = t + i\n    } elif i % 3 == 1 {\n        t = t - 1\n    } else {\n        t = t + 2\n    }\n    i = i + 1\n}\nt",
+            "let n = 0\nwhile n != 10 {\n    n = n + 1\n}\nn <= 10",
+            "if (true) { 1 } else { 2 }",
+            "let a = [1, 2, 3]\nlen(a) + 1",
+            "fun fib(n) {\n    if (n <= 1) {\n        return n;\n    }\n    return fib(n - 1) + fib(n - 2);\n}\nfib(15)",
+            "fun add(a, b) {\n    return a + b\n}\nlet k = 1\nk = add(k, 2)\nk + 3",
+            "fun make_counter() {\n    let count = 0\n    fun increment() {\n        count = count + 1\n        count\n    }\n    increment\n}\nlet c = make_counter()\nc()\nc()\nc()",
+            "fun loop_in_fn(n) {\n    let total = 0\n    let j = 0\n    while j < n {\n        total = total + j\n        j = j + 1\n    }\n    total\n}\nloop_in_fn(50)",
+            "let x = 1\nfun change() {\n    x = 100\n}\nchange()\nx + 1",
+            "\"a\" - 1",
+            "undefined_name + 1",
+            "let e = 1\ne = e + \"x\"",
+        ];
+
+        for source in programs {
+            let expected = run(compile(source, OptLevel::None));
+            for level in [OptLevel::Basic, OptLevel::Full] {
+                let actual = run(compile(source, level));
+                match (&expected, &actual) {
+                    (Ok(e), Ok(a)) => assert_eq!(e, a, "{:?} differs at {:?}", source, level),
+                    (Err(_), Err(_)) => {}
+                    _ => panic!("{:?} at {:?}: {:?} vs {:?}", source, level, expected, actual),
+                }
+            }
+        }
+    }
+}
@@ -1,5 +1,6 @@
 /// パーサー - トークンからASTを構築
 use crate::ast::*;
+use crate::shape::InlineCache;
 use crate::token::{Token, TokenType};
 use thiserror::Error;
 
@@ -24,18 +25,20 @@ pub enum ParserError {
     },
 }
 
-pub struct Parser {
-    tokens: Vec<Token>,
+pub struct Parser<'src> {
+    tokens: Vec<Token<'src>>,
     current: usize,
+    /// 構築中の構文木
+    ast: Ast,
 }
 
-impl Parser {
-    pub fn new(tokens: Vec<Token>) -> Self {
-        Parser { tokens, current: 0 }
+impl<'src> Parser<'src> {
+    pub fn new(tokens: Vec<Token<'src>>) -> Self {
+        Parser { tokens, current: 0, ast: Ast::new() }
     }
 
-    /// トークンからASTを構築
-    pub fn parse(mut self) -> Result<ASTNode, ParserError> {
+    /// トークンからASTを構築（ルートは Program ノード）
+    pub fn parse(mut self) -> Result<Ast, ParserError> {
         let mut statements = Vec::new();
 
         // NEWLINEとINDENT/DEDENTをスキップ
@@ -46,11 +49,13 @@ impl Parser {
             self.skip_newlines();
         }
 
-        Ok(ASTNode::Program { statements })
+        self.ast.set_root(statements);
+        self.ast.shrink_to_fit();
+        Ok(self.ast)
     }
 
     /// 文のパース
-    fn statement(&mut self) -> Result<ASTNode, ParserError> {
+    fn statement(&mut self) -> Result<NodeId, ParserError> {
         // let/const宣言
         if self.match_token(&[TokenType::Let, TokenType::Const]) {
             return self.variable_declaration();
@@ -61,6 +66,11 @@ impl Parser {
             return self.function_declaration();
         }
 
+        // クラス定義
+        if self.match_token(&[TokenType::Class]) {
+            return self.class_declaration();
+        }
+
         // return文
         if self.match_token(&[TokenType::Return]) {
             return self.return_statement();
@@ -89,19 +99,19 @@ impl Parser {
         // break文
         if self.match_token(&[TokenType::Break]) {
             self.skip_newlines();
-            return Ok(ASTNode::BreakStatement);
+            return Ok(self.ast.push(ASTNode::BreakStatement));
         }
 
         // continue文
         if self.match_token(&[TokenType::Continue]) {
             self.skip_newlines();
-            return Ok(ASTNode::ContinueStatement);
+            return Ok(self.ast.push(ASTNode::ContinueStatement));
         }
 
         // pass文
         if self.match_token(&[TokenType::Pass]) {
             self.skip_newlines();
-            return Ok(ASTNode::PassStatement);
+            return Ok(self.ast.push(ASTNode::PassStatement));
         }
 
         // assert文
@@ -116,30 +126,55 @@ impl Parser {
     }
 
     /// 変数宣言
-    fn variable_declaration(&mut self) -> Result<ASTNode, ParserError> {
+    fn variable_declaration(&mut self) -> Result<NodeId, ParserError> {
         let is_const = self.previous().token_type == TokenType::Const;
 
         let name = self.consume_identifier("variable name")?;
 
         self.consume(&TokenType::Assign, "=")?;
 
-        let value = Box::new(self.expression()?);
+        let value = self.expression()?;
 
         self.skip_newlines();
 
-        Ok(ASTNode::VariableDeclaration {
+        Ok(self.ast.push(ASTNode::VariableDeclaration {
             name,
             value,
             is_const,
-        })
+            slot: None,
+        }))
     }
 
     /// 関数定義
-    fn function_declaration(&mut self) -> Result<ASTNode, ParserError> {
+    fn function_declaration(&mut self) -> Result<NodeId, ParserError> {
         let is_async = self.previous().token_type == TokenType::AsyncFun;
+        // `async fun name()` と `async name()` のどちらも受け付ける
+        if is_async {
+            self.match_token(&[TokenType::Fun]);
+        }
 
         let name = self.consume_identifier("function name")?;
+        let parameters = self.parameters()?;
+        self.consume(&TokenType::LeftBrace, "{")?;
+        self.skip_newlines();
+
+        let body = self.block()?;
+
+        self.consume(&TokenType::RightBrace, "}")?;
+        self.skip_newlines();
 
+        Ok(self.ast.push(ASTNode::FunctionDeclaration {
+            name,
+            parameters,
+            body,
+            is_async,
+            is_generator: false,
+            slot: None,
+        }))
+    }
+
+    /// 括弧で囲んだパラメータ名の並び
+    fn parameters(&mut self) -> Result<Vec<String>, ParserError> {
         self.consume(&TokenType::LeftParen, "(")?;
 
         let mut parameters = Vec::new();
@@ -154,24 +189,46 @@ impl Parser {
         }
 
         self.consume(&TokenType::RightParen, ")")?;
+        Ok(parameters)
+    }
+
+    /// クラス定義（本体はメソッド定義の並び）
+    fn class_declaration(&mut self) -> Result<NodeId, ParserError> {
+        let name = self.consume_identifier("class name")?;
+
+        let parent = if self.match_token(&[TokenType::Extends]) {
+            let parent = self.consume_identifier("superclass name")?;
+            Some(self.ast.push(ASTNode::Identifier(parent)))
+        } else {
+            None
+        };
+
         self.consume(&TokenType::LeftBrace, "{")?;
         self.skip_newlines();
 
-        let body = self.block()?;
+        let mut methods = Vec::new();
+        while !self.check(&TokenType::RightBrace) && !self.is_at_end() {
+            if !self.match_token(&[TokenType::Fun, TokenType::AsyncFun]) {
+                self.consume(&TokenType::Fun, "method definition")?;
+            }
+            methods.push(self.function_declaration()?);
+            self.skip_newlines();
+        }
 
         self.consume(&TokenType::RightBrace, "}")?;
         self.skip_newlines();
 
-        Ok(ASTNode::FunctionDeclaration {
+        let body = self.ast.push_list(methods);
+        Ok(self.ast.push(ASTNode::ClassDeclaration {
             name,
-            parameters,
+            parent,
             body,
-            is_async,
-        })
+            slot: None,
+        }))
     }
 
     /// ブロック（複数の文）
-    fn block(&mut self) -> Result<Vec<ASTNode>, ParserError> {
+    fn block(&mut self) -> Result<NodeList, ParserError> {
         let mut statements = Vec::new();
 
         while !self.check(&TokenType::RightBrace) && !self.is_at_end() {
@@ -179,33 +236,36 @@ impl Parser {
             self.skip_newlines();
         }
 
-        Ok(statements)
+        Ok(self.ast.push_list(statements))
     }
 
     /// return文
-    fn return_statement(&mut self) -> Result<ASTNode, ParserError> {
-        let value = if self.check(&TokenType::Newline) || self.check(&TokenType::Semicolon) {
+    fn return_statement(&mut self) -> Result<NodeId, ParserError> {
+        let value = if self.check(&TokenType::Newline)
+            || self.check(&TokenType::Semicolon)
+            || self.check(&TokenType::RightBrace)
+        {
             None
         } else {
-            Some(Box::new(self.expression()?))
+            Some(self.expression()?)
         };
 
         self.skip_newlines();
 
-        Ok(ASTNode::ReturnStatement { value })
+        Ok(self.ast.push(ASTNode::ReturnStatement { value }))
     }
 
     /// yield文
-    fn yield_statement(&mut self) -> Result<ASTNode, ParserError> {
-        let value = Box::new(self.expression()?);
+    fn yield_statement(&mut self) -> Result<NodeId, ParserError> {
+        let value = self.expression()?;
         self.skip_newlines();
 
-        Ok(ASTNode::YieldStatement { value })
+        Ok(self.ast.push(ASTNode::YieldStatement { value }))
     }
 
     /// if文
-    fn if_statement(&mut self) -> Result<ASTNode, ParserError> {
-        let condition = Box::new(self.expression()?);
+    fn if_statement(&mut self) -> Result<NodeId, ParserError> {
+        let condition = self.expression()?;
 
         self.consume(&TokenType::LeftBrace, "{")?;
         self.skip_newlines();
@@ -243,17 +303,17 @@ impl Parser {
             None
         };
 
-        Ok(ASTNode::IfStatement {
+        Ok(self.ast.push(ASTNode::IfStatement {
             condition,
             then_body,
             elif_clauses,
             else_body,
-        })
+        }))
     }
 
     /// while文
-    fn while_statement(&mut self) -> Result<ASTNode, ParserError> {
-        let condition = Box::new(self.expression()?);
+    fn while_statement(&mut self) -> Result<NodeId, ParserError> {
+        let condition = self.expression()?;
 
         self.consume(&TokenType::LeftBrace, "{")?;
         self.skip_newlines();
@@ -263,18 +323,18 @@ impl Parser {
         self.consume(&TokenType::RightBrace, "}")?;
         self.skip_newlines();
 
-        Ok(ASTNode::WhileStatement { condition, body })
+        Ok(self.ast.push(ASTNode::WhileStatement { condition, body }))
     }
 
     /// for文
-    fn for_statement(&mut self) -> Result<ASTNode, ParserError> {
+    fn for_statement(&mut self) -> Result<NodeId, ParserError> {
         self.consume(&TokenType::LeftParen, "(")?;
 
         let variable = self.consume_identifier("loop variable")?;
 
         self.consume(&TokenType::In, "in")?;
 
-        let iterable = Box::new(self.expression()?);
+        let iterable = self.expression()?;
 
         self.consume(&TokenType::RightParen, ")")?;
         self.consume(&TokenType::LeftBrace, "{")?;
@@ -285,53 +345,54 @@ impl Parser {
         self.consume(&TokenType::RightBrace, "}")?;
         self.skip_newlines();
 
-        Ok(ASTNode::ForStatement {
+        Ok(self.ast.push(ASTNode::ForStatement {
             variable,
             iterable,
             body,
-        })
+            slot: None,
+        }))
     }
 
     /// assert文
-    fn assert_statement(&mut self) -> Result<ASTNode, ParserError> {
-        let condition = Box::new(self.expression()?);
+    fn assert_statement(&mut self) -> Result<NodeId, ParserError> {
+        let condition = self.expression()?;
 
         let message = if self.match_token(&[TokenType::Comma]) {
-            Some(Box::new(self.expression()?))
+            Some(self.expression()?)
         } else {
             None
         };
 
         self.skip_newlines();
 
-        Ok(ASTNode::AssertStatement { condition, message })
+        Ok(self.ast.push(ASTNode::AssertStatement { condition, message }))
     }
 
     /// 式のパース
-    fn expression(&mut self) -> Result<ASTNode, ParserError> {
+    fn expression(&mut self) -> Result<NodeId, ParserError> {
         self.assignment()
     }
 
     /// 代入
-    fn assignment(&mut self) -> Result<ASTNode, ParserError> {
+    fn assignment(&mut self) -> Result<NodeId, ParserError> {
         let expr = self.ternary()?;
 
         if self.match_token(&[TokenType::Assign]) {
-            let value = Box::new(self.assignment()?);
-            return Ok(ASTNode::Assignment {
-                target: Box::new(expr),
+            let value = self.assignment()?;
+            return Ok(self.ast.push(ASTNode::Assignment {
+                target: expr,
                 value,
-            });
+            }));
         }
 
         // 複合代入
         if let Some(op) = self.match_compound_assignment() {
-            let value = Box::new(self.assignment()?);
-            return Ok(ASTNode::CompoundAssignment {
-                target: Box::new(expr),
+            let value = self.assignment()?;
+            return Ok(self.ast.push(ASTNode::CompoundAssignment {
+                target: expr,
                 operator: op,
                 value,
-            });
+            }));
         }
 
         Ok(expr)
@@ -356,74 +417,74 @@ impl Parser {
     }
 
     /// 三項演算子
-    fn ternary(&mut self) -> Result<ASTNode, ParserError> {
+    fn ternary(&mut self) -> Result<NodeId, ParserError> {
         let mut expr = self.logical_or()?;
 
         if self.match_token(&[TokenType::Question]) {
-            let true_value = Box::new(self.expression()?);
+            let true_value = self.expression()?;
             self.consume(&TokenType::Colon, ":")?;
-            let false_value = Box::new(self.expression()?);
+            let false_value = self.expression()?;
 
-            expr = ASTNode::TernaryOperation {
-                condition: Box::new(expr),
+            expr = self.ast.push(ASTNode::TernaryOperation {
+                condition: expr,
                 true_value,
                 false_value,
-            };
+            });
         }
 
         Ok(expr)
     }
 
     /// 論理OR
-    fn logical_or(&mut self) -> Result<ASTNode, ParserError> {
+    fn logical_or(&mut self) -> Result<NodeId, ParserError> {
         let mut left = self.logical_and()?;
 
         while self.match_token(&[TokenType::Or]) {
-            let right = Box::new(self.logical_and()?);
-            left = ASTNode::BinaryOperation {
-                left: Box::new(left),
+            let right = self.logical_and()?;
+            left = self.ast.push(ASTNode::BinaryOperation {
+                left: left,
                 operator: BinaryOperator::Or,
                 right,
-            };
+            });
         }
 
         Ok(left)
     }
 
     /// 論理AND
-    fn logical_and(&mut self) -> Result<ASTNode, ParserError> {
+    fn logical_and(&mut self) -> Result<NodeId, ParserError> {
         let mut left = self.equality()?;
 
         while self.match_token(&[TokenType::And]) {
-            let right = Box::new(self.equality()?);
-            left = ASTNode::BinaryOperation {
-                left: Box::new(left),
+            let right = self.equality()?;
+            left = self.ast.push(ASTNode::BinaryOperation {
+                left: left,
                 operator: BinaryOperator::And,
                 right,
-            };
+            });
         }
 
         Ok(left)
     }
 
     /// 比較演算子
-    fn equality(&mut self) -> Result<ASTNode, ParserError> {
+    fn equality(&mut self) -> Result<NodeId, ParserError> {
         let mut left = self.comparison()?;
 
         while let Some(op) = self.match_binary_operator(&[TokenType::Equal, TokenType::NotEqual]) {
-            let right = Box::new(self.comparison()?);
-            left = ASTNode::BinaryOperation {
-                left: Box::new(left),
+            let right = self.comparison()?;
+            left = self.ast.push(ASTNode::BinaryOperation {
+                left: left,
                 operator: op,
                 right,
-            };
+            });
         }
 
         Ok(left)
     }
 
     /// 比較
-    fn comparison(&mut self) -> Result<ASTNode, ParserError> {
+    fn comparison(&mut self) -> Result<NodeId, ParserError> {
         let mut left = self.term()?;
 
         while let Some(op) = self.match_binary_operator(&[
@@ -432,74 +493,74 @@ impl Parser {
             TokenType::LessEqual,
             TokenType::GreaterEqual,
         ]) {
-            let right = Box::new(self.term()?);
-            left = ASTNode::BinaryOperation {
-                left: Box::new(left),
+            let right = self.term()?;
+            left = self.ast.push(ASTNode::BinaryOperation {
+                left: left,
                 operator: op,
                 right,
-            };
+            });
         }
 
         Ok(left)
     }
 
     /// 加減算
-    fn term(&mut self) -> Result<ASTNode, ParserError> {
+    fn term(&mut self) -> Result<NodeId, ParserError> {
         let mut left = self.factor()?;
 
         while let Some(op) = self.match_binary_operator(&[TokenType::Plus, TokenType::Minus]) {
-            let right = Box::new(self.factor()?);
-            left = ASTNode::BinaryOperation {
-                left: Box::new(left),
+            let right = self.factor()?;
+            left = self.ast.push(ASTNode::BinaryOperation {
+                left: left,
                 operator: op,
                 right,
-            };
+            });
         }
 
         Ok(left)
     }
 
     /// 乗除算
-    fn factor(&mut self) -> Result<ASTNode, ParserError> {
+    fn factor(&mut self) -> Result<NodeId, ParserError> {
         let mut left = self.unary()?;
 
         while let Some(op) =
             self.match_binary_operator(&[TokenType::Star, TokenType::Slash, TokenType::Percent])
         {
-            let right = Box::new(self.unary()?);
-            left = ASTNode::BinaryOperation {
-                left: Box::new(left),
+            let right = self.unary()?;
+            left = self.ast.push(ASTNode::BinaryOperation {
+                left: left,
                 operator: op,
                 right,
-            };
+            });
         }
 
         Ok(left)
     }
 
     /// 単項演算
-    fn unary(&mut self) -> Result<ASTNode, ParserError> {
+    fn unary(&mut self) -> Result<NodeId, ParserError> {
         if self.match_token(&[TokenType::Not]) {
-            let operand = Box::new(self.unary()?);
-            return Ok(ASTNode::UnaryOperation {
+            let operand = self.unary()?;
+            return Ok(self.ast.push(ASTNode::UnaryOperation {
                 operator: UnaryOperator::Not,
                 operand,
-            });
+            }));
         }
 
         if self.match_token(&[TokenType::Minus]) {
-            let operand = Box::new(self.unary()?);
-            return Ok(ASTNode::UnaryOperation {
+            let operand = self.unary()?;
+            return Ok(self.ast.push(ASTNode::UnaryOperation {
                 operator: UnaryOperator::Negate,
                 operand,
-            });
+            }));
         }
 
         self.postfix()
     }
 
     /// 後置演算子（関数呼び出し、インデックスアクセス等）
-    fn postfix(&mut self) -> Result<ASTNode, ParserError> {
+    fn postfix(&mut self) -> Result<NodeId, ParserError> {
         let mut expr = self.primary()?;
 
         loop {
@@ -508,19 +569,20 @@ impl Parser {
                 expr = self.finish_call(expr)?;
             } else if self.match_token(&[TokenType::LeftBracket]) {
                 // インデックスアクセス
-                let index = Box::new(self.expression()?);
+                let index = self.expression()?;
                 self.consume(&TokenType::RightBracket, "]")?;
-                expr = ASTNode::IndexAccess {
-                    object: Box::new(expr),
+                expr = self.ast.push(ASTNode::IndexAccess {
+                    object: expr,
                     index,
-                };
+                });
             } else if self.match_token(&[TokenType::Dot]) {
                 // メンバーアクセス
                 let member = self.consume_identifier("property name")?;
-                expr = ASTNode::MemberAccess {
-                    object: Box::new(expr),
+                expr = self.ast.push(ASTNode::MemberAccess {
+                    object: expr,
                     member,
-                };
+                    cache: InlineCache::new(),
+                });
             } else {
                 break;
             }
@@ -530,12 +592,45 @@ impl Parser {
     }
 
     /// 関数呼び出しの完了
-    fn finish_call(&mut self, callee: ASTNode) -> Result<ASTNode, ParserError> {
+    fn finish_call(&mut self, callee: NodeId) -> Result<NodeId, ParserError> {
+        let arguments = self.arguments()?;
+        Ok(self.ast.push(ASTNode::FunctionCall {
+            callee: callee,
+            arguments,
+        }))
+    }
+
+    /// インスタンス生成（new の後、クラス名とメンバーアクセスに続く引数）
+    fn new_expression(&mut self) -> Result<NodeId, ParserError> {
+        let name = self.consume_identifier("class name")?;
+        let mut class = self.ast.push(ASTNode::Identifier(name));
+        while self.match_token(&[TokenType::Dot]) {
+            let member = self.consume_identifier("class name")?;
+            class = self.ast.push(ASTNode::MemberAccess {
+                object: class,
+                member,
+                cache: InlineCache::new(),
+            });
+        }
+
+        self.consume(&TokenType::LeftParen, "(")?;
+        let arguments = self.arguments()?;
+        Ok(self.ast.push(ASTNode::NewExpression { class, arguments }))
+    }
+
+    /// 引数の並び（開き括弧の後から閉じ括弧まで）
+    fn arguments(&mut self) -> Result<NodeList, ParserError> {
         let mut arguments = Vec::new();
 
         if !self.check(&TokenType::RightParen) {
             loop {
-                arguments.push(self.expression()?);
+                let argument = self.expression()?;
+                // 唯一の引数ならジェネレータ式のかっこを省ける sum(x * x for x in xs)
+                if arguments.is_empty() && self.match_token(&[TokenType::For]) {
+                    arguments.push(self.generator_expression(argument)?);
+                    break;
+                }
+                arguments.push(argument);
 
                 if !self.match_token(&[TokenType::Comma]) {
                     break;
@@ -545,25 +640,22 @@ impl Parser {
 
         self.consume(&TokenType::RightParen, ")")?;
 
-        Ok(ASTNode::FunctionCall {
-            callee: Box::new(callee),
-            arguments,
-        })
+        Ok(self.ast.push_list(arguments))
     }
 
     /// プライマリ式
-    fn primary(&mut self) -> Result<ASTNode, ParserError> {
+    fn primary(&mut self) -> Result<NodeId, ParserError> {
         // リテラル
         if self.match_token(&[TokenType::True]) {
-            return Ok(ASTNode::Boolean(true));
+            return Ok(self.ast.push(ASTNode::Boolean(true)));
         }
 
         if self.match_token(&[TokenType::False]) {
-            return Ok(ASTNode::Boolean(false));
+            return Ok(self.ast.push(ASTNode::Boolean(false)));
         }
 
         if self.match_token(&[TokenType::Null]) {
-            return Ok(ASTNode::Null);
+            return Ok(self.ast.push(ASTNode::Null));
         }
 
         // 数値
@@ -576,7 +668,7 @@ impl Parser {
                     column: token.column,
                 }
             })?;
-            return Ok(ASTNode::Number(value));
+            return Ok(self.ast.push(ASTNode::Number(value)));
         }
 
         // 文字列
@@ -584,13 +676,18 @@ impl Parser {
             let token = self.advance();
             // クォートを削除
             let value = token.lexeme[1..token.lexeme.len() - 1].to_string();
-            return Ok(ASTNode::String(value));
+            return Ok(self.ast.push(ASTNode::String(value)));
         }
 
         // 識別子
         if let TokenType::Identifier = self.peek().token_type {
-            let name = self.advance().lexeme;
-            return Ok(ASTNode::Identifier(name));
+            let name = self.advance().lexeme.to_string();
+            return Ok(self.ast.push(ASTNode::Identifier(name)));
+        }
+
+        // インスタンス生成
+        if self.match_token(&[TokenType::New]) {
+            return self.new_expression();
         }
 
         // リスト
@@ -603,17 +700,32 @@ impl Parser {
             return self.dictionary();
         }
 
-        // グループ化
+        // グループ化・ジェネレータ式 (element for variable in iterable if condition)
         if self.match_token(&[TokenType::LeftParen]) {
             let expr = self.expression()?;
+            let expr = if self.match_token(&[TokenType::For]) {
+                self.generator_expression(expr)?
+            } else {
+                expr
+            };
             self.consume(&TokenType::RightParen, ")")?;
             return Ok(expr);
         }
 
+        // ラムダ式 lambda(params) { body }（関数と同じく最後の式の値を返す）
+        if self.match_token(&[TokenType::Lambda]) {
+            let parameters = self.parameters()?;
+            self.consume(&TokenType::LeftBrace, "{")?;
+            self.skip_newlines();
+            let body = self.block()?;
+            self.consume(&TokenType::RightBrace, "}")?;
+            return Ok(self.ast.push(ASTNode::Lambda { parameters, body }));
+        }
+
         // await式
         if self.match_token(&[TokenType::Await]) {
-            let expression = Box::new(self.expression()?);
-            return Ok(ASTNode::AwaitExpression { expression });
+            let expression = self.expression()?;
+            return Ok(self.ast.push(ASTNode::AwaitExpression { expression }));
         }
 
         Err(ParserError::UnexpectedToken {
@@ -625,45 +737,103 @@ impl Parser {
     }
 
     /// リスト
-    fn list(&mut self) -> Result<ASTNode, ParserError> {
+    fn list(&mut self) -> Result<NodeId, ParserError> {
         let mut elements = Vec::new();
 
         if !self.check(&TokenType::RightBracket) {
-            loop {
-                elements.push(self.expression()?);
+            let element = self.expression()?;
 
-                if !self.match_token(&[TokenType::Comma]) {
-                    break;
-                }
+            // リスト内包表記 [element for variable in iterable if condition]
+            if self.match_token(&[TokenType::For]) {
+                let (variable, iterable, condition) = self.comprehension_clause()?;
+                self.consume(&TokenType::RightBracket, "]")?;
+                return Ok(self.ast.push(ASTNode::ListComprehension {
+                    element,
+                    variable,
+                    iterable,
+                    condition,
+                    slot: None,
+                }));
+            }
+
+            elements.push(element);
+            while self.match_token(&[TokenType::Comma]) {
+                elements.push(self.expression()?);
             }
         }
 
         self.consume(&TokenType::RightBracket, "]")?;
 
-        Ok(ASTNode::List { elements })
+        let elements = self.ast.push_list(elements);
+        Ok(self.ast.push(ASTNode::List { elements }))
     }
 
     /// 辞書
-    fn dictionary(&mut self) -> Result<ASTNode, ParserError> {
+    fn dictionary(&mut self) -> Result<NodeId, ParserError> {
         let mut pairs = Vec::new();
 
         if !self.check(&TokenType::RightBrace) {
-            loop {
-                let key = self.expression()?;
-                self.consume(&TokenType::Colon, ":")?;
-                let value = self.expression()?;
-
-                pairs.push((key, value));
+            let key = self.expression()?;
+            self.consume(&TokenType::Colon, ":")?;
+            let value = self.expression()?;
+
+            // 辞書内包表記 {key: value for variable in iterable if condition}
+            if self.match_token(&[TokenType::For]) {
+                let (variable, iterable, condition) = self.comprehension_clause()?;
+                self.consume(&TokenType::RightBrace, "}")?;
+                return Ok(self.ast.push(ASTNode::DictComprehension {
+                    key,
+                    value,
+                    variable,
+                    iterable,
+                    condition,
+                    slot: None,
+                }));
+            }
 
-                if !self.match_token(&[TokenType::Comma]) {
-                    break;
-                }
+            pairs.push(key);
+            pairs.push(value);
+            while self.match_token(&[TokenType::Comma]) {
+                pairs.push(self.expression()?);
+                self.consume(&TokenType::Colon, ":")?;
+                pairs.push(self.expression()?);
             }
         }
 
         self.consume(&TokenType::RightBrace, "}")?;
 
-        Ok(ASTNode::Dictionary { pairs })
+        let pairs = self.ast.push_list(pairs);
+        Ok(self.ast.push(ASTNode::Dictionary { pairs }))
+    }
+
+    /// 内包表記の for 以降（変数・反復対象・省略できる if 条件）
+    /// for 文と同じく `for (x in xs)` とかっこで囲んでもよい
+    fn comprehension_clause(&mut self) -> Result<(String, NodeId, Option<NodeId>), ParserError> {
+        let parenthesized = self.match_token(&[TokenType::LeftParen]);
+        let variable = self.consume_identifier("loop variable")?;
+        self.consume(&TokenType::In, "in")?;
+        let iterable = self.expression()?;
+        if parenthesized {
+            self.consume(&TokenType::RightParen, ")")?;
+        }
+        let condition = if self.match_token(&[TokenType::If]) {
+            Some(self.expression()?)
+        } else {
+            None
+        };
+        Ok((variable, iterable, condition))
+    }
+
+    /// ジェネレータ式の for 以降（要素は解析済み、かっこは呼び出し側で閉じる）
+    fn generator_expression(&mut self, element: NodeId) -> Result<NodeId, ParserError> {
+        let (variable, iterable, condition) = self.comprehension_clause()?;
+        Ok(self.ast.push(ASTNode::GeneratorExpression {
+            element,
+            variable,
+            iterable,
+            condition,
+            slot: None,
+        }))
     }
 
     // ヘルパーメソッド
@@ -709,7 +879,7 @@ impl Parser {
         std::mem::discriminant(&self.peek().token_type) == std::mem::discriminant(token_type)
     }
 
-    fn advance(&mut self) -> Token {
+    fn advance(&mut self) -> Token<'src> {
         if !self.is_at_end() {
             self.current += 1;
         }
@@ -720,15 +890,15 @@ impl Parser {
         matches!(self.peek().token_type, TokenType::Eof)
     }
 
-    fn peek(&self) -> &Token {
+    fn peek(&self) -> &Token<'src> {
         &self.tokens[self.current]
     }
 
-    fn previous(&self) -> Token {
-        self.tokens[self.current - 1].clone()
+    fn previous(&self) -> Token<'src> {
+        self.tokens[self.current - 1]
     }
 
-    fn consume(&mut self, token_type: &TokenType, message: &str) -> Result<Token, ParserError> {
+    fn consume(&mut self, token_type: &TokenType, message: &str) -> Result<Token<'src>, ParserError> {
         if self.check(token_type) {
             return Ok(self.advance());
         }
@@ -743,7 +913,7 @@ impl Parser {
 
     fn consume_identifier(&mut self, context: &str) -> Result<String, ParserError> {
         if let TokenType::Identifier = self.peek().token_type {
-            Ok(self.advance().lexeme)
+            Ok(self.advance().lexeme.to_string())
         } else {
             Err(ParserError::UnexpectedToken {
                 expected: context.to_string(),
@@ -754,8 +924,9 @@ impl Parser {
         }
     }
 
+    /// 文の区切り（改行・インデント・セミコロン）を読み飛ばす
     fn skip_newlines(&mut self) {
-        while self.match_token(&[TokenType::Newline, TokenType::Indent, TokenType::Dedent]) {}
+        while self.match_token(&[TokenType::Newline, TokenType::Indent, TokenType::Dedent, TokenType::Semicolon]) {}
     }
 }
 
@@ -764,8 +935,8 @@ mod tests {
     use super::*;
     use crate::lexer::Lexer;
 
-    fn parse_source(source: &str) -> Result<ASTNode, ParserError> {
-        let lexer = Lexer::new(source.to_string());
+    fn parse_source(source: &str) -> Result<Ast, ParserError> {
+        let lexer = Lexer::new(source);
         let tokens = lexer.tokenize().unwrap();
         let parser = Parser::new(tokens);
         parser.parse()
@@ -774,22 +945,20 @@ mod tests {
     #[test]
     fn test_parse_number() {
         let ast = parse_source("42").unwrap();
-        if let ASTNode::Program { statements } = ast {
-            assert_eq!(statements.len(), 1);
-            assert!(matches!(statements[0], ASTNode::Number(42.0)));
-        }
+        let statements = ast.statements();
+        assert_eq!(statements.len(), 1);
+        assert!(matches!(ast.node(statements[0]), ASTNode::Number(n) if *n == 42.0));
     }
 
     #[test]
     fn test_parse_variable() {
         let ast = parse_source("let x = 10").unwrap();
-        if let ASTNode::Program { statements } = ast {
-            assert_eq!(statements.len(), 1);
-            assert!(matches!(
-                &statements[0],
-                ASTNode::VariableDeclaration { .. }
-            ));
-        }
+        let statements = ast.statements();
+        assert_eq!(statements.len(), 1);
+        assert!(matches!(
+            ast.node(statements[0]),
+            ASTNode::VariableDeclaration { .. }
+        ));
     }
 
     #[test]
@@ -800,20 +969,184 @@ fun add(a, b) {
 }
 "#;
         let ast = parse_source(source).unwrap();
-        if let ASTNode::Program { statements } = ast {
-            assert_eq!(statements.len(), 1);
-            assert!(matches!(
-                &statements[0],
-                ASTNode::FunctionDeclaration { .. }
-            ));
+        let statements = ast.statements();
+        assert_eq!(statements.len(), 1);
+        match ast.node(statements[0]) {
+            ASTNode::FunctionDeclaration { parameters, body, .. } => {
+                assert_eq!(parameters, &["a".to_string(), "b".to_string()]);
+                assert_eq!(body.len(), 1);
+                assert!(matches!(ast.node(ast.list(*body)[0]), ASTNode::ReturnStatement { value: Some(_) }));
+            }
+            _ => panic!("Expected FunctionDeclaration"),
+        }
+    }
+
+    #[test]
+    fn test_parse_async_function() {
+        // `async fun name()` と `async name()` は同じ
+        for source in ["async fun fetch(url) {\n return await get(url)\n}", "async fetch(url) {\n return await get(url)\n}"] {
+            let ast = parse_source(source).unwrap();
+            match ast.node(ast.statements()[0]) {
+                ASTNode::FunctionDeclaration { name, is_async: true, body, .. } => {
+                    assert_eq!(name, "fetch");
+                    let ASTNode::ReturnStatement { value: Some(value) } = ast.node(ast.list(*body)[0]) else {
+                        panic!("Expected ReturnStatement");
+                    };
+                    assert!(matches!(ast.node(*value), ASTNode::AwaitExpression { .. }));
+                }
+                _ => panic!("Expected async FunctionDeclaration"),
+            }
+        }
+    }
+
+    #[test]
+    fn test_parse_lambda() {
+        let ast = parse_source("let add = lambda(a, b) { a + b }").unwrap();
+        let ASTNode::VariableDeclaration { value, .. } = ast.node(ast.statements()[0]) else {
+            panic!("Expected VariableDeclaration");
+        };
+        match ast.node(*value) {
+            ASTNode::Lambda { parameters, body } => {
+                assert_eq!(parameters, &["a".to_string(), "b".to_string()]);
+                assert_eq!(body.len(), 1);
+                assert!(matches!(ast.node(ast.list(*body)[0]), ASTNode::BinaryOperation { operator: BinaryOperator::Add, .. }));
+            }
+            _ => panic!("Expected Lambda"),
         }
     }
 
     #[test]
     fn test_parse_binary_operation() {
         let ast = parse_source("1 + 2 * 3").unwrap();
-        if let ASTNode::Program { statements } = ast {
-            assert!(matches!(&statements[0], ASTNode::BinaryOperation { .. }));
+        match ast.node(ast.statements()[0]) {
+            ASTNode::BinaryOperation { operator: BinaryOperator::Add, right, .. } => {
+                assert!(matches!(ast.node(*right), ASTNode::BinaryOperation { operator: BinaryOperator::Multiply, .. }));
+            }
+            _ => panic!("Expected BinaryOperation"),
         }
     }
+
+    #[test]
+    fn test_parse_semicolons() {
+        let ast = parse_source("let x = 42; x;\nfun f() { return; }").unwrap();
+        let statements = ast.statements();
+        assert_eq!(statements.len(), 3);
+        assert!(matches!(ast.node(statements[1]), ASTNode::Identifier(_)));
+    }
+
+    #[test]
+    fn test_parse_dictionary_pairs() {
+        let ast = parse_source("{\"a\": 1, \"b\": 2}").unwrap();
+        match ast.node(ast.statements()[0]) {
+            ASTNode::Dictionary { pairs } => {
+                let pairs: Vec<_> = ast.pairs(*pairs).collect();
+                assert_eq!(pairs.len(), 2);
+                assert_eq!(ast.node(pairs[1].0), &ASTNode::String("b".to_string()));
+                assert_eq!(ast.node(pairs[1].1), &ASTNode::Number(2.0));
+            }
+            _ => panic!("Expected Dictionary"),
+        }
+    }
+
+    #[test]
+    fn test_parse_list_comprehension() {
+        for source in ["[x * x for x in xs]", "[x * x for (x in range(1, 11))]"] {
+            let ast = parse_source(source).unwrap();
+            match ast.node(ast.statements()[0]) {
+                ASTNode::ListComprehension { variable, condition, .. } => {
+                    assert_eq!(variable, "x");
+                    assert!(condition.is_none());
+                }
+                _ => panic!("Expected ListComprehension: {}", source),
+            }
+        }
+
+        for source in ["[x for x in xs if x % 2 == 0]", "[x for (x in range(1, 21)) if (x % 2 == 0)]"] {
+            let ast = parse_source(source).unwrap();
+            assert!(
+                matches!(ast.node(ast.statements()[0]), ASTNode::ListComprehension { condition: Some(_), .. }),
+                "{}",
+                source
+            );
+        }
+        assert!(parse_source("[x for (x in xs]").is_err());
+    }
+
+    #[test]
+    fn test_parse_dict_comprehension() {
+        let ast = parse_source("{w: len(w) for w in words if w != \"\"}").unwrap();
+        match ast.node(ast.statements()[0]) {
+            ASTNode::DictComprehension { variable, condition, .. } => {
+                assert_eq!(variable, "w");
+                assert!(condition.is_some());
+            }
+            _ => panic!("Expected DictComprehension"),
+        }
+
+        for source in ["{x: x * x for x in xs}", "{x: x * x for (x in range(1, 6))}"] {
+            let ast = parse_source(source).unwrap();
+            assert!(
+                matches!(ast.node(ast.statements()[0]), ASTNode::DictComprehension { condition: None, .. }),
+                "{}",
+                source
+            );
+        }
+        let ast = parse_source("{x: x * x for (x in range(1, 11)) if (x % 2 == 0)}").unwrap();
+        assert!(matches!(ast.node(ast.statements()[0]), ASTNode::DictComprehension { condition: Some(_), .. }));
+    }
+
+    #[test]
+    fn test_parse_generator_expression() {
+        let ast = parse_source("(x * x for x in xs if x > 0)").unwrap();
+        assert!(matches!(ast.node(ast.statements()[0]), ASTNode::GeneratorExpression { condition: Some(_), .. }));
+
+        // 唯一の引数ならかっこを省ける
+        let ast = parse_source("sum(x for x in xs)").unwrap();
+        match ast.node(ast.statements()[0]) {
+            ASTNode::FunctionCall { arguments, .. } => {
+                assert_eq!(arguments.len(), 1);
+                assert!(matches!(ast.node(ast.list(*arguments)[0]), ASTNode::GeneratorExpression { .. }));
+            }
+            _ => panic!("Expected FunctionCall"),
+        }
+        assert!(parse_source("f(x for x in xs, 1)").is_err());
+    }
+
+    #[test]
+    fn test_parse_class() {
+        let source = r#"
+class Dog extends Animal {
+    fun __init__(self, name) {
+        self.name = name
+    }
+
+    fun speak(self) {
+        return self.name
+    }
+}
+new Dog("rex").speak()
+"#;
+        let ast = parse_source(source).unwrap();
+        let statements = ast.statements();
+        match ast.node(statements[0]) {
+            ASTNode::ClassDeclaration { name, parent: Some(parent), body, .. } => {
+                assert_eq!(name, "Dog");
+                assert_eq!(ast.node(*parent), &ASTNode::Identifier("Animal".to_string()));
+                assert_eq!(body.len(), 2);
+            }
+            _ => panic!("Expected ClassDeclaration"),
+        }
+        match ast.node(statements[1]) {
+            ASTNode::FunctionCall { callee, .. } => match ast.node(*callee) {
+                ASTNode::MemberAccess { object, member, .. } => {
+                    assert_eq!(member, "speak");
+                    assert!(matches!(ast.node(*object), ASTNode::NewExpression { arguments, .. } if arguments.len() == 1));
+                }
+                _ => panic!("Expected MemberAccess"),
+            },
+            _ => panic!("Expected FunctionCall"),
+        }
+
+        assert!(parse_source("class A { let x = 1 }").is_err());
+    }
 }
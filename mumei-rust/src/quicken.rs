@@ -0,0 +1,373 @@
+/// 実行時の命令特殊化（quickening）
+/// VMは関数ごとに命令列の複製を持ち、汎用命令が何度か実行されたところで
+/// そのときのオペランドの型専用の命令（AddNum, LessNumJump, ConcatStr, LoadGlobalCached など）に書き換える。
+/// 特殊化命令は型を確かめ、想定と違えば汎用命令に戻してから実行し直す（脱特殊化）。
+/// 共有されるバイトコード（Arc<ByteCode>）は書き換えないので、スレッド間で共有したままでよい。
+
+use crate::bytecode::{ByteCode, Instruction};
+use crate::shape::InlineCache;
+use crate::value::Value;
+use std::cell::{Cell, OnceCell};
+use std::fmt::Write;
+use std::rc::Rc;
+
+/// 特殊化を試みるまでに汎用命令を実行する回数
+const WARMUP: u8 = 8;
+
+/// 特殊化できなかった・脱特殊化した命令が、次に特殊化を試みるまでに実行する回数
+const BACKOFF: u8 = 64;
+
+/// 書き換え可能な命令列（1つのチャンクに1つ、同じ関数のクロージャで共有する）
+pub struct QuickCode {
+    /// 実行する命令（元のチャンクと同じ長さ・同じジャンプ先）
+    instructions: Box<[Cell<Instruction>]>,
+
+    /// 命令ごとの、次に特殊化を試みるまでの残り実行回数
+    counters: Box<[Cell<u8>]>,
+
+    /// 入れ子の関数の命令列（最初にクロージャを作るときに用意する）
+    functions: Box<[OnceCell<Rc<QuickCode>>]>,
+
+    /// 定数プールを実行時の値にしたもの（文字列を読み込むたびに作らず、共有する）
+    constants: Box<[Value]>,
+
+    /// メンバーアクセス命令のインラインキャッシュ（命令のオペランドの番号で引く）
+    caches: Box<[InlineCache]>,
+}
+
+impl QuickCode {
+    /// チャンクの命令列を複製する
+    pub fn new(chunk: &ByteCode) -> Self {
+        QuickCode {
+            instructions: chunk.instructions.iter().copied().map(Cell::new).collect(),
+            counters: chunk.instructions.iter().map(|_| Cell::new(WARMUP)).collect(),
+            functions: chunk.functions.iter().map(|_| OnceCell::new()).collect(),
+            constants: chunk.constants.iter().map(|constant| constant.to_value()).collect(),
+            caches: (0..Self::cache_count(chunk)).map(|_| InlineCache::new()).collect(),
+        }
+    }
+
+    /// チャンクのメンバーアクセス命令が使うキャッシュの数
+    fn cache_count(chunk: &ByteCode) -> usize {
+        chunk.instructions
+            .iter()
+            .filter_map(Instruction::inline_cache)
+            .map(|cache| cache as usize + 1)
+            .max()
+            .unwrap_or(0)
+    }
+
+    /// index 番目のインラインキャッシュ
+    #[inline(always)]
+    pub fn cache(&self, index: u32) -> &InlineCache {
+        // SAFETY: キャッシュは命令列に現れる最大の番号まで用意し、特殊化でもオペランドは変わらない
+        unsafe { self.caches.get_unchecked(index as usize) }
+    }
+
+    /// index 番目の定数の値
+    #[inline(always)]
+    pub fn constant(&self, index: u32) -> &Value {
+        // SAFETY: 検証器が定数のインデックスが定数プールの範囲内であることを保証している
+        unsafe { self.constants.get_unchecked(index as usize) }
+    }
+
+    /// 実行する命令列
+    #[inline(always)]
+    pub fn instructions(&self) -> &[Cell<Instruction>] {
+        &self.instructions
+    }
+
+    /// chunk（この命令列の元）の index 番目の関数の命令列
+    pub fn function(&self, index: usize, chunk: &ByteCode) -> Rc<QuickCode> {
+        self.functions[index]
+            .get_or_init(|| Rc::new(QuickCode::new(&chunk.functions[index].chunk)))
+            .clone()
+    }
+
+    /// 汎用命令の実行を数え、特殊化を試みる時期ならtrue
+    #[inline(always)]
+    pub fn warm_up(&self, pc: usize) -> bool {
+        let counter = &self.counters[pc];
+        let remaining = counter.get();
+        if remaining > 1 {
+            counter.set(remaining - 1);
+            false
+        } else {
+            true
+        }
+    }
+
+    /// 特殊化命令に書き換える（Noneなら書き換えず、しばらく試みない）
+    pub fn rewrite(&self, pc: usize, specialized: Option<Instruction>) {
+        match specialized {
+            Some(instruction) => self.instructions[pc].set(instruction),
+            None => self.counters[pc].set(BACKOFF),
+        }
+    }
+
+    /// 特殊化命令を汎用命令に戻す
+    pub fn deoptimize(&self, pc: usize) {
+        let cell = &self.instructions[pc];
+        cell.set(cell.get().generic());
+        self.counters[pc].set(BACKOFF);
+    }
+}
+
+/// 二項演算（比較と分岐の複合命令を含む）のオペランドの型に合う特殊化命令
+pub fn specialize_binary(instruction: Instruction, left: &Value, right: &Value) -> Option<Instruction> {
+    match (left, right) {
+        (Value::Number(_), Value::Number(_)) => Some(match instruction {
+            Instruction::Add => Instruction::AddNum,
+            Instruction::Subtract => Instruction::SubtractNum,
+            Instruction::Multiply => Instruction::MultiplyNum,
+            Instruction::Divide => Instruction::DivideNum,
+            Instruction::Less => Instruction::LessNum,
+            Instruction::Greater => Instruction::GreaterNum,
+            Instruction::LessEqual => Instruction::LessEqualNum,
+            Instruction::GreaterEqual => Instruction::GreaterEqualNum,
+            Instruction::LessJumpIfFalse(target) => Instruction::LessNumJump(target),
+            Instruction::GreaterJumpIfFalse(target) => Instruction::GreaterNumJump(target),
+            Instruction::LessEqualJumpIfFalse(target) => Instruction::LessEqualNumJump(target),
+            Instruction::GreaterEqualJumpIfFalse(target) => Instruction::GreaterEqualNumJump(target),
+            _ => return None,
+        }),
+        (Value::String(_), Value::String(_)) if instruction == Instruction::Add => Some(Instruction::ConcatStr),
+        _ => None,
+    }
+}
+
+/// 特殊化の種類（統計の集計単位）
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum Specialization {
+    AddNum,
+    SubtractNum,
+    MultiplyNum,
+    DivideNum,
+    ConcatStr,
+    CompareNum,
+    CompareNumJump,
+    LoadGlobalCached,
+}
+
+impl Specialization {
+    /// すべての種類（表示順）
+    pub const ALL: [Specialization; 8] = [
+        Specialization::AddNum,
+        Specialization::SubtractNum,
+        Specialization::MultiplyNum,
+        Specialization::DivideNum,
+        Specialization::ConcatStr,
+        Specialization::CompareNum,
+        Specialization::CompareNumJump,
+        Specialization::LoadGlobalCached,
+    ];
+
+    /// 特殊化命令の種類（特殊化命令以外はNone）
+    pub fn of(instruction: Instruction) -> Option<Specialization> {
+        Some(match instruction {
+            Instruction::AddNum => Specialization::AddNum,
+            Instruction::SubtractNum => Specialization::SubtractNum,
+            Instruction::MultiplyNum => Specialization::MultiplyNum,
+            Instruction::DivideNum => Specialization::DivideNum,
+            Instruction::ConcatStr => Specialization::ConcatStr,
+            Instruction::LessNum
+            | Instruction::GreaterNum
+            | Instruction::LessEqualNum
+            | Instruction::GreaterEqualNum => Specialization::CompareNum,
+            Instruction::LessNumJump(_)
+            | Instruction::GreaterNumJump(_)
+            | Instruction::LessEqualNumJump(_)
+            | Instruction::GreaterEqualNumJump(_) => Specialization::CompareNumJump,
+            Instruction::LoadGlobalCached(_) => Specialization::LoadGlobalCached,
+            _ => return None,
+        })
+    }
+
+    /// 表示名
+    pub fn name(self) -> &'static str {
+        match self {
+            Specialization::AddNum => "AddNum",
+            Specialization::SubtractNum => "SubtractNum",
+            Specialization::MultiplyNum => "MultiplyNum",
+            Specialization::DivideNum => "DivideNum",
+            Specialization::ConcatStr => "ConcatStr",
+            Specialization::CompareNum => "CompareNum",
+            Specialization::CompareNumJump => "CompareNumJump",
+            Specialization::LoadGlobalCached => "LoadGlobalCached",
+        }
+    }
+}
+
+/// 1種類の特殊化命令の実行回数
+#[derive(Debug, Clone, Copy, Default, PartialEq)]
+pub struct SpecializationCounts {
+    /// 汎用命令をこの命令に書き換えた回数
+    pub specialized: u64,
+
+    /// 型が想定どおりで特殊化したまま実行できた回数
+    pub hits: u64,
+
+    /// 型が違い汎用命令に戻した回数
+    pub misses: u64,
+}
+
+impl SpecializationCounts {
+    /// 特殊化命令の実行のうち型が想定どおりだった割合（0.0〜1.0）
+    pub fn hit_rate(&self) -> f64 {
+        let total = self.hits + self.misses;
+        if total > 0 {
+            self.hits as f64 / total as f64
+        } else {
+            0.0
+        }
+    }
+}
+
+/// 特殊化の統計（VM::set_quicken_stats で有効にした実行のみ集計する）
+#[derive(Debug, Clone, Default, PartialEq)]
+pub struct QuickenStats {
+    /// 種類ごとの回数（Specialization::ALL の順）
+    counts: [SpecializationCounts; Specialization::ALL.len()],
+
+    /// 特殊化できる命令を汎用命令のまま実行した回数
+    pub generic: u64,
+}
+
+impl QuickenStats {
+    /// 種類ごとの回数
+    pub fn get(&self, kind: Specialization) -> SpecializationCounts {
+        self.counts[kind as usize]
+    }
+
+    /// 全種類の合計
+    pub fn total(&self) -> SpecializationCounts {
+        self.counts.iter().fold(SpecializationCounts::default(), |sum, counts| SpecializationCounts {
+            specialized: sum.specialized + counts.specialized,
+            hits: sum.hits + counts.hits,
+            misses: sum.misses + counts.misses,
+        })
+    }
+
+    /// 特殊化できる命令の実行のうち特殊化命令として実行できた割合（0.0〜1.0）
+    pub fn coverage(&self) -> f64 {
+        let total = self.total();
+        let executed = total.hits + total.misses + self.generic;
+        if executed > 0 {
+            total.hits as f64 / executed as f64
+        } else {
+            0.0
+        }
+    }
+
+    #[inline(always)]
+    pub(crate) fn record_specialized(&mut self, instruction: Instruction) {
+        if let Some(kind) = Specialization::of(instruction) {
+            self.counts[kind as usize].specialized += 1;
+        }
+    }
+
+    #[inline(always)]
+    pub(crate) fn record_hit(&mut self, instruction: Instruction) {
+        if let Some(kind) = Specialization::of(instruction) {
+            self.counts[kind as usize].hits += 1;
+        }
+    }
+
+    #[inline(always)]
+    pub(crate) fn record_miss(&mut self, instruction: Instruction) {
+        if let Some(kind) = Specialization::of(instruction) {
+            self.counts[kind as usize].misses += 1;
+        }
+    }
+
+    /// 種類ごとの表（CLI の MUMEI_QUICKEN_STATS 用）
+    pub fn report(&self) -> String {
+        let mut report = format!(
+            "{:<18} {:>12} {:>12} {:>12} {:>9}\n",
+            "specialization", "specialized", "hits", "misses", "hit rate"
+        );
+        for kind in Specialization::ALL {
+            let counts = self.get(kind);
+            if counts.specialized == 0 {
+                continue;
+            }
+            let _ = writeln!(
+                report,
+                "{:<18} {:>12} {:>12} {:>12} {:>8.1}%",
+                kind.name(),
+                counts.specialized,
+                counts.hits,
+                counts.misses,
+                counts.hit_rate() * 100.0
+            );
+        }
+        let _ = writeln!(
+            report,
+            "generic executions: {}, specialized coverage: {:.1}%",
+            self.generic,
+            self.coverage() * 100.0
+        );
+        report
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_specialize_binary() {
+        let (one, text) = (Value::Number(1.0), Value::String("a".into()));
+        assert_eq!(specialize_binary(Instruction::Add, &one, &one), Some(Instruction::AddNum));
+        assert_eq!(specialize_binary(Instruction::Add, &text, &text), Some(Instruction::ConcatStr));
+        assert_eq!(specialize_binary(Instruction::Add, &one, &text), None);
+        assert_eq!(specialize_binary(Instruction::Less, &text, &text), None);
+        assert_eq!(
+            specialize_binary(Instruction::LessEqualJumpIfFalse(7), &one, &one),
+            Some(Instruction::LessEqualNumJump(7))
+        );
+        assert_eq!(specialize_binary(Instruction::Equal, &one, &one), None);
+    }
+
+    #[test]
+    fn test_rewrite_and_deoptimize() {
+        let mut chunk = ByteCode::new();
+        chunk.emit(Instruction::Add);
+        chunk.emit(Instruction::Halt);
+        let code = QuickCode::new(&chunk);
+
+        // WARMUP 回目で特殊化を試みる
+        for _ in 1..WARMUP {
+            assert!(!code.warm_up(0));
+        }
+        assert!(code.warm_up(0));
+        code.rewrite(0, Some(Instruction::AddNum));
+        assert_eq!(code.instructions()[0].get(), Instruction::AddNum);
+
+        // 脱特殊化すると汎用命令に戻り、BACKOFF 回実行するまで試みない
+        code.deoptimize(0);
+        assert_eq!(code.instructions()[0].get(), Instruction::Add);
+        for _ in 1..BACKOFF {
+            assert!(!code.warm_up(0));
+        }
+        assert!(code.warm_up(0));
+    }
+
+    #[test]
+    fn test_stats() {
+        let mut stats = QuickenStats::default();
+        stats.record_specialized(Instruction::LessNumJump(3));
+        for _ in 0..3 {
+            stats.record_hit(Instruction::LessNumJump(3));
+        }
+        stats.record_miss(Instruction::GreaterNumJump(3));
+        stats.generic = 4;
+
+        let counts = stats.get(Specialization::CompareNumJump);
+        assert_eq!(counts, SpecializationCounts { specialized: 1, hits: 3, misses: 1 });
+        assert_eq!(counts.hit_rate(), 0.75);
+        assert_eq!(stats.coverage(), 3.0 / 8.0);
+        assert!(stats.report().contains("CompareNumJump"));
+        assert!(!stats.report().contains("AddNum"));
+    }
+}
@@ -0,0 +1,553 @@
+/// 変数解決パス
+/// パース済みASTを走査し、関数ローカル変数に (depth, slot) を割り当てる
+/// インタプリタとバイトコードコンパイラの両方がこの結果を利用する
+
+use std::collections::{HashMap, HashSet};
+use crate::ast::{ASTNode, Ast, NodeId, NodeList};
+
+/// 関数スコープ（ローカル変数のスロット割り当て）
+struct FunctionScope {
+    /// 変数名 → スロット番号
+    slots: HashMap<String, usize>,
+
+    /// 定数（const）として宣言された変数名
+    constants: HashSet<String>,
+
+    /// 本体に yield がある（ネストした関数の yield は数えない）
+    generator: bool,
+}
+
+impl FunctionScope {
+    fn new() -> Self {
+        FunctionScope {
+            slots: HashMap::new(),
+            constants: HashSet::new(),
+            generator: false,
+        }
+    }
+}
+
+/// ジェネレータ式の関数が反復対象を受け取るパラメータ（識別子にならない名前）
+pub const GENERATOR_SOURCE: &str = "<source>";
+
+/// リゾルバ
+///
+/// トップレベルの変数はグローバル（名前で参照）のまま残し、
+/// 関数本体内で宣言された変数・パラメータにはフレーム内のスロット番号を割り当てる。
+/// スコープは関数単位（if/while のブロックは新しいスコープを作らない）で、
+/// インタプリタの環境チェーンと同じ構造になる。
+pub struct Resolver {
+    /// 関数スコープのスタック（空ならトップレベル）
+    scopes: Vec<FunctionScope>,
+}
+
+impl Resolver {
+    /// 新しいリゾルバを作成
+    pub fn new() -> Self {
+        Resolver { scopes: Vec::new() }
+    }
+
+    /// 構文木を解決（ノードをその場で書き換える）
+    pub fn resolve(&mut self, ast: &mut Ast) -> Result<(), String> {
+        match ast.root() {
+            Some(root) => self.resolve_node(ast, root),
+            None => Ok(()),
+        }
+    }
+
+    /// ブロックを解決（関数宣言とクラス宣言は先に巻き上げる）
+    fn resolve_block(&mut self, ast: &mut Ast, nodes: NodeList) -> Result<(), String> {
+        // 相互再帰するネスト関数のため、宣言名を先にスロットへ割り当てる
+        for &id in ast.list(nodes) {
+            match ast.node(id) {
+                ASTNode::FunctionDeclaration { name, .. } | ASTNode::ClassDeclaration { name, .. } => {
+                    self.declare(name);
+                }
+                _ => {}
+            }
+        }
+
+        self.resolve_list(ast, nodes)
+    }
+
+    /// 子ノードのリストを解決（巻き上げなし）
+    fn resolve_list(&mut self, ast: &mut Ast, nodes: NodeList) -> Result<(), String> {
+        for index in 0..nodes.len() {
+            let id = ast.list(nodes)[index];
+            self.resolve_node(ast, id)?;
+        }
+        Ok(())
+    }
+
+    fn resolve_optional(&mut self, ast: &mut Ast, node: Option<NodeId>) -> Result<(), String> {
+        match node {
+            Some(id) => self.resolve_node(ast, id),
+            None => Ok(()),
+        }
+    }
+
+    /// 現在の関数スコープに変数を宣言（トップレベルならNone = グローバル）
+    fn declare(&mut self, name: &str) -> Option<usize> {
+        let scope = self.scopes.last_mut()?;
+
+        if let Some(&slot) = scope.slots.get(name) {
+            return Some(slot);
+        }
+
+        let slot = scope.slots.len();
+        scope.slots.insert(name.to_string(), slot);
+        Some(slot)
+    }
+
+    /// 変数を内側のスコープから順に探す
+    fn lookup(&self, name: &str) -> Option<(usize, usize)> {
+        for (depth, scope) in self.scopes.iter().rev().enumerate() {
+            if let Some(&slot) = scope.slots.get(name) {
+                return Some((depth, slot));
+            }
+        }
+        None
+    }
+
+    /// 変数参照（Identifier ノード）を解決済みノードに置き換える
+    fn resolve_variable(&self, ast: &mut Ast, id: NodeId) {
+        let node = ast.node_mut(id);
+        if let ASTNode::Identifier(name) = node {
+            let name = std::mem::take(name);
+            *node = match self.lookup(&name) {
+                Some((depth, slot)) => ASTNode::LocalVariable { name, depth, slot },
+                None => ASTNode::GlobalVariable { name },
+            };
+        }
+    }
+
+    /// 代入先を解決（ローカル定数への代入はここで検出）
+    fn resolve_assignment_target(&mut self, ast: &mut Ast, target: NodeId) -> Result<(), String> {
+        let name = match ast.node(target) {
+            ASTNode::Identifier(name) => name,
+            _ => return self.resolve_node(ast, target),
+        };
+
+        if let Some((depth, _)) = self.lookup(name) {
+            let scope = &self.scopes[self.scopes.len() - 1 - depth];
+            if scope.constants.contains(name) {
+                return Err(format!("Cannot assign to constant '{}'", name));
+            }
+        }
+        self.resolve_variable(ast, target);
+        Ok(())
+    }
+
+    /// 関数本体を新しいスコープで解決
+    fn resolve_function(&mut self, ast: &mut Ast, function: NodeId) -> Result<(), String> {
+        self.scopes.push(FunctionScope::new());
+
+        let result = match ast.node(function) {
+            ASTNode::FunctionDeclaration { parameters, body, .. } | ASTNode::Lambda { parameters, body } => {
+                for param in parameters {
+                    self.declare(param);
+                }
+                let body = *body;
+                self.resolve_block(ast, body)
+            }
+            _ => Ok(()),
+        };
+
+        let scope = self.scopes.pop().unwrap();
+        if scope.generator && matches!(ast.node(function), ASTNode::Lambda { .. }) {
+            return Err("lambda cannot yield".to_string());
+        }
+        if let ASTNode::FunctionDeclaration { name, is_generator, is_async, .. } = ast.node_mut(function) {
+            if *is_async && scope.generator {
+                return Err(format!("async function '{}' cannot yield", name));
+            }
+            *is_generator = scope.generator;
+        }
+        result
+    }
+
+    /// 単一のASTノードを解決
+    fn resolve_node(&mut self, ast: &mut Ast, id: NodeId) -> Result<(), String> {
+        match ast.node(id) {
+            ASTNode::Identifier(_) => {
+                self.resolve_variable(ast, id);
+                Ok(())
+            }
+
+            ASTNode::VariableDeclaration { value, .. } => {
+                // 初期化式は宣言前のスコープで解決する（let x = x + 1 は外側のxを参照）
+                let value = *value;
+                self.resolve_node(ast, value)?;
+
+                if let ASTNode::VariableDeclaration { name, is_const, slot, .. } = ast.node_mut(id) {
+                    *slot = self.declare(name);
+                    if let Some(scope) = self.scopes.last_mut() {
+                        if *is_const {
+                            scope.constants.insert(name.clone());
+                        }
+                    }
+                }
+                Ok(())
+            }
+
+            ASTNode::FunctionDeclaration { .. } => {
+                if let ASTNode::FunctionDeclaration { name, slot, .. } = ast.node_mut(id) {
+                    *slot = self.declare(name);
+                }
+                self.resolve_function(ast, id)
+            }
+
+            ASTNode::Lambda { .. } => self.resolve_function(ast, id),
+
+            ASTNode::Assignment { target, value }
+            | ASTNode::CompoundAssignment { target, value, .. } => {
+                let (target, value) = (*target, *value);
+                self.resolve_node(ast, value)?;
+                self.resolve_assignment_target(ast, target)
+            }
+
+            ASTNode::ForStatement { iterable, body, .. } => {
+                let (iterable, body) = (*iterable, *body);
+                self.resolve_node(ast, iterable)?;
+                if let ASTNode::ForStatement { variable, slot, .. } = ast.node_mut(id) {
+                    *slot = self.declare(variable);
+                }
+                self.resolve_list(ast, body)
+            }
+
+            ASTNode::ListComprehension { element, iterable, condition, .. } => {
+                let (element, iterable, condition) = (*element, *iterable, *condition);
+                self.resolve_node(ast, iterable)?;
+                if let ASTNode::ListComprehension { variable, slot, .. } = ast.node_mut(id) {
+                    *slot = self.declare(variable);
+                }
+                self.resolve_node(ast, element)?;
+                self.resolve_optional(ast, condition)
+            }
+
+            // 反復対象は外側で評価し、要素・条件は反復対象を引数に取るジェネレータ関数の中で解決する
+            ASTNode::GeneratorExpression { element, iterable, condition, .. } => {
+                let (element, iterable, condition) = (*element, *iterable, *condition);
+                self.resolve_node(ast, iterable)?;
+
+                self.scopes.push(FunctionScope::new());
+                self.declare(GENERATOR_SOURCE);
+                if let ASTNode::GeneratorExpression { variable, slot, .. } = ast.node_mut(id) {
+                    *slot = self.declare(variable);
+                }
+                let result = self.resolve_node(ast, element).and_then(|()| self.resolve_optional(ast, condition));
+                self.scopes.pop();
+                result
+            }
+
+            ASTNode::DictComprehension { key, value, iterable, condition, .. } => {
+                let (key, value, iterable, condition) = (*key, *value, *iterable, *condition);
+                self.resolve_node(ast, iterable)?;
+                if let ASTNode::DictComprehension { variable, slot, .. } = ast.node_mut(id) {
+                    *slot = self.declare(variable);
+                }
+                self.resolve_node(ast, key)?;
+                self.resolve_node(ast, value)?;
+                self.resolve_optional(ast, condition)
+            }
+
+            ASTNode::TryCatch { try_body, catch_body, finally_body, .. } => {
+                let (try_body, catch_body, finally_body) = (*try_body, *catch_body, *finally_body);
+                self.resolve_list(ast, try_body)?;
+                if let ASTNode::TryCatch { catch_variable: Some(var), catch_slot, .. } = ast.node_mut(id) {
+                    *catch_slot = self.declare(var);
+                }
+                self.resolve_list(ast, catch_body)?;
+                match finally_body {
+                    Some(body) => self.resolve_list(ast, body),
+                    None => Ok(()),
+                }
+            }
+
+            ASTNode::ClassDeclaration { parent, .. } => {
+                let parent = *parent;
+                self.resolve_optional(ast, parent)?;
+                let body = match ast.node_mut(id) {
+                    ASTNode::ClassDeclaration { name, slot, body, .. } => {
+                        *slot = self.declare(name);
+                        *body
+                    }
+                    _ => unreachable!(),
+                };
+
+                // メソッドはクラスのスコープに名前を宣言しない
+                for index in 0..body.len() {
+                    let method = ast.list(body)[index];
+                    if let ASTNode::FunctionDeclaration { .. } = ast.node(method) {
+                        self.resolve_function(ast, method)?;
+                    } else {
+                        self.resolve_node(ast, method)?;
+                    }
+                }
+                Ok(())
+            }
+
+            // 子ノードを持つノード
+            ASTNode::FunctionCall { callee, arguments } | ASTNode::NewExpression { class: callee, arguments } => {
+                let (callee, arguments) = (*callee, *arguments);
+                self.resolve_node(ast, callee)?;
+                self.resolve_list(ast, arguments)
+            }
+
+            ASTNode::BinaryOperation { left, right, .. } => {
+                let (left, right) = (*left, *right);
+                self.resolve_node(ast, left)?;
+                self.resolve_node(ast, right)
+            }
+
+            ASTNode::IfStatement { condition, then_body, elif_clauses, else_body } => {
+                let (condition, then_body, else_body) = (*condition, *then_body, *else_body);
+                let elif_clauses = elif_clauses.clone();
+                self.resolve_node(ast, condition)?;
+                self.resolve_list(ast, then_body)?;
+                for (elif_cond, elif_body) in elif_clauses {
+                    self.resolve_node(ast, elif_cond)?;
+                    self.resolve_list(ast, elif_body)?;
+                }
+                match else_body {
+                    Some(body) => self.resolve_list(ast, body),
+                    None => Ok(()),
+                }
+            }
+
+            ASTNode::WhileStatement { condition, body } => {
+                let (condition, body) = (*condition, *body);
+                self.resolve_node(ast, condition)?;
+                self.resolve_list(ast, body)
+            }
+
+            ASTNode::ReturnStatement { value } => {
+                let value = *value;
+                self.resolve_optional(ast, value)
+            }
+
+            ASTNode::YieldStatement { value } => {
+                let value = *value;
+                match self.scopes.last_mut() {
+                    Some(scope) => scope.generator = true,
+                    None => return Err("'yield' outside function".to_string()),
+                }
+                self.resolve_node(ast, value)
+            }
+
+            ASTNode::UnaryOperation { operand: value, .. }
+            | ASTNode::ThrowStatement { value }
+            | ASTNode::MemberAccess { object: value, .. }
+            | ASTNode::AwaitExpression { expression: value } => {
+                let value = *value;
+                self.resolve_node(ast, value)
+            }
+
+            ASTNode::List { elements: nodes } | ASTNode::Dictionary { pairs: nodes } => {
+                let nodes = *nodes;
+                self.resolve_list(ast, nodes)
+            }
+
+            ASTNode::IndexAccess { object, index } => {
+                let (object, index) = (*object, *index);
+                self.resolve_node(ast, object)?;
+                self.resolve_node(ast, index)
+            }
+
+            ASTNode::Slice { object, start, end, step } => {
+                let (object, start, end, step) = (*object, *start, *end, *step);
+                self.resolve_node(ast, object)?;
+                self.resolve_optional(ast, start)?;
+                self.resolve_optional(ast, end)?;
+                self.resolve_optional(ast, step)
+            }
+
+            ASTNode::TernaryOperation { condition, true_value, false_value } => {
+                let (condition, true_value, false_value) = (*condition, *true_value, *false_value);
+                self.resolve_node(ast, condition)?;
+                self.resolve_node(ast, true_value)?;
+                self.resolve_node(ast, false_value)
+            }
+
+            ASTNode::Program { statements } => {
+                let statements = *statements;
+                self.resolve_block(ast, statements)
+            }
+
+            ASTNode::AssertStatement { condition, message } => {
+                let (condition, message) = (*condition, *message);
+                self.resolve_node(ast, condition)?;
+                self.resolve_optional(ast, message)
+            }
+
+            // リテラル・解決済みノードなど（子ノードなし）
+            _ => Ok(()),
+        }
+    }
+}
+
+impl Default for Resolver {
+    fn default() -> Self {
+        Self::new()
+    }
+}
+
+/// 構文木を解決（ヘルパー）
+pub fn resolve(ast: &mut Ast) -> Result<(), String> {
+    Resolver::new().resolve(ast)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::lexer::Lexer;
+    use crate::parser::Parser;
+
+    fn parse_and_resolve(source: &str) -> Result<Ast, String> {
+        let tokens = Lexer::new(source).tokenize().map_err(|e| e.to_string())?;
+        let mut ast = Parser::new(tokens).parse().map_err(|e| e.to_string())?;
+        resolve(&mut ast)?;
+        Ok(ast)
+    }
+
+    /// 関数宣言の本体
+    fn function_body(ast: &Ast, id: NodeId) -> &[NodeId] {
+        match ast.node(id) {
+            ASTNode::FunctionDeclaration { body, .. } => ast.list(*body),
+            _ => panic!("Expected FunctionDeclaration"),
+        }
+    }
+
+    #[test]
+    fn test_top_level_is_global() {
+        let ast = parse_and_resolve("let x = 1\nx").unwrap();
+        let nodes = ast.statements();
+        assert!(matches!(ast.node(nodes[0]), ASTNode::VariableDeclaration { slot: None, .. }));
+        assert!(matches!(ast.node(nodes[1]), ASTNode::GlobalVariable { name } if name == "x"));
+    }
+
+    #[test]
+    fn test_parameters_and_locals_get_slots() {
+        let source = r#"
+fun f(a, b) {
+    let c = a + b
+    return c
+}
+"#;
+        let ast = parse_and_resolve(source).unwrap();
+        let body = function_body(&ast, ast.statements()[0]);
+        match ast.node(body[0]) {
+            ASTNode::VariableDeclaration { slot, value, .. } => {
+                assert_eq!(*slot, Some(2));
+                match ast.node(*value) {
+                    ASTNode::BinaryOperation { left, right, .. } => {
+                        assert!(matches!(ast.node(*left), ASTNode::LocalVariable { depth: 0, slot: 0, .. }));
+                        assert!(matches!(ast.node(*right), ASTNode::LocalVariable { depth: 0, slot: 1, .. }));
+                    }
+                    _ => panic!("Expected BinaryOperation"),
+                }
+            }
+            _ => panic!("Expected VariableDeclaration"),
+        }
+    }
+
+    #[test]
+    fn test_enclosing_function_depth() {
+        let source = r#"
+fun outer(x) {
+    fun inner() {
+        return x
+    }
+    return inner
+}
+"#;
+        let ast = parse_and_resolve(source).unwrap();
+        let outer_body = function_body(&ast, ast.statements()[0]);
+        assert!(matches!(ast.node(outer_body[0]), ASTNode::FunctionDeclaration { slot: Some(1), .. }));
+        let inner_body = function_body(&ast, outer_body[0]);
+        match ast.node(inner_body[0]) {
+            ASTNode::ReturnStatement { value: Some(v) } => {
+                assert!(matches!(ast.node(*v), ASTNode::LocalVariable { depth: 1, slot: 0, .. }));
+            }
+            _ => panic!("Expected ReturnStatement"),
+        }
+    }
+
+    #[test]
+    fn test_generator_functions_are_marked() {
+        let source = r#"
+fun outer(n) {
+    fun inner() {
+        yield 1
+    }
+    return inner
+}
+fun count(n) {
+    for (i in range(0, n)) {
+        yield i
+    }
+}
+"#;
+        let ast = parse_and_resolve(source).unwrap();
+        let statements = ast.statements();
+        // ネストした関数の yield は外側の関数をジェネレータにしない
+        assert!(matches!(ast.node(statements[0]), ASTNode::FunctionDeclaration { is_generator: false, .. }));
+        let inner = function_body(&ast, statements[0])[0];
+        assert!(matches!(ast.node(inner), ASTNode::FunctionDeclaration { is_generator: true, .. }));
+        assert!(matches!(ast.node(statements[1]), ASTNode::FunctionDeclaration { is_generator: true, .. }));
+
+        assert!(parse_and_resolve("yield 1").unwrap_err().contains("'yield' outside function"));
+    }
+
+    #[test]
+    fn test_generator_expression_scope() {
+        let source = r#"
+fun f(xs, k) {
+    return (x * k for x in xs)
+}
+"#;
+        let ast = parse_and_resolve(source).unwrap();
+        let body = function_body(&ast, ast.statements()[0]);
+        let ASTNode::ReturnStatement { value: Some(generator) } = ast.node(body[0]) else {
+            panic!("Expected ReturnStatement");
+        };
+        match ast.node(*generator) {
+            ASTNode::GeneratorExpression { element, iterable, slot, .. } => {
+                // 反復対象は外側の関数、要素は反復対象の次のスロットの変数と外側の k
+                assert!(matches!(ast.node(*iterable), ASTNode::LocalVariable { depth: 0, slot: 0, .. }));
+                assert_eq!(*slot, Some(1));
+                match ast.node(*element) {
+                    ASTNode::BinaryOperation { left, right, .. } => {
+                        assert!(matches!(ast.node(*left), ASTNode::LocalVariable { depth: 0, slot: 1, .. }));
+                        assert!(matches!(ast.node(*right), ASTNode::LocalVariable { depth: 1, slot: 1, .. }));
+                    }
+                    _ => panic!("Expected BinaryOperation"),
+                }
+            }
+            _ => panic!("Expected GeneratorExpression"),
+        }
+    }
+
+    #[test]
+    fn test_local_const_assignment_is_rejected() {
+        let source = r#"
+fun f() {
+    const k = 1
+    k = 2
+}
+"#;
+        let result = parse_and_resolve(source);
+        assert!(result.unwrap_err().contains("Cannot assign to constant"));
+    }
+
+    #[test]
+    fn test_async_generator_is_rejected() {
+        let source = r#"
+async fun f() {
+    yield 1
+}
+"#;
+        let result = parse_and_resolve(source);
+        assert!(result.unwrap_err().contains("async function 'f' cannot yield"));
+    }
+}
@@ -0,0 +1,372 @@
+/// クラスとインスタンス（隠れクラス）
+/// インスタンスのフィールドは名前の表ではなく Vec<Value> に並べ、名前から位置への対応は
+/// 形（Shape）として同じ順にフィールドを追加したインスタンスの間で共有する。
+/// メソッドは親クラスの分も含めてクラス作成時に1つの表にまとめる（実行時に継承をたどらない）。
+/// メンバーアクセスの箇所はインラインキャッシュを持ち、前に見た形なら名前を引かずに位置を得る。
+
+use crate::value::Value;
+use std::cell::RefCell;
+use std::collections::HashMap;
+use std::fmt;
+use std::rc::Rc;
+
+/// 初期化メソッドの名前（new で呼ばれる）
+pub const INITIALIZER: &str = "__init__";
+
+/// 1つのキャッシュが覚える形の数（これを超えた箇所は毎回名前で引く）
+const POLYMORPHIC_LIMIT: usize = 4;
+
+/// インスタンスの形（フィールド名と位置の対応）
+pub struct Shape {
+    /// フィールド名 → values の位置
+    fields: HashMap<String, usize>,
+
+    /// フィールドを1つ追加した形（同じ順に追加すれば同じ形になる）
+    transitions: RefCell<HashMap<String, Rc<Shape>>>,
+}
+
+impl Shape {
+    /// フィールドのない形
+    pub fn root() -> Rc<Shape> {
+        Rc::new(Shape { fields: HashMap::new(), transitions: RefCell::new(HashMap::new()) })
+    }
+
+    /// フィールドの位置
+    #[inline]
+    pub fn index_of(&self, name: &str) -> Option<usize> {
+        self.fields.get(name).copied()
+    }
+
+    /// フィールドの数
+    pub fn len(&self) -> usize {
+        self.fields.len()
+    }
+
+    /// フィールドがないか
+    pub fn is_empty(&self) -> bool {
+        self.fields.is_empty()
+    }
+
+    /// name を末尾に追加した形（作成済みならそれを共有する）
+    pub fn with_field(self: &Rc<Shape>, name: &str) -> Rc<Shape> {
+        if let Some(next) = self.transitions.borrow().get(name) {
+            return next.clone();
+        }
+        let mut fields = self.fields.clone();
+        fields.insert(name.to_string(), self.fields.len());
+        let next = Rc::new(Shape { fields, transitions: RefCell::new(HashMap::new()) });
+        self.transitions.borrow_mut().insert(name.to_string(), next.clone());
+        next
+    }
+
+    /// フィールド名（位置の順）
+    pub fn field_names(&self) -> Vec<&str> {
+        let mut names: Vec<(&str, usize)> = self.fields.iter().map(|(name, &index)| (name.as_str(), index)).collect();
+        names.sort_by_key(|&(_, index)| index);
+        names.into_iter().map(|(name, _)| name).collect()
+    }
+}
+
+impl fmt::Debug for Shape {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "Shape{:?}", self.field_names())
+    }
+}
+
+/// クラス
+#[derive(Debug)]
+pub struct Class {
+    pub name: String,
+
+    /// メソッド名 → methods の位置（親クラスのメソッドを含む）
+    method_indices: HashMap<String, usize>,
+
+    /// メソッド（子クラスで定義し直したものは親の位置を上書きする）
+    methods: Vec<Value>,
+
+    pub parent: Option<Rc<Class>>,
+
+    /// インスタンスの最初の形（クラスごとに別なので、形が同じならクラスも同じ）
+    root: Rc<Shape>,
+}
+
+impl Class {
+    /// クラスを作成（親クラスのメソッド表を引き継ぎ、同名のメソッドは上書きする）
+    pub fn new(name: String, methods: Vec<(String, Value)>, parent: Option<Rc<Class>>) -> Class {
+        let (mut method_indices, mut table) = match &parent {
+            Some(parent) => (parent.method_indices.clone(), parent.methods.clone()),
+            None => (HashMap::new(), Vec::new()),
+        };
+        for (method_name, method) in methods {
+            match method_indices.get(&method_name) {
+                Some(&index) => table[index] = method,
+                None => {
+                    method_indices.insert(method_name, table.len());
+                    table.push(method);
+                }
+            }
+        }
+        Class { name, method_indices, methods: table, parent, root: Shape::root() }
+    }
+
+    /// メソッドを名前で取得
+    pub fn method(&self, name: &str) -> Option<&Value> {
+        self.method_indices.get(name).map(|&index| &self.methods[index])
+    }
+
+    /// 初期化メソッド
+    pub fn initializer(&self) -> Option<&Value> {
+        self.method(INITIALIZER)
+    }
+}
+
+/// インスタンス
+pub struct Instance {
+    pub class: Rc<Class>,
+    fields: RefCell<Fields>,
+}
+
+/// インスタンスのフィールド（形と値の組で一緒に書き換える）
+struct Fields {
+    shape: Rc<Shape>,
+    values: Vec<Value>,
+}
+
+/// メンバーの値
+#[derive(Debug, Clone)]
+pub enum Member {
+    /// フィールドの値
+    Field(Value),
+    /// クラスのメソッド（呼び出すときはインスタンスを最初の引数にする）
+    Method(Value),
+}
+
+impl Member {
+    /// フィールド・メソッドの区別なく値を取り出す
+    pub fn into_value(self) -> Value {
+        match self {
+            Member::Field(value) | Member::Method(value) => value,
+        }
+    }
+}
+
+impl Instance {
+    /// フィールドのないインスタンスを作成
+    pub fn new(class: Rc<Class>) -> Instance {
+        let shape = class.root.clone();
+        Instance { class, fields: RefCell::new(Fields { shape, values: Vec::new() }) }
+    }
+
+    /// クラス名
+    pub fn class_name(&self) -> &str {
+        &self.class.name
+    }
+
+    /// メンバーを読む（フィールドがなければクラスのメソッド）
+    pub fn get(&self, name: &str, cache: &InlineCache) -> Option<Member> {
+        let fields = self.fields.borrow();
+        let location = match cache.find(&fields.shape) {
+            Some(location) => location,
+            None => {
+                let location = match fields.shape.index_of(name) {
+                    Some(index) => Location::Field(index),
+                    None => Location::Method(*self.class.method_indices.get(name)?),
+                };
+                cache.insert(&fields.shape, location.clone());
+                location
+            }
+        };
+        match location {
+            Location::Field(index) => Some(Member::Field(fields.values[index].clone())),
+            Location::Method(index) => Some(Member::Method(self.class.methods[index].clone())),
+            Location::Append(_) => None,
+        }
+    }
+
+    /// フィールドに書き込む（なければ追加して次の形に移る）
+    pub fn set(&self, name: &str, value: Value, cache: &InlineCache) {
+        let mut fields = self.fields.borrow_mut();
+        let location = match cache.find(&fields.shape) {
+            Some(location @ (Location::Field(_) | Location::Append(_))) => location,
+            _ => {
+                let location = match fields.shape.index_of(name) {
+                    Some(index) => Location::Field(index),
+                    None => Location::Append(fields.shape.with_field(name)),
+                };
+                cache.insert(&fields.shape, location.clone());
+                location
+            }
+        };
+        match location {
+            Location::Field(index) => fields.values[index] = value,
+            Location::Append(shape) => {
+                fields.values.push(value);
+                fields.shape = shape;
+            }
+            Location::Method(_) => unreachable!(),
+        }
+    }
+
+    /// 現在の形
+    pub fn shape(&self) -> Rc<Shape> {
+        self.fields.borrow().shape.clone()
+    }
+}
+
+impl fmt::Debug for Instance {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        // フィールドは自分自身を参照しうるためクラス名と形のみ出力
+        let fields = self.fields.borrow();
+        write!(f, "<{} instance {:?}>", self.class.name, fields.shape)
+    }
+}
+
+/// 形ごとのメンバーの場所
+#[derive(Debug, Clone)]
+enum Location {
+    /// values の位置
+    Field(usize),
+    /// クラスのメソッド表の位置（形からクラスが決まるので位置だけ覚える）
+    Method(usize),
+    /// まだないフィールドへの書き込み（値を末尾に追加してこの形に移る）
+    Append(Rc<Shape>),
+}
+
+/// メンバーアクセスの箇所ごとのインラインキャッシュ
+/// 見た形と場所の組を POLYMORPHIC_LIMIT 個まで覚える（形は強参照で持つので、
+/// 解放された形のアドレスが別の形に再利用されて誤って一致することはない）。
+/// 構文木・命令列のメソッドを値として持たない（関数が構文木を参照し、循環しないように）。
+#[derive(Default)]
+pub struct InlineCache {
+    entries: RefCell<Vec<(Rc<Shape>, Location)>>,
+}
+
+impl InlineCache {
+    /// 空のキャッシュ
+    pub fn new() -> Self {
+        InlineCache::default()
+    }
+
+    /// 形に対して覚えた場所
+    #[inline]
+    fn find(&self, shape: &Rc<Shape>) -> Option<Location> {
+        self.entries
+            .borrow()
+            .iter()
+            .find(|(seen, _)| Rc::ptr_eq(seen, shape))
+            .map(|(_, location)| location.clone())
+    }
+
+    /// 形と場所を覚える（上限に達していれば覚えない）
+    fn insert(&self, shape: &Rc<Shape>, location: Location) {
+        let mut entries = self.entries.borrow_mut();
+        if entries.len() < POLYMORPHIC_LIMIT {
+            entries.push((shape.clone(), location));
+        }
+    }
+
+    /// 覚えている形の数
+    pub fn len(&self) -> usize {
+        self.entries.borrow().len()
+    }
+
+    /// まだ何も覚えていないか
+    pub fn is_empty(&self) -> bool {
+        self.entries.borrow().is_empty()
+    }
+}
+
+// 構文木のノードに埋め込むため、複製は空のキャッシュとし、比較では常に等しいとみなす
+
+impl Clone for InlineCache {
+    fn clone(&self) -> Self {
+        InlineCache::new()
+    }
+}
+
+impl PartialEq for InlineCache {
+    fn eq(&self, _other: &Self) -> bool {
+        true
+    }
+}
+
+impl fmt::Debug for InlineCache {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "InlineCache({})", self.len())
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn class(name: &str, methods: &[&str], parent: Option<Rc<Class>>) -> Rc<Class> {
+        let methods = methods.iter().map(|m| (m.to_string(), Value::String((*m).into()))).collect();
+        Rc::new(Class::new(name.to_string(), methods, parent))
+    }
+
+    #[test]
+    fn test_shapes_are_shared() {
+        let point = class("Point", &[], None);
+        let (a, b) = (Instance::new(point.clone()), Instance::new(point.clone()));
+        let cache = InlineCache::new();
+        for instance in [&a, &b] {
+            instance.set("x", Value::Number(1.0), &cache);
+            instance.set("y", Value::Number(2.0), &InlineCache::new());
+        }
+        assert!(Rc::ptr_eq(&a.shape(), &b.shape()));
+        assert_eq!(a.shape().field_names(), vec!["x", "y"]);
+
+        // 追加の順が違えば別の形
+        let c = Instance::new(point);
+        c.set("y", Value::Number(2.0), &InlineCache::new());
+        c.set("x", Value::Number(1.0), &InlineCache::new());
+        assert!(!Rc::ptr_eq(&a.shape(), &c.shape()));
+    }
+
+    #[test]
+    fn test_inline_cache() {
+        let point = class("Point", &["norm"], None);
+        let instance = Instance::new(point);
+        instance.set("x", Value::Number(3.0), &InlineCache::new());
+
+        let cache = InlineCache::new();
+        for _ in 0..3 {
+            assert!(matches!(instance.get("x", &cache), Some(Member::Field(Value::Number(n))) if n == 3.0));
+        }
+        assert_eq!(cache.len(), 1);
+
+        // 書き込みは位置を覚えた箇所でも同じ形のまま
+        let store = InlineCache::new();
+        instance.set("x", Value::Number(4.0), &store);
+        instance.set("x", Value::Number(5.0), &store);
+        assert_eq!(instance.get("x", &cache).unwrap().into_value(), Value::Number(5.0));
+
+        assert!(matches!(instance.get("norm", &InlineCache::new()), Some(Member::Method(_))));
+        assert!(instance.get("missing", &InlineCache::new()).is_none());
+    }
+
+    #[test]
+    fn test_polymorphic_limit() {
+        let cache = InlineCache::new();
+        for i in 0..POLYMORPHIC_LIMIT + 2 {
+            let instance = Instance::new(class(&format!("C{}", i), &[], None));
+            instance.set("value", Value::Number(i as f64), &InlineCache::new());
+            assert_eq!(instance.get("value", &cache).unwrap().into_value(), Value::Number(i as f64));
+        }
+        assert_eq!(cache.len(), POLYMORPHIC_LIMIT);
+    }
+
+    #[test]
+    fn test_methods_are_flattened() {
+        let animal = class("Animal", &["speak", "name"], None);
+        let dog = Class::new(
+            "Dog".to_string(),
+            vec![("speak".to_string(), Value::String("woof".into()))],
+            Some(animal),
+        );
+        assert_eq!(dog.method("speak"), Some(&Value::String("woof".into())));
+        assert_eq!(dog.method("name"), Some(&Value::String("name".into())));
+        assert!(dog.method("fly").is_none());
+    }
+}
@@ -0,0 +1,592 @@
+/// Discord Gateway のシャード（接続を複数に分け、スレッドごとにイベントを受け取る）
+/// サーバーのイベントは (guild_id >> 22) % シャードの数 のシャードに届く。gateway_shards で起動したシャードは
+/// スレッドのグループに分け、スレッドごとに:
+/// - 自分のランタイムとVMでハンドラーのスクリプトを実行し、gateway_on のハンドラーを登録する
+/// - 割り当てられたシャードの Gateway に接続し、イベントをそのスレッドのハンドラーに渡す
+/// 値はスレッドをまたげないので、スレッドの間で共有するのは設定・IDENTIFY の順番・状態の記録だけ
+/// （REST のレート制限のバケットもスレッドごと）
+
+use crate::builtins;
+use crate::bytecode::ByteCode;
+use crate::cache;
+use crate::discord::{self, RestConfig};
+use crate::environment::Environment;
+use crate::gateway::{self, Gateway, GatewayConfig, Stats};
+use crate::task;
+use crate::value::Value;
+use crate::vm::VM;
+use futures_util::stream::{FuturesUnordered, StreamExt};
+use reqwest::Method;
+use std::cell::{Cell, RefCell};
+use std::collections::VecDeque;
+use std::rc::Rc;
+use std::sync::{Arc, Mutex};
+use std::time::{Duration, Instant};
+use tokio::sync::{oneshot, watch};
+
+/// 同じバケットの IDENTIFY の間隔（Discord はバケットごとに 5 秒に1回まで）
+const IDENTIFY_INTERVAL: Duration = Duration::from_secs(5);
+
+/// シャードの状態を記録する間隔
+const HEALTH_INTERVAL: Duration = Duration::from_millis(250);
+
+/// 1秒あたりのイベントの数を数える期間
+const RATE_WINDOW: Duration = Duration::from_secs(1);
+
+/// サーバーのイベントを受け取るシャードの番号
+pub fn shard_for(guild_id: u64, shards: u32) -> u32 {
+    ((guild_id >> 22) % shards as u64) as u32
+}
+
+/// IDENTIFY の順番（シャードの番号 % max_concurrency のバケットごとに interval に1回。スレッドの間で共有する）
+#[derive(Debug)]
+pub struct IdentifyQueue {
+    interval: Duration,
+
+    /// バケットごとの次に IDENTIFY できる時刻
+    next: Mutex<Vec<Instant>>,
+}
+
+impl IdentifyQueue {
+    pub fn new(max_concurrency: usize, interval: Duration) -> IdentifyQueue {
+        IdentifyQueue { interval, next: Mutex::new(vec![Instant::now(); max_concurrency.max(1)]) }
+    }
+
+    /// シャードが IDENTIFY できるまで待つ（待ち始めた順にバケットの時刻を interval ずつ取る）
+    pub async fn wait(&self, shard: u32) {
+        let at = {
+            let mut next = self.next.lock().unwrap();
+            let bucket = shard as usize % next.len();
+            let at = next[bucket].max(Instant::now());
+            next[bucket] = at + self.interval;
+            at
+        };
+        tokio::time::sleep_until(at.into()).await;
+    }
+}
+
+/// シャードの設定
+#[derive(Debug, Clone)]
+pub struct ShardConfig {
+    /// 各シャードの接続の設定（shard・identify はシャードごとに埋める）
+    pub gateway: GatewayConfig,
+
+    /// シャードの数（None なら /gateway/bot の推奨の数）
+    pub shards: Option<u32>,
+
+    /// シャードを受け持つスレッドの数（None なら CPU の数。シャードの数より多くはしない）
+    pub threads: Option<usize>,
+
+    /// 同時に IDENTIFY できるシャードの数（None なら /gateway/bot の値、シャードの数を指定したときは 1）
+    pub max_concurrency: Option<usize>,
+
+    /// 同じバケットの IDENTIFY の間隔
+    pub identify_interval: Duration,
+}
+
+impl ShardConfig {
+    pub fn new(gateway: GatewayConfig) -> Self {
+        ShardConfig { gateway, shards: None, threads: None, max_concurrency: None, identify_interval: IDENTIFY_INTERVAL }
+    }
+}
+
+/// シャードの状態の記録
+#[derive(Debug, Clone)]
+struct Health {
+    /// 受け持つスレッドの番号
+    thread: usize,
+
+    stats: Stats,
+
+    /// 直近の1秒あたりのイベントの数
+    rate: f64,
+}
+
+/// 1つのスレッドが受け持つシャード
+struct Group {
+    index: usize,
+    shards: Vec<u32>,
+    count: u32,
+    config: GatewayConfig,
+    rest: RestConfig,
+    script: Arc<ByteCode>,
+}
+
+/// シャードのスレッドを起動し、状態をまとめる
+pub struct ShardManager {
+    /// シャードの番号ごとの状態（シャードの数が決まるまでは空）
+    health: Mutex<Vec<Health>>,
+
+    /// true にするとすべてのシャードを閉じる
+    shutdown: watch::Sender<bool>,
+}
+
+impl ShardManager {
+    pub fn new() -> Arc<ShardManager> {
+        Arc::new(ShardManager { health: Mutex::new(Vec::new()), shutdown: watch::channel(false).0 })
+    }
+
+    /// シャードをスレッドに分けて起動し、すべてのシャードが閉じるまで待つ
+    /// スクリプトはスレッドごとに実行し、失敗したシャードがあればすべてのシャードを閉じてそのエラーで終わる
+    pub async fn run(self: Arc<Self>, config: ShardConfig, script: Arc<ByteCode>, rest: RestConfig) -> Result<Value, String> {
+        let mut gateway = config.gateway;
+        let (count, max_concurrency) = match config.shards {
+            Some(count) => (count, config.max_concurrency.unwrap_or(1)),
+            None => {
+                let (count, max_concurrency, url) = recommended().await?;
+                // url を指定しなければ /gateway/bot の接続先
+                if gateway.url == gateway::GATEWAY_URL {
+                    gateway.url = url;
+                }
+                (count, config.max_concurrency.unwrap_or(max_concurrency))
+            }
+        };
+        if count == 0 {
+            return Err("gateway_shards() requires at least one shard".to_string());
+        }
+        let threads = config.threads.unwrap_or_else(|| std::thread::available_parallelism().map_or(1, |n| n.get())).clamp(1, count as usize);
+        *self.health.lock().unwrap() = (0..count)
+            .map(|shard| Health {
+                thread: shard as usize % threads,
+                stats: Stats { state: "connecting", ..Stats::default() },
+                rate: 0.0,
+            })
+            .collect();
+        gateway.identify = Some(Arc::new(IdentifyQueue::new(max_concurrency, config.identify_interval)));
+
+        // 同じバケットのシャードが1つのスレッドに偏らないよう、シャードは順にスレッドに割り当てる
+        let mut finished = FuturesUnordered::new();
+        for index in 0..threads {
+            let group = Group {
+                index,
+                shards: (index as u32..count).step_by(threads).collect(),
+                count,
+                config: gateway.clone(),
+                rest: rest.clone(),
+                script: script.clone(),
+            };
+            let (sender, receiver) = oneshot::channel();
+            let manager = self.clone();
+            std::thread::Builder::new()
+                .name(format!("mumei-shard-{}", index))
+                .spawn(move || {
+                    let _ = sender.send(worker(manager, group));
+                })
+                .map_err(|e| {
+                    self.close();
+                    format!("Failed to start shard thread: {}", e)
+                })?;
+            finished.push(async move { receiver.await.unwrap_or_else(|_| Err(format!("Shard thread {} panicked", index))) });
+        }
+
+        let mut result = Ok(Value::Null);
+        while let Some(done) = finished.next().await {
+            if let (Err(error), true) = (done, result.is_ok()) {
+                self.close();
+                result = Err(error);
+            }
+        }
+        result
+    }
+
+    /// すべてのシャードを閉じる
+    pub fn close(&self) {
+        self.shutdown.send_replace(true);
+    }
+
+    /// シャードの数（起動するまでは 0）
+    pub fn shards(&self) -> u32 {
+        self.health.lock().unwrap().len() as u32
+    }
+
+    /// シャードごとの {"shard", "thread", "events_per_second", "state", "latency", "events", ...} の辞書のリスト
+    pub fn status(&self) -> Value {
+        let health = self.health.lock().unwrap();
+        let list = health
+            .iter()
+            .enumerate()
+            .map(|(shard, health)| {
+                let status = discord::dict([
+                    ("shard", Value::Number(shard as f64)),
+                    ("thread", Value::Number(health.thread as f64)),
+                    ("events_per_second", Value::Number(health.rate)),
+                ]);
+                if let (Value::Dictionary(status), Value::Dictionary(stats)) = (&status, health.stats.to_value()) {
+                    let mut status = status.borrow_mut();
+                    for (key, value) in stats.borrow().iter() {
+                        status.insert(key.clone(), value.clone());
+                    }
+                }
+                status
+            })
+            .collect();
+        Value::List(Rc::new(RefCell::new(list)))
+    }
+
+    /// スレッドのシャードの状態を HEALTH_INTERVAL ごとに記録する（閉じるよう言われたらシャードを閉じ、すべて閉じたら終わる）
+    async fn monitor(self: Arc<Self>, gateways: Vec<(u32, Rc<Gateway>)>) -> Result<Value, String> {
+        let mut shutdown = self.shutdown.subscribe();
+        let mut samples: VecDeque<(Instant, Vec<usize>)> = VecDeque::new();
+        loop {
+            if *shutdown.borrow_and_update() {
+                gateways.iter().for_each(|(_, gateway)| gateway.close());
+            }
+            let stats: Vec<Stats> = gateways.iter().map(|(_, gateway)| gateway.stats()).collect();
+            let now = Instant::now();
+            samples.push_back((now, stats.iter().map(|stats| stats.events).collect()));
+            while samples.len() > 1 && now - samples[1].0 >= RATE_WINDOW {
+                samples.pop_front();
+            }
+            let (since, events) = &samples[0];
+            let elapsed = (now - *since).as_secs_f64();
+            let all_closed = stats.iter().all(|stats| stats.state == "closed");
+            {
+                let mut health = self.health.lock().unwrap();
+                for (((shard, _), stats), before) in gateways.iter().zip(stats).zip(events) {
+                    let health = &mut health[*shard as usize];
+                    health.rate = if elapsed > 0.0 { (stats.events - before) as f64 / elapsed } else { 0.0 };
+                    health.stats = stats;
+                }
+            }
+            if all_closed {
+                return Ok(Value::Null);
+            }
+            tokio::select! {
+                _ = tokio::time::sleep(HEALTH_INTERVAL) => {}
+                _ = shutdown.changed() => {}
+            }
+        }
+    }
+}
+
+/// /gateway/bot の推奨のシャードの数・同時に IDENTIFY できる数・接続先（discord_set_token() のトークンで問い合わせる）
+async fn recommended() -> Result<(u32, usize, String), String> {
+    let rest = discord::rest();
+    let request = rest.request(Method::GET, &rest.endpoint("/gateway/bot"), None, None)?;
+    let info = task::join(&request).await.map_err(|error| error.to_string())?;
+    let field = |value: &Value, name: &str| match value {
+        Value::Dictionary(dict) => dict.borrow().get_str(name).cloned(),
+        _ => None,
+    };
+    let shards = field(&info, "shards").ok_or("/gateway/bot returned no shard count")?.as_number()?;
+    let max_concurrency = field(&info, "session_start_limit")
+        .and_then(|limit| field(&limit, "max_concurrency"))
+        .map_or(Ok(1.0), |value| value.as_number())?;
+    let url = field(&info, "url").ok_or("/gateway/bot returned no url")?;
+    Ok((shards as u32, max_concurrency.max(1.0) as usize, discord::text(&url)?))
+}
+
+/// シャードのスレッド: 自分のVMでスクリプトを実行してハンドラーを登録し、受け持つシャードが閉じるまでイベントを受け取る
+fn worker(manager: Arc<ShardManager>, group: Group) -> Result<(), String> {
+    SHARDS.with(|shards| shards.set(Some(group.count)));
+    let rest = discord::rest();
+    rest.set_config(group.rest);
+    rest.set_token(group.config.token.clone());
+
+    let mut vm = VM::new();
+    builtins::setup_vm_builtins(&mut vm);
+    vm.execute_shared(group.script).map_err(|e| format!("Shard script failed on thread {}: {}", group.index, e))?;
+
+    let gateways: Vec<(u32, Rc<Gateway>)> = group
+        .shards
+        .iter()
+        .map(|&shard| {
+            let mut config = group.config.clone();
+            config.shard = Some((shard, group.count));
+            let gateway = Gateway::new(config);
+            gateway::register(gateway.clone());
+            (shard, gateway)
+        })
+        .collect();
+    let mut tasks: Vec<_> =
+        gateways.iter().map(|(shard, gateway)| task::spawn_native(&format!("shard {}", shard), gateway.clone().run())).collect();
+    tasks.push(task::spawn_native("shard health", manager.monitor(gateways)));
+    vm.wait(&task::gather(tasks)).map(|_| ())
+}
+
+thread_local! {
+    /// このスレッドで起動したシャード（最後のものが gateway_shard_status() の対象）
+    static MANAGERS: RefCell<Vec<Arc<ShardManager>>> = const { RefCell::new(Vec::new()) };
+
+    /// シャードのスレッドなら、シャードの数
+    static SHARDS: Cell<Option<u32>> = const { Cell::new(None) };
+}
+
+/// このスレッドで起動したシャードをすべて閉じる
+pub fn close() {
+    MANAGERS.with(|managers| managers.borrow().iter().for_each(|manager| manager.close()));
+}
+
+/// このスレッドで起動したシャードを閉じて捨てる（VMが新しいプログラムを実行する前に呼ぶ）
+pub fn reset() {
+    close();
+    MANAGERS.with(|managers| managers.borrow_mut().clear());
+}
+
+// ============================================
+// 組み込み関数
+// ============================================
+
+/// シャードの組み込み関数を環境に登録
+pub fn setup_shard_builtins(env: &Environment) {
+    env.define("gateway_shards".to_string(), Value::native_with_optional("gateway_shards", 3, 4, gateway_shards)).unwrap();
+    env.define("gateway_shard_status".to_string(), Value::native("gateway_shard_status", 0, gateway_shard_status)).unwrap();
+    env.define("gateway_shard_for".to_string(), Value::native_with_optional("gateway_shard_for", 1, 2, gateway_shard_for)).unwrap();
+}
+
+/// gateway_shards(token, intents, script, options?) - シャードが閉じるまで続くタスク
+/// script はスレッドごとに実行するハンドラーのスクリプトのパス（gateway_on でハンドラーを登録する）
+/// options: gateway_connect() のオプションと {"shards": 数, "threads": 数, "max_concurrency": 数, "identify_interval": 秒}
+fn gateway_shards(args: Vec<Value>) -> Result<Value, String> {
+    let intents = match &args[1] {
+        Value::Null => 32767,
+        value => value.as_number()? as u64,
+    };
+    let mut config = ShardConfig::new(GatewayConfig::new(discord::text(&args[0])?, intents));
+    let path = discord::text(&args[2])?;
+    match args.get(3) {
+        None | Some(Value::Null) => {}
+        Some(Value::Dictionary(options)) => {
+            for (key, value) in options.borrow().iter() {
+                match key.to_value().to_string().as_str() {
+                    "shards" => config.shards = Some(value.as_number()?.max(1.0) as u32),
+                    "threads" => config.threads = Some(value.as_number()?.max(1.0) as usize),
+                    "max_concurrency" => config.max_concurrency = Some(value.as_number()?.max(1.0) as usize),
+                    "identify_interval" => {
+                        config.identify_interval = Duration::try_from_secs_f64(value.as_number()?).map_err(|e| e.to_string())?
+                    }
+                    name => {
+                        if !gateway::configure(&mut config.gateway, name, value)? {
+                            return Err(format!("gateway_shards() got an unknown option '{}'", name));
+                        }
+                    }
+                }
+            }
+        }
+        Some(other) => return Err(format!("gateway_shards() options must be a dictionary, got {}", other.type_name())),
+    }
+    // スクリプトはここでコンパイルし（エラーをすぐに返す）、スレッドはバイトコードを共有する
+    let source = std::fs::read_to_string(&path).map_err(|e| format!("Failed to read shard script '{}': {}", path, e))?;
+    let (_, script) = cache::global_cache().get_or_compile(&source, crate::bytecode_cache::compile_source)?;
+
+    let manager = ShardManager::new();
+    MANAGERS.with(|managers| managers.borrow_mut().push(manager.clone()));
+    Ok(Value::Task(task::spawn_native("gateway_shards", manager.run(config, script, discord::rest().config()))))
+}
+
+/// gateway_shard_status() - シャードごとの状態のリスト（シャードを起動していなければ空）
+fn gateway_shard_status(_args: Vec<Value>) -> Result<Value, String> {
+    Ok(MANAGERS.with(|managers| {
+        managers.borrow().last().map_or_else(|| Value::List(Rc::new(RefCell::new(Vec::new()))), |manager| manager.status())
+    }))
+}
+
+/// gateway_shard_for(guild_id, shards?) - サーバーのイベントを受け取るシャードの番号
+/// shards を省略すると、シャードのスレッドではそのシャードの数、ほかは最後に起動したシャードの数
+fn gateway_shard_for(args: Vec<Value>) -> Result<Value, String> {
+    let guild = discord::id(&args[0])?.parse::<u64>().map_err(|_| format!("Invalid Discord ID: {}", args[0]))?;
+    let shards = match args.get(1) {
+        None | Some(Value::Null) => SHARDS
+            .with(|shards| shards.get())
+            .or_else(|| MANAGERS.with(|managers| managers.borrow().last().map(|manager| manager.shards())))
+            .filter(|&shards| shards > 0)
+            .ok_or("gateway_shard_for() requires the number of shards")?,
+        Some(value) => value.as_number()? as u32,
+    };
+    if shards == 0 {
+        return Err("gateway_shard_for() requires at least one shard".to_string());
+    }
+    Ok(Value::Number(shard_for(guild, shards) as f64))
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use futures_util::SinkExt;
+    use serde_json::{json, Value as Json};
+    use tokio_tungstenite::accept_async;
+    use tokio_tungstenite::tungstenite::Message;
+
+    /// 偽の Gateway のサーバーの数
+    const GUILDS: u64 = 200;
+
+    const SHARDS: u32 = 4;
+
+    /// 偽の Gateway が受け取ったもの
+    #[derive(Default)]
+    struct Log {
+        /// IDENTIFY の [シャードの番号, シャードの数] と受け取った時刻
+        identified: Vec<(u64, u64, Instant)>,
+        /// ハンドラーが gateway_send(3, ...) で送ったもの
+        reports: Vec<Json>,
+    }
+
+    /// ID の上位のビットがばらばらのサーバー
+    fn guilds() -> Vec<u64> {
+        (0..GUILDS).map(|i| ((1_000_000 + i * 7919) << 22) | i).collect()
+    }
+
+    /// 多数のサーバーを持つ偽の Gateway を別スレッドで起動する
+    /// 接続ごとに IDENTIFY のシャードを読み、READY のあとそのシャードのサーバーの GUILD_CREATE と MESSAGE_CREATE を送る
+    /// （MESSAGE_CREATE の content は送ったシャードの番号）。ハートビートには ACK を返す
+    fn start_fake_gateway() -> (u16, Arc<Mutex<Log>>) {
+        let log = Arc::new(Mutex::new(Log::default()));
+        let (sender, receiver) = std::sync::mpsc::channel();
+        let recorded = log.clone();
+        std::thread::spawn(move || {
+            let runtime = tokio::runtime::Builder::new_multi_thread().enable_all().build().unwrap();
+            runtime.block_on(async move {
+                let listener = tokio::net::TcpListener::bind("127.0.0.1:0").await.unwrap();
+                sender.send(listener.local_addr().unwrap().port()).unwrap();
+                loop {
+                    let (stream, _) = listener.accept().await.unwrap();
+                    stream.set_nodelay(true).unwrap();
+                    let recorded = recorded.clone();
+                    tokio::spawn(async move {
+                        let mut socket = accept_async(stream).await.unwrap();
+                        let text = |payload: Json| Message::Text(payload.to_string());
+                        socket.send(text(json!({"op": 10, "d": {"heartbeat_interval": 50}}))).await.unwrap();
+                        let Some(Ok(Message::Text(identify))) = socket.next().await else { return };
+                        let identify: Json = serde_json::from_str(&identify).unwrap();
+                        let (shard, count) = (identify["d"]["shard"][0].as_u64().unwrap(), identify["d"]["shard"][1].as_u64().unwrap());
+                        recorded.lock().unwrap().identified.push((shard, count, Instant::now()));
+
+                        let mut sequence = 0;
+                        let mut dispatch = |t: &str, d: Json| {
+                            sequence += 1;
+                            text(json!({"op": 0, "t": t, "s": sequence, "d": d}))
+                        };
+                        socket.send(dispatch("READY", json!({"session_id": format!("s{}", shard)}))).await.unwrap();
+                        let mine: Vec<u64> = guilds().into_iter().filter(|&id| shard_for(id, count as u32) as u64 == shard).collect();
+                        for id in &mine {
+                            socket.send(dispatch("GUILD_CREATE", json!({"id": id.to_string()}))).await.unwrap();
+                        }
+                        for id in &mine {
+                            let message = json!({"guild_id": id.to_string(), "content": shard.to_string()});
+                            socket.send(dispatch("MESSAGE_CREATE", message)).await.unwrap();
+                        }
+                        while let Some(Ok(Message::Text(received))) = socket.next().await {
+                            let payload: Json = serde_json::from_str(&received).unwrap();
+                            match payload["op"].as_u64() {
+                                Some(1) => socket.send(text(json!({"op": 11}))).await.unwrap(),
+                                Some(3) => recorded.lock().unwrap().reports.push(payload["d"].clone()),
+                                _ => {}
+                            }
+                        }
+                    });
+                }
+            });
+        });
+        (receiver.recv().unwrap(), log)
+    }
+
+    fn run(source: &str) -> Result<Value, String> {
+        let bytecode = crate::bytecode_cache::compile_source(source)?;
+        let mut vm = VM::new();
+        builtins::setup_vm_builtins(&mut vm);
+        vm.execute(bytecode)
+    }
+
+    #[test]
+    fn test_shard_for() {
+        assert_eq!(shard_for(81384788765712384, 16), 2);
+        assert_eq!(shard_for(81384788765712384, 1), 0);
+        assert_eq!(run("gateway_shard_for(\"81384788765712384\", 16)").unwrap(), Value::Number(2.0));
+        assert!(run("gateway_shard_for(\"81384788765712384\")").unwrap_err().contains("requires the number of shards"));
+    }
+
+    #[test]
+    fn test_shards() {
+        let (port, log) = start_fake_gateway();
+        // ハンドラーはシャードのスレッドのVMで動き、サーバーが届いたシャードを報告する
+        let script = std::env::temp_dir().join(format!("mumei_shards_{}.mu", std::process::id()));
+        std::fs::write(
+            &script,
+            r#"
+fun on_message(message) {
+    let shard = gateway_shard_for(message["guild_id"])
+    gateway_send(3, {"guild_id": message["guild_id"], "routed": str(shard) == message["content"]}, shard)
+}
+gateway_on("message", on_message)
+"#,
+        )
+        .unwrap();
+        let source = r#"
+fun settled(status) {
+    if (len(status) == 0) {
+        return false
+    }
+    let total = 0
+    for (shard in status) {
+        if (shard["latency"] == null or shard["queued"] > 0) {
+            return false
+        }
+        total = total + shard["events"]
+    }
+    return total == EVENTS
+}
+let options = {"url": "ws://127.0.0.1:PORT", "compress": false, "shards": SHARDS, "threads": 2, "max_concurrency": 2, "identify_interval": 0.1}
+let shards = gateway_shards("test", 513, "SCRIPT", options)
+let waited = 0
+while (not settled(gateway_shard_status()) and waited < 1000) {
+    await sleep(0.01)
+    waited = waited + 1
+}
+let status = gateway_shard_status()
+gateway_close()
+await shards
+let out = []
+for (shard in status) {
+    let rate = shard["events_per_second"] >= 0
+    push(out, str(shard["shard"]) + ":" + str(shard["thread"]) + ":" + shard["state"] + ":" + str(shard["events"]) + ":" + shard["session_id"] + ":" + str(rate))
+}
+join(out, ",")
+"#;
+        let source = source
+            .replace("EVENTS", &(SHARDS as u64 + 2 * GUILDS).to_string())
+            .replace("SHARDS", &SHARDS.to_string())
+            .replace("PORT", &port.to_string())
+            .replace("SCRIPT", script.to_str().unwrap());
+        let result = run(&source);
+        std::fs::remove_file(&script).unwrap();
+
+        // シャードは順にスレッドに割り当て、それぞれのシャードには自分のサーバーのイベントだけが届く
+        let expected: Vec<String> = (0..SHARDS)
+            .map(|shard| {
+                let mine = guilds().into_iter().filter(|&id| shard_for(id, SHARDS) == shard).count();
+                assert!(mine > 0);
+                format!("{}:{}:ready:{}:s{}:true", shard, shard % 2, 1 + 2 * mine, shard)
+            })
+            .collect();
+        assert_eq!(result.unwrap().to_string(), expected.join(","));
+
+        // ハンドラーの報告は接続を閉じる前に送ったものなので、偽の Gateway がすべて受け取るまで待つ
+        let deadline = Instant::now() + Duration::from_secs(5);
+        while log.lock().unwrap().reports.len() < GUILDS as usize && Instant::now() < deadline {
+            std::thread::sleep(Duration::from_millis(10));
+        }
+        let log = log.lock().unwrap();
+        let mut reported: Vec<u64> = log.reports.iter().map(|report| report["guild_id"].as_str().unwrap().parse().unwrap()).collect();
+        reported.sort();
+        assert_eq!(reported, guilds());
+        assert!(log.reports.iter().all(|report| report["routed"] == true));
+
+        // IDENTIFY は max_concurrency のバケット（シャードの番号 % 2）ごとに identify_interval の間隔をあける
+        let mut identified = log.identified.clone();
+        identified.sort_by_key(|&(_, _, at)| at);
+        assert_eq!(identified.len(), SHARDS as usize);
+        assert!(identified.iter().all(|&(_, count, _)| count == SHARDS as u64));
+        for bucket in 0..2 {
+            let times: Vec<Instant> = identified.iter().filter(|&&(shard, _, _)| shard % 2 == bucket).map(|&(_, _, at)| at).collect();
+            assert_eq!(times.len(), 2);
+            assert!(times[1] - times[0] >= Duration::from_millis(80), "{:?}", times[1] - times[0]);
+        }
+        drop(log);
+
+        assert!(run("await gateway_shards(\"test\", 1, \"/nonexistent/shards.mu\", {\"shards\": 2})")
+            .unwrap_err()
+            .contains("Failed to read shard script"));
+        assert!(run("gateway_shards(\"test\", 1, \"x.mu\", {\"shard_count\": 2})").unwrap_err().contains("unknown option 'shard_count'"));
+        assert!(run("gateway_send(3, {}, 1)").unwrap_err().contains("Shard 1 is not connected on this thread"));
+    }
+}
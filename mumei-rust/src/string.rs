@@ -0,0 +1,407 @@
+/// 文字列の値
+/// Value::String の中身。短い文字列はその場に持ち（ヒープを確保しない）、長い文字列は
+/// 参照カウントで共有する（変数の読み出し・リスト要素の複製でバッファをコピーしない）。
+/// 共有されていない文字列への追記はその場で行うので、ループでの連結は償却 O(1)。
+
+use crate::value::Value;
+use std::borrow::Borrow;
+use std::cell::OnceCell;
+use std::fmt;
+use std::hash::{Hash, Hasher};
+use std::ops::Deref;
+use std::rc::Rc;
+
+/// その場に持てる最大バイト数（Str が16バイト、Value も16バイトに収まる大きさ）
+const INLINE_CAPACITY: usize = 14;
+
+/// 文字列（複製は参照カウントの増減だけ）
+#[derive(Clone)]
+pub struct Str(Repr);
+
+#[derive(Clone)]
+enum Repr {
+    /// 短い文字列
+    Inline { len: u8, bytes: [u8; INLINE_CAPACITY] },
+
+    /// 共有バッファ
+    Heap(Rc<Buffer>),
+}
+
+/// 共有される文字列のバッファ（追記できるよう String のまま持つ）
+struct Buffer {
+    text: String,
+
+    /// 文字位置の索引（添字アクセス・文字数で初めて作り、追記したら捨てる）
+    index: OnceCell<CharIndex>,
+}
+
+/// 文字位置からバイト位置への対応
+enum CharIndex {
+    /// ASCIIのみ（文字位置 = バイト位置）
+    Ascii,
+
+    /// 各文字の開始バイト位置
+    Offsets(Box<[usize]>),
+}
+
+impl Buffer {
+    fn new(text: String) -> Buffer {
+        Buffer { text, index: OnceCell::new() }
+    }
+
+    fn index(&self) -> &CharIndex {
+        self.index.get_or_init(|| {
+            if self.text.is_ascii() {
+                CharIndex::Ascii
+            } else {
+                CharIndex::Offsets(self.text.char_indices().map(|(offset, _)| offset).collect())
+            }
+        })
+    }
+}
+
+impl Str {
+    /// 文字列をコピーして作成
+    pub fn new(text: &str) -> Str {
+        if text.len() <= INLINE_CAPACITY {
+            Str::inline(text)
+        } else {
+            Str(Repr::Heap(Rc::new(Buffer::new(text.to_string()))))
+        }
+    }
+
+    fn inline(text: &str) -> Str {
+        debug_assert!(text.len() <= INLINE_CAPACITY);
+        let mut bytes = [0; INLINE_CAPACITY];
+        bytes[..text.len()].copy_from_slice(text.as_bytes());
+        Str(Repr::Inline { len: text.len() as u8, bytes })
+    }
+
+    /// 2つの文字列を連結（確保は1回）
+    pub fn concat(left: &str, right: &str) -> Str {
+        let len = left.len() + right.len();
+        if len <= INLINE_CAPACITY {
+            let mut bytes = [0; INLINE_CAPACITY];
+            bytes[..left.len()].copy_from_slice(left.as_bytes());
+            bytes[left.len()..len].copy_from_slice(right.as_bytes());
+            return Str(Repr::Inline { len: len as u8, bytes });
+        }
+        let mut text = String::with_capacity(len);
+        text.push_str(left);
+        text.push_str(right);
+        Str::from(text)
+    }
+
+    /// 文字列スライスとして取得
+    #[inline]
+    pub fn as_str(&self) -> &str {
+        match &self.0 {
+            // SAFETY: その場の文字列は &str を文字境界ごとにコピーしたものだけ
+            Repr::Inline { len, bytes } => unsafe { std::str::from_utf8_unchecked(&bytes[..*len as usize]) },
+            Repr::Heap(buffer) => &buffer.text,
+        }
+    }
+
+    /// 末尾に追記（共有されていなければその場で、共有されていれば複製してから）
+    pub fn push_str(&mut self, text: &str) {
+        match &mut self.0 {
+            Repr::Inline { len, bytes } if *len as usize + text.len() <= INLINE_CAPACITY => {
+                let start = *len as usize;
+                bytes[start..start + text.len()].copy_from_slice(text.as_bytes());
+                *len += text.len() as u8;
+                return;
+            }
+            Repr::Heap(buffer) => {
+                if let Some(buffer) = Rc::get_mut(buffer) {
+                    buffer.text.push_str(text);
+                    buffer.index = OnceCell::new();
+                    return;
+                }
+            }
+            Repr::Inline { .. } => {}
+        }
+
+        // 新しいバッファに移す（続けて追記されても償却 O(1) になるよう倍の容量を取る）
+        let current = self.as_str();
+        let mut buffer = String::with_capacity((current.len() + text.len()).max(current.len() * 2));
+        buffer.push_str(current);
+        buffer.push_str(text);
+        *self = Str(Repr::Heap(Rc::new(Buffer::new(buffer))));
+    }
+
+    /// 文字数（長い文字列では索引を作って覚えておく）
+    pub fn char_count(&self) -> usize {
+        match &self.0 {
+            Repr::Inline { .. } => self.as_str().chars().count(),
+            Repr::Heap(buffer) => match buffer.index() {
+                CharIndex::Ascii => buffer.text.len(),
+                CharIndex::Offsets(offsets) => offsets.len(),
+            },
+        }
+    }
+
+    /// index 番目の文字（ASCIIなら O(1)、それ以外は索引を作って O(1)）
+    pub fn char_at(&self, index: usize) -> Option<Str> {
+        let (text, start) = match &self.0 {
+            Repr::Inline { .. } => {
+                let text = self.as_str();
+                (text, text.char_indices().nth(index)?.0)
+            }
+            Repr::Heap(buffer) => match buffer.index() {
+                CharIndex::Ascii if index < buffer.text.len() => (&buffer.text[..], index),
+                CharIndex::Ascii => return None,
+                CharIndex::Offsets(offsets) => (&buffer.text[..], *offsets.get(index)?),
+            },
+        };
+        text[start..].chars().next().map(Str::from)
+    }
+
+    /// 同じバッファを共有しているか（短い文字列は共有しない）
+    pub fn ptr_eq(&self, other: &Str) -> bool {
+        match (&self.0, &other.0) {
+            (Repr::Heap(a), Repr::Heap(b)) => Rc::ptr_eq(a, b),
+            _ => false,
+        }
+    }
+
+    /// String に変換（共有されていないバッファはコピーしない）
+    pub fn into_string(self) -> String {
+        match self.0 {
+            Repr::Inline { .. } => self.as_str().to_string(),
+            Repr::Heap(buffer) => match Rc::try_unwrap(buffer) {
+                Ok(buffer) => buffer.text,
+                Err(buffer) => buffer.text.clone(),
+            },
+        }
+    }
+}
+
+impl Default for Str {
+    fn default() -> Self {
+        Str::inline("")
+    }
+}
+
+impl Deref for Str {
+    type Target = str;
+
+    #[inline]
+    fn deref(&self) -> &str {
+        self.as_str()
+    }
+}
+
+impl AsRef<str> for Str {
+    fn as_ref(&self) -> &str {
+        self.as_str()
+    }
+}
+
+impl Borrow<str> for Str {
+    fn borrow(&self) -> &str {
+        self.as_str()
+    }
+}
+
+impl From<&str> for Str {
+    fn from(text: &str) -> Self {
+        Str::new(text)
+    }
+}
+
+impl From<String> for Str {
+    /// 長い文字列はバッファをそのまま引き取る
+    fn from(text: String) -> Self {
+        if text.len() <= INLINE_CAPACITY {
+            Str::inline(&text)
+        } else {
+            Str(Repr::Heap(Rc::new(Buffer::new(text))))
+        }
+    }
+}
+
+impl From<&String> for Str {
+    fn from(text: &String) -> Self {
+        Str::new(text)
+    }
+}
+
+impl From<char> for Str {
+    fn from(ch: char) -> Self {
+        Str::inline(ch.encode_utf8(&mut [0; 4]))
+    }
+}
+
+impl PartialEq for Str {
+    fn eq(&self, other: &Self) -> bool {
+        self.ptr_eq(other) || self.as_str() == other.as_str()
+    }
+}
+
+impl Eq for Str {}
+
+impl PartialEq<str> for Str {
+    fn eq(&self, other: &str) -> bool {
+        self.as_str() == other
+    }
+}
+
+impl PartialEq<&str> for Str {
+    fn eq(&self, other: &&str) -> bool {
+        self.as_str() == *other
+    }
+}
+
+impl PartialOrd for Str {
+    fn partial_cmp(&self, other: &Self) -> Option<std::cmp::Ordering> {
+        Some(self.cmp(other))
+    }
+}
+
+impl Ord for Str {
+    fn cmp(&self, other: &Self) -> std::cmp::Ordering {
+        self.as_str().cmp(other.as_str())
+    }
+}
+
+impl Hash for Str {
+    fn hash<H: Hasher>(&self, state: &mut H) {
+        self.as_str().hash(state)
+    }
+}
+
+impl fmt::Display for Str {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        f.write_str(self.as_str())
+    }
+}
+
+impl fmt::Debug for Str {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        fmt::Debug::fmt(self.as_str(), f)
+    }
+}
+
+/// 文字列の組み立て（1つのバッファに書き足し、最後にコピーせずに Str にする）
+#[derive(Debug, Default)]
+pub struct StringBuilder {
+    text: String,
+}
+
+impl StringBuilder {
+    /// 空の組み立てを作成
+    pub fn new() -> Self {
+        Self::default()
+    }
+
+    /// 容量を指定して作成
+    pub fn with_capacity(capacity: usize) -> Self {
+        StringBuilder { text: String::with_capacity(capacity) }
+    }
+
+    /// 文字列を追記
+    #[inline]
+    pub fn push_str(&mut self, text: &str) {
+        self.text.push_str(text);
+    }
+
+    /// 値の表示形式を追記（文字列・数値は一時的な文字列を作らない）
+    pub fn push_value(&mut self, value: &Value) {
+        use std::fmt::Write;
+        match value {
+            Value::String(s) => self.text.push_str(s),
+            Value::Number(n) if n.fract() == 0.0 => {
+                let _ = write!(self.text, "{}", *n as i64);
+            }
+            Value::Number(n) => {
+                let _ = write!(self.text, "{}", n);
+            }
+            _ => self.text.push_str(&value.to_string()),
+        }
+    }
+
+    /// 書き足したバイト数
+    pub fn len(&self) -> usize {
+        self.text.len()
+    }
+
+    /// まだ何も書き足していないか
+    pub fn is_empty(&self) -> bool {
+        self.text.is_empty()
+    }
+
+    /// 組み立てた文字列
+    pub fn finish(self) -> Str {
+        Str::from(self.text)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_inline_and_heap() {
+        assert_eq!(std::mem::size_of::<Str>(), 16);
+        let short = Str::from("hello");
+        let long = Str::from("a string that does not fit inline");
+        assert!(matches!(short.0, Repr::Inline { .. }));
+        assert!(matches!(long.0, Repr::Heap(_)));
+        assert_eq!(short, "hello");
+        assert_eq!(long.len(), 33);
+
+        // 複製はバッファを共有する
+        let copy = long.clone();
+        assert!(copy.ptr_eq(&long));
+    }
+
+    #[test]
+    fn test_push_str_in_place() {
+        let mut text = Str::from("abc");
+        for _ in 0..100 {
+            text.push_str("de");
+        }
+        assert_eq!(text.len(), 203);
+
+        // 共有されていなければ同じバッファに追記する
+        let before = text.as_ptr();
+        text.push_str("f");
+        assert_eq!(text.as_ptr(), before);
+
+        // 共有されていれば複製してから追記する（元の値は変わらない）
+        let shared = text.clone();
+        text.push_str("g");
+        assert!(!text.ptr_eq(&shared));
+        assert!(shared.ends_with('f'));
+        assert!(text.ends_with("fg"));
+    }
+
+    #[test]
+    fn test_char_at() {
+        let ascii = Str::from("abcdefghijklmnopqrstuvwxyz");
+        assert_eq!(ascii.char_at(25), Some(Str::from('z')));
+        assert_eq!(ascii.char_at(26), None);
+        assert_eq!(ascii.char_count(), 26);
+
+        let mixed = Str::from("こんにちは、世界。hello");
+        assert_eq!(mixed.char_at(7), Some(Str::from('界')));
+        assert_eq!(mixed.char_at(9), Some(Str::from('h')));
+        assert_eq!(mixed.char_count(), 14);
+
+        // 追記すると索引を作り直す
+        let mut grown = mixed.clone();
+        grown.push_str("！");
+        assert_eq!(grown.char_at(14), Some(Str::from('！')));
+        assert_eq!(Str::from("é").char_at(0), Some(Str::from('é')));
+    }
+
+    #[test]
+    fn test_builder() {
+        let mut builder = StringBuilder::new();
+        builder.push_value(&Value::Number(3.0));
+        builder.push_str(", ");
+        builder.push_value(&Value::Number(1.5));
+        builder.push_value(&Value::String(Str::from("!")));
+        assert_eq!(builder.finish(), "3, 1.5!");
+    }
+}
@@ -0,0 +1,494 @@
+/// 非同期タスクとイベントループ
+/// async 関数を呼び出すと本体をすぐには実行せず、タスクを作って実行待ちの列に入れる。
+/// タスクは await されたときに回るイベントループ（スレッドごとに1つのシングルスレッドのスケジューラ）で順に実行する。
+/// VMは await で待つたびにフレームをヒープに移して（ジェネレータと同じ仕組み）ほかのタスクに実行を譲り、
+/// 待っているタスクが終わったらその結果を積んで続きから実行する。
+/// タイマー・I/O などの組み込みの非同期処理は tokio のランタイム（LocalSet）の上で動かし、
+/// 終わったら待っているタスクを起こす。実行できるタスクがなければ tokio で I/O の完了を待つ。
+/// ツリー走査インタプリタは評価を途中で止められないため、タスクの中の await はそこで入れ子のイベントループを回す。
+/// 入れ子のイベントループの下で実行中のタスクが取り消されたら、そのループから取り消しのエラーで抜ける。
+
+use crate::generator::Frame;
+use crate::value::Value;
+use std::cell::{Cell, RefCell};
+use std::collections::VecDeque;
+use std::fmt;
+use std::future::Future;
+use std::rc::Rc;
+use std::time::Duration;
+use tokio::sync::Notify;
+use tokio::task::{JoinHandle, LocalSet};
+
+/// タスクの状態
+pub enum State {
+    /// 実行を待つ呼び出し（インタプリタの async 関数・spawn された関数）
+    Call { function: Value, args: Vec<Value> },
+
+    /// VM: 中断したコルーチンのフレーム（awaiting が終わったらその結果を積んで続きを実行する）
+    Suspended { frame: Frame, awaiting: Option<Rc<Task>> },
+
+    /// 組み込みの非同期処理（tokio のタスク）の完了待ち
+    Native(JoinHandle<()>),
+
+    /// 別のタスクの結果をそのまま結果にする（タスクを返した関数）
+    Follow(Rc<Task>),
+
+    /// gather: すべてのタスクの結果のリスト（どれかが失敗したらそのエラー）
+    Gather(Vec<Rc<Task>>),
+
+    /// timeout: タスクの結果（先にタイマーが終わったらタスクを取り消してエラー）
+    Timeout { task: Rc<Task>, timer: Rc<Task>, seconds: f64 },
+
+    /// join: 待っているタスクが終わったら組み込みの非同期処理に知らせる（自分は終わらない）
+    Wake(Rc<Notify>),
+
+    /// 実行中
+    Running,
+
+    /// 終了した（失敗したら throw された値・エラーメッセージ）
+    Done(Result<Value, Value>),
+}
+
+/// タスク
+pub struct Task {
+    /// 関数名（表示用）
+    name: String,
+
+    state: RefCell<State>,
+
+    /// このタスクの終了を待っているタスク
+    waiters: RefCell<Vec<Rc<Task>>>,
+
+    /// 実行中に取り消された（実行エンジンが止まったところで取り消しのエラーで終わらせる）
+    cancelled: Cell<bool>,
+}
+
+impl Task {
+    fn new(name: &str, state: State) -> Rc<Task> {
+        Rc::new(Task {
+            name: name.to_string(),
+            state: RefCell::new(state),
+            waiters: RefCell::new(Vec::new()),
+            cancelled: Cell::new(false),
+        })
+    }
+
+    /// 関数名
+    pub fn name(&self) -> &str {
+        &self.name
+    }
+
+    /// 終了したか
+    pub fn is_done(&self) -> bool {
+        matches!(*self.state.borrow(), State::Done(_))
+    }
+
+    /// 終了していればその結果
+    pub fn result(&self) -> Option<Result<Value, Value>> {
+        match &*self.state.borrow() {
+            State::Done(result) => Some(result.clone()),
+            _ => None,
+        }
+    }
+
+    /// 実行するために状態を取り出す（実行中にする）
+    pub fn start(&self) -> State {
+        std::mem::replace(&mut *self.state.borrow_mut(), State::Running)
+    }
+
+    /// 実行を終えたあとの状態を設定
+    pub fn set(&self, state: State) {
+        *self.state.borrow_mut() = state;
+    }
+}
+
+impl fmt::Debug for Task {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        // フレーム・待ち合わせは自分自身を参照しうるため名前のみ出力
+        write!(f, "<task {}>", self.name)
+    }
+}
+
+/// スレッドごとのスケジューラ
+struct Scheduler {
+    /// 実行できるタスク（呼び出されたばかり・待っていたタスクが終わった）
+    ready: RefCell<VecDeque<Rc<Task>>>,
+
+    /// 実行エンジンが実行中のタスク（入れ子のイベントループの外側から順に）
+    running: RefCell<Vec<Rc<Task>>>,
+
+    /// 実行中の組み込みの非同期処理の数
+    pending: Cell<usize>,
+
+    /// 組み込みの非同期処理が終わったことを知らせる
+    notify: Notify,
+
+    /// 組み込みの非同期処理（値は Rc を含むため、このスレッドだけで動かす）
+    /// ランタイムより先に捨てる（フィールドは宣言順に捨てられる。スレッドの終了中にランタイムを先に捨てると、
+    /// 止めたタイマーがすでに捨てられた LocalSet のタスクを起こそうとする）
+    local: RefCell<Rc<LocalSet>>,
+
+    /// 組み込みの非同期処理を動かす tokio のランタイム（最初に I/O を待つときに作る）
+    runtime: RefCell<Option<Rc<tokio::runtime::Runtime>>>,
+}
+
+thread_local! {
+    static SCHEDULER: Scheduler = Scheduler {
+        ready: RefCell::new(VecDeque::new()),
+        running: RefCell::new(Vec::new()),
+        pending: Cell::new(0),
+        notify: Notify::new(),
+        local: RefCell::new(Rc::new(LocalSet::new())),
+        runtime: RefCell::new(None),
+    };
+}
+
+/// 組み込みの非同期処理の数を数える（取り消されて future が捨てられても減らす）
+struct PendingGuard;
+
+impl PendingGuard {
+    fn new() -> PendingGuard {
+        SCHEDULER.with(|s| s.pending.set(s.pending.get() + 1));
+        PendingGuard
+    }
+}
+
+impl Drop for PendingGuard {
+    fn drop(&mut self) {
+        // スレッドの終了中はスケジューラがすでにないことがある
+        let _ = SCHEDULER.try_with(|s| s.pending.set(s.pending.get() - 1));
+    }
+}
+
+/// 関数の呼び出しをタスクにして実行待ちの列に入れる
+pub fn spawn(name: &str, function: Value, args: Vec<Value>) -> Rc<Task> {
+    let task = Task::new(name, State::Call { function, args });
+    schedule(task.clone());
+    task
+}
+
+/// VMのコルーチン（先頭で止まっているフレーム）をタスクにして実行待ちの列に入れる
+pub fn spawn_frame(name: &str, frame: Frame) -> Rc<Task> {
+    let task = Task::new(name, State::Suspended { frame, awaiting: None });
+    schedule(task.clone());
+    task
+}
+
+/// 組み込みの非同期処理をタスクにする（future はイベントループが I/O を待つ間に進む）
+pub fn spawn_native<F>(name: &str, future: F) -> Rc<Task>
+where
+    F: Future<Output = Result<Value, String>> + 'static,
+{
+    let task = Task::new(name, State::Running);
+    let guard = PendingGuard::new();
+    let waiting = task.clone();
+    let handle = SCHEDULER.with(|s| {
+        s.local.borrow().spawn_local(async move {
+            let result = future.await;
+            drop(guard);
+            complete(&waiting, result.map_err(|message| Value::String(message.into())));
+            SCHEDULER.with(|s| s.notify.notify_one());
+        })
+    });
+    // すでに終わっていることはない（LocalSet は次に I/O を待つときに初めて future を動かす）
+    task.set(State::Native(handle));
+    task
+}
+
+/// seconds 秒後に終わるタスク
+pub fn sleep(seconds: f64) -> Rc<Task> {
+    // タイマーは作ったときから数える（future が最初に動くのは次に I/O を待つとき）
+    // 表せないほど遠い期限は十分先（約30年後）にする
+    let now = tokio::time::Instant::now();
+    let deadline = Duration::try_from_secs_f64(seconds)
+        .ok()
+        .and_then(|duration| now.checked_add(duration))
+        .unwrap_or_else(|| now + Duration::from_secs(30 * 365 * 24 * 60 * 60));
+    spawn_native("sleep", async move {
+        tokio::time::sleep_until(deadline).await;
+        Ok(Value::Null)
+    })
+}
+
+/// すべてのタスクの結果のリストを結果にするタスク
+pub fn gather(tasks: Vec<Rc<Task>>) -> Rc<Task> {
+    let gathered = Task::new("gather", State::Gather(tasks.clone()));
+    for task in &tasks {
+        wait_on(&gathered, task);
+    }
+    poll(&gathered);
+    gathered
+}
+
+/// タスクが終わるまで待つ future（組み込みの非同期処理が、実行エンジンの実行するタスクの結果を待つ）
+pub async fn join(task: &Rc<Task>) -> Result<Value, Value> {
+    if let Some(result) = task.result() {
+        return result;
+    }
+    let notify = Rc::new(Notify::new());
+    wait_on(&Task::new(&task.name, State::Wake(notify.clone())), task);
+    loop {
+        notify.notified().await;
+        if let Some(result) = task.result() {
+            return result;
+        }
+    }
+}
+
+/// seconds 秒以内に終わらなければ取り消してエラーにするタスク
+pub fn timeout(task: Rc<Task>, seconds: f64) -> Rc<Task> {
+    let timer = sleep(seconds);
+    let limited = Task::new(&task.name, State::Timeout { task: task.clone(), timer: timer.clone(), seconds });
+    wait_on(&limited, &task);
+    wait_on(&limited, &timer);
+    poll(&limited);
+    limited
+}
+
+/// タスクを取り消す（実行中でなければ "cancelled" で終わらせ、組み込みの非同期処理は止める）
+pub fn cancel(task: &Rc<Task>) {
+    let state = match task.start() {
+        State::Running => {
+            // 実行中（入れ子のイベントループの下にいる）のタスクは、そのループが気づいて抜けるまで止まらない
+            task.set(State::Running);
+            task.cancelled.set(true);
+            return;
+        }
+        State::Done(result) => {
+            task.set(State::Done(result));
+            return;
+        }
+        state => state,
+    };
+    match state {
+        State::Native(handle) => handle.abort(),
+        // 取り消されたタスクが待っていたものも取り消す
+        State::Suspended { awaiting: Some(awaited), .. } => cancel(&awaited),
+        State::Follow(inner) => cancel(&inner),
+        State::Gather(tasks) => tasks.iter().for_each(cancel),
+        State::Timeout { task, timer, .. } => {
+            cancel(&task);
+            cancel(&timer);
+        }
+        _ => {}
+    }
+    finish(task, Err(Value::String(cancelled_message(task).into())));
+}
+
+fn cancelled_message(task: &Task) -> String {
+    format!("Task {} was cancelled", task.name)
+}
+
+/// タスクを結果で終わらせ、待っているタスクを起こす
+/// 関数がタスクを返したら、そのタスクの結果を待つ
+pub fn complete(task: &Rc<Task>, result: Result<Value, Value>) {
+    if task.cancelled.get() {
+        return finish(task, Err(Value::String(cancelled_message(task).into())));
+    }
+    match result {
+        Ok(Value::Task(inner)) if !Rc::ptr_eq(&inner, task) => {
+            task.set(State::Follow(inner.clone()));
+            wait_on(task, &inner);
+        }
+        result => finish(task, result),
+    }
+}
+
+fn finish(task: &Rc<Task>, result: Result<Value, Value>) {
+    task.set(State::Done(result));
+    let waiters = std::mem::take(&mut *task.waiters.borrow_mut());
+    for waiter in waiters {
+        poll(&waiter);
+    }
+}
+
+/// task が awaited の終了を待つ（すでに終わっていればすぐに起こす）
+pub fn wait_on(task: &Rc<Task>, awaited: &Rc<Task>) {
+    if awaited.is_done() {
+        poll(task);
+    } else {
+        awaited.waiters.borrow_mut().push(task.clone());
+    }
+}
+
+/// 待っていたタスクが終わったタスクを進める
+/// コルーチン・呼び出しは実行エンジンが実行するので列に入れ、組み合わせのタスクはその場で調べる
+fn poll(task: &Rc<Task>) {
+    let result = match &*task.state.borrow() {
+        State::Call { .. } | State::Suspended { .. } => None,
+        State::Wake(notify) => {
+            notify.notify_one();
+            return;
+        }
+        State::Follow(inner) => match inner.result() {
+            Some(result) => Some(result),
+            None => return,
+        },
+        State::Gather(tasks) => {
+            let mut values = Vec::with_capacity(tasks.len());
+            let mut waiting = false;
+            let mut failed = None;
+            for task in tasks {
+                match task.result() {
+                    Some(Ok(value)) => values.push(value),
+                    // 失敗したタスクがあれば残りを待たずにそのエラーで終わる
+                    Some(Err(error)) => {
+                        failed = Some(error);
+                        break;
+                    }
+                    None => waiting = true,
+                }
+            }
+            match failed {
+                Some(error) => Some(Err(error)),
+                None if waiting => return,
+                None => Some(Ok(Value::List(Rc::new(RefCell::new(values))))),
+            }
+        }
+        State::Timeout { task: inner, timer, seconds } => match inner.result() {
+            Some(result) => Some(result),
+            None if timer.is_done() => {
+                let message = format!("Task {} timed out after {} seconds", inner.name, Value::Number(*seconds));
+                Some(Err(Value::String(message.into())))
+            }
+            None => return,
+        },
+        State::Native(_) | State::Running | State::Done(_) => return,
+    };
+
+    match result {
+        None => schedule(task.clone()),
+        Some(result) => {
+            // 期限切れなら待っていたタスクを取り消し、終わっていればタイマーを止める
+            let state = task.start();
+            if let State::Timeout { task: inner, timer, .. } = &state {
+                cancel(inner);
+                cancel(timer);
+            }
+            drop(state);
+            finish(task, result);
+        }
+    }
+}
+
+/// 実行できるタスクの列に入れる
+/// 組み込みの非同期処理が入れたときも実行エンジンが実行できるように、I/O を待っているイベントループを起こす
+fn schedule(task: Rc<Task>) {
+    SCHEDULER.with(|s| {
+        s.ready.borrow_mut().push_back(task);
+        s.notify.notify_one();
+    });
+}
+
+/// 次に実行するタスク
+pub fn next_ready() -> Option<Rc<Task>> {
+    SCHEDULER.with(|s| s.ready.borrow_mut().pop_front())
+}
+
+/// 実行エンジンがタスクを実行する間、実行中のタスクとして記録する
+pub fn run<R>(task: &Rc<Task>, execute: impl FnOnce() -> R) -> R {
+    SCHEDULER.with(|s| s.running.borrow_mut().push(task.clone()));
+    let result = execute();
+    SCHEDULER.with(|s| s.running.borrow_mut().pop());
+    result
+}
+
+/// 実行中のタスクのどれかが取り消されていれば、そのエラーメッセージ
+/// （入れ子のイベントループはこのエラーで抜け、取り消されたタスクまで巻き戻す）
+pub fn interrupted() -> Option<String> {
+    SCHEDULER.with(|s| {
+        let running = s.running.borrow();
+        running.iter().find(|task| task.cancelled.get()).map(|task| cancelled_message(task))
+    })
+}
+
+/// 実行できるタスクがないとき、組み込みの非同期処理のどれかが終わるまで待つ
+/// target はイベントループが終わりを待っているタスク（何も待つものがなければ二度と終わらない）
+pub fn wait_for_io(target: &Task) -> Result<(), String> {
+    SCHEDULER.with(|s| {
+        if s.pending.get() == 0 {
+            return Err(format!("Deadlock: task {} can never complete", target.name));
+        }
+        let runtime = s.runtime()?;
+        let local = s.local.borrow().clone();
+        runtime.block_on(local.run_until(s.notify.notified()));
+        Ok(())
+    })
+}
+
+impl Scheduler {
+    fn runtime(&self) -> Result<Rc<tokio::runtime::Runtime>, String> {
+        let mut runtime = self.runtime.borrow_mut();
+        if let Some(runtime) = &*runtime {
+            return Ok(runtime.clone());
+        }
+        let created = tokio::runtime::Builder::new_current_thread()
+            .enable_all()
+            .build()
+            .map_err(|e| format!("Failed to start async runtime: {}", e))?;
+        Ok(runtime.insert(Rc::new(created)).clone())
+    }
+}
+
+/// このスレッドのタスクをすべて捨てる（VMが新しいプログラムを実行する前に呼ぶ）
+pub fn reset() {
+    SCHEDULER.with(|s| {
+        s.ready.borrow_mut().clear();
+        s.running.borrow_mut().clear();
+        // 動いている組み込みの非同期処理も future ごと捨てる
+        let local = std::mem::replace(&mut *s.local.borrow_mut(), Rc::new(LocalSet::new()));
+        drop(local);
+    });
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    /// 実行エンジンを使わずに、組み込みの非同期処理だけのタスクが終わるまで待つ
+    fn block_on(target: &Rc<Task>) -> Result<Value, String> {
+        loop {
+            if let Some(result) = target.result() {
+                return result.map_err(|error| error.to_string());
+            }
+            assert!(next_ready().is_none());
+            wait_for_io(target)?;
+        }
+    }
+
+    #[test]
+    fn test_gather_and_timeout() {
+        reset();
+        let started = std::time::Instant::now();
+        let gathered = gather(vec![sleep(0.05), sleep(0.05), gather(vec![sleep(0.05)])]);
+        assert_eq!(block_on(&gathered).unwrap().to_string(), "[null, null, [null]]");
+        assert!(started.elapsed() < Duration::from_millis(500));
+
+        // 期限切れになったタスクは取り消され、タイマーは待たずに終わる
+        let slow = sleep(5.0);
+        let limited = timeout(slow.clone(), 0.01);
+        assert_eq!(block_on(&limited).unwrap_err(), "Task sleep timed out after 0.01 seconds");
+        assert_eq!(slow.result().unwrap().unwrap_err().to_string(), "Task sleep was cancelled");
+        assert!(started.elapsed() < Duration::from_secs(1));
+    }
+
+    #[test]
+    fn test_follow_and_deadlock() {
+        reset();
+        let inner = sleep(0.0);
+        let outer = Task::new("outer", State::Running);
+        complete(&outer, Ok(Value::Task(inner.clone())));
+        assert_eq!(block_on(&outer).unwrap(), Value::Null);
+
+        // 実行中のタスクは取り消しの印だけが付き、実行エンジンが止まったところで終わる
+        let running = Task::new("running", State::Running);
+        cancel(&running);
+        assert!(!running.is_done());
+        assert_eq!(run(&running, interrupted).as_deref(), Some("Task running was cancelled"));
+        complete(&running, Ok(Value::Null));
+        assert!(running.result().unwrap().is_err());
+
+        let never = Task::new("never", State::Running);
+        assert_eq!(block_on(&never).unwrap_err(), "Deadlock: task never can never complete");
+    }
+}
@@ -1,5 +1,7 @@
+use std::collections::HashMap;
+
 /// トークンの種類
-#[derive(Debug, Clone, PartialEq)]
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
 pub enum TokenType {
     // リテラル
     Number,
@@ -14,6 +16,7 @@ pub enum TokenType {
     Const,
     Fun,
     AsyncFun,
+    Lambda,
     Return,
     Yield,
     If,
@@ -108,20 +111,67 @@ pub enum TokenType {
     Eof,
 }
 
+/// インターンした識別子の番号（同じ名前には同じ番号が付く）
+#[derive(Debug, Clone, Copy, PartialEq, Eq, Hash)]
+pub struct Symbol(pub u32);
+
+/// 識別子のインターン表
+/// 名前はソースを借用したまま保持するので、登録してもコピーは発生しない
+#[derive(Debug, Default)]
+pub struct Interner<'src> {
+    symbols: HashMap<&'src str, Symbol>,
+    names: Vec<&'src str>,
+}
+
+impl<'src> Interner<'src> {
+    pub fn new() -> Self {
+        Interner::default()
+    }
+
+    /// 名前を登録して番号を返す（登録済みなら同じ番号）
+    pub fn intern(&mut self, name: &'src str) -> Symbol {
+        if let Some(&symbol) = self.symbols.get(name) {
+            return symbol;
+        }
+        let symbol = Symbol(self.names.len() as u32);
+        self.symbols.insert(name, symbol);
+        self.names.push(name);
+        symbol
+    }
+
+    /// 番号から名前を引く
+    pub fn resolve(&self, symbol: Symbol) -> &'src str {
+        self.names[symbol.0 as usize]
+    }
+
+    /// 登録されている名前の数
+    pub fn len(&self) -> usize {
+        self.names.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.names.is_empty()
+    }
+}
+
 /// トークン
-#[derive(Debug, Clone)]
-pub struct Token {
+/// 字句はソースのスライスを借用する（トークンごとに文字列を確保しない）
+#[derive(Debug, Clone, Copy)]
+pub struct Token<'src> {
     pub token_type: TokenType,
-    pub lexeme: String,
+    pub lexeme: &'src str,
+    /// 識別子ならインターンした番号
+    pub symbol: Option<Symbol>,
     pub line: usize,
     pub column: usize,
 }
 
-impl Token {
-    pub fn new(token_type: TokenType, lexeme: String, line: usize, column: usize) -> Self {
+impl<'src> Token<'src> {
+    pub fn new(token_type: TokenType, lexeme: &'src str, line: usize, column: usize) -> Self {
         Token {
             token_type,
             lexeme,
+            symbol: None,
             line,
             column,
         }
@@ -135,6 +185,7 @@ pub fn keyword_to_token_type(keyword: &str) -> Option<TokenType> {
         "const" => Some(TokenType::Const),
         "fun" => Some(TokenType::Fun),
         "async" => Some(TokenType::AsyncFun),
+        "lambda" => Some(TokenType::Lambda),
         "return" => Some(TokenType::Return),
         "yield" => Some(TokenType::Yield),
         "if" => Some(TokenType::If),
@@ -1,12 +1,19 @@
 /// 値の型システム
 /// Mumei言語の実行時の値を表現
 
-use std::collections::HashMap;
+use std::cmp::Ordering;
 use std::fmt;
 use std::rc::Rc;
 use std::cell::RefCell;
-use crate::ast::ASTNode;
+use crate::array::{self, NumArray};
+use crate::ast::{ASTNode, Ast, NodeId};
+use crate::dict::{Dict, Key};
 use crate::environment::Environment;
+use crate::iterator::{Iter, Range};
+use crate::shape::{Class, Instance};
+use crate::string::Str;
+use crate::task::Task;
+use crate::vm::Closure;
 
 /// Mumei言語の値
 #[derive(Debug, Clone)]
@@ -14,8 +21,8 @@ pub enum Value {
     /// 数値（f64）
     Number(f64),
 
-    /// 文字列
-    String(String),
+    /// 文字列（短ければその場に、長ければ共有バッファに持つ）
+    String(Str),
 
     /// 真偽値
     Boolean(bool),
@@ -26,40 +33,151 @@ pub enum Value {
     /// リスト
     List(Rc<RefCell<Vec<Value>>>),
 
-    /// 辞書
-    Dictionary(Rc<RefCell<HashMap<String, Value>>>),
+    /// 辞書（挿入順）
+    Dictionary(Rc<RefCell<Dict>>),
+
+    /// 数値配列（連続した f64、スライスはバッファを共有するビュー）
+    Array(Rc<NumArray>),
+
+    /// 整数の範囲（range() の結果、要素は反復するときに1つずつ作る）
+    Range(Rc<Range>),
+
+    /// 反復の途中の状態（for 文・GetIter が作る）
+    Iterator(Rc<RefCell<Iter>>),
 
     /// 関数
-    Function {
-        name: String,
-        parameters: Vec<String>,
-        body: Vec<ASTNode>,
-        closure: Rc<Environment>,
-        is_async: bool,
-    },
+    Function(Rc<Function>),
+
+    /// バイトコードVMのクロージャ（コンパイル済み関数＋捕捉変数）
+    Closure(Rc<Closure>),
 
     /// ネイティブ関数（Rustで実装された組み込み関数）
-    NativeFunction {
-        name: String,
-        arity: usize,
-        function: fn(Vec<Value>) -> Result<Value, String>,
-    },
+    NativeFunction(Rc<NativeFunction>),
 
     /// クラス
-    Class {
-        name: String,
-        methods: HashMap<String, Value>,
-        parent: Option<Box<Value>>,
-    },
+    Class(Rc<Class>),
 
     /// インスタンス
-    Instance {
-        class_name: String,
-        fields: Rc<RefCell<HashMap<String, Value>>>,
-    },
+    Instance(Rc<Instance>),
+
+    /// 非同期タスク（async 関数の呼び出し・sleep などの結果、await で結果を待つ）
+    Task(Rc<Task>),
+}
+
+// 大きなペイロードはRcの裏に置き、Valueのコピー・移動を小さく保つ
+
+/// ユーザー定義関数（ツリーウォーキングインタプリタ用）
+/// 本体は構文木を共有して宣言ノードの番号で指す（宣言・呼び出しでASTをコピーしない）
+#[derive(Debug)]
+pub struct Function {
+    pub name: String,
+    pub ast: Rc<Ast>,
+    pub declaration: NodeId,
+    pub closure: Rc<Environment>,
+    pub is_async: bool,
+}
+
+impl Function {
+    /// パラメータ名
+    pub fn parameters(&self) -> &[String] {
+        match self.ast.node(self.declaration) {
+            ASTNode::FunctionDeclaration { parameters, .. } | ASTNode::Lambda { parameters, .. } => parameters,
+            _ => &[],
+        }
+    }
+
+    /// 本体の文
+    pub fn body(&self) -> &[NodeId] {
+        match self.ast.node(self.declaration) {
+            ASTNode::FunctionDeclaration { body, .. } | ASTNode::Lambda { body, .. } => self.ast.list(*body),
+            _ => &[],
+        }
+    }
+
+    /// 本体に yield を含むか（呼び出すと本体を実行せずにジェネレータを返す）
+    pub fn is_generator(&self) -> bool {
+        matches!(self.ast.node(self.declaration), ASTNode::FunctionDeclaration { is_generator: true, .. })
+    }
+}
+
+/// ネイティブ関数
+#[derive(Debug)]
+pub struct NativeFunction {
+    pub name: String,
+    /// 最小の引数の数
+    pub arity: usize,
+    /// 最大の引数の数（省略できる引数がなければ arity と同じ）
+    pub max_arity: usize,
+    /// 引数の反復できる値を最後まで読むか（ユーザー定義の関数を呼ぶイテレータは実行エンジンがリストにしてから渡す）
+    pub collects: bool,
+    /// 第2引数は第1引数のリストの要素ごとのキーを求める関数か（sort。ユーザー定義の関数なら
+    /// 実行エンジンが map と同じ経路で呼び、キーのリストにしてから渡す）
+    pub keyed: bool,
+    pub function: fn(Vec<Value>) -> Result<Value, String>,
+}
+
+impl NativeFunction {
+    /// 引数の数を確認
+    pub fn check_arity(&self, arg_count: usize) -> Result<(), String> {
+        if arg_count < self.arity || arg_count > self.max_arity {
+            let expected = if self.arity == self.max_arity {
+                self.arity.to_string()
+            } else {
+                format!("{} to {}", self.arity, self.max_arity)
+            };
+            return Err(format!("Native function expects {} arguments, got {}", expected, arg_count));
+        }
+        Ok(())
+    }
 }
 
 impl Value {
+    /// ネイティブ関数の値を作成
+    pub fn native(name: &str, arity: usize, function: fn(Vec<Value>) -> Result<Value, String>) -> Value {
+        Self::native_with_optional(name, arity, arity, function)
+    }
+
+    /// 省略できる引数を持つネイティブ関数の値を作成（arity〜max_arity 個の引数を受け取る）
+    pub fn native_with_optional(
+        name: &str,
+        arity: usize,
+        max_arity: usize,
+        function: fn(Vec<Value>) -> Result<Value, String>,
+    ) -> Value {
+        Value::NativeFunction(Rc::new(NativeFunction {
+            name: name.to_string(),
+            arity,
+            max_arity,
+            collects: false,
+            keyed: false,
+            function,
+        }))
+    }
+
+    /// 要素ごとのキーを求める関数を省略できる第2引数に取るネイティブ関数の値を作成（sort）
+    pub fn native_keyed(name: &str, function: fn(Vec<Value>) -> Result<Value, String>) -> Value {
+        Value::NativeFunction(Rc::new(NativeFunction {
+            name: name.to_string(),
+            arity: 1,
+            max_arity: 2,
+            collects: false,
+            keyed: true,
+            function,
+        }))
+    }
+
+    /// 反復できる値を最後まで読むネイティブ関数の値を作成（list・extend など）
+    pub fn native_collecting(name: &str, arity: usize, function: fn(Vec<Value>) -> Result<Value, String>) -> Value {
+        Value::NativeFunction(Rc::new(NativeFunction {
+            name: name.to_string(),
+            arity,
+            max_arity: arity,
+            collects: true,
+            keyed: false,
+            function,
+        }))
+    }
+
     /// 値を真偽値として評価
     pub fn is_truthy(&self) -> bool {
         match self {
@@ -69,6 +187,8 @@ impl Value {
             Value::String(s) => !s.is_empty(),
             Value::List(list) => !list.borrow().is_empty(),
             Value::Dictionary(dict) => !dict.borrow().is_empty(),
+            Value::Array(array) => !array.is_empty(),
+            Value::Range(range) => !range.is_empty(),
             _ => true,
         }
     }
@@ -82,10 +202,14 @@ impl Value {
             Value::Null => "null",
             Value::List(_) => "list",
             Value::Dictionary(_) => "dictionary",
-            Value::Function { .. } => "function",
-            Value::NativeFunction { .. } => "native_function",
-            Value::Class { .. } => "class",
-            Value::Instance { .. } => "instance",
+            Value::Array(_) => "array",
+            Value::Range(_) => "range",
+            Value::Iterator(_) => "iterator",
+            Value::Function(_) | Value::Closure(_) => "function",
+            Value::NativeFunction(_) => "native_function",
+            Value::Class(_) => "class",
+            Value::Instance(_) => "instance",
+            Value::Task(_) => "task",
         }
     }
 
@@ -98,7 +222,7 @@ impl Value {
     }
 
     /// 文字列として取得
-    pub fn as_string(&self) -> Result<String, String> {
+    pub fn as_string(&self) -> Result<Str, String> {
         match self {
             Value::String(s) => Ok(s.clone()),
             _ => Err(format!("Expected string, got {}", self.type_name())),
@@ -122,7 +246,7 @@ impl Value {
     }
 
     /// 辞書として取得
-    pub fn as_dict(&self) -> Result<Rc<RefCell<HashMap<String, Value>>>, String> {
+    pub fn as_dict(&self) -> Result<Rc<RefCell<Dict>>, String> {
         match self {
             Value::Dictionary(dict) => Ok(dict.clone()),
             _ => Err(format!("Expected dictionary, got {}", self.type_name())),
@@ -144,6 +268,15 @@ impl Value {
                 }
                 a_vec.iter().zip(b_vec.iter()).all(|(x, y)| x.equals(y))
             }
+            (Value::Array(a), Value::Array(b)) => a == b,
+            (Value::Range(a), Value::Range(b)) => a == b,
+            (Value::Iterator(a), Value::Iterator(b)) => Rc::ptr_eq(a, b),
+            (Value::Function(a), Value::Function(b)) => Rc::ptr_eq(a, b),
+            (Value::Closure(a), Value::Closure(b)) => Rc::ptr_eq(a, b),
+            (Value::NativeFunction(a), Value::NativeFunction(b)) => Rc::ptr_eq(a, b),
+            (Value::Class(a), Value::Class(b)) => Rc::ptr_eq(a, b),
+            (Value::Instance(a), Value::Instance(b)) => Rc::ptr_eq(a, b),
+            (Value::Task(a), Value::Task(b)) => Rc::ptr_eq(a, b),
             _ => false,
         }
     }
@@ -158,7 +291,7 @@ impl Value {
                     format!("{}", n)
                 }
             }
-            Value::String(s) => s.clone(),
+            Value::String(s) => s.to_string(),
             Value::Boolean(b) => b.to_string(),
             Value::Null => "null".to_string(),
             Value::List(list) => {
@@ -177,17 +310,39 @@ impl Value {
                     .collect();
                 format!("{{{}}}", items.join(", "))
             }
-            Value::Function { name, parameters, .. } => {
-                format!("<function {}({})>", name, parameters.join(", "))
+            Value::Array(array) => {
+                let items: Vec<String> = array
+                    .as_slice()
+                    .iter()
+                    .map(|&n| Value::Number(n).to_string())
+                    .collect();
+                format!("array([{}])", items.join(", "))
+            }
+            Value::Range(range) => {
+                if range.step == 1 {
+                    format!("range({}, {})", range.start, range.end)
+                } else {
+                    format!("range({}, {}, {})", range.start, range.end, range.step)
+                }
+            }
+            Value::Iterator(_) => "<iterator>".to_string(),
+            Value::Function(function) => {
+                format!("<function {}({})>", function.name, function.parameters().join(", "))
+            }
+            Value::Closure(closure) => {
+                format!("<function {}({})>", closure.function.name, closure.function.parameters.join(", "))
             }
-            Value::NativeFunction { name, .. } => {
-                format!("<native function {}>", name)
+            Value::NativeFunction(native) => {
+                format!("<native function {}>", native.name)
             }
-            Value::Class { name, .. } => {
-                format!("<class {}>", name)
+            Value::Class(class) => {
+                format!("<class {}>", class.name)
             }
-            Value::Instance { class_name, .. } => {
-                format!("<{} instance>", class_name)
+            Value::Instance(instance) => {
+                format!("<{} instance>", instance.class_name())
+            }
+            Value::Task(task) => {
+                format!("<task {}>", task.name())
             }
         }
     }
@@ -225,11 +380,61 @@ impl Value {
         }
     }
 
+    /// インデックスアクセス（values[index]）
+    pub fn get_index(&self, index: &Value) -> Result<Value, String> {
+        // 順序のある値の添字は非負の整数
+        let position = |kind: &str| -> Result<usize, String> {
+            let n = index.as_number()?;
+            if n < 0.0 || n.fract() != 0.0 {
+                return Err(format!("{} index must be non-negative integer, got {}", kind, n));
+            }
+            Ok(n as usize)
+        };
+        let out_of_range = || format!("Index {} out of range", index);
+
+        match self {
+            Value::List(list) => list.borrow().get(position("List")?).cloned().ok_or_else(out_of_range),
+            Value::Dictionary(dict) => {
+                let key = Key::from_value(index)?;
+                dict.borrow()
+                    .get(&key)
+                    .cloned()
+                    .ok_or_else(|| format!("Key '{}' not found", key))
+            }
+            Value::String(s) => s.char_at(position("String")?).map(Value::String).ok_or_else(out_of_range),
+            Value::Array(array) => array.get(position("Array")?).map(Value::Number).ok_or_else(out_of_range),
+            Value::Range(range) => range.get(position("Range")?).map(|n| Value::Number(n as f64)).ok_or_else(out_of_range),
+            _ => Err(format!("Cannot index {}", self.type_name())),
+        }
+    }
+
+    /// インデックスへの代入（values[index] = value）
+    pub fn set_index(&self, index: &Value, value: Value) -> Result<(), String> {
+        match self {
+            Value::List(list) => {
+                let n = index.as_number()?;
+                if n < 0.0 || n.fract() != 0.0 {
+                    return Err("List index must be non-negative integer".to_string());
+                }
+                let mut list = list.borrow_mut();
+                let slot = list.get_mut(n as usize).ok_or_else(|| format!("Index {} out of range", n))?;
+                *slot = value;
+                Ok(())
+            }
+            Value::Dictionary(dict) => {
+                let key = Key::from_value(index)?;
+                dict.borrow_mut().insert(key, value);
+                Ok(())
+            }
+            _ => Err(format!("Cannot index assign to {}", self.type_name())),
+        }
+    }
+
     /// 辞書に値を設定
     pub fn dict_set(&self, key: String, value: Value) -> Result<(), String> {
         match self {
             Value::Dictionary(dict) => {
-                dict.borrow_mut().insert(key, value);
+                dict.borrow_mut().insert(Key::Str(key.into()), value);
                 Ok(())
             }
             _ => Err(format!("Cannot set property on {}", self.type_name())),
@@ -241,7 +446,7 @@ impl Value {
         match self {
             Value::Dictionary(dict) => {
                 dict.borrow()
-                    .get(key)
+                    .get_str(key)
                     .cloned()
                     .ok_or_else(|| format!("Key '{}' not found", key))
             }
@@ -268,9 +473,12 @@ impl Value {
     pub fn add(&self, other: &Value) -> Result<Value, String> {
         match (self, other) {
             (Value::Number(a), Value::Number(b)) => Ok(Value::Number(a + b)),
-            (Value::String(a), Value::String(b)) => Ok(Value::String(format!("{}{}", a, b))),
-            (Value::String(a), b) => Ok(Value::String(format!("{}{}", a, b.to_string()))),
-            (a, Value::String(b)) => Ok(Value::String(format!("{}{}", a.to_string(), b))),
+            (Value::String(a), Value::String(b)) => Ok(Value::String(Str::concat(a, b))),
+            (Value::String(a), b) => Ok(Value::String(Str::concat(a, &b.to_string()))),
+            (a, Value::String(b)) => Ok(Value::String(Str::concat(&a.to_string(), b))),
+            (Value::Array(a), Value::Array(b)) => array::zip(a, b, |x, y| x + y),
+            (Value::Array(a), Value::Number(n)) => Ok(array::map(a, |x| x + n)),
+            (Value::Number(n), Value::Array(a)) => Ok(array::map(a, |x| n + x)),
             _ => Err(format!(
                 "Cannot add {} and {}",
                 self.type_name(),
@@ -279,10 +487,24 @@ impl Value {
         }
     }
 
+    /// 加算して自身を結果に置き換える（x = x + y・x += y）
+    /// 文字列は共有されていなければその場で追記する（ループでの連結が償却 O(1)）
+    pub fn add_assign(&mut self, other: &Value) -> Result<(), String> {
+        match (&mut *self, other) {
+            (Value::String(a), Value::String(b)) => a.push_str(b),
+            (Value::String(a), b) => a.push_str(&b.to_string()),
+            _ => *self = self.add(other)?,
+        }
+        Ok(())
+    }
+
     /// 減算
     pub fn subtract(&self, other: &Value) -> Result<Value, String> {
         match (self, other) {
             (Value::Number(a), Value::Number(b)) => Ok(Value::Number(a - b)),
+            (Value::Array(a), Value::Array(b)) => array::zip(a, b, |x, y| x - y),
+            (Value::Array(a), Value::Number(n)) => Ok(array::map(a, |x| x - n)),
+            (Value::Number(n), Value::Array(a)) => Ok(array::map(a, |x| n - x)),
             _ => Err(format!(
                 "Cannot subtract {} from {}",
                 other.type_name(),
@@ -295,9 +517,12 @@ impl Value {
     pub fn multiply(&self, other: &Value) -> Result<Value, String> {
         match (self, other) {
             (Value::Number(a), Value::Number(b)) => Ok(Value::Number(a * b)),
+            (Value::Array(a), Value::Array(b)) => array::zip(a, b, |x, y| x * y),
+            (Value::Array(a), Value::Number(n)) => Ok(array::map(a, |x| x * n)),
+            (Value::Number(n), Value::Array(a)) => Ok(array::map(a, |x| n * x)),
             (Value::String(s), Value::Number(n)) | (Value::Number(n), Value::String(s)) => {
                 if *n >= 0.0 && n.fract() == 0.0 {
-                    Ok(Value::String(s.repeat(*n as usize)))
+                    Ok(Value::String(s.repeat(*n as usize).into()))
                 } else {
                     Err("String multiplication requires non-negative integer".to_string())
                 }
@@ -320,6 +545,12 @@ impl Value {
                     Ok(Value::Number(a / b))
                 }
             }
+            // 要素ごとの除算も 0 で割ればエラー（数値の除算と同じ）
+            (Value::Array(_), Value::Number(b)) if *b == 0.0 => Err("Division by zero".to_string()),
+            (Value::Array(_) | Value::Number(_), Value::Array(b)) if array::contains_zero(b) => Err("Division by zero".to_string()),
+            (Value::Array(a), Value::Array(b)) => array::zip(a, b, |x, y| x / y),
+            (Value::Array(a), Value::Number(n)) => Ok(array::map(a, |x| x / n)),
+            (Value::Number(n), Value::Array(a)) => Ok(array::map(a, |x| n / x)),
             _ => Err(format!(
                 "Cannot divide {} by {}",
                 self.type_name(),
@@ -371,6 +602,19 @@ impl Value {
         }
     }
 
+    /// 並べ替えの順序（数値同士・文字列同士だけ比較できる）
+    pub fn compare(&self, other: &Value) -> Result<Ordering, String> {
+        match (self, other) {
+            (Value::Number(a), Value::Number(b)) => Ok(a.total_cmp(b)),
+            (Value::String(a), Value::String(b)) => Ok(a.cmp(b)),
+            _ => Err(format!(
+                "Cannot compare {} and {}",
+                self.type_name(),
+                other.type_name()
+            )),
+        }
+    }
+
     /// 比較: >
     pub fn greater_than(&self, other: &Value) -> Result<Value, String> {
         match (self, other) {
@@ -389,13 +633,24 @@ impl Value {
 mod tests {
     use super::*;
 
+    #[test]
+    fn test_value_is_compact() {
+        // 大きなペイロードはRcの裏にあり、最大のペイロードは文字列（16バイト）
+        // 文字列の種類を表すバイトの空き値に Value の種類も入るので、全体も16バイト
+        assert_eq!(std::mem::size_of::<Value>(), 16);
+
+        // クローンはRcを共有する
+        let native = Value::native("f", 0, |_| Ok(Value::Null));
+        assert_eq!(native.clone(), native);
+    }
+
     #[test]
     fn test_value_types() {
         let num = Value::Number(42.0);
         assert_eq!(num.type_name(), "number");
         assert_eq!(num.to_string(), "42");
 
-        let str_val = Value::String("hello".to_string());
+        let str_val = Value::String("hello".into());
         assert_eq!(str_val.type_name(), "string");
         assert_eq!(str_val.to_string(), "hello");
     }
@@ -413,12 +668,12 @@ mod tests {
 
     #[test]
     fn test_string_concat() {
-        let a = Value::String("Hello, ".to_string());
-        let b = Value::String("World!".to_string());
+        let a = Value::String("Hello, ".into());
+        let b = Value::String("World!".into());
 
         assert_eq!(
             a.add(&b).unwrap(),
-            Value::String("Hello, World!".to_string())
+            Value::String("Hello, World!".into())
         );
     }
 
@@ -436,7 +691,7 @@ mod tests {
         assert!(Value::Number(42.0).equals(&Value::Number(42.0)));
         assert!(!Value::Number(42.0).equals(&Value::Number(43.0)));
 
-        assert!(Value::String("hello".to_string()).equals(&Value::String("hello".to_string())));
-        assert!(!Value::String("hello".to_string()).equals(&Value::String("world".to_string())));
+        assert!(Value::String("hello".into()).equals(&Value::String("hello".into())));
+        assert!(!Value::String("hello".into()).equals(&Value::String("world".into())));
     }
 }
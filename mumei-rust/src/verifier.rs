@@ -0,0 +1,362 @@
+/// バイトコード検証
+/// 実行前に一度だけ命令列を調べ、VMが命令ごとの境界チェックを省けることを保証する
+/// （ジャンプ先・オペランドの範囲、スタックの深さ、命令列の末尾を越えないこと）
+
+use crate::bytecode::{ByteCode, Constant, FunctionProto, Instruction};
+use std::ops::Deref;
+use std::sync::Arc;
+
+/// 検証済みのバイトコード
+/// verify を通ったものだけが作られ、中の関数のチャンクも含めて max_stack が正しいことを表す
+/// （Arc で共有している間は中身を書き換えられないので、検証結果は変わらない）
+#[derive(Debug, Clone)]
+pub struct Verified(Arc<ByteCode>);
+
+impl Verified {
+    /// 共有しているバイトコードを取り出す
+    pub fn bytecode(&self) -> &Arc<ByteCode> {
+        &self.0
+    }
+}
+
+impl Deref for Verified {
+    type Target = ByteCode;
+
+    fn deref(&self) -> &ByteCode {
+        &self.0
+    }
+}
+
+/// バイトコードを検証する
+/// 各チャンクの max_stack が足りなければ計算した値で埋める（共有されていれば複製してから）
+pub fn verify(mut bytecode: Arc<ByteCode>) -> Result<Verified, String> {
+    let name_count = bytecode.names.len();
+    // トップレベルは中断できるフレームではない
+    if contains_yield(&bytecode) {
+        return Err("yield outside generator function".to_string());
+    }
+    if !is_consistent(&bytecode, 0, name_count)? {
+        let chunk = Arc::make_mut(&mut bytecode);
+        fill_max_stack(chunk, 0, name_count)?;
+    }
+    Ok(Verified(bytecode))
+}
+
+/// チャンク（と中の関数）の max_stack を計算して設定する（コンパイラの出力用）
+pub fn fill_max_stack(chunk: &mut ByteCode, upvalue_count: usize, name_count: usize) -> Result<(), String> {
+    for function in &mut chunk.functions {
+        let function = Arc::make_mut(function);
+        let upvalues = function.upvalues.len();
+        fill_max_stack(Arc::make_mut(&mut function.chunk), upvalues, name_count)?;
+    }
+    chunk.max_stack = max_stack_depth(chunk, upvalue_count, name_count)?;
+    Ok(())
+}
+
+/// すべてのチャンクが正しく、記録された max_stack で足りるか
+fn is_consistent(chunk: &ByteCode, upvalue_count: usize, name_count: usize) -> Result<bool, String> {
+    let mut consistent = max_stack_depth(chunk, upvalue_count, name_count)? <= chunk.max_stack;
+    for function in &chunk.functions {
+        consistent &= is_consistent(&function.chunk, function.upvalues.len(), name_count)?;
+    }
+    Ok(consistent)
+}
+
+/// 命令のスタック効果（取り出す数, 積む数）
+/// 分岐命令は次の命令に進む場合の効果（ジャンプした場合は jump_stack_effect）
+fn stack_effect(instruction: Instruction) -> (usize, usize) {
+    match instruction {
+        Instruction::LoadConst(_)
+        | Instruction::LoadLocal(_)
+        | Instruction::LoadGlobal(_)
+        | Instruction::LoadUpvalue(_)
+        | Instruction::MakeClosure(_) => (0, 1),
+        Instruction::StoreLocal(_)
+        | Instruction::StoreGlobal(_)
+        | Instruction::StoreUpvalue(_)
+        | Instruction::Pop
+        | Instruction::Print
+        | Instruction::Yield
+        | Instruction::JumpIfFalse(_)
+        | Instruction::JumpIfTrue(_) => (1, 0),
+        Instruction::Dup => (1, 2),
+        Instruction::Add
+        | Instruction::Subtract
+        | Instruction::Multiply
+        | Instruction::Divide
+        | Instruction::Modulo
+        | Instruction::Power
+        | Instruction::Less
+        | Instruction::Greater
+        | Instruction::LessEqual
+        | Instruction::GreaterEqual
+        | Instruction::Equal
+        | Instruction::NotEqual
+        | Instruction::And
+        | Instruction::Or
+        | Instruction::IndexGet => (2, 1),
+        Instruction::Not | Instruction::Negate | Instruction::Await => (1, 1),
+        Instruction::Jump(_) | Instruction::Halt => (0, 0),
+        Instruction::Call(count) => (count.saturating_add(1), 1),
+        Instruction::TailCall(count) => (count.saturating_add(1), 0),
+        Instruction::Return => (1, 0),
+        Instruction::MakeList(count) => (count, 1),
+        Instruction::MakeDict(count) => (count.saturating_mul(2), 1),
+        Instruction::IndexSet => (3, 0),
+        Instruction::NewCollection(_) => (1, 2),
+        // 下の結果とイテレータも取り出して積み直すものとして数える（スタックに残っていることを検証する）
+        Instruction::ListAppend => (3, 2),
+        Instruction::DictInsert => (4, 2),
+        Instruction::GetIter => (1, 1),
+        Instruction::ForIter(_) => (0, 1),
+        Instruction::MakeClass(_, methods, inherits) => (methods as usize + inherits as usize, 1),
+        Instruction::GetField(_, _) => (1, 1),
+        Instruction::SetField(_, _) => (2, 0),
+        Instruction::GetMethod(_, _) => (1, 2),
+        Instruction::CallMethod(count) => (count.saturating_add(2), 1),
+        Instruction::IncrLocal(_, _) | Instruction::IncrGlobal(_, _) => (0, 0),
+        Instruction::LessJumpIfFalse(_)
+        | Instruction::GreaterJumpIfFalse(_)
+        | Instruction::LessEqualJumpIfFalse(_)
+        | Instruction::GreaterEqualJumpIfFalse(_)
+        | Instruction::EqualJumpIfFalse(_)
+        | Instruction::NotEqualJumpIfFalse(_) => (2, 0),
+        Instruction::AddNum
+        | Instruction::SubtractNum
+        | Instruction::MultiplyNum
+        | Instruction::DivideNum
+        | Instruction::ConcatStr
+        | Instruction::LessNum
+        | Instruction::GreaterNum
+        | Instruction::LessEqualNum
+        | Instruction::GreaterEqualNum
+        | Instruction::LessNumJump(_)
+        | Instruction::GreaterNumJump(_)
+        | Instruction::LessEqualNumJump(_)
+        | Instruction::GreaterEqualNumJump(_)
+        | Instruction::LoadGlobalCached(_) => stack_effect(instruction.generic()),
+    }
+}
+
+/// ジャンプした場合のスタック効果（ForIter は尽きるとイテレータを取り除いて飛ぶ）
+fn jump_stack_effect(instruction: Instruction) -> (usize, usize) {
+    match instruction {
+        Instruction::ForIter(_) => (1, 0),
+        _ => stack_effect(instruction),
+    }
+}
+
+/// 1チャンクを検証し、ローカル変数より上に積まれる値の最大数を返す
+/// 到達できる命令だけを調べる（到達できない命令は実行されない）
+pub fn max_stack_depth(chunk: &ByteCode, upvalue_count: usize, name_count: usize) -> Result<usize, String> {
+    let len = chunk.instructions.len();
+    if len == 0 {
+        return Err("empty chunk".to_string());
+    }
+    if chunk.local_count > u16::MAX as usize + 1 {
+        return Err(format!("too many local slots: {}", chunk.local_count));
+    }
+
+    // 各命令の直前のスタックの深さ（未到達はNone）
+    let mut depths: Vec<Option<usize>> = vec![None; len];
+    // VMは常に先頭から実行する
+    let mut worklist = vec![(0, 0usize)];
+    let mut max_depth = 0;
+
+    while let Some((pc, depth)) = worklist.pop() {
+        if pc >= len {
+            return Err(format!("jump target {} out of range (chunk has {} instructions)", pc, len));
+        }
+        match depths[pc] {
+            Some(seen) if seen == depth => continue,
+            Some(seen) => {
+                return Err(format!("inconsistent stack depth at {}: {} vs {}", pc, seen, depth));
+            }
+            None => depths[pc] = Some(depth),
+        }
+
+        let instruction = chunk.instructions[pc];
+        check_operands(chunk, instruction, upvalue_count, name_count)
+            .map_err(|e| format!("{} at {} ({:?})", e, pc, instruction))?;
+
+        let (pops, pushes) = stack_effect(instruction);
+        if depth < pops {
+            return Err(format!("stack underflow at {} ({:?})", pc, instruction));
+        }
+        let after = depth - pops + pushes;
+        max_depth = max_depth.max(after);
+
+        if let Some(target) = instruction.jump_target() {
+            let (pops, pushes) = jump_stack_effect(instruction);
+            if depth < pops {
+                return Err(format!("stack underflow at {} ({:?})", pc, instruction));
+            }
+            worklist.push((target, depth - pops + pushes));
+        }
+        if !instruction.is_terminator() {
+            if pc + 1 >= len {
+                return Err(format!("execution falls off the end of the chunk at {}", pc));
+            }
+            worklist.push((pc + 1, after));
+        }
+    }
+
+    Ok(max_depth)
+}
+
+/// オペランドが定数プール・スロット・名前テーブル・関数の範囲内か
+fn check_operands(chunk: &ByteCode, instruction: Instruction, upvalue_count: usize, name_count: usize) -> Result<(), String> {
+    let constant = |index: u32| {
+        if (index as usize) < chunk.constants.len() {
+            Ok(())
+        } else {
+            Err(format!("constant #{} out of range", index))
+        }
+    };
+    let local = |slot: u16| {
+        if (slot as usize) < chunk.local_count {
+            Ok(())
+        } else {
+            Err(format!("local slot {} out of range", slot))
+        }
+    };
+    let name = |index: u32| match chunk.constants.get(index as usize) {
+        Some(Constant::String(_)) => Ok(()),
+        Some(_) => Err(format!("constant #{} is not a name", index)),
+        None => Err(format!("constant #{} out of range", index)),
+    };
+    let global = |index: u32| {
+        if (index as usize) < name_count {
+            Ok(())
+        } else {
+            Err(format!("global #{} out of range", index))
+        }
+    };
+
+    match instruction {
+        Instruction::LoadConst(index) => constant(index),
+        Instruction::LoadLocal(slot) | Instruction::StoreLocal(slot) => local(slot),
+        Instruction::LoadGlobal(index)
+        | Instruction::StoreGlobal(index)
+        | Instruction::LoadGlobalCached(index) => global(index),
+        Instruction::LoadUpvalue(index) | Instruction::StoreUpvalue(index) => {
+            if (index as usize) < upvalue_count {
+                Ok(())
+            } else {
+                Err(format!("upvalue {} out of range", index))
+            }
+        }
+        Instruction::MakeClass(index, _, _)
+        | Instruction::GetField(index, _)
+        | Instruction::SetField(index, _)
+        | Instruction::GetMethod(index, _) => name(index),
+        Instruction::IncrLocal(slot, index) => local(slot).and(constant(index)),
+        Instruction::IncrGlobal(name, index) => global(name).and(constant(index)),
+        Instruction::MakeClosure(index) => match chunk.functions.get(index) {
+            Some(function) => check_captures(chunk, function, upvalue_count),
+            None => Err(format!("function #{} out of range", index)),
+        },
+        _ => Ok(()),
+    }
+}
+
+/// クロージャが捕捉する変数が、作成する側のスロット・捕捉変数の範囲内か
+fn check_captures(chunk: &ByteCode, function: &FunctionProto, upvalue_count: usize) -> Result<(), String> {
+    if function.chunk.local_count < function.parameters.len() {
+        return Err(format!("function {} has fewer slots than parameters", function.name));
+    }
+    // Yield はジェネレータとして呼ばれたフレーム（再開した実行ループの最初のフレーム）でだけ実行できる
+    if !function.is_generator && contains_yield(&function.chunk) {
+        return Err(format!("yield in non-generator function {}", function.name));
+    }
+    // async 関数のフレームはタスクとして再開するので、ジェネレータにはならない
+    if function.is_generator && function.is_async {
+        return Err(format!("async function {} cannot be a generator", function.name));
+    }
+    for upvalue in &function.upvalues {
+        let limit = if upvalue.is_local { chunk.local_count } else { upvalue_count };
+        if upvalue.index as usize >= limit {
+            return Err(format!("captured variable {} out of range in {}", upvalue.index, function.name));
+        }
+    }
+    Ok(())
+}
+
+/// チャンクに Yield 命令があるか
+fn contains_yield(chunk: &ByteCode) -> bool {
+    chunk.instructions.contains(&Instruction::Yield)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn chunk(instructions: Vec<Instruction>) -> ByteCode {
+        let mut bytecode = ByteCode::new();
+        bytecode.add_constant(Constant::Number(1.0));
+        bytecode.instructions = instructions;
+        bytecode
+    }
+
+    #[test]
+    fn test_max_stack_depth() {
+        // 1 + (1 + 1)
+        let bytecode = chunk(vec![
+            Instruction::LoadConst(0),
+            Instruction::LoadConst(0),
+            Instruction::LoadConst(0),
+            Instruction::Add,
+            Instruction::Add,
+            Instruction::Halt,
+        ]);
+        assert_eq!(max_stack_depth(&bytecode, 0, 0), Ok(3));
+
+        let verified = verify(Arc::new(bytecode)).unwrap();
+        assert_eq!(verified.max_stack, 3);
+    }
+
+    #[test]
+    fn test_rejects_invalid_code() {
+        let underflow = chunk(vec![Instruction::Add, Instruction::Halt]);
+        assert!(verify(Arc::new(underflow)).unwrap_err().contains("underflow"));
+
+        let bad_jump = chunk(vec![Instruction::Jump(7), Instruction::Halt]);
+        assert!(verify(Arc::new(bad_jump)).unwrap_err().contains("out of range"));
+
+        let falls_off = chunk(vec![Instruction::LoadConst(0)]);
+        assert!(verify(Arc::new(falls_off)).unwrap_err().contains("falls off"));
+
+        let bad_constant = chunk(vec![Instruction::LoadConst(5), Instruction::Halt]);
+        assert!(verify(Arc::new(bad_constant)).unwrap_err().contains("constant #5"));
+
+        let bad_local = chunk(vec![Instruction::LoadLocal(0), Instruction::Halt]);
+        assert!(verify(Arc::new(bad_local)).unwrap_err().contains("local slot 0"));
+
+        let top_level_yield = chunk(vec![Instruction::LoadConst(0), Instruction::Yield, Instruction::Halt]);
+        assert!(verify(Arc::new(top_level_yield)).unwrap_err().contains("yield outside generator"));
+    }
+
+    #[test]
+    fn test_rejects_inconsistent_depth() {
+        // 分岐の片側だけが値を積んで合流する
+        let bytecode = chunk(vec![
+            Instruction::LoadConst(0),
+            Instruction::JumpIfFalse(3),
+            Instruction::LoadConst(0),
+            Instruction::Halt,
+        ]);
+        assert!(verify(Arc::new(bytecode)).unwrap_err().contains("inconsistent stack depth"));
+    }
+
+    #[test]
+    fn test_compiled_code_is_already_verified() {
+        let tokens = crate::lexer::Lexer::new("fun f(a, b) { a + b * 2 }\nf(1, 2)").tokenize().unwrap();
+        let ast = crate::parser::Parser::new(tokens).parse().unwrap();
+        let bytecode = Arc::new(crate::compiler::Compiler::new().compile(ast).unwrap());
+
+        // コンパイラが max_stack を埋めているので、検証しても複製されない
+        let verified = verify(bytecode.clone()).unwrap();
+        assert!(Arc::ptr_eq(verified.bytecode(), &bytecode));
+        assert_eq!(bytecode.functions[0].chunk.max_stack, 3);
+    }
+}
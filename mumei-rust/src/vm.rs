@@ -1,321 +1,1622 @@
 /// 超高速バイトコード実行エンジン
 /// スタックベースVM（最適化済み）
 
-use crate::bytecode::{ByteCode, Instruction};
+use crate::bytecode::{ByteCode, Constant, FunctionProto, Instruction};
+use crate::dict::{Dict, Key};
+use crate::gateway;
+use crate::generator::{self, Generator, State};
+use crate::iterator::{self, Iter, Step};
+use crate::quicken::{self, QuickCode, QuickenStats};
+use crate::shape::{Class, Instance, Member};
+use crate::task::{self, Task};
 use crate::value::Value;
+use crate::verifier::{self, Verified};
+use std::cell::RefCell;
 use std::collections::HashMap;
+use std::fmt;
+use std::rc::Rc;
+use std::sync::Arc;
 
-/// VM実行スタック（高速化のため固定サイズ）
-const STACK_SIZE: usize = 1024;
+/// VM実行スタックの上限（全フレームのローカル変数と一時値の合計）
+const STACK_SIZE: usize = 64 * 1024;
+
+/// デフォルトの最大呼び出し深度
+/// CLI では環境変数 MUMEI_MAX_FRAMES（MAX_FRAMES_ENV）で変えられる（例: MUMEI_MAX_FRAMES=10000 mumei deep.mu）
+pub const DEFAULT_MAX_FRAMES: usize = 1024;
+
+/// 最大呼び出し深度を指定する環境変数（正の整数）
+pub const MAX_FRAMES_ENV: &str = "MUMEI_MAX_FRAMES";
+
+/// 実行トレースを有効にする環境変数
+pub const TRACE_ENV: &str = "MUMEI_TRACE";
+
+/// 命令特殊化の統計を出力する環境変数
+pub const QUICKEN_STATS_ENV: &str = "MUMEI_QUICKEN_STATS";
+
+/// 実行トレースが環境変数で要求されているか
+pub fn trace_requested() -> bool {
+    env_flag(TRACE_ENV)
+}
+
+/// 命令特殊化の統計が環境変数で要求されているか
+pub fn quicken_stats_requested() -> bool {
+    env_flag(QUICKEN_STATS_ENV)
+}
+
+/// 環境変数で指定された最大呼び出し深度（設定されていなければ DEFAULT_MAX_FRAMES）
+pub fn max_frames_requested() -> Result<usize, String> {
+    parse_max_frames(std::env::var(MAX_FRAMES_ENV).ok().as_deref())
+}
+
+fn parse_max_frames(value: Option<&str>) -> Result<usize, String> {
+    match value.map(str::trim) {
+        None | Some("") => Ok(DEFAULT_MAX_FRAMES),
+        Some(text) => match text.parse::<usize>() {
+            Ok(frames) if frames > 0 => Ok(frames),
+            _ => Err(format!("{} must be a positive integer, got '{}'", MAX_FRAMES_ENV, text)),
+        },
+    }
+}
+
+/// 環境変数が空でも "0" でもなく設定されているか
+fn env_flag(name: &str) -> bool {
+    std::env::var_os(name).map_or(false, |value| !value.is_empty() && value != "0")
+}
+
+/// 捕捉された変数
+/// 元のフレームが生きている間はスタック上の位置を指し、フレーム終了時に値を移す
+#[derive(Debug)]
+pub enum Upvalue {
+    /// スタック上の絶対位置
+    Open(usize),
+    /// フレーム終了後に移された値
+    Closed(Value),
+}
+
+/// クロージャ（関数プロトタイプと捕捉変数の組）
+/// 検証済みのチャンクからVMだけが作る（命令の実行は検証結果を前提にするため）
+pub struct Closure {
+    pub(crate) function: Arc<FunctionProto>,
+    pub(crate) upvalues: Vec<Rc<RefCell<Upvalue>>>,
+
+    /// 実行する命令列（関数のチャンクの複製、特殊化で書き換える）
+    pub(crate) code: Rc<QuickCode>,
+}
+
+impl Closure {
+    /// 関数プロトタイプ
+    pub fn function(&self) -> &Arc<FunctionProto> {
+        &self.function
+    }
+}
+
+impl fmt::Debug for Closure {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        // 捕捉変数は自分自身を参照しうるため名前のみ出力
+        write!(f, "<closure {}>", self.function.name)
+    }
+}
+
+/// 呼び出しフレーム
+struct CallFrame {
+    /// 実行中のクロージャ
+    closure: Rc<Closure>,
+
+    /// 呼び出し元に戻るときの再開位置
+    pc: usize,
+
+    /// ローカル変数スロット0のスタック上の位置
+    base: usize,
+}
 
 /// 仮想マシン
 pub struct VM {
-    /// 実行スタック
+    /// 実行スタック（各フレームのローカル変数はbaseから並ぶ）
     stack: Vec<Value>,
 
-    /// グローバル変数
-    globals: HashMap<String, Value>,
+    /// 呼び出しフレームのスタック
+    frames: Vec<CallFrame>,
 
-    /// プログラムカウンタ
-    pc: usize,
+    /// 最大呼び出し深度
+    max_frames: usize,
 
-    /// 実行中のバイトコード
-    bytecode: Option<ByteCode>,
+    /// まだスタック上にある捕捉変数
+    open_upvalues: Vec<Rc<RefCell<Upvalue>>>,
+
+    /// 直前に Yield で中断したジェネレータのフレーム（再開した側が受け取る）
+    suspended: Option<generator::Frame>,
+
+    /// グローバル変数（バイトコードの名前テーブルと同じインデックス、未定義はNone）
+    globals: Vec<Option<Value>>,
+
+    /// 実行前に定義済みのグローバル変数（組み込み関数など、名前で登録）
+    predefined: HashMap<String, Value>,
+
+    /// 実行中プログラムのグローバル変数名テーブル
+    names: Vec<String>,
+
+    /// 命令ごとにpc・命令・スタックを標準エラーに出力するか
+    trace: bool,
+
+    /// 汎用命令をオペランドの型に合わせて特殊化するか
+    quickening: bool,
+
+    /// 特殊化の統計を集計するか
+    collect_stats: bool,
+
+    /// 直近の実行の特殊化の統計
+    stats: QuickenStats,
 }
 
 impl VM {
     /// 新しいVMを作成
     pub fn new() -> Self {
+        Self::with_max_frames(DEFAULT_MAX_FRAMES)
+    }
+
+    /// 最大呼び出し深度を指定してVMを作成
+    pub fn with_max_frames(max_frames: usize) -> Self {
         VM {
-            stack: Vec::with_capacity(STACK_SIZE),
-            globals: HashMap::new(),
-            pc: 0,
-            bytecode: None,
+            stack: Vec::with_capacity(1024),
+            frames: Vec::new(),
+            max_frames,
+            open_upvalues: Vec::new(),
+            suspended: None,
+            globals: Vec::new(),
+            predefined: HashMap::new(),
+            names: Vec::new(),
+            trace: false,
+            quickening: true,
+            collect_stats: false,
+            stats: QuickenStats::default(),
         }
     }
 
+    /// 最大呼び出し深度を変更
+    pub fn set_max_frames(&mut self, max_frames: usize) {
+        self.max_frames = max_frames;
+    }
+
+    /// 実行トレースの有効・無効を切り替え（無効時はトレースの判定自体を行わない）
+    pub fn set_trace(&mut self, enabled: bool) {
+        self.trace = enabled;
+    }
+
+    /// 命令特殊化の有効・無効を切り替え（無効時は汎用命令のまま実行する）
+    pub fn set_quickening(&mut self, enabled: bool) {
+        self.quickening = enabled;
+    }
+
+    /// 命令特殊化の統計の集計を切り替え（無効時は集計のコードを含まない実行ループを使う）
+    pub fn set_quicken_stats(&mut self, enabled: bool) {
+        self.collect_stats = enabled;
+    }
+
+    /// 直近の実行の命令特殊化の統計
+    pub fn quicken_stats(&self) -> &QuickenStats {
+        &self.stats
+    }
+
+    /// 実行前にグローバル変数を定義（組み込み関数の登録用）
+    pub fn define_global(&mut self, name: &str, value: Value) {
+        self.predefined.insert(name.to_string(), value);
+    }
+
+    /// 実行後のグローバル変数を名前で取得
+    pub fn get_global(&self, name: &str) -> Option<Value> {
+        let index = self.names.iter().position(|n| n == name)?;
+        self.globals.get(index).cloned().flatten()
+    }
+
     /// バイトコードを実行
     pub fn execute(&mut self, bytecode: ByteCode) -> Result<Value, String> {
-        self.bytecode = Some(bytecode);
-        self.pc = 0;
+        self.execute_shared(Arc::new(bytecode))
+    }
+
+    /// 共有されたバイトコードを複製せずに実行（キャッシュからの実行用）
+    pub fn execute_shared(&mut self, bytecode: Arc<ByteCode>) -> Result<Value, String> {
+        let verified = verifier::verify(bytecode).map_err(|e| format!("Invalid bytecode: {}", e))?;
+        self.execute_verified(&verified)
+    }
+
+    /// 検証済みのバイトコードを実行（検証をやり直さない）
+    pub fn execute_verified(&mut self, bytecode: &Verified) -> Result<Value, String> {
+        // 名前テーブルからグローバル変数スロットを用意（名前の検索はここで一度だけ）
+        self.globals = bytecode.names
+            .iter()
+            .map(|name| self.predefined.get(name).cloned())
+            .collect();
+        self.names = bytecode.names.clone();
+
         self.stack.clear();
+        self.frames.clear();
+        self.open_upvalues.clear();
+        self.suspended = None;
+        self.stats = QuickenStats::default();
+        // 前のプログラムのタスク・Gateway のハンドラーは別のグローバル変数を指しているので捨てる
+        task::reset();
+        gateway::reset();
+
+        // トップレベルも引数なしの関数として1つ目のフレームで実行
+        let script = Rc::new(Closure {
+            function: Arc::new(FunctionProto {
+                name: "<script>".to_string(),
+                parameters: Vec::new(),
+                chunk: bytecode.bytecode().clone(),
+                upvalues: Vec::new(),
+                is_generator: false,
+                is_async: false,
+            }),
+            upvalues: Vec::new(),
+            code: Rc::new(QuickCode::new(bytecode)),
+        });
+        self.reserve_frame(&script.function.chunk, 0)?;
+        self.frames.push(CallFrame { closure: script, pc: 0, base: 0 });
+
+        match (self.trace, self.collect_stats) {
+            (false, false) => self.run::<false, false>(0),
+            (false, true) => self.run::<false, true>(0),
+            (true, false) => self.run::<true, false>(0),
+            (true, true) => self.run::<true, true>(0),
+        }
+    }
+
+    /// プログラムを実行したあとに、組み込みの処理が作ったタスクが終わるまでイベントループを回す
+    /// （プログラムが gateway_on で登録したハンドラーを、あとから接続した Gateway のイベントで呼び出すなど）
+    pub fn wait(&mut self, task: &Rc<Task>) -> Result<Value, String> {
+        match (self.trace, self.collect_stats) {
+            (false, false) => self.run_until::<false, false>(task),
+            (false, true) => self.run_until::<false, true>(task),
+            (true, false) => self.run_until::<true, false>(task),
+            (true, true) => self.run_until::<true, true>(task),
+        }
+    }
+
+    /// 命令の実行ループ
+    /// 検証済みのコードだけを実行するので、命令の取得・スタック操作・ローカル変数の参照で境界を調べない
+    /// （スタックの上限はフレームを積むときに max_stack を使って一度だけ確認する）
+    /// 汎用命令は何度か実行されるとオペランドの型に合わせて特殊化命令に書き換わる（quicken モジュール）
+    /// 最後に積まれたフレームから始め、フレームの数が stop_depth に戻ったらその戻り値を返す
+    fn run<const TRACE: bool, const STATS: bool>(&mut self, stop_depth: usize) -> Result<Value, String> {
+        // 実行中フレームの状態はローカル変数に保持し、呼び出し・復帰時のみ同期する
+        let frame = self.frames.last().unwrap();
+        let mut closure = frame.closure.clone();
+        let mut pc = frame.pc;
+        let mut base = frame.base;
 
         loop {
-            // 命令を取得
-            let instruction = self.fetch_instruction()?;
+            // SAFETY: 検証器が到達しうるpc（入口・ジャンプ先・末尾以外の命令の次）が範囲内であることを保証している
+            // （実行する命令列は検証済みのチャンクの複製で、特殊化してもジャンプ先とスタック効果は変わらない）
+            let instruction = unsafe { closure.code.instructions().get_unchecked(pc).get() };
+            pc += 1;
+
+            if TRACE {
+                eprintln!("PC: {:04} | {:?} | Stack: {:?}", pc - 1, instruction, self.stack);
+            }
+
+            // 汎用命令: 実行回数を数え、時期が来たらスタック上のオペランドの型で特殊化を試みる
+            macro_rules! warm_up_binary {
+                () => {
+                    if self.quickening && closure.code.warm_up(pc - 1) {
+                        self.quicken_binary::<STATS>(&closure.code, pc - 1, instruction);
+                    }
+                    if STATS {
+                        self.stats.generic += 1;
+                    }
+                };
+            }
+
+            // 特殊化命令の型ガード: 外れたら汎用命令に戻して同じ命令を実行し直す
+            macro_rules! guard {
+                ($operands:expr) => {
+                    match $operands {
+                        Some(operands) => {
+                            if STATS {
+                                self.stats.record_hit(instruction);
+                            }
+                            operands
+                        }
+                        None => {
+                            pc -= 1;
+                            self.deoptimize::<STATS>(&closure.code, pc, instruction);
+                            continue;
+                        }
+                    }
+                };
+            }
 
-            // デバッグ用（リリースビルドでは削除される）
-            #[cfg(debug_assertions)]
-            {
-                eprintln!("PC: {:04} | {:?} | Stack: {:?}", self.pc - 1, instruction, self.stack);
+            // 関数・クラスの呼び出し（呼び出す値と引数がスタックに積まれている）
+            // クロージャは新しいフレームへ移り、クラスはインスタンスを作って __init__ のフレームへ移る
+            // ジェネレータ関数・async 関数はフレームを実行せずにジェネレータ・タスクを作る
+            macro_rules! invoke {
+                ($arg_count:expr) => {{
+                    let arg_count = $arg_count;
+                    match self.callee(arg_count) {
+                        Value::Closure(callee) if callee.function.suspends() => {
+                            self.start_suspended(&callee, arg_count)?;
+                        }
+                        Value::Closure(callee) => {
+                            // 呼び出し元の再開位置を保存して新しいフレームへ
+                            self.frames.last_mut().unwrap().pc = pc;
+                            base = self.push_frame(callee.clone(), arg_count)?;
+                            closure = callee;
+                            pc = 0;
+                        }
+                        Value::Class(class) => {
+                            if let Some(initializer) = self.prepare_instance(class, arg_count)? {
+                                self.frames.last_mut().unwrap().pc = pc;
+                                base = self.push_frame(initializer.clone(), arg_count + 1)?;
+                                closure = initializer;
+                                pc = 0;
+                            }
+                        }
+                        callee => {
+                            let result = self.call_native::<TRACE, STATS>(callee, arg_count)?;
+                            self.push(result);
+                        }
+                    }
+                }};
             }
 
             match instruction {
-                Instruction::LoadConst(value) => {
-                    self.push(value)?;
+                Instruction::LoadConst(index) => {
+                    let value = closure.code.constant(index).clone();
+                    self.push(value);
+                }
+
+                Instruction::LoadLocal(slot) => {
+                    let value = self.local(base, slot).clone();
+                    self.push(value);
+                }
+
+                Instruction::StoreLocal(slot) => {
+                    let value = self.pop();
+                    *self.local_mut(base, slot) = value;
+                }
+
+                Instruction::LoadUpvalue(index) => {
+                    let value = match &*closure.upvalues[index as usize].borrow() {
+                        Upvalue::Open(position) => self.stack[*position].clone(),
+                        Upvalue::Closed(value) => value.clone(),
+                    };
+                    self.push(value);
                 }
 
-                Instruction::LoadVar(name) => {
-                    let value = self.globals
-                        .get(&name)
-                        .ok_or_else(|| format!("Variable '{}' not found", name))?
-                        .clone();
-                    self.push(value)?;
+                Instruction::StoreUpvalue(index) => {
+                    let value = self.pop();
+                    let mut upvalue = closure.upvalues[index as usize].borrow_mut();
+                    match &mut *upvalue {
+                        Upvalue::Open(position) => self.stack[*position] = value,
+                        Upvalue::Closed(closed) => *closed = value,
+                    }
+                }
+
+                Instruction::LoadGlobal(index) => {
+                    let value = match &self.globals[index as usize] {
+                        Some(value) => value.clone(),
+                        None => return Err(self.undefined_global(index)),
+                    };
+                    // 定義済みなら以後は未定義の場合の分岐を通らない命令にする
+                    if self.quickening && closure.code.warm_up(pc - 1) {
+                        let specialized = Instruction::LoadGlobalCached(index);
+                        closure.code.rewrite(pc - 1, Some(specialized));
+                        if STATS {
+                            self.stats.record_specialized(specialized);
+                        }
+                    }
+                    if STATS {
+                        self.stats.generic += 1;
+                    }
+                    self.push(value);
                 }
 
-                Instruction::StoreVar(name) => {
-                    let value = self.pop()?;
-                    self.globals.insert(name.clone(), value);
+                Instruction::StoreGlobal(index) => {
+                    let value = self.pop();
+                    self.globals[index as usize] = Some(value);
                 }
 
                 Instruction::Pop => {
-                    self.pop()?;
+                    self.pop();
+                }
+
+                Instruction::Dup => {
+                    let value = self.peek().clone();
+                    self.push(value);
                 }
 
                 Instruction::Add => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    warm_up_binary!();
+                    let right = self.pop();
+                    let left = self.pop();
                     // 数値演算の高速パス
                     match (&left, &right) {
                         (Value::Number(l), Value::Number(r)) => {
-                            self.push(Value::Number(l + r))?;
+                            self.push(Value::Number(l + r));
                         }
                         _ => {
                             let result = left.add(&right)?;
-                            self.push(result)?;
+                            self.push(result);
                         }
                     }
                 }
 
                 Instruction::Subtract => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    warm_up_binary!();
+                    let right = self.pop();
+                    let left = self.pop();
                     match (&left, &right) {
                         (Value::Number(l), Value::Number(r)) => {
-                            self.push(Value::Number(l - r))?;
+                            self.push(Value::Number(l - r));
                         }
                         _ => {
                             let result = left.subtract(&right)?;
-                            self.push(result)?;
+                            self.push(result);
                         }
                     }
                 }
 
                 Instruction::Multiply => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    warm_up_binary!();
+                    let right = self.pop();
+                    let left = self.pop();
                     match (&left, &right) {
                         (Value::Number(l), Value::Number(r)) => {
-                            self.push(Value::Number(l * r))?;
+                            self.push(Value::Number(l * r));
                         }
                         _ => {
                             let result = left.multiply(&right)?;
-                            self.push(result)?;
+                            self.push(result);
                         }
                     }
                 }
 
                 Instruction::Divide => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    warm_up_binary!();
+                    let right = self.pop();
+                    let left = self.pop();
                     match (&left, &right) {
-                        (Value::Number(l), Value::Number(r)) => {
-                            self.push(Value::Number(l / r))?;
+                        // ゼロ除算は Value::divide でエラーにする
+                        (Value::Number(l), Value::Number(r)) if *r != 0.0 => {
+                            self.push(Value::Number(l / r));
                         }
                         _ => {
                             let result = left.divide(&right)?;
-                            self.push(result)?;
+                            self.push(result);
                         }
                     }
                 }
 
                 Instruction::Modulo => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    let right = self.pop();
+                    let left = self.pop();
                     let result = left.modulo(&right)?;
-                    self.push(result)?;
+                    self.push(result);
                 }
 
                 Instruction::Power => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    let right = self.pop();
+                    let left = self.pop();
                     let result = left.power(&right)?;
-                    self.push(result)?;
+                    self.push(result);
                 }
 
                 Instruction::Less => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    warm_up_binary!();
+                    let right = self.pop();
+                    let left = self.pop();
                     let result = left.less_than(&right)?;
-                    self.push(result)?;
+                    self.push(result);
                 }
 
                 Instruction::Greater => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    warm_up_binary!();
+                    let right = self.pop();
+                    let left = self.pop();
                     let result = left.greater_than(&right)?;
-                    self.push(result)?;
+                    self.push(result);
                 }
 
                 Instruction::LessEqual => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    warm_up_binary!();
+                    let right = self.pop();
+                    let left = self.pop();
                     let greater = left.greater_than(&right)?;
-                    self.push(Value::Boolean(!greater.as_boolean()?))?;
+                    self.push(Value::Boolean(!greater.as_boolean()?));
                 }
 
                 Instruction::GreaterEqual => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    warm_up_binary!();
+                    let right = self.pop();
+                    let left = self.pop();
                     let less = left.less_than(&right)?;
-                    self.push(Value::Boolean(!less.as_boolean()?))?;
+                    self.push(Value::Boolean(!less.as_boolean()?));
                 }
 
                 Instruction::Equal => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
-                    self.push(Value::Boolean(left.equals(&right)))?;
+                    let right = self.pop();
+                    let left = self.pop();
+                    self.push(Value::Boolean(left.equals(&right)));
                 }
 
                 Instruction::NotEqual => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
-                    self.push(Value::Boolean(!left.equals(&right)))?;
+                    let right = self.pop();
+                    let left = self.pop();
+                    self.push(Value::Boolean(!left.equals(&right)));
                 }
 
                 Instruction::And => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    let right = self.pop();
+                    let left = self.pop();
                     if !left.is_truthy() {
-                        self.push(left)?;
+                        self.push(left);
                     } else {
-                        self.push(right)?;
+                        self.push(right);
                     }
                 }
 
                 Instruction::Or => {
-                    let right = self.pop()?;
-                    let left = self.pop()?;
+                    let right = self.pop();
+                    let left = self.pop();
                     if left.is_truthy() {
-                        self.push(left)?;
+                        self.push(left);
                     } else {
-                        self.push(right)?;
+                        self.push(right);
                     }
                 }
 
                 Instruction::Not => {
-                    let value = self.pop()?;
-                    self.push(Value::Boolean(!value.is_truthy()))?;
+                    let value = self.pop();
+                    self.push(Value::Boolean(!value.is_truthy()));
                 }
 
                 Instruction::Negate => {
-                    let value = self.pop()?;
+                    let value = self.pop();
                     let num = value.as_number()?;
-                    self.push(Value::Number(-num))?;
+                    self.push(Value::Number(-num));
                 }
 
                 Instruction::Jump(target) => {
-                    self.pc = target;
+                    pc = target;
                 }
 
                 Instruction::JumpIfFalse(target) => {
-                    let condition = self.pop()?;
+                    let condition = self.pop();
                     if !condition.is_truthy() {
-                        self.pc = target;
+                        pc = target;
                     }
                 }
 
                 Instruction::JumpIfTrue(target) => {
-                    let condition = self.pop()?;
+                    let condition = self.pop();
                     if condition.is_truthy() {
-                        self.pc = target;
+                        pc = target;
+                    }
+                }
+
+                Instruction::Call(arg_count) => invoke!(arg_count),
+
+                Instruction::CallMethod(arg_count) => {
+                    // メソッドならインスタンスを最初の引数にし、そうでなければ Null の印を取り除いて呼ぶ
+                    let receiver = self.stack.len() - arg_count - 1;
+                    if let Value::Null = self.stack[receiver] {
+                        self.stack.remove(receiver);
+                        invoke!(arg_count);
+                    } else {
+                        invoke!(arg_count + 1);
+                    }
+                }
+
+                Instruction::TailCall(arg_count) => {
+                    let callee = self.callee(arg_count);
+                    match callee {
+                        Value::Closure(callee) if !callee.function.suspends() && self.frames.len() > 1 => {
+                            // 現在のフレームを閉じ、関数と引数をフレームの先頭に移して再利用
+                            self.check_arity(&callee, arg_count)?;
+                            self.close_upvalues(base);
+                            let start = self.stack.len() - arg_count - 1;
+                            self.stack.drain(base - 1..start);
+                            self.reserve_frame(&callee.function.chunk, arg_count)?;
+                            self.frames.last_mut().unwrap().closure = callee.clone();
+                            closure = callee;
+                            pc = 0;
+                        }
+                        Value::Closure(callee) if !callee.function.suspends() => {
+                            // トップレベルには再利用するフレームがないため通常の呼び出し
+                            self.frames.last_mut().unwrap().pc = pc;
+                            base = self.push_frame(callee.clone(), arg_count)?;
+                            closure = callee;
+                            pc = 0;
+                        }
+                        callee => {
+                            let result = match callee {
+                                Value::Class(class) => self.construct::<TRACE, STATS>(class, arg_count)?,
+                                Value::Closure(callee) => {
+                                    self.start_suspended(&callee, arg_count)?;
+                                    self.pop()
+                                }
+                                callee => self.call_native::<TRACE, STATS>(callee, arg_count)?,
+                            };
+                            match self.return_from_frame(result, base, stop_depth) {
+                                Some(result) => return Ok(result),
+                                None => {
+                                    let frame = self.frames.last().unwrap();
+                                    closure = frame.closure.clone();
+                                    pc = frame.pc;
+                                    base = frame.base;
+                                }
+                            }
+                        }
+                    }
+                }
+
+                Instruction::Return => {
+                    let result = self.pop();
+                    match self.return_from_frame(result, base, stop_depth) {
+                        Some(result) => return Ok(result),
+                        None => {
+                            let frame = self.frames.last().unwrap();
+                            closure = frame.closure.clone();
+                            pc = frame.pc;
+                            base = frame.base;
+                        }
+                    }
+                }
+
+                // ジェネレータのフレームはこの実行ループを始めたフレーム（resume が積んだもの）
+                // スタック部分をヒープに移してフレームを外し、値を resume に返す
+                Instruction::Yield => {
+                    let value = self.pop();
+                    let captured = self.suspend_upvalues(base - 1);
+                    let stack = self.stack.split_off(base - 1);
+                    self.frames.pop();
+                    self.suspended = Some(generator::Frame { closure, pc, stack, captured });
+                    return Ok(value);
+                }
+
+                // 終わったタスクならその結果を積む。終わっていなければ、async 関数のフレーム
+                // （タスクを再開した実行ループの最初のフレーム）は Yield と同じように中断してイベントループに戻り、
+                // それ以外（トップレベル・通常の関数）はここでタスクが終わるまでイベントループを回す
+                Instruction::Await => {
+                    let awaited = match self.pop() {
+                        Value::Task(task) => task,
+                        value => return Err(format!("Cannot await {}", value.type_name())),
+                    };
+                    match awaited.result() {
+                        Some(result) => self.push(result.map_err(|error| error.to_string())?),
+                        None if closure.function.is_async => {
+                            let captured = self.suspend_upvalues(base - 1);
+                            let stack = self.stack.split_off(base - 1);
+                            self.frames.pop();
+                            self.suspended = Some(generator::Frame { closure, pc, stack, captured });
+                            return Ok(Value::Task(awaited));
+                        }
+                        None => {
+                            let result = self.run_until::<TRACE, STATS>(&awaited)?;
+                            self.push(result);
+                        }
                     }
                 }
 
+                Instruction::MakeClosure(index) => {
+                    let function = closure.function.chunk.functions[index].clone();
+                    let upvalues = function.upvalues
+                        .iter()
+                        .map(|desc| {
+                            if desc.is_local {
+                                self.capture_upvalue(base + desc.index as usize)
+                            } else {
+                                closure.upvalues[desc.index as usize].clone()
+                            }
+                        })
+                        .collect();
+                    let code = closure.code.function(index, &closure.function.chunk);
+                    self.push(Value::Closure(Rc::new(Closure { function, upvalues, code })));
+                }
+
+                // 要素はスタックの末尾に順に並んでいるので、まとめて移す
                 Instruction::MakeList(count) => {
-                    let mut elements = Vec::with_capacity(count);
-                    for _ in 0..count {
-                        elements.insert(0, self.pop()?);
+                    let start = self.stack.len() - count;
+                    let elements = self.stack.split_off(start);
+                    self.push(Value::List(Rc::new(RefCell::new(elements))));
+                }
+
+                Instruction::MakeDict(count) => {
+                    let start = self.stack.len() - count * 2;
+                    let mut dict = Dict::with_capacity(count);
+                    let mut pairs = self.stack.drain(start..);
+                    while let (Some(key), Some(value)) = (pairs.next(), pairs.next()) {
+                        dict.insert(Key::from_value(&key)?, value);
+                    }
+                    drop(pairs);
+                    self.push(Value::Dictionary(Rc::new(RefCell::new(dict))));
+                }
+
+                Instruction::IndexGet => {
+                    let index = self.pop();
+                    let object = self.pop();
+                    self.push(object.get_index(&index)?);
+                }
+
+                Instruction::IndexSet => {
+                    let index = self.pop();
+                    let object = self.pop();
+                    let value = self.pop();
+                    object.set_index(&index, value)?;
+                }
+
+                Instruction::NewCollection(dict) => {
+                    let capacity = match self.peek() {
+                        Value::Iterator(iterator) => iterator.borrow().len_hint(),
+                        _ => 0,
+                    };
+                    let collection = if dict {
+                        Value::Dictionary(Rc::new(RefCell::new(Dict::with_capacity(capacity))))
+                    } else {
+                        Value::List(Rc::new(RefCell::new(Vec::with_capacity(capacity))))
+                    };
+                    let top = self.stack.len() - 1;
+                    self.stack.insert(top, collection);
+                }
+
+                Instruction::ListAppend => {
+                    let value = self.pop();
+                    match self.collection() {
+                        Value::List(list) => list.borrow_mut().push(value),
+                        other => return Err(format!("Cannot append to {}", other.type_name())),
+                    }
+                }
+
+                Instruction::DictInsert => {
+                    let value = self.pop();
+                    let key = Key::from_value(&self.pop())?;
+                    match self.collection() {
+                        Value::Dictionary(dict) => {
+                            dict.borrow_mut().insert(key, value);
+                        }
+                        other => return Err(format!("Cannot insert into {}", other.type_name())),
+                    }
+                }
+
+                Instruction::IncrLocal(slot, index) => {
+                    let constant = Self::constant(&closure, index);
+                    let local = self.local_mut(base, slot);
+                    match (&*local, constant) {
+                        (Value::Number(n), Constant::Number(k)) => *local = Value::Number(n + k),
+                        _ => local.add_assign(closure.code.constant(index))?,
+                    }
+                }
+
+                Instruction::IncrGlobal(name, index) => {
+                    let constant = Self::constant(&closure, index);
+                    let global = match &mut self.globals[name as usize] {
+                        Some(value) => value,
+                        None => return Err(self.undefined_global(name)),
+                    };
+                    match (&*global, constant) {
+                        (Value::Number(n), Constant::Number(k)) => *global = Value::Number(n + k),
+                        _ => global.add_assign(closure.code.constant(index))?,
+                    }
+                }
+
+                Instruction::LessJumpIfFalse(target)
+                | Instruction::GreaterJumpIfFalse(target)
+                | Instruction::LessEqualJumpIfFalse(target)
+                | Instruction::GreaterEqualJumpIfFalse(target)
+                | Instruction::EqualJumpIfFalse(target)
+                | Instruction::NotEqualJumpIfFalse(target) => {
+                    if !matches!(instruction, Instruction::EqualJumpIfFalse(_) | Instruction::NotEqualJumpIfFalse(_)) {
+                        warm_up_binary!();
+                    }
+                    let right = self.pop();
+                    let left = self.pop();
+                    if !Self::compare(instruction, &left, &right)? {
+                        pc = target;
+                    }
+                }
+
+                Instruction::AddNum => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.replace_numbers(Value::Number(l + r));
+                }
+
+                Instruction::SubtractNum => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.replace_numbers(Value::Number(l - r));
+                }
+
+                Instruction::MultiplyNum => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.replace_numbers(Value::Number(l * r));
+                }
+
+                Instruction::DivideNum => {
+                    // ゼロ除算は汎用のDivideに戻してエラーにする
+                    let (l, r) = guard!(self.number_operands().filter(|&(_, r)| r != 0.0));
+                    self.replace_numbers(Value::Number(l / r));
+                }
+
+                Instruction::ConcatStr => {
+                    guard!(self.has_string_operands().then_some(()));
+                    // 左の文字列のバッファに右を追記する（共有されていなければ新しい文字列を作らない）
+                    if let Some(next) = closure.code.instructions().get(pc) {
+                        self.release_concat_target(next.get(), base);
+                    }
+                    let right = self.pop();
+                    if let (Value::String(left), Value::String(right)) = (self.peek_mut(), &right) {
+                        left.push_str(right);
+                    }
+                }
+
+                // 比較結果は汎用命令と同じ（<= は > の否定、>= は < の否定）
+                Instruction::LessNum => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.replace_numbers(Value::Boolean(l < r));
+                }
+
+                Instruction::GreaterNum => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.replace_numbers(Value::Boolean(l > r));
+                }
+
+                Instruction::LessEqualNum => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.replace_numbers(Value::Boolean(!(l > r)));
+                }
+
+                Instruction::GreaterEqualNum => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.replace_numbers(Value::Boolean(!(l < r)));
+                }
+
+                Instruction::LessNumJump(target) => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.discard_numbers();
+                    if !(l < r) {
+                        pc = target;
+                    }
+                }
+
+                Instruction::GreaterNumJump(target) => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.discard_numbers();
+                    if !(l > r) {
+                        pc = target;
+                    }
+                }
+
+                Instruction::LessEqualNumJump(target) => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.discard_numbers();
+                    if l > r {
+                        pc = target;
+                    }
+                }
+
+                Instruction::GreaterEqualNumJump(target) => {
+                    let (l, r) = guard!(self.number_operands());
+                    self.discard_numbers();
+                    if l < r {
+                        pc = target;
+                    }
+                }
+
+                Instruction::LoadGlobalCached(index) => {
+                    // SAFETY: 検証器がインデックスが名前テーブルの範囲内であることを保証し、globals は名前テーブルと同じ長さ
+                    let value = guard!(unsafe { self.globals.get_unchecked(index as usize) }.as_ref()).clone();
+                    self.push(value);
+                }
+
+                Instruction::GetIter => {
+                    let value = self.pop();
+                    self.push(iterator::iterate(value)?);
+                }
+
+                Instruction::ForIter(target) => {
+                    let step = match self.peek() {
+                        Value::Iterator(iterator) => iterator.borrow_mut().next()?,
+                        other => return Err(format!("Cannot iterate over {}", other.type_name())),
+                    };
+                    let item = match step {
+                        Step::Item(item) => Some(item),
+                        Step::Done => None,
+                        // ユーザー定義の関数の呼び出し・ジェネレータの再開は戻るまで実行してから続ける
+                        step => {
+                            let Value::Iterator(iterator) = self.peek().clone() else { unreachable!() };
+                            self.drive::<TRACE, STATS>(&iterator, step)?
+                        }
+                    };
+                    match item {
+                        Some(item) => self.push(item),
+                        None => {
+                            self.pop();
+                            pc = target;
+                        }
+                    }
+                }
+
+                Instruction::MakeClass(name, method_count, inherits) => {
+                    let start = self.stack.len() - method_count as usize;
+                    let methods = self.stack
+                        .drain(start..)
+                        .map(|method| match &method {
+                            Value::Closure(function) => (function.function.name.clone(), method),
+                            _ => unreachable!("methods are compiled to closures"),
+                        })
+                        .collect();
+                    let parent = if inherits {
+                        match self.pop() {
+                            Value::Class(class) => Some(class),
+                            other => return Err(format!("Superclass must be a class, got {}", other.type_name())),
+                        }
+                    } else {
+                        None
+                    };
+                    let name = Self::name(&closure, name).to_string();
+                    self.push(Value::Class(Rc::new(Class::new(name, methods, parent))));
+                }
+
+                Instruction::GetField(name, cache) => {
+                    let value = match self.pop() {
+                        Value::Instance(instance) => instance.get(Self::name(&closure, name), closure.code.cache(cache)),
+                        object => Self::member(object, Self::name(&closure, name))?.map(Member::Field),
+                    };
+                    match value {
+                        Some(member) => self.push(member.into_value()),
+                        None => return Err(format!("Property '{}' not found", Self::name(&closure, name))),
+                    }
+                }
+
+                Instruction::SetField(name, cache) => {
+                    let object = self.pop();
+                    let value = self.pop();
+                    let name = Self::name(&closure, name);
+                    match object {
+                        Value::Instance(instance) => instance.set(name, value, closure.code.cache(cache)),
+                        Value::Dictionary(dict) => {
+                            dict.borrow_mut().insert(Key::from(name), value);
+                        }
+                        object => return Err(format!("Cannot set member on {}", object.type_name())),
+                    }
+                }
+
+                Instruction::GetMethod(name, cache) => {
+                    let object = self.pop();
+                    let member = match &object {
+                        Value::Instance(instance) => instance.get(Self::name(&closure, name), closure.code.cache(cache)),
+                        _ => Self::member(object.clone(), Self::name(&closure, name))?.map(Member::Field),
+                    };
+                    match member {
+                        Some(Member::Method(method)) => {
+                            self.push(method);
+                            self.push(object);
+                        }
+                        Some(Member::Field(value)) => {
+                            self.push(value);
+                            self.push(Value::Null);
+                        }
+                        None => return Err(format!("Property '{}' not found", Self::name(&closure, name))),
                     }
-                    self.push(Value::List(std::rc::Rc::new(std::cell::RefCell::new(elements))))?;
                 }
 
                 Instruction::Print => {
-                    let value = self.pop()?;
+                    let value = self.pop();
                     println!("{}", value.to_string());
                 }
 
                 Instruction::Halt => {
-                    // スタックに値があれば返す、なければNull
-                    return if !self.stack.is_empty() {
-                        Ok(self.pop()?)
+                    // ローカル変数より上に値があれば返す、なければNull
+                    return if self.stack.len() > base + closure.function.chunk.local_count {
+                        Ok(self.pop())
                     } else {
                         Ok(Value::Null)
                     };
                 }
-
-                _ => {
-                    return Err(format!("Unimplemented instruction: {:?}", instruction));
-                }
             }
         }
     }
 
-    /// 命令をフェッチ（インライン展開される）
+    /// 比較と分岐の複合命令の比較結果（比較命令＋JumpIfFalse と同じ結果になる）
     #[inline(always)]
-    fn fetch_instruction(&mut self) -> Result<Instruction, String> {
-        let bytecode = self.bytecode.as_ref()
-            .ok_or("No bytecode loaded")?;
-
-        if self.pc >= bytecode.instructions.len() {
-            return Err("Program counter out of bounds".to_string());
+    fn compare(instruction: Instruction, left: &Value, right: &Value) -> Result<bool, String> {
+        if let (Value::Number(l), Value::Number(r)) = (left, right) {
+            match instruction {
+                Instruction::LessJumpIfFalse(_) => return Ok(l < r),
+                Instruction::GreaterJumpIfFalse(_) => return Ok(l > r),
+                Instruction::LessEqualJumpIfFalse(_) => return Ok(!(l > r)),
+                Instruction::GreaterEqualJumpIfFalse(_) => return Ok(!(l < r)),
+                _ => {}
+            }
         }
 
-        let instruction = bytecode.instructions[self.pc].clone();
-        self.pc += 1;
-        Ok(instruction)
+        Ok(match instruction {
+            Instruction::LessJumpIfFalse(_) => left.less_than(right)?.is_truthy(),
+            Instruction::GreaterJumpIfFalse(_) => left.greater_than(right)?.is_truthy(),
+            Instruction::LessEqualJumpIfFalse(_) => !left.greater_than(right)?.as_boolean()?,
+            Instruction::GreaterEqualJumpIfFalse(_) => !left.less_than(right)?.as_boolean()?,
+            Instruction::EqualJumpIfFalse(_) => left.equals(right),
+            Instruction::NotEqualJumpIfFalse(_) => !left.equals(right),
+            _ => return Err(format!("Not a compare instruction: {:?}", instruction)),
+        })
     }
 
-    /// スタックにプッシュ（インライン展開される）
-    #[inline(always)]
-    fn push(&mut self, value: Value) -> Result<(), String> {
-        if self.stack.len() >= STACK_SIZE {
-            return Err("Stack overflow".to_string());
+    /// スタック上のオペランドの型に合わせて命令を特殊化する（合わなければしばらく試みない）
+    #[inline(never)]
+    fn quicken_binary<const STATS: bool>(&mut self, code: &QuickCode, pc: usize, instruction: Instruction) {
+        let len = self.stack.len();
+        let specialized = quicken::specialize_binary(instruction, &self.stack[len - 2], &self.stack[len - 1]);
+        code.rewrite(pc, specialized);
+        if STATS {
+            if let Some(specialized) = specialized {
+                self.stats.record_specialized(specialized);
+            }
         }
-        self.stack.push(value);
-        Ok(())
     }
 
-    /// スタックからポップ（インライン展開される）
+    /// 型ガードの外れた特殊化命令を汎用命令に戻す
+    #[cold]
+    fn deoptimize<const STATS: bool>(&mut self, code: &QuickCode, pc: usize, instruction: Instruction) {
+        code.deoptimize(pc);
+        if STATS {
+            self.stats.record_miss(instruction);
+        }
+    }
+
+    /// 呼び出される値（引数の下にある）を取得
     #[inline(always)]
-    fn pop(&mut self) -> Result<Value, String> {
-        self.stack.pop().ok_or_else(|| "Stack underflow".to_string())
+    fn callee(&self, arg_count: usize) -> Value {
+        self.stack[self.stack.len() - arg_count - 1].clone()
     }
-}
 
-impl Default for VM {
-    fn default() -> Self {
-        Self::new()
+    /// 引数の数をチェック
+    #[inline(always)]
+    fn check_arity(&self, closure: &Closure, arg_count: usize) -> Result<(), String> {
+        let expected = closure.function.parameters.len();
+        if expected != arg_count {
+            return Err(format!("Function expects {} arguments, got {}", expected, arg_count));
+        }
+        Ok(())
     }
-}
 
-#[cfg(test)]
-mod tests {
-    use super::*;
+    /// 新しいフレームを積み、そのbaseを返す（引数がスロット 0..n になる）
+    fn push_frame(&mut self, closure: Rc<Closure>, arg_count: usize) -> Result<usize, String> {
+        self.check_arity(&closure, arg_count)?;
+        if self.frames.len() >= self.max_frames {
+            return Err(format!("Stack overflow: maximum call depth of {} exceeded", self.max_frames));
+        }
 
-    #[test]
-    fn test_vm_arithmetic() {
-        let mut vm = VM::new();
+        let base = self.stack.len() - arg_count;
+        self.reserve_frame(&closure.function.chunk, arg_count)?;
+        self.frames.push(CallFrame { closure, pc: 0, base });
+        Ok(base)
+    }
 
-        let mut bytecode = ByteCode::new();
-        // 2 + 3
-        bytecode.emit(Instruction::LoadConst(Value::Number(2.0)));
-        bytecode.emit(Instruction::LoadConst(Value::Number(3.0)));
-        bytecode.emit(Instruction::Add);
-        bytecode.emit(Instruction::Halt);
+    /// 現在のフレームを破棄して戻り値を呼び出し元に積む
+    /// 実行ループを始めたときのフレームから戻った場合（トップレベルなら終了）は戻り値をSomeで返す
+    fn return_from_frame(&mut self, result: Value, base: usize, stop_depth: usize) -> Option<Value> {
+        self.close_upvalues(base);
+        self.frames.pop();
 
-        let result = vm.execute(bytecode).unwrap();
-        assert_eq!(result, Value::Number(5.0));
+        if self.frames.len() == stop_depth {
+            if stop_depth == 0 {
+                self.stack.clear();
+            } else {
+                self.stack.truncate(base - 1);
+            }
+            return Some(result);
+        }
+
+        // 関数本体（base - 1）から上を取り除く
+        self.stack.truncate(base - 1);
+        self.stack.push(result);
+        None
+    }
+
+    /// 実行ループの中から関数を呼び出し、戻り値を得る（イテレータ関数・map・filter・spawn されたタスク用）
+    /// クロージャなら新しいフレームを積み、そのフレームから戻るまで入れ子の実行ループを回す
+    fn call_value<const TRACE: bool, const STATS: bool>(&mut self, callee: Value, args: Vec<Value>) -> Result<Value, String> {
+        let arg_count = args.len();
+        self.push(callee.clone());
+        self.stack.extend(args);
+        match callee {
+            Value::Closure(closure) if closure.function.suspends() => {
+                self.start_suspended(&closure, arg_count)?;
+                Ok(self.pop())
+            }
+            Value::Closure(closure) => {
+                let depth = self.frames.len();
+                self.push_frame(closure, arg_count)?;
+                self.run::<TRACE, STATS>(depth)
+            }
+            Value::Class(class) => self.construct::<TRACE, STATS>(class, arg_count),
+            callee => self.call_native::<TRACE, STATS>(callee, arg_count),
+        }
+    }
+
+    /// イテレータの1ステップを要素が得られるまで進める（尽きたら None）
+    /// 関数の呼び出し・ジェネレータの再開を頼まれたら実行し、その結果をイテレータに返す
+    fn drive<const TRACE: bool, const STATS: bool>(&mut self, iterator: &Rc<RefCell<Iter>>, mut step: Step) -> Result<Option<Value>, String> {
+        loop {
+            // 呼び出しの間はイテレータを借りない（呼び出し先が同じイテレータを読むこともある）
+            let result = match step {
+                Step::Item(item) => return Ok(Some(item)),
+                Step::Done => return Ok(None),
+                Step::Call(function, args) => Some(self.call_value::<TRACE, STATS>(function, args)?),
+                Step::Resume(generator) => self.resume::<TRACE, STATS>(&generator)?,
+            };
+            step = iterator.borrow_mut().complete(result)?;
+        }
+    }
+
+    /// ジェネレータ関数・async 関数の呼び出し（関数と引数がスタックに積まれている）
+    /// 引数とローカル変数のスロットを先頭で止まったフレームとして保存し、ジェネレータ・タスクに置き換える
+    /// （タスクは実行待ちの列に入り、イベントループが回ったときに実行される）
+    fn start_suspended(&mut self, closure: &Rc<Closure>, arg_count: usize) -> Result<(), String> {
+        self.check_arity(closure, arg_count)?;
+        let mut stack = self.stack.split_off(self.stack.len() - arg_count - 1);
+        stack.resize(closure.function.chunk.local_count + 1, Value::Null);
+
+        let frame = generator::Frame { closure: closure.clone(), pc: 0, stack, captured: Vec::new() };
+        let name = &closure.function.name;
+        if closure.function.is_async {
+            self.push(Value::Task(task::spawn_frame(name, frame)));
+        } else {
+            let generator = Generator::new(name, State::Suspended(frame));
+            self.push(Value::Iterator(Rc::new(RefCell::new(Iter::Generator(generator)))));
+        }
+        Ok(())
+    }
+
+    /// ジェネレータを次の yield まで実行し、その値を得る（関数から戻ったら None）
+    fn resume<const TRACE: bool, const STATS: bool>(&mut self, generator: &Generator) -> Result<Option<Value>, String> {
+        let frame = match generator.start()? {
+            State::Suspended(frame) => frame,
+            State::Done => {
+                generator.set(State::Done);
+                return Ok(None);
+            }
+            _ => return Err(format!("Generator {} was not created by the VM", generator.name())),
+        };
+
+        let (result, suspended) = self.resume_frame::<TRACE, STATS>(frame, None);
+        match suspended {
+            Some(frame) => {
+                generator.set(State::Suspended(frame));
+                result.map(Some)
+            }
+            None => {
+                generator.set(State::Done);
+                result.map(|_| None)
+            }
+        }
+    }
+
+    /// 中断したフレームを再開し、次に中断するか戻るまで実行する
+    /// 保存したフレームをスタックの上に戻し（sent があれば await の結果として積む）、そのフレームから入れ子の実行ループを回す
+    /// 中断したら Yield・Await に渡された値とフレームを、戻ったら戻り値を返す（失敗したらフレームを捨てる）
+    fn resume_frame<const TRACE: bool, const STATS: bool>(
+        &mut self,
+        frame: generator::Frame,
+        sent: Option<Value>,
+    ) -> (Result<Value, String>, Option<generator::Frame>) {
+        let start = self.stack.len();
+        let chunk = &frame.closure.function.chunk;
+        if self.frames.len() >= self.max_frames {
+            return (Err(format!("Stack overflow: maximum call depth of {} exceeded", self.max_frames)), None);
+        }
+        if start + frame.stack.len() + chunk.max_stack > STACK_SIZE {
+            return (Err("Stack overflow".to_string()), None);
+        }
+        self.stack.reserve(frame.stack.len() + chunk.max_stack);
+        self.stack.extend(frame.stack);
+
+        // 中断中に値を持っていた捕捉変数を、戻したスタックを指すように開き直す
+        for (offset, upvalue) in frame.captured {
+            let position = start + offset;
+            if let Upvalue::Closed(value) = std::mem::replace(&mut *upvalue.borrow_mut(), Upvalue::Open(position)) {
+                self.stack[position] = value;
+            }
+            self.open_upvalues.push(upvalue);
+        }
+        if let Some(value) = sent {
+            self.push(value);
+        }
+
+        let depth = self.frames.len();
+        self.frames.push(CallFrame { closure: frame.closure, pc: frame.pc, base: start + 1 });
+        let result = self.run::<TRACE, STATS>(depth);
+        if result.is_err() {
+            self.unwind(depth, start);
+        }
+        (result, self.suspended.take())
+    }
+
+    /// 失敗した実行のフレームとスタックを外す（depth 個のフレーム・start 個の値に戻す）
+    /// タスクの失敗は await した側に渡し、VMは残りのタスクの実行を続ける
+    fn unwind(&mut self, depth: usize, start: usize) {
+        self.close_upvalues(start);
+        self.frames.truncate(depth);
+        self.stack.truncate(start);
+        self.suspended = None;
+    }
+
+    /// タスクが終わるまでイベントループを回し、その結果を得る
+    /// 実行できるタスクを順に進め、なければ組み込みの非同期処理（タイマー・I/O）の完了を待つ
+    fn run_until<const TRACE: bool, const STATS: bool>(&mut self, target: &Rc<Task>) -> Result<Value, String> {
+        loop {
+            if let Some(result) = target.result() {
+                return result.map_err(|error| error.to_string());
+            }
+            if let Some(message) = task::interrupted() {
+                // 取り消されたタスクが待っていたものも取り消す
+                task::cancel(target);
+                return Err(message);
+            }
+            match task::next_ready() {
+                Some(task) => task::run(&task, || self.step_task::<TRACE, STATS>(&task)),
+                None => task::wait_for_io(target)?,
+            }
+        }
+    }
+
+    /// タスクを次に await で待つか終わるまで実行する（タスクの失敗はタスクの結果になる）
+    fn step_task<const TRACE: bool, const STATS: bool>(&mut self, task: &Rc<Task>) {
+        let result = match task.start() {
+            task::State::Suspended { frame, awaiting } => {
+                let sent = match awaiting.as_ref().map(|awaited| awaited.result()) {
+                    None => None,
+                    Some(Some(Ok(value))) => Some(value),
+                    // 待っていたタスクが失敗したら、続きを実行せずに同じエラーで終わる
+                    Some(Some(Err(error))) => return task::complete(task, Err(error)),
+                    Some(None) => return task.set(task::State::Suspended { frame, awaiting }),
+                };
+                match self.resume_frame::<TRACE, STATS>(frame, sent) {
+                    // Await がフレームを中断した（値はまだ終わっていないタスク）
+                    (Ok(Value::Task(awaited)), Some(frame)) => {
+                        task.set(task::State::Suspended { frame, awaiting: Some(awaited.clone()) });
+                        return task::wait_on(task, &awaited);
+                    }
+                    (result, _) => result,
+                }
+            }
+            task::State::Call { function, args } => {
+                let (depth, start) = (self.frames.len(), self.stack.len());
+                let result = self.call_value::<TRACE, STATS>(function, args);
+                if result.is_err() {
+                    self.unwind(depth, start);
+                }
+                result
+            }
+            // 組み込みの非同期処理・組み合わせのタスクは実行エンジンを使わない（取り消し済みのタスクも）
+            state => return task.set(state),
+        };
+        task::complete(task, result.map_err(|message| Value::String(message.into())));
+    }
+
+    /// クラスの呼び出しの準備（クラスをインスタンスに置き換える）
+    /// __init__ があれば [__init__, インスタンス, 引数...] に並べ替えてそのクロージャを返す
+    /// （__init__ は self を返すようコンパイルされているので、呼び出しの結果がインスタンスになる）
+    fn prepare_instance(&mut self, class: Rc<Class>, arg_count: usize) -> Result<Option<Rc<Closure>>, String> {
+        let position = self.stack.len() - arg_count - 1;
+        let instance = Value::Instance(Rc::new(Instance::new(class.clone())));
+        match class.initializer() {
+            Some(Value::Closure(initializer)) => {
+                self.stack[position] = Value::Closure(initializer.clone());
+                self.stack.insert(position + 1, instance);
+                Ok(Some(initializer.clone()))
+            }
+            Some(other) => Err(format!("Cannot call {}", other.type_name())),
+            None if arg_count > 0 => Err(format!("{}() takes no arguments, got {}", class.name, arg_count)),
+            None => {
+                self.stack[position] = instance;
+                Ok(None)
+            }
+        }
+    }
+
+    /// 実行ループの中からクラスを呼び出し、作ったインスタンスを得る（末尾呼び出し用）
+    fn construct<const TRACE: bool, const STATS: bool>(&mut self, class: Rc<Class>, arg_count: usize) -> Result<Value, String> {
+        match self.prepare_instance(class, arg_count)? {
+            Some(initializer) => {
+                let depth = self.frames.len();
+                self.push_frame(initializer, arg_count + 1)?;
+                self.run::<TRACE, STATS>(depth)
+            }
+            None => Ok(self.pop()),
+        }
+    }
+
+    /// インスタンス以外の値のメンバー（辞書の要素）
+    fn member(object: Value, name: &str) -> Result<Option<Value>, String> {
+        match object {
+            Value::Dictionary(dict) => Ok(dict.borrow().get_str(name).cloned()),
+            object => Err(format!("Cannot access member of {}", object.type_name())),
+        }
+    }
+
+    /// ネイティブ関数を呼び出す（関数と引数はスタックから取り除かれる）
+    fn call_native<const TRACE: bool, const STATS: bool>(&mut self, callee: Value, arg_count: usize) -> Result<Value, String> {
+        match callee {
+            Value::NativeFunction(native) => {
+                native.check_arity(arg_count)?;
+
+                let mut args: Vec<Value> = self.stack.drain(self.stack.len() - arg_count..).collect();
+                self.stack.pop();
+                if native.collects {
+                    self.collect_arguments::<TRACE, STATS>(&mut args)?;
+                }
+                if native.keyed {
+                    self.apply_key::<TRACE, STATS>(&mut args)?;
+                }
+                (native.function)(args)
+            }
+            _ => Err(format!("Cannot call {}", callee.type_name())),
+        }
+    }
+
+    /// ユーザー定義の関数を呼ぶイテレータの引数を、実行エンジンで最後まで回したリストに置き換える
+    fn collect_arguments<const TRACE: bool, const STATS: bool>(&mut self, args: &mut [Value]) -> Result<(), String> {
+        for arg in args {
+            let iterator = match arg {
+                Value::Iterator(iterator) if iterator.borrow().needs_engine() => iterator.clone(),
+                _ => continue,
+            };
+            let mut items = Vec::with_capacity(iterator.borrow().len_hint());
+            loop {
+                let step = iterator.borrow_mut().next()?;
+                match self.drive::<TRACE, STATS>(&iterator, step)? {
+                    Some(item) => items.push(item),
+                    None => break,
+                }
+            }
+            *arg = Value::List(Rc::new(RefCell::new(items)));
+        }
+        Ok(())
+    }
+
+    /// ユーザー定義のキー関数（sort の第2引数）を、map と同じく各要素に呼んだキーのリストに置き換える
+    fn apply_key<const TRACE: bool, const STATS: bool>(&mut self, args: &mut [Value]) -> Result<(), String> {
+        if let [items @ Value::List(_), key @ (Value::Function(_) | Value::Closure(_))] = args {
+            *key = iterator::map(key.clone(), items)?;
+            self.collect_arguments::<TRACE, STATS>(std::slice::from_mut(key))?;
+        }
+        Ok(())
+    }
+
+    /// フレームのローカル変数スロットをNullで確保し、max_stack 個の一時値を積める空きを確かめる
+    /// （引数の分のスロットはすでにスタック上にある。以後このフレームの push は上限を調べない）
+    #[inline(always)]
+    fn reserve_frame(&mut self, chunk: &ByteCode, arg_count: usize) -> Result<(), String> {
+        let locals = chunk.local_count - arg_count;
+        if self.stack.len() + locals + chunk.max_stack > STACK_SIZE {
+            return Err("Stack overflow".to_string());
+        }
+        self.stack.reserve(locals + chunk.max_stack);
+        self.stack.resize(self.stack.len() + locals, Value::Null);
+        Ok(())
+    }
+
+    /// スタック上の変数を捕捉（同じ位置の捕捉は共有する）
+    fn capture_upvalue(&mut self, position: usize) -> Rc<RefCell<Upvalue>> {
+        for upvalue in &self.open_upvalues {
+            if matches!(&*upvalue.borrow(), Upvalue::Open(p) if *p == position) {
+                return upvalue.clone();
+            }
+        }
+
+        let upvalue = Rc::new(RefCell::new(Upvalue::Open(position)));
+        self.open_upvalues.push(upvalue.clone());
+        upvalue
+    }
+
+    /// from以降のスタック位置を指す捕捉変数に現在の値を移す
+    fn close_upvalues(&mut self, from: usize) {
+        if self.open_upvalues.is_empty() {
+            return;
+        }
+
+        let stack = &self.stack;
+        self.open_upvalues.retain(|upvalue| {
+            let position = match &*upvalue.borrow() {
+                Upvalue::Open(position) => *position,
+                Upvalue::Closed(_) => return false,
+            };
+            if position < from {
+                return true;
+            }
+            *upvalue.borrow_mut() = Upvalue::Closed(stack[position].clone());
+            false
+        });
+    }
+
+    /// ジェネレータのフレームを中断するとき、from 以降を指す捕捉変数に値を移し、from からの位置と組にして返す
+    fn suspend_upvalues(&mut self, from: usize) -> Vec<(usize, Rc<RefCell<Upvalue>>)> {
+        let mut captured = Vec::new();
+        if self.open_upvalues.is_empty() {
+            return captured;
+        }
+
+        let stack = &self.stack;
+        self.open_upvalues.retain(|upvalue| {
+            let position = match &*upvalue.borrow() {
+                Upvalue::Open(position) => *position,
+                Upvalue::Closed(_) => return false,
+            };
+            if position < from {
+                return true;
+            }
+            *upvalue.borrow_mut() = Upvalue::Closed(stack[position].clone());
+            captured.push((position - from, upvalue.clone()));
+            false
+        });
+        captured
+    }
+
+    /// 未定義グローバル変数のエラーメッセージ（エラー時のみ名前を参照）
+    #[cold]
+    fn undefined_global(&self, index: u32) -> String {
+        let name = self.names
+            .get(index as usize)
+            .map(|n| n.as_str())
+            .unwrap_or("?");
+        format!("Variable '{}' not found", name)
+    }
+
+    /// スタックにプッシュ（上限はフレームを積むときに確認済み）
+    #[inline(always)]
+    fn push(&mut self, value: Value) {
+        self.stack.push(value);
+    }
+
+    /// スタックからポップ
+    #[inline(always)]
+    fn pop(&mut self) -> Value {
+        debug_assert!(!self.stack.is_empty(), "stack underflow in verified code");
+        // SAFETY: 検証器が各命令の取り出す数がそのフレームの一時値の数以下であることを保証している
+        unsafe { self.stack.pop().unwrap_unchecked() }
+    }
+
+    /// スタックトップを参照
+    #[inline(always)]
+    fn peek(&self) -> &Value {
+        debug_assert!(!self.stack.is_empty(), "stack underflow in verified code");
+        // SAFETY: pop と同じ（Dup は一時値が1つ以上あるときだけ検証を通る）
+        unsafe { self.stack.get_unchecked(self.stack.len() - 1) }
+    }
+
+    /// 内包表記の結果（反復中のイテレータの下）
+    #[inline(always)]
+    fn collection(&self) -> &Value {
+        // 検証器が ListAppend・DictInsert の前に結果とイテレータが積まれていることを保証している
+        &self.stack[self.stack.len() - 2]
+    }
+
+    /// スタックトップを書き換え用に参照
+    #[inline(always)]
+    fn peek_mut(&mut self) -> &mut Value {
+        debug_assert!(!self.stack.is_empty(), "stack underflow in verified code");
+        // SAFETY: peek と同じ
+        let top = self.stack.len() - 1;
+        unsafe { self.stack.get_unchecked_mut(top) }
+    }
+
+    /// スタックトップの2つ（二項演算のオペランド）がともに数値ならその値
+    #[inline(always)]
+    fn number_operands(&self) -> Option<(f64, f64)> {
+        let len = self.stack.len();
+        debug_assert!(len >= 2, "stack underflow in verified code");
+        // SAFETY: 検証器が二項演算の前に一時値が2つ以上あることを保証している
+        match unsafe { (self.stack.get_unchecked(len - 2), self.stack.get_unchecked(len - 1)) } {
+            (Value::Number(l), Value::Number(r)) => Some((*l, *r)),
+            _ => None,
+        }
+    }
+
+    /// スタックトップの2つがともに文字列か
+    #[inline(always)]
+    fn has_string_operands(&self) -> bool {
+        let len = self.stack.len();
+        debug_assert!(len >= 2, "stack underflow in verified code");
+        // SAFETY: number_operands と同じ
+        matches!(
+            unsafe { (self.stack.get_unchecked(len - 2), self.stack.get_unchecked(len - 1)) },
+            (Value::String(_), Value::String(_))
+        )
+    }
+
+    /// s = s + x の連結の前に、結果を代入する変数から左辺の文字列への参照を外す
+    /// （変数はすぐ上書きされるので、左辺をスタック上だけが持つ状態にしてその場で追記できるようにする）
+    #[inline]
+    fn release_concat_target(&mut self, next: Instruction, base: usize) {
+        let len = self.stack.len();
+        let (below, operands) = self.stack.split_at_mut(len - 2);
+        let target = match next {
+            Instruction::StoreLocal(slot) => below.get_mut(base + slot as usize),
+            Instruction::StoreGlobal(name) => self.globals.get_mut(name as usize).and_then(Option::as_mut),
+            _ => None,
+        };
+        if let (Some(target), Value::String(left)) = (target, &operands[0]) {
+            if matches!(target, Value::String(held) if held.ptr_eq(left)) {
+                *target = Value::Null;
+            }
+        }
+    }
+
+    /// number_operands で数値と確かめた2つを演算結果に置き換える
+    #[inline(always)]
+    fn replace_numbers(&mut self, result: Value) {
+        let len = self.stack.len();
+        // SAFETY: 2つとも数値（解放する資源を持たない）なので、drop せずに上書き・切り詰めてよい
+        unsafe {
+            std::ptr::write(self.stack.as_mut_ptr().add(len - 2), result);
+            self.stack.set_len(len - 1);
+        }
+    }
+
+    /// number_operands で数値と確かめた2つを取り除く
+    #[inline(always)]
+    fn discard_numbers(&mut self) {
+        let len = self.stack.len();
+        // SAFETY: replace_numbers と同じ
+        unsafe { self.stack.set_len(len - 2) };
+    }
+
+    /// ローカル変数スロットを参照
+    #[inline(always)]
+    fn local(&self, base: usize, slot: u16) -> &Value {
+        debug_assert!(base + (slot as usize) < self.stack.len());
+        // SAFETY: 検証器が slot < local_count を保証し、フレームは local_count 個のスロットを確保している
+        unsafe { self.stack.get_unchecked(base + slot as usize) }
+    }
+
+    /// ローカル変数スロットを書き換え用に参照
+    #[inline(always)]
+    fn local_mut(&mut self, base: usize, slot: u16) -> &mut Value {
+        debug_assert!(base + (slot as usize) < self.stack.len());
+        // SAFETY: local と同じ
+        unsafe { self.stack.get_unchecked_mut(base + slot as usize) }
+    }
+
+    /// 名前の定数（クラス名・メンバー名）
+    #[inline(always)]
+    fn name(closure: &Closure, index: u32) -> &str {
+        match closure.code.constant(index) {
+            Value::String(name) => name.as_str(),
+            // 検証器が名前のオペランドは文字列定数を指すことを保証している
+            _ => unreachable!("name operand is not a string constant"),
+        }
+    }
+
+    /// 実行中のチャンクの定数
+    #[inline(always)]
+    fn constant(closure: &Closure, index: u32) -> &Constant {
+        // SAFETY: 検証器が定数のインデックスが定数プールの範囲内であることを保証している
+        unsafe { closure.function.chunk.constants.get_unchecked(index as usize) }
+    }
+}
+
+impl Default for VM {
+    fn default() -> Self {
+        Self::new()
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_vm_arithmetic() {
+        let mut vm = VM::new();
+
+        let mut bytecode = ByteCode::new();
+        // 2 + 3
+        bytecode.emit_constant(Constant::Number(2.0));
+        bytecode.emit_constant(Constant::Number(3.0));
+        bytecode.emit(Instruction::Add);
+        bytecode.emit(Instruction::Halt);
+
+        let result = vm.execute(bytecode).unwrap();
+        assert_eq!(result, Value::Number(5.0));
     }
 
     #[test]
@@ -324,14 +1625,723 @@ mod tests {
 
         let mut bytecode = ByteCode::new();
         // let x = 10; x + 5
-        bytecode.emit(Instruction::LoadConst(Value::Number(10.0)));
-        bytecode.emit(Instruction::StoreVar("x".to_string()));
-        bytecode.emit(Instruction::LoadVar("x".to_string()));
-        bytecode.emit(Instruction::LoadConst(Value::Number(5.0)));
+        let x = bytecode.add_name("x");
+        bytecode.emit_constant(Constant::Number(10.0));
+        bytecode.emit(Instruction::StoreGlobal(x));
+        bytecode.emit(Instruction::LoadGlobal(x));
+        bytecode.emit_constant(Constant::Number(5.0));
         bytecode.emit(Instruction::Add);
         bytecode.emit(Instruction::Halt);
 
         let result = vm.execute(bytecode).unwrap();
         assert_eq!(result, Value::Number(15.0));
+        assert_eq!(vm.get_global("x"), Some(Value::Number(10.0)));
+    }
+
+    #[test]
+    fn test_vm_locals() {
+        let mut vm = VM::new();
+
+        let mut bytecode = ByteCode::new();
+        // local0 = 4; local1 = 6; local0 * local1
+        bytecode.local_count = 2;
+        bytecode.emit_constant(Constant::Number(4.0));
+        bytecode.emit(Instruction::StoreLocal(0));
+        bytecode.emit_constant(Constant::Number(6.0));
+        bytecode.emit(Instruction::StoreLocal(1));
+        bytecode.emit(Instruction::LoadLocal(0));
+        bytecode.emit(Instruction::LoadLocal(1));
+        bytecode.emit(Instruction::Multiply);
+        bytecode.emit(Instruction::Halt);
+
+        let result = vm.execute(bytecode).unwrap();
+        assert_eq!(result, Value::Number(24.0));
+    }
+
+    #[test]
+    fn test_vm_undefined_global() {
+        let mut vm = VM::new();
+
+        let mut bytecode = ByteCode::new();
+        let y = bytecode.add_name("y");
+        bytecode.emit(Instruction::LoadGlobal(y));
+        bytecode.emit(Instruction::Halt);
+
+        let result = vm.execute(bytecode);
+        assert!(result.unwrap_err().contains("Variable 'y' not found"));
+    }
+
+    #[test]
+    fn test_vm_predefined_global() {
+        let mut vm = VM::new();
+        vm.define_global("answer", Value::Number(42.0));
+
+        let mut bytecode = ByteCode::new();
+        let answer = bytecode.add_name("answer");
+        bytecode.emit(Instruction::LoadGlobal(answer));
+        bytecode.emit(Instruction::Halt);
+
+        assert_eq!(vm.execute(bytecode).unwrap(), Value::Number(42.0));
+    }
+
+    #[test]
+    fn test_vm_rejects_invalid_bytecode() {
+        let mut vm = VM::new();
+
+        // 値を積まずに足し算する
+        let mut bytecode = ByteCode::new();
+        bytecode.emit(Instruction::Add);
+        bytecode.emit(Instruction::Halt);
+        assert!(vm.execute(bytecode).unwrap_err().contains("Invalid bytecode"));
+
+        // 命令列の外へのジャンプ
+        let mut bytecode = ByteCode::new();
+        bytecode.emit(Instruction::Jump(10));
+        assert!(vm.execute(bytecode).unwrap_err().contains("out of range"));
+    }
+
+    #[test]
+    fn test_vm_trace_mode() {
+        let mut bytecode = ByteCode::new();
+        bytecode.emit_constant(Constant::Number(20.0));
+        bytecode.emit_constant(Constant::Number(22.0));
+        bytecode.emit(Instruction::Add);
+        bytecode.emit(Instruction::Halt);
+
+        // トレースの有無で結果は変わらない
+        let mut vm = VM::new();
+        vm.set_trace(true);
+        assert_eq!(vm.execute(bytecode).unwrap(), Value::Number(42.0));
+    }
+
+    /// ソースをコンパイルして組み込み関数付きのVMで実行
+    fn run(source: &str, vm: &mut VM) -> Result<Value, String> {
+        use crate::compiler::Compiler;
+        use crate::lexer::Lexer;
+        use crate::parser::Parser;
+
+        let tokens = Lexer::new(source).tokenize().unwrap();
+        let ast = Parser::new(tokens).parse().unwrap();
+        let bytecode = Compiler::new().compile(ast)?;
+        crate::builtins::setup_vm_builtins(vm);
+        vm.execute(bytecode)
+    }
+
+    #[test]
+    fn test_vm_recursive_function() {
+        let source = r#"
+fun fib(n) {
+    if (n <= 1) {
+        return n;
+    }
+    return fib(n - 1) + fib(n - 2);
+}
+fib(15)
+"#;
+        assert_eq!(run(source, &mut VM::new()).unwrap(), Value::Number(610.0));
+    }
+
+    #[test]
+    fn test_vm_closure_upvalues() {
+        let source = r#"
+fun make_counter() {
+    let count = 0
+    fun increment() {
+        count = count + 1
+        count
+    }
+    increment
+}
+let a = make_counter()
+let b = make_counter()
+a()
+a()
+b()
+a() * 10 + b()
+"#;
+        // 各クロージャは自分のcountを持ち、フレーム終了後も値を保持する
+        assert_eq!(run(source, &mut VM::new()).unwrap(), Value::Number(32.0));
+    }
+
+    #[test]
+    fn test_vm_lambda() {
+        // ラムダ式は定義した場所の変数を捕捉するクロージャになる
+        let source = r#"
+fun make_adder(n) {
+    return lambda(x) { x + n }
+}
+let add5 = make_adder(5)
+let square = lambda(x) { x * x }
+let ops = [square, lambda(x) { x - 1 }, add5]
+let value = 3
+for (op in ops) {
+    value = op(value)
+}
+let pair = lambda(a, b) {
+    let first = a * 10;
+    [first, b]
+}
+str(value) + str(list(map(lambda(x) { x * 2 }, [1, 2, 3]))) + str(pair(1, 2)) + str((lambda() { 7 })())
+"#;
+        assert_eq!(run(source, &mut VM::new()).unwrap().to_string(), "13[2, 4, 6][10, 2]7");
+        assert!(run("let f = lambda() {\n yield 1\n}", &mut VM::new()).unwrap_err().contains("lambda cannot yield"));
+    }
+
+    #[test]
+    fn test_vm_nested_capture() {
+        let source = r#"
+fun outer(x) {
+    fun middle() {
+        fun inner(y) {
+            x + y
+        }
+        inner
+    }
+    middle()
+}
+outer(40)(2)
+"#;
+        assert_eq!(run(source, &mut VM::new()).unwrap(), Value::Number(42.0));
+    }
+
+    #[test]
+    fn test_vm_tail_call_reuses_frame() {
+        let source = r#"
+fun count_down(n, acc) {
+    if (n == 0) {
+        return acc;
+    }
+    return count_down(n - 1, acc + 1);
+}
+count_down(5000, 0)
+"#;
+        // 末尾呼び出しはフレームを増やさないため、深度上限を超えない
+        let mut vm = VM::with_max_frames(16);
+        assert_eq!(run(source, &mut vm).unwrap(), Value::Number(5000.0));
+    }
+
+    #[test]
+    fn test_vm_frame_limit() {
+        let source = r#"
+fun depth(n) {
+    if (n == 0) {
+        return 0;
+    }
+    return 1 + depth(n - 1);
+}
+depth(100)
+"#;
+        let mut vm = VM::with_max_frames(50);
+        assert!(run(source, &mut vm).unwrap_err().contains("maximum call depth"));
+
+        vm.set_max_frames(200);
+        assert_eq!(run(source, &mut vm).unwrap(), Value::Number(100.0));
+
+        // MUMEI_MAX_FRAMES の値
+        assert_eq!(parse_max_frames(None), Ok(DEFAULT_MAX_FRAMES));
+        assert_eq!(parse_max_frames(Some("")), Ok(DEFAULT_MAX_FRAMES));
+        assert_eq!(parse_max_frames(Some(" 5000 ")), Ok(5000));
+        for invalid in ["0", "-1", "deep"] {
+            assert!(parse_max_frames(Some(invalid)).unwrap_err().contains(MAX_FRAMES_ENV));
+        }
+    }
+
+    #[test]
+    fn test_vm_native_call_and_arity() {
+        assert_eq!(run("len([1, 2, 3]) + abs(-2)", &mut VM::new()).unwrap(), Value::Number(5.0));
+
+        let error = run("fun f(a) { a }\nf(1, 2)", &mut VM::new()).unwrap_err();
+        assert!(error.contains("Function expects 1 arguments, got 2"));
+    }
+
+    #[test]
+    fn test_vm_quickening_specializes_hot_loop() {
+        let source = r#"
+fun count(n) {
+    let i = 0
+    let total = 0
+    while i < n {
+        total = total + i * 2
+        i = i + 1
+    }
+    total
+}
+let label = ""
+let k = 0
+while k < 20 {
+    label = "x" + label
+    k = k + 1
+}
+count(1000)
+"#;
+        let mut vm = VM::new();
+        vm.set_quicken_stats(true);
+        assert_eq!(run(source, &mut vm).unwrap(), Value::Number(999000.0));
+        assert_eq!(vm.get_global("label"), Some(Value::String("x".repeat(20).into())));
+
+        let stats = vm.quicken_stats();
+        assert!(stats.get(quicken::Specialization::CompareNumJump).hits > 900);
+        assert!(stats.get(quicken::Specialization::MultiplyNum).hits > 900);
+        assert!(stats.get(quicken::Specialization::ConcatStr).hits > 0);
+        assert!(stats.get(quicken::Specialization::LoadGlobalCached).specialized > 0);
+        assert_eq!(stats.total().misses, 0);
+        assert!(stats.coverage() > 0.9);
+    }
+
+    #[test]
+    fn test_vm_quickening_deoptimizes_on_type_change() {
+        // 同じ + が数値で特殊化された後に文字列・数値と文字列の組で実行される
+        let source = r#"
+fun add(a, b) { a + b }
+let i = 0
+let n = 0
+while i < 50 {
+    n = add(n, 1)
+    i = i + 1
+}
+let s = add("a", "b")
+let t = add(1, "b")
+let m = add(n, 1)
+"#;
+        let mut vm = VM::new();
+        vm.set_quicken_stats(true);
+        run(source, &mut vm).unwrap();
+        assert_eq!(vm.get_global("n"), Some(Value::Number(50.0)));
+        assert_eq!(vm.get_global("s"), Some(Value::String("ab".into())));
+        assert_eq!(vm.get_global("t"), Some(Value::String("1b".into())));
+        assert_eq!(vm.get_global("m"), Some(Value::Number(51.0)));
+        assert_eq!(vm.quicken_stats().get(quicken::Specialization::AddNum).misses, 1);
+
+        // 特殊化なしでも同じ結果になる
+        let mut generic = VM::new();
+        generic.set_quickening(false);
+        run(source, &mut generic).unwrap();
+        assert_eq!(generic.get_global("t"), vm.get_global("t"));
+        assert_eq!(generic.get_global("m"), vm.get_global("m"));
+        assert_eq!(generic.quicken_stats().total().specialized, 0);
+    }
+
+    #[test]
+    fn test_vm_division_by_zero() {
+        // 汎用のDivideでも、特殊化されたDivideNumでもエラーになる
+        let mut vm = VM::new();
+        let error = run("1 / 0", &mut vm).unwrap_err();
+        assert!(error.contains("Division by zero"), "{}", error);
+
+        let source = r#"
+fun div(a, b) { a / b }
+let i = 0
+let total = 0
+while i < 50 {
+    total = total + div(10, 2)
+    i = i + 1
+}
+div(total, 0)
+"#;
+        let mut vm = VM::new();
+        vm.set_quicken_stats(true);
+        let error = run(source, &mut vm).unwrap_err();
+        assert!(error.contains("Division by zero"), "{}", error);
+        assert_eq!(vm.get_global("total"), Some(Value::Number(250.0)));
+        assert!(vm.quicken_stats().get(quicken::Specialization::DivideNum).hits > 0);
+    }
+
+    #[test]
+    fn test_vm_for_loops() {
+        let source = r#"
+fun sum_range(start, end, step) {
+    let total = 0
+    for (i in range(start, end, step)) {
+        total = total + i
+    }
+    total
+}
+let chars = ""
+for (c in "abc") {
+    chars = c + chars
+}
+let items = 0
+for (x in [1, 2, 3]) {
+    for (y in [10, 20]) {
+        items = items + x * y
+    }
+}
+sum_range(0, 10, 1) + sum_range(10, 0, -3) * 100
+"#;
+        let mut vm = VM::new();
+        assert_eq!(run(source, &mut vm).unwrap(), Value::Number(45.0 + 22.0 * 100.0));
+        assert_eq!(vm.get_global("chars"), Some(Value::String("cba".into())));
+        assert_eq!(vm.get_global("items"), Some(Value::Number(180.0)));
+    }
+
+    #[test]
+    fn test_vm_for_loop_is_lazy() {
+        // 要素をすべて作っていたら終わらない範囲から途中で return する
+        let source = r#"
+fun first_multiple(k) {
+    for (i in range(1, 10000000000000)) {
+        if i % k == 0 {
+            return i
+        }
+    }
+}
+first_multiple(7) + len(range(0, 10000000000000))
+"#;
+        assert_eq!(run(source, &mut VM::new()).unwrap(), Value::Number(7.0 + 1e13));
+    }
+
+    #[test]
+    fn test_vm_iterator_function() {
+        // 呼ぶたびに次の値を返し、null で終わるクロージャ
+        let source = r#"
+fun countdown(n) {
+    let current = n
+    fun next() {
+        if current == 0 {
+            return null
+        }
+        current = current - 1
+        return current + 1
+    }
+    next
+}
+let seen = 0
+let total = 0
+for (k in countdown(4)) {
+    seen = seen + 1
+    total = total * 10 + k
+}
+total
+"#;
+        let mut vm = VM::new();
+        assert_eq!(run(source, &mut vm).unwrap(), Value::Number(4321.0));
+        assert_eq!(vm.get_global("seen"), Some(Value::Number(4.0)));
+
+        let error = run("for (x in 5) { x }", &mut VM::new()).unwrap_err();
+        assert!(error.contains("Cannot iterate over number"));
+    }
+
+    #[test]
+    fn test_vm_string_append() {
+        // s = s + x・s += x は共有されていなければその場で追記する。別名の値は変わらない
+        let source = r#"
+fun build(n) {
+    let s = ""
+    let i = 0
+    while i < n {
+        s = s + str(i)
+        s += ","
+        i = i + 1
+    }
+    return s
+}
+let text = "start:"
+let alias = text
+let i = 0
+while i < 20 {
+    text = text + "ab"
+    i = i + 1
+}
+let built = build(1000)
+len(built)
+"#;
+        let mut vm = VM::new();
+        assert_eq!(run(source, &mut vm).unwrap(), Value::Number(2890.0 + 1000.0));
+        assert_eq!(vm.get_global("alias"), Some(Value::String("start:".into())));
+        assert_eq!(vm.get_global("text").unwrap().to_string(), format!("start:{}", "ab".repeat(20)));
+        assert!(vm.get_global("built").unwrap().to_string().starts_with("0,1,2,"));
+    }
+
+    #[test]
+    fn test_vm_arrays() {
+        // 数値で特殊化された命令に配列が来ても汎用の演算で続ける
+        let source = r#"
+fun scale(x, k) {
+    return x * k + 1
+}
+let i = 0
+while i < 20 {
+    scale(i, 2)
+    i = i + 1
+}
+let xs = array(range(0, 10))
+let ys = scale(xs, 2)
+let total = 0
+for (y in slice(ys, 8)) {
+    total = total + y
+}
+sum(ys) + dot(xs, xs) + mean(xs) + max(ys) + total
+"#;
+        let mut vm = VM::new();
+        assert_eq!(run(source, &mut vm).unwrap(), Value::Number(100.0 + 285.0 + 4.5 + 19.0 + 36.0));
+        assert_eq!(vm.get_global("ys").unwrap().to_string(), "array([1, 3, 5, 7, 9, 11, 13, 15, 17, 19])");
+
+        let error = run("array(range(0, 3)) + array(range(0, 4))", &mut VM::new()).unwrap_err();
+        assert!(error.contains("Array length mismatch"));
+        let error = run("array(range(1, 3)) / array(range(0, 2))", &mut VM::new()).unwrap_err();
+        assert!(error.contains("Division by zero"));
+    }
+
+    #[test]
+    fn test_vm_classes() {
+        // 同じ呼び出し箇所に2つのクラスのインスタンスが来る（多相のインラインキャッシュ）
+        let source = r#"
+class Point {
+    fun __init__(self, x, y) {
+        self.x = x
+        self.y = y
+    }
+    fun norm(self) {
+        return self.x * self.x + self.y * self.y
+    }
+    fun scaled(self, k) {
+        return Point(self.x * k, self.y * k)
+    }
+}
+class Point3 extends Point {
+    fun __init__(self, x, y, z) {
+        self.x = x
+        self.y = y
+        self.z = z
+        return 0
+    }
+    fun norm(self) {
+        return self.x * self.x + self.y * self.y + self.z * self.z
+    }
+}
+class Empty {}
+let points = [new Point(1, 2), new Point3(1, 2, 3), new Point(3, 4).scaled(2)]
+let total = 0
+for (p in points) {
+    total = total + p.norm()
+}
+fun double(x) {
+    return x * 2
+}
+let e = new Empty()
+e.label = "empty"
+e.double = double
+e.label + ":" + str(total + e.double(0.5))
+"#;
+        let mut vm = VM::new();
+        assert_eq!(run(source, &mut vm).unwrap().to_string(), "empty:120");
+        assert_eq!(vm.get_global("e").unwrap().to_string(), "<Empty instance>");
+
+        let error = run("class A {}\nlet a = A()\na.missing", &mut VM::new()).unwrap_err();
+        assert!(error.contains("Property 'missing' not found"));
+        let error = run("class A {}\nA(1)", &mut VM::new()).unwrap_err();
+        assert!(error.contains("takes no arguments"));
+        let error = run("let x = 1\nx.y", &mut VM::new()).unwrap_err();
+        assert!(error.contains("Cannot access member of number"));
+    }
+
+    #[test]
+    fn test_vm_collections() {
+        let source = r#"
+let words = split("b a b c a b", " ")
+let counts = {w: 0 for w in words}
+for (w in words) {
+    counts[w] = counts[w] + 1
+}
+let grid = [[0, 0], [0, 0]]
+grid[1][0] = 5
+let evens = [i * i for i in range(0, 10) if i % 2 == 0]
+let config = {"name": "mumei", 1: "one"}
+str(counts) + str(grid) + str(evens) + config["name"] + config[1] + "abc"[2]
+"#;
+        let mut vm = VM::new();
+        assert_eq!(
+            run(source, &mut vm).unwrap().to_string(),
+            "{b: 3, a: 2, c: 1}[[0, 0], [5, 0]][0, 4, 16, 36, 64]mumeionec"
+        );
+
+        // 関数の中ではループ変数はローカル変数になる
+        let source = r#"
+fun squares(n) {
+    return {i: i * i for i in range(0, n)}
+}
+squares(5)[4] + len([x for x in [1, 2, 3]])
+"#;
+        assert_eq!(run(source, &mut VM::new()).unwrap(), Value::Number(19.0));
+
+        let error = run("let d = {\"a\": 1}\nd[\"b\"]", &mut VM::new()).unwrap_err();
+        assert!(error.contains("Key 'b' not found"));
+        let error = run("let xs = [1]\nxs[3] = 0", &mut VM::new()).unwrap_err();
+        assert!(error.contains("out of range"));
+    }
+
+    #[test]
+    fn test_vm_sort_with_user_key() {
+        // ユーザー定義の key は map と同じく要素ごとに1回だけ呼ぶ
+        let source = r#"
+let words = split("pear fig banana kiwi", " ")
+sort(words, lambda(w) { 0 - len(w) })
+fun last(w) {
+    return w[len(w) - 1]
+}
+let ys = ["ab", "ca", "bb"]
+sort(ys, last)
+let calls = 0
+let zs = [3, 1, 2]
+sort(zs, lambda(x) {
+    calls = calls + 1
+    x
+})
+str(words) + str(ys) + str(zs) + str(calls)
+"#;
+        assert_eq!(run(source, &mut VM::new()).unwrap().to_string(), "[banana, pear, kiwi, fig][ca, ab, bb][1, 2, 3]3");
+
+        let error = run("sort([1, 2], lambda(x) { x + null })", &mut VM::new()).unwrap_err();
+        assert!(error.contains("Cannot add"), "{}", error);
+        assert!(run("sort([1, 2], 3)", &mut VM::new()).unwrap_err().contains("not callable"));
+    }
+
+    #[test]
+    fn test_vm_generators() {
+        // 無限に続くジェネレータも take・break で必要な分だけ取り出せる
+        let source = r#"
+fun naturals() {
+    let i = 0
+    while true {
+        yield i
+        i = i + 1
+    }
+}
+fun counter() {
+    let n = 0
+    fun bump() {
+        n = n + 1
+        return n
+    }
+    yield bump()
+    yield bump()
+    yield n
+}
+fun chain(a, b) {
+    for (x in a) {
+        yield x
+    }
+    for (y in b) {
+        if y == 2 { continue }
+        if y == 4 { break }
+        yield y
+    }
+}
+fun double(x) {
+    return x * 2
+}
+let g = naturals()
+let seen = ""
+for (x in g) {
+    seen = seen + str(x)
+    if x == 2 { break }
+}
+for (x in g) {
+    seen = seen + str(x)
+    if x == 4 { break }
+}
+let evens = filter(double, map(double, take(naturals(), 5)))
+let pairs = zip(counter(), (w + "!" for w in ["a", "b", "c", "d"]))
+seen + str(list(counter())) + str(list(chain(counter(), range(0, 10)))) + str(list(evens)) + str(list(pairs)) + str(sum(x * x for x in range(0, 4)))
+"#;
+        // 中断したフレームはヒープに置かれるため、要素をいくつ取り出してもフレームは増えない
+        let mut vm = VM::with_max_frames(8);
+        assert_eq!(
+            run(source, &mut vm).unwrap().to_string(),
+            "01234[1, 2, 2][1, 2, 2, 0, 1, 3][2, 4, 6, 8][[1, a!], [2, b!], [2, c!]]14"
+        );
+        let total = run("fun naturals() {\n let i = 0\n while true {\n yield i\n i = i + 1\n }\n}\nsum(take(naturals(), 100000))", &mut vm);
+        assert_eq!(total.unwrap(), Value::Number(4999950000.0));
+
+        let source = r#"
+let g = null
+fun echo() {
+    for (x in g) {
+        yield x
+    }
+}
+g = echo()
+list(g)
+"#;
+        assert!(run(source, &mut VM::new()).unwrap_err().contains("already running"));
+        let error = run("fun f() {\n yield 1\n}\nlist(map(1, f()))", &mut VM::new()).unwrap_err();
+        assert!(error.contains("not callable"));
+    }
+
+    #[test]
+    fn test_vm_async() {
+        // await はフレームを中断してほかのタスクに譲るので、sleep は並行に進む
+        let started = std::time::Instant::now();
+        let source = r#"
+async fun work(name, seconds) {
+    await sleep(seconds)
+    return name + "!"
+}
+async fun twice(name) {
+    let first = await work(name, 0.1)
+    return first + await work(name, 0.1)
+}
+fun double(x) {
+    return x * 2
+}
+fun plain(task) {
+    return await task
+}
+let tasks = [twice(str(i)) for i in range(0, 50)]
+let all = await gather(tasks)
+str(all[0]) + str(all[49]) + str(len(all)) + str(task_done(tasks[7])) + str(await spawn(double, 21)) + plain(work("p", 0))
+"#;
+        // 中断したフレームはヒープに置かれるため、タスクがいくつあってもフレームは増えない
+        let mut vm = VM::with_max_frames(8);
+        assert_eq!(run(source, &mut vm).unwrap().to_string(), "0!0!49!49!50true42p!");
+        assert!(started.elapsed() < std::time::Duration::from_millis(350));
+
+        let started = std::time::Instant::now();
+        let source = "async fun slow() {\n await sleep(5)\n}\nasync fun quick() {\n return 7\n}\nawait timeout(quick(), 1)\nawait timeout(slow(), 0.05)";
+        // ツリー走査インタプリタと同じメッセージになる
+        let error = run(source, &mut VM::new()).unwrap_err();
+        assert_eq!(error, "Task slow timed out after 0.05 seconds");
+        assert!(started.elapsed() < std::time::Duration::from_secs(1));
+
+        // 失敗は await したところに伝わり、gather は最初の失敗で終わる
+        let source = "async fun bad() {\n await sleep(0)\n return 1 + null\n}\nasync fun outer() {\n return await bad()\n}\nawait gather(outer(), sleep(5))";
+        assert!(run(source, &mut VM::new()).unwrap_err().contains("Cannot add number and null"));
+        let source = "let t = null\nasync fun me() {\n return await t\n}\nt = me()\nawait t";
+        assert!(run(source, &mut VM::new()).unwrap_err().contains("Deadlock: task me can never complete"));
+        assert!(run("await 1", &mut VM::new()).unwrap_err().contains("Cannot await number"));
+        assert!(run("sleep(-1)", &mut VM::new()).is_err());
+    }
+
+    #[test]
+    fn test_vm_sleep_statement() {
+        // sleep は await したときだけ待つ（async 関数の中ではほかのタスクに譲る）
+        let started = std::time::Instant::now();
+        let source = r#"
+let start = get_time()
+async fun nap(label) {
+    await sleep(0.05)
+    return label
+}
+fun pause() {
+    await sleep(0.05)
+}
+let steps = 0
+sleep(5)
+await sleep(0.05)
+pause()
+for (i in range(0, 2)) {
+    if (i >= 0) {
+        await sleep(0.025)
+    }
+    steps = steps + 1
+}
+let both = await gather(nap("a"), nap("b"))
+let timer = sleep(5)
+str(both) + str(steps) + str(task_done(timer)) + str(get_time() - start >= 0.2)
+"#;
+        assert_eq!(run(source, &mut VM::new()).unwrap().to_string(), "[a, b]2falsetrue");
+        let elapsed = started.elapsed();
+        assert!(elapsed >= std::time::Duration::from_millis(200), "{:?}", elapsed);
+        assert!(elapsed < std::time::Duration::from_millis(450), "{:?}", elapsed);
     }
 }
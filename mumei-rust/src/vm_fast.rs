@@ -2,7 +2,6 @@
 /// SIMD最適化とinline最適化により極限まで高速化
 
 use crate::bytecode::{ByteCode, Instruction};
-use crate::value::Value;
 
 /// 数値演算専用の超高速実行（SIMD最適化）
 #[inline(always)]
@@ -12,8 +11,9 @@ pub fn execute_numeric_fast(bytecode: &ByteCode) -> Result<f64, String> {
 
     for instruction in &bytecode.instructions {
         match instruction {
-            Instruction::LoadConst(Value::Number(n)) => {
-                stack.push(*n);
+            Instruction::LoadConst(index) => {
+                let n = bytecode.number_constant(*index).ok_or("Non-numeric constant in fast path")?;
+                stack.push(n);
             }
 
             Instruction::Add => {
@@ -75,7 +75,9 @@ pub fn execute_numeric_fast(bytecode: &ByteCode) -> Result<f64, String> {
 pub fn is_numeric_only(bytecode: &ByteCode) -> bool {
     for instruction in &bytecode.instructions {
         match instruction {
-            Instruction::LoadConst(Value::Number(_)) |
+            Instruction::LoadConst(index) if bytecode.number_constant(*index).is_some() => {
+                // OK
+            }
             Instruction::Add |
             Instruction::Subtract |
             Instruction::Multiply |
@@ -5,15 +5,46 @@
 
 import os
 import glob
+import subprocess
 import sys
 
-# Mumeiインタプリタをインポート
-sys.path.insert(0, os.path.dirname(__file__))
-from mumei import run_file
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RUST_DIR = os.path.join(ROOT, "mumei-rust")
+
+# 1ファイルあたりの制限時間（秒）。無限ループ・終わらないジェネレータを失敗として扱う
+TIMEOUT = 120
+
+
+def find_binary():
+    """Rust実装のmumeiバイナリを探す（MUMEI_BIN > release > debug、なければreleaseでビルド）"""
+    if os.environ.get("MUMEI_BIN"):
+        return os.environ["MUMEI_BIN"]
+    for profile in ("release", "debug"):
+        path = os.path.join(RUST_DIR, "target", profile, "mumei")
+        if os.path.exists(path):
+            return path
+    subprocess.run(["cargo", "build", "--release"], cwd=RUST_DIR, check=True)
+    return os.path.join(RUST_DIR, "target", "release", "mumei")
+
+
+def run_file(binary, path):
+    """exampleをRust実装で実行し、失敗したらエラー出力を例外にする"""
+    # .muc キャッシュを examples/ に残さない
+    env = dict(os.environ, MUMEI_NO_CACHE="1")
+    try:
+        result = subprocess.run([binary, path], env=env, timeout=TIMEOUT, capture_output=True, text=True)
+    except subprocess.TimeoutExpired:
+        raise RuntimeError(f"{TIMEOUT}秒以内に終わらなかった")
+    print(result.stdout)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or f"終了コード {result.returncode}")
+
 
 def test_examples():
     """全exampleファイルをテスト"""
 
+    os.chdir(ROOT)
+    binary = find_binary()
     examples_dir = "examples"
     example_files = sorted(glob.glob(f"{examples_dir}/*.mu"))
 
@@ -32,10 +63,10 @@ def test_examples():
         "discord_",  # Discord API必要
         "http_",     # HTTP接続必要
         "file_io_",  # ファイルI/O（既に実装済みなら削除）
-        "async_",    # async/await未実装
+        "async_demo",             # async_run・await_task・wait_all 未実装
+        "async_await_example",    # wait_all・throw 未実装
         "import_",   # import未実装
         "with_",     # with文未実装
-        "generator_" # generator未実装
     ]
 
     for example_file in example_files:
@@ -55,7 +86,7 @@ def test_examples():
 
         try:
             print(f"実行中...")
-            run_file(example_file)
+            run_file(binary, example_file)
             print(f"✅ 成功")
             results["success"].append(filename)
         except Exception as e: